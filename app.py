@@ -10,7 +10,8 @@ from google.cloud.firestore_v1.base_query import FieldFilter
 from collections import Counter, defaultdict
 
 # Importar get_counts_for_navbar do utils
-from utils import get_counts_for_navbar, set_db, get_db, login_required, admin_required, permission_required, get_all_endpoints, SAO_PAULO_TZ, parse_date_input, convert_doc_to_dict
+from utils import get_counts_for_navbar, set_db, get_db, login_required, admin_required, permission_required, get_all_endpoints, SAO_PAULO_TZ, parse_date_input, convert_doc_to_dict, get_background_job
+from pei_repository import PeiRepository
 from blueprints.users import register_users_routes
 from blueprints.professionals import register_professionals_routes
 from blueprints.patients import register_patients_routes
@@ -23,11 +24,18 @@ from blueprints.estoque import register_estoque_routes
 from blueprints.contas_a_pagar import register_contas_a_pagar_routes
 from blueprints.peis import peis_bp
 from blueprints.patrimonio import register_patrimonio_routes
+from blueprints.relatorios import register_relatorios_routes
+from blueprints.analytics import register_analytics_routes
 from blueprints.protocols import protocols_bp
 from blueprints.weekly_planning import weekly_planning_bp
 from blueprints.user_api import user_api_bp
 from blueprints.evaluations import evaluations_bp
 from blueprints.cargos import cargos_bp  # NOVO: Importar o blueprint de cargos
+from blueprints.notifications import notifications_bp
+from blueprints.daily_agenda import daily_agenda_bp
+from notifications import start_dispatcher
+from query_registry import register_query
+from appointment_cube import load_cube, schedule_cube_rebuild, slice_cube
 
 import google.generativeai as genai
 from PyPDF2 import PdfReader
@@ -84,6 +92,9 @@ except Exception as e:
 
 if _db_client_instance:
     set_db(_db_client_instance)
+    # Despachante contínuo do outbox de notificações (os leases permitem vários processos)
+    if os.environ.get('NOTIFICACOES_DESPACHANTE') == '1':
+        start_dispatcher(_db_client_instance)
 
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 if not os.getenv("GEMINI_API_KEY"):
@@ -287,6 +298,15 @@ def logout():
     session.clear()
     return jsonify({"success": True, "message": "Sessão do servidor limpa."})
 
+# Gráficos do painel: dias exibidos e status que contam como atendimento (lidos do cubo de agendamentos)
+PAINEL_JANELA_DIAS = 15
+PAINEL_STATUS_ATENDIMENTO = ('confirmado', 'concluido')
+
+# Consulta do painel (próximos atendimentos)
+register_query('painel.proximos_agendamentos', 'clinicas/{clinica_id}/agendamentos',
+               equality=('status', 'profissional_id'), range_fields=('data_agendamento_ts',),
+               order_by=('data_agendamento_ts',), optional=('profissional_id',))
+
 @app.route('/', endpoint='index')
 @login_required
 @permission_required('index') # NOVO: Decorador de permissão
@@ -374,6 +394,7 @@ def index():
     pacientes_pei_mental_map_data = {}
 
     try:
+        pei_repository = PeiRepository(db_instance, clinica_id)
         all_patients_docs = pacientes_ref.order_by('nome').stream()
         for patient_doc in all_patients_docs:
             patient_id = patient_doc.id
@@ -403,33 +424,21 @@ def index():
 
             for pei_doc in patient_peis_query.stream():
                 total_active_peis_patient += 1
-                metas_ref = peis_ref.document(pei_doc.id).collection('metas')
-                metas_docs = metas_ref.stream()
-
-                for meta_doc in metas_docs:
+                # A árvore de metas vem embutida no próprio PEI (uma leitura por PEI)
+                for meta in pei_repository.get_tree(pei_doc):
                     total_metas_patient += 1
-                    meta_data = meta_doc.to_dict()
-                    meta_status = meta_data.get('status', '')
-                    
-                    if meta_status == 'Finalizado':
+                    if meta.get('status', '') == 'Finalizado':
                         completed_metas_patient += 1
-                    
-                    alvos_ref = metas_ref.document(meta_doc.id).collection('alvos')
-                    alvos_docs = alvos_ref.stream()
 
-                    for alvo_doc in alvos_docs:
+                    for alvo in meta.get('alvos', []):
                         total_targets_patient += 1
-                        if alvo_doc.to_dict().get('status') == 'finalizada':
+                        if alvo.get('status') == 'Finalizado':
                             completed_targets_patient += 1
-                        
-                        ajudas_ref = alvos_ref.document(alvo_doc.id).collection('ajudas')
-                        ajudas_docs = ajudas_ref.stream()
-                        for ajuda_doc in ajudas_docs:
-                            ajuda_data = ajuda_doc.to_dict()
-                            sigla = ajuda_data.get('sigla')
-                            attempts_count = ajuda_data.get('attempts_count', 0)
+
+                        for ajuda in alvo.get('ajudas', []):
+                            sigla = ajuda.get('sigla')
                             if sigla:
-                                aids_attempts_by_type[sigla] += attempts_count
+                                aids_attempts_by_type[sigla] += ajuda.get('attempts_count', 0)
                                 aids_counts_by_type[sigla] += 1
                     
             progress_percentage = 0
@@ -467,73 +476,52 @@ def index():
         print(f"Erro ao calcular progresso de PEIs por paciente: {e}")
         flash("Erro ao carregar progresso de PEIs por paciente.", "danger")
 
-    agendamentos_para_analise = []
-    try:
-        query_analise = agendamentos_ref.where(
-            filter=FieldFilter('status', 'in', ['confirmado', 'concluido'])
-        ).where(
-            filter=FieldFilter('data_agendamento_ts', '>=', hoje_dt - datetime.timedelta(days=15))
-        )
-
-        if user_role != 'admin':
-            if profissional_id_logado:
-                query_analise = query_analise.where(
-                    filter=FieldFilter('profissional_id', '==', profissional_id_logado)
-                )
-            else:
-                agendamentos_para_analise = []
-
-        if user_role == 'admin' or profissional_id_logado:
-            docs_analise = query_analise.stream()
-            for doc in docs_analise:
-                ag_data = doc.to_dict()
-                if ag_data:
-                    agendamentos_para_analise.append(ag_data)
-
-    except Exception as e:
-        print(f"Erro na consulta de agendamentos para o painel: {e}")
-        flash("Erro ao calcular estatísticas do painel. Verifique seus índices do Firestore.", "danger")
-
-    atendimentos_por_dia = Counter()
+    # Séries dos gráficos: atendimentos e receita (concluídos) dos últimos dias e os mais frequentes
+    # do mês, somados no cubo de agendamentos em vez de ler os agendamentos
     hoje_date = hoje_dt.date()
-    for i in range(15):
-        data = hoje_date - datetime.timedelta(days=i)
-        atendimentos_por_dia[data] = 0
-
-    for ag in agendamentos_para_analise:
-        ag_ts = ag.get('data_agendamento_ts')
-        if ag_ts:
-          ag_date = ag_ts.date()
-          if (hoje_date - ag_date).days < 15:
-              atendimentos_por_dia[ag_date] += 1
-
-    labels_atend_receita = sorted(atendimentos_por_dia.keys())
+    inicio_janela = hoje_date - datetime.timedelta(days=PAINEL_JANELA_DIAS - 1)
+    inicio_mes = hoje_date.replace(day=1)
+    fim_mes = (inicio_mes + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+    atendimentos_por_dia = Counter()
+    receitas_por_dia = defaultdict(float)
+    contagem_procedimento = Counter()
+    atendimentos_por_profissional = Counter()
+    if user_role == 'admin' or profissional_id_logado:
+        try:
+            # Carga inicial do cubo ou, uma vez por dia, a correção dos meses recentes
+            schedule_cube_rebuild(db_instance, clinica_id)
+            profissional_ids = [profissional_id_logado] if user_role != 'admin' else None
+            docs_cubo = load_cube(db_instance, clinica_id, min(inicio_janela, inicio_mes), fim_mes, profissional_ids)
+
+            janela = slice_cube(docs_cubo, inicio_janela, hoje_date, ('dia', 'status'), profissional_ids,
+                                status=PAINEL_STATUS_ATENDIMENTO)
+            for linha in janela['linhas']:
+                atendimentos_por_dia[linha['dia']] += linha['qtd']
+                if linha['status'] == 'concluido':
+                    receitas_por_dia[linha['dia']] += linha['receita']
+
+            mes = slice_cube(docs_cubo, inicio_mes, fim_mes, ('servico', 'profissional'), profissional_ids,
+                             status=PAINEL_STATUS_ATENDIMENTO)
+            for linha in mes['linhas']:
+                contagem_procedimento[mes['servicos'].get(linha['servico'], 'Desconhecido')] += linha['qtd']
+                atendimentos_por_profissional[mes['profissionais'].get(linha['profissional'], 'Desconhecido')] += linha['qtd']
+        except Exception as e:
+            print(f"Erro ao ler o cubo de agendamentos para o painel: {e}")
+            flash("Erro ao calcular estatísticas do painel.", "danger")
+
+    labels_atend_receita = [inicio_janela + datetime.timedelta(days=i) for i in range(PAINEL_JANELA_DIAS)]
     dados_atendimento_vs_receita = {
         "labels": [label.strftime('%d/%m') for label in labels_atend_receita],
-        "atendimentos": [atendimentos_por_dia[label] for label in labels_atend_receita],
-        "receitas": [0 for _ in labels_atend_receita]
+        "atendimentos": [atendimentos_por_dia[label.isoformat()] for label in labels_atend_receita],
+        "receitas": [round(receitas_por_dia[label.isoformat()], 2) for label in labels_atend_receita]
     }
 
-    contagem_procedimento = Counter()
-    for ag in agendamentos_para_analise:
-        ag_ts = ag.get('data_agendamento_ts')
-        if ag_ts and ag_ts.month == hoje_dt.month and ag_ts.year == hoje_dt.year:
-            nome_proc = ag.get('servico_procedimento_nome', 'Desconhecido')
-            contagem_procedimento[nome_proc] += 1
-
     top_5_procedimentos = contagem_procedimento.most_common(5)
     dados_receita_procedimento = {
         "labels": [item[0] for item in top_5_procedimentos],
         "valores": [item[1] for item in top_5_procedimentos]
     }
 
-    atendimentos_por_profissional = Counter()
-    for ag in agendamentos_para_analise:
-        ag_ts = ag.get('data_agendamento_ts')
-        if ag_ts and ag_ts.month == hoje_dt.month and ag_ts.year == hoje_dt.year:
-            nome_prof = ag.get('profissional_nome', 'Desconhecido')
-            atendimentos_por_profissional[nome_prof] += 1
-
     top_5_profissionais = atendimentos_por_profissional.most_common(5)
     dados_desempenho_profissional = {
         "labels": [item[0] for item in top_5_profissionais],
@@ -616,6 +604,16 @@ def busca_peis():
 
     return render_template('busca_peis.html', pacientes=pacientes_lista, current_year=datetime.datetime.now(SAO_PAULO_TZ).year)
 
+@app.route('/api/jobs/<string:job_id>', methods=['GET'], endpoint='status_job')
+@login_required
+def status_job(job_id):
+    """Retorna o progresso de um job em segundo plano (ex.: exclusão em cascata)."""
+    job = get_background_job(job_id)
+    if not job or job.get('clinica_id') != session.get('clinica_id'):
+        return jsonify({'success': False, 'message': 'Job não encontrado.'}), 404
+    job.pop('clinica_id', None)
+    return jsonify({'success': True, 'job': job}), 200
+
 @app.route('/protocols/import_from_ai', methods=['POST'])
 @login_required
 @admin_required # Mantém a restrição de administrador para importação de protocolo via IA
@@ -833,11 +831,15 @@ register_estoque_routes(app)
 register_contas_a_pagar_routes(app)
 app.register_blueprint(peis_bp)
 register_patrimonio_routes(app)
+register_relatorios_routes(app)
+register_analytics_routes(app)
 app.register_blueprint(protocols_bp)
 app.register_blueprint(weekly_planning_bp)
 app.register_blueprint(user_api_bp)
 app.register_blueprint(evaluations_bp)
 app.register_blueprint(cargos_bp) # NOVO: Registro do blueprint de cargos
+app.register_blueprint(notifications_bp)
+app.register_blueprint(daily_agenda_bp)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5001)), debug=True)
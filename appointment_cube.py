@@ -0,0 +1,336 @@
+import datetime
+import threading
+import time
+from collections import defaultdict
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ, start_background_job
+from query_registry import exempt_field, register_query
+
+# =================================================================
+# CUBO DE PRODUTIVIDADE E RECEITA DOS AGENDAMENTOS
+# =================================================================
+#
+# Contagens e receita (servico_procedimento_preco) por dia x profissional x serviço x status ficam em
+# um documento por mês, clinicas/{id}/agendamentos_cubo/{AAAA-MM}:
+#   celulas.{profissional_id}.{DD}.{servico_id}.{status} = {'qtd', 'receita'}
+#   profissionais.{id} / servicos.{id} = nome (para os rótulos)
+# O profissional vem primeiro para que o recorte de um profissional leia só o ramo dele.
+# Cada gravação de agendamento que atualiza a agenda diária grava também os incrementos do cubo
+# (cube_operations, no mesmo batch/transação); agendamentos excluídos saem do cubo.
+# cube_slice responde a recortes (datas, profissionais, serviços, status) agrupados por qualquer
+# combinação de CUBO_DIMENSOES sem ler 'agendamentos'. rebuild_cube recalcula os meses a partir dos
+# agendamentos, um mês por transação (carga inicial e, diariamente, os meses recentes como correção).
+
+CUBO_DIMENSOES = ('mes', 'dia', 'profissional', 'servico', 'status')
+
+# Chaves usadas quando o agendamento não tem profissional ou serviço
+CUBO_SEM_PROFISSIONAL = 'sem_profissional'
+CUBO_SEM_SERVICO = 'sem_servico'
+
+# Maior intervalo aceito por consulta (meses)
+CUBO_MESES_MAXIMO = 36
+
+# Meses recalculados pela reconstrução: os CUBO_MESES_RECONSTRUCAO até o atual e os seguintes
+# (ocorrências de séries já materializadas)
+CUBO_MESES_RECONSTRUCAO = 24
+CUBO_MESES_FUTUROS = 3
+
+# Meses até o atual recalculados pela correção diária, depois da carga inicial
+CUBO_MESES_CORRECAO = 2
+
+# Intervalo mínimo (segundos) entre duas reconstruções automáticas de uma clínica
+CUBO_RECONSTRUCAO_INTERVALO_SEGUNDOS = 24 * 3600
+
+# Incrementar quando o formato das células mudar: força a reconstrução
+CUBO_VERSAO = 1
+
+_CAMPOS_AGENDAMENTO = ['data_agendamento', 'data_agendamento_ts', 'status', 'profissional_id', 'profissional_nome',
+                       'servico_procedimento_id', 'servico_procedimento_nome', 'servico_procedimento_preco']
+
+_prontos = set()
+_ultima_reconstrucao = {}
+_ultima_reconstrucao_lock = threading.Lock()
+
+exempt_field('clinicas/{clinica_id}/agendamentos_cubo', 'celulas')
+register_query('cubo.agendamentos_do_mes', 'clinicas/{clinica_id}/agendamentos',
+               range_fields=('data_agendamento',))
+
+
+def _clinica_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id)
+
+def _cubo_ref(db_instance, clinica_id):
+    return _clinica_ref(db_instance, clinica_id).collection('agendamentos_cubo')
+
+def _controle_ref(db_instance, clinica_id):
+    return _clinica_ref(db_instance, clinica_id).collection('agendamentos_cubo_controle').document('geral')
+
+def _month_index(day):
+    return day.year * 12 + day.month - 1
+
+def _month_key(index):
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def months_between(inicio, fim):
+    """Meses (AAAA-MM) de inicio a fim (datas), inclusive."""
+    return [_month_key(index) for index in range(_month_index(inicio), _month_index(fim) + 1)]
+
+def parse_period(periodo):
+    """
+    Datas (inicio, fim) de um período 'AAAA-MM' (mês), 'AAAA-Tn' (trimestre, n de 1 a 4) ou 'AAAA' (ano).
+    Levanta ValueError se o formato é inválido.
+    """
+    periodo = (periodo or '').strip().upper()
+    if len(periodo) == 4 and periodo.isdigit():
+        return datetime.date(int(periodo), 1, 1), datetime.date(int(periodo), 12, 31)
+    if len(periodo) == 7 and periodo[4:6] == '-T' and periodo[6] in '1234':
+        ano, primeiro = int(periodo[:4]), (int(periodo[6]) - 1) * 3 + 1
+        inicio, ultimo_mes = datetime.date(ano, primeiro, 1), datetime.date(ano, primeiro + 2, 1)
+    else:
+        inicio = ultimo_mes = datetime.datetime.strptime(periodo, '%Y-%m').date()
+    return inicio, (ultimo_mes + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+
+def _price(agendamento):
+    try:
+        return float(agendamento.get('servico_procedimento_preco') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _day(agendamento):
+    data = agendamento.get('data_agendamento')
+    if isinstance(data, str):
+        try:
+            return datetime.date.fromisoformat(data)
+        except ValueError:
+            pass
+    ts = agendamento.get('data_agendamento_ts')
+    if isinstance(ts, datetime.datetime):
+        return ts.astimezone(SAO_PAULO_TZ).date()
+    return None
+
+def cube_cell(agendamento):
+    """(mês, dia DD, profissional_id, servico_id, status) do agendamento no cubo, ou None se ele não conta."""
+    if not agendamento or not agendamento.get('status') or agendamento.get('status') == 'excluido':
+        return None
+    day = _day(agendamento)
+    if day is None:
+        return None
+    return (day.strftime('%Y-%m'), day.strftime('%d'), agendamento.get('profissional_id') or CUBO_SEM_PROFISSIONAL,
+            agendamento.get('servico_procedimento_id') or CUBO_SEM_SERVICO, agendamento['status'])
+
+def _accumulate(mudancas):
+    """Saldo por mês e célula [qtd, receita] e nomes vistos, das mudanças [(antes, depois)]."""
+    deltas = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+    nomes = defaultdict(lambda: {'profissionais': {}, 'servicos': {}})
+    for antes, depois in mudancas:
+        for agendamento, sinal in ((antes, -1), (depois, 1)):
+            cell = cube_cell(agendamento)
+            if not cell:
+                continue
+            saldo = deltas[cell[0]][cell[1:]]
+            saldo[0] += sinal
+            saldo[1] += sinal * _price(agendamento)
+            if sinal > 0:
+                if agendamento.get('profissional_nome'):
+                    nomes[cell[0]]['profissionais'][cell[2]] = agendamento['profissional_nome']
+                if agendamento.get('servico_procedimento_nome'):
+                    nomes[cell[0]]['servicos'][cell[3]] = agendamento['servico_procedimento_nome']
+    return deltas, nomes
+
+def _cells_map(celulas, valor):
+    """Mapa aninhado profissional -> dia -> serviço -> status a partir de {(dia, prof, serv, status): saldo}."""
+    mapa = {}
+    for (dia, profissional_id, servico_id, status), saldo in celulas.items():
+        mapa.setdefault(profissional_id, {}).setdefault(dia, {}).setdefault(servico_id, {})[status] = valor(saldo)
+    return mapa
+
+def cube_operations(db_instance, clinica_id, mudancas):
+    """
+    Gravações [('merge', referência, dados)] que levam o cubo de cada 'antes' para o 'depois' correspondente
+    (dados completos do agendamento; None quando ele não existia/deixou de existir), uma por mês afetado.
+    """
+    deltas, nomes = _accumulate(mudancas)
+    operations = []
+    for mes in sorted(deltas):
+        # Alterações que não mudam a célula nem o preço (observações, horário...) não gravam no cubo
+        celulas = {cell: saldo for cell, saldo in deltas[mes].items() if saldo[0] or round(saldo[1], 2)}
+        if not celulas:
+            continue
+        data = {campo: valores for campo, valores in nomes[mes].items() if valores}
+        data.update({
+            'mes': mes,
+            'celulas': _cells_map(celulas, lambda saldo: {'qtd': firestore.Increment(saldo[0]),
+                                                          'receita': firestore.Increment(round(saldo[1], 2))}),
+            'atualizado_em': firestore.SERVER_TIMESTAMP,
+        })
+        operations.append(('merge', _cubo_ref(db_instance, clinica_id).document(mes), data))
+    return operations
+
+
+# --- Consulta ---
+
+def load_cube(db_instance, clinica_id, inicio, fim, profissional_ids=None):
+    """
+    Documentos mensais do cubo entre as datas inicio e fim, numa única leitura. Com profissional_ids,
+    só os ramos desses profissionais são transferidos.
+    """
+    meses = months_between(inicio, fim)
+    if len(meses) > CUBO_MESES_MAXIMO:
+        raise ValueError(f'O período pode ter no máximo {CUBO_MESES_MAXIMO} meses.')
+    field_paths = None
+    if profissional_ids:
+        field_paths = ['mes', 'profissionais', 'servicos'] + [firestore.FieldPath('celulas', profissional_id).to_api_repr()
+                                                             for profissional_id in profissional_ids]
+    refs = [_cubo_ref(db_instance, clinica_id).document(mes) for mes in meses]
+    return [dict(doc.to_dict() or {}, mes=doc.id) for doc in db_instance.get_all(refs, field_paths=field_paths) if doc.exists]
+
+def slice_cube(docs, inicio, fim, agrupar=('profissional',), profissional_ids=None, servico_ids=None, status=None):
+    """
+    Soma qtd e receita das células dos documentos (load_cube) entre inicio e fim que passam nos filtros,
+    agrupadas pelas dimensões de 'agrupar' (CUBO_DIMENSOES; vazio soma tudo).
+    Retorna {'linhas': [{dimensão: valor, ..., 'qtd', 'receita'}], 'totais': {'qtd', 'receita'},
+    'profissionais': {id: nome}, 'servicos': {id: nome}}; as linhas vêm em ordem de receita e quantidade.
+    """
+    desconhecidas = [dimensao for dimensao in agrupar if dimensao not in CUBO_DIMENSOES]
+    if desconhecidas:
+        raise ValueError(f"Dimensões inválidas: {', '.join(desconhecidas)}.")
+    profissional_ids = set(profissional_ids) if profissional_ids else None
+    servico_ids = set(servico_ids) if servico_ids else None
+    status = set(status) if status else None
+    inicio_iso, fim_iso = inicio.isoformat(), fim.isoformat()
+
+    grupos = defaultdict(lambda: [0, 0.0])
+    profissionais, servicos = {}, {}
+    for doc in docs:
+        mes = doc['mes']
+        profissionais.update(doc.get('profissionais') or {})
+        servicos.update(doc.get('servicos') or {})
+        for profissional_id, dias in (doc.get('celulas') or {}).items():
+            if profissional_ids is not None and profissional_id not in profissional_ids:
+                continue
+            for dia, por_servico in dias.items():
+                data = f'{mes}-{dia}'
+                if not inicio_iso <= data <= fim_iso:
+                    continue
+                for servico_id, por_status in por_servico.items():
+                    if servico_ids is not None and servico_id not in servico_ids:
+                        continue
+                    for status_celula, valores in por_status.items():
+                        if status is not None and status_celula not in status:
+                            continue
+                        chave = {'mes': mes, 'dia': data, 'profissional': profissional_id, 'servico': servico_id,
+                                 'status': status_celula}
+                        grupo = grupos[tuple(chave[dimensao] for dimensao in agrupar)]
+                        grupo[0] += valores.get('qtd') or 0
+                        grupo[1] += valores.get('receita') or 0
+
+    linhas = [dict(zip(agrupar, chave), qtd=qtd, receita=round(receita, 2))
+              for chave, (qtd, receita) in grupos.items() if qtd or round(receita, 2)]
+    linhas.sort(key=lambda linha: (-linha['receita'], -linha['qtd']))
+    return {
+        'linhas': linhas,
+        'totais': {'qtd': sum(linha['qtd'] for linha in linhas), 'receita': round(sum(linha['receita'] for linha in linhas), 2)},
+        'profissionais': profissionais,
+        'servicos': servicos,
+    }
+
+def cube_slice(db_instance, clinica_id, inicio, fim, agrupar=('profissional',), profissional_ids=None, servico_ids=None,
+               status=None):
+    """Recorte do cubo entre as datas inicio e fim (load_cube + slice_cube)."""
+    docs = load_cube(db_instance, clinica_id, inicio, fim, profissional_ids)
+    return slice_cube(docs, inicio, fim, agrupar, profissional_ids, servico_ids, status)
+
+
+# --- Reconstrução ---
+
+def _month_cells(celulas_map):
+    """{(dia, profissional, serviço, status): (qtd, receita)} de um mapa 'celulas' gravado, sem as zeradas."""
+    celulas = {}
+    for profissional_id, dias in (celulas_map or {}).items():
+        for dia, por_servico in dias.items():
+            for servico_id, por_status in por_servico.items():
+                for status, valores in por_status.items():
+                    qtd, receita = valores.get('qtd') or 0, round(valores.get('receita') or 0, 2)
+                    if qtd or receita:
+                        celulas[(dia, profissional_id, servico_id, status)] = (qtd, receita)
+    return celulas
+
+@firestore.transactional
+def _rebuild_month_in_transaction(transaction, db_instance, clinica_id, index):
+    """
+    Recalcula o documento de um mês lendo os agendamentos e o próprio documento na mesma transação: um
+    agendamento gravado no meio (que também incrementa o cubo) faz a transação ser repetida, sem perder
+    o incremento. Retorna (agendamentos contados, True se o documento mudou).
+    """
+    mes = _month_key(index)
+    cubo_doc_ref = _cubo_ref(db_instance, clinica_id).document(mes)
+    atual = cubo_doc_ref.get(transaction=transaction)
+    query = _clinica_ref(db_instance, clinica_id).collection('agendamentos')\
+        .where(filter=FieldFilter('data_agendamento', '>=', f'{mes}-01'))\
+        .where(filter=FieldFilter('data_agendamento', '<', f'{_month_key(index + 1)}-01'))\
+        .select(_CAMPOS_AGENDAMENTO)
+    deltas, nomes = _accumulate((None, doc.to_dict() or {}) for doc in query.stream(transaction=transaction))
+    celulas = {cell: saldo for cell, saldo in deltas[mes].items() if saldo[0]}
+    quantidade = sum(saldo[0] for saldo in celulas.values())
+    atual_data = atual.to_dict() or {}
+    if (atual.exists and _month_cells(atual_data.get('celulas'))
+            == {cell: (saldo[0], round(saldo[1], 2)) for cell, saldo in celulas.items()}
+            and (atual_data.get('profissionais') or {}) == nomes[mes]['profissionais']
+            and (atual_data.get('servicos') or {}) == nomes[mes]['servicos']):
+        return quantidade, False
+    transaction.set(cubo_doc_ref, {
+        'mes': mes,
+        'celulas': _cells_map(celulas, lambda saldo: {'qtd': saldo[0], 'receita': round(saldo[1], 2)}),
+        'profissionais': nomes[mes]['profissionais'],
+        'servicos': nomes[mes]['servicos'],
+        'atualizado_em': firestore.SERVER_TIMESTAMP,
+    })
+    return quantidade, True
+
+def rebuild_cube(db_instance, clinica_id, meses=CUBO_MESES_RECONSTRUCAO, progress_callback=None):
+    """
+    Recalcula os documentos do cubo dos 'meses' meses até o atual e dos CUBO_MESES_FUTUROS seguintes,
+    um mês por transação, a partir dos agendamentos. Só a reconstrução completa (CUBO_MESES_RECONSTRUCAO
+    meses) marca o cubo como pronto. Retorna {'meses', 'agendamentos', 'meses_corrigidos'}.
+    """
+    atual = _month_index(datetime.datetime.now(SAO_PAULO_TZ).date())
+    indices = list(range(atual - meses + 1, atual + CUBO_MESES_FUTUROS + 1))
+    total, corrigidos = 0, 0
+    for posicao, index in enumerate(indices):
+        quantidade, mudou = _rebuild_month_in_transaction(db_instance.transaction(), db_instance, clinica_id, index)
+        total += quantidade
+        corrigidos += mudou
+        if progress_callback:
+            progress_callback(posicao + 1, len(indices))
+    if meses >= CUBO_MESES_RECONSTRUCAO:
+        _controle_ref(db_instance, clinica_id).set({'versao': CUBO_VERSAO, 'primeiro_mes': _month_key(indices[0]),
+                                                    'gerado_em': firestore.SERVER_TIMESTAMP}, merge=True)
+        _prontos.add(clinica_id)
+    return {'meses': len(indices), 'agendamentos': total, 'meses_corrigidos': corrigidos}
+
+def cube_ready(db_instance, clinica_id):
+    """O cubo da clínica já foi construído na versão atual? (a resposta positiva fica em memória)"""
+    if clinica_id in _prontos:
+        return True
+    controle = _controle_ref(db_instance, clinica_id).get(field_paths=['versao'])
+    if (controle.to_dict() or {}).get('versao', 0) >= CUBO_VERSAO:
+        _prontos.add(clinica_id)
+        return True
+    return False
+
+def schedule_cube_rebuild(db_instance, clinica_id, force=False):
+    """
+    Agenda rebuild_cube em segundo plano, no máximo uma vez a cada CUBO_RECONSTRUCAO_INTERVALO_SEGUNDOS
+    por clínica (a menos que force=True): completa se o cubo ainda não está pronto ou com force=True;
+    senão, só os CUBO_MESES_CORRECAO meses recentes. Retorna o job_id ou None se não foi necessário.
+    """
+    now = time.monotonic()
+    with _ultima_reconstrucao_lock:
+        if not force and now - _ultima_reconstrucao.get(clinica_id, float('-inf')) < CUBO_RECONSTRUCAO_INTERVALO_SEGUNDOS:
+            return None
+        _ultima_reconstrucao[clinica_id] = now
+    meses = CUBO_MESES_RECONSTRUCAO if force or not cube_ready(db_instance, clinica_id) else CUBO_MESES_CORRECAO
+    return start_background_job('Cubo de agendamentos', rebuild_cube, db_instance, clinica_id, meses,
+                                clinica_id=clinica_id)
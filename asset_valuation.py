@@ -0,0 +1,240 @@
+import datetime
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ, start_background_job
+from query_registry import register_query
+
+# =================================================================
+# PATRIMÔNIO: DEPRECIAÇÃO, VALOR CONTÁBIL E ÍNDICE DE BUSCA
+# =================================================================
+#
+# Depreciação linear: (valor - valor residual) / vida útil em meses, a partir do mês de aquisição.
+# A vida útil é a do item (vida_util_meses, informada no formulário) ou a padrão do tipo. Uma tarefa
+# diária calcula numa só passada sobre os itens:
+#   - os campos derivados de cada item (depreciacao_mensal, depreciacao_acumulada, valor_contabil);
+#   - o retrato do mês em patrimonio_valor_mensal/{AAAA-MM}: totais e totais por tipo e por local.
+# Retratos de meses anteriores só são gravados se ainda não existem (o histórico não é reescrito).
+# A lista de itens e as opções do formulário de contas vêm de um índice por clínica em cache.
+
+PATRIMONIO_BATCH_SIZE = 400
+
+# Vida útil padrão (anos) por tipo; 0 = não depreciável. Tipos não listados usam VIDA_UTIL_ANOS_OUTROS.
+VIDA_UTIL_PADRAO_ANOS = {
+    'Móvel': 10, 'Mesa': 10, 'Armário': 10, 'Estante': 10, 'Arquivo': 10,
+    'Equipamento': 10, 'Instrumento Médico': 10, 'Ar Condicionado': 10, 'Eletrodoméstico': 10,
+    'Utensílio de Cozinha': 5, 'Ferramenta': 5,
+    'Computador/Notebook': 5, 'Impressora': 5, 'Telefone/Celular': 5, 'Câmera': 5, 'Projetor': 5,
+    'Software': 5, 'Licença': 5,
+    'Veículo': 5,
+    'Imóvel': 25,
+    'Material de Consumo': 0, 'Material de Limpeza': 0, 'Material de Escritório': 0,
+    'Documentação': 0, 'Protocolo de Avaliação': 0,
+}
+VIDA_UTIL_ANOS_OUTROS = 10
+
+# Meses anteriores ao atual com retrato gravado na primeira execução
+PATRIMONIO_RETRATO_MESES = 60
+
+# Intervalo mínimo (segundos) entre dois cálculos automáticos de uma clínica
+PATRIMONIO_CALCULO_INTERVALO_SEGUNDOS = 24 * 3600
+
+# Tempo (segundos) em que o índice de itens de uma clínica fica em cache
+PATRIMONIO_INDICE_TTL = 300
+
+_CAMPOS_INDICE = ('nome', 'codigo', 'tipo', 'local_armazenamento', 'valor', 'valor_residual', 'vida_util_meses',
+                  'data_aquisicao', 'data_cadastro', 'observacao')
+_CAMPOS_BUSCA = ('nome', 'codigo', 'tipo', 'local_armazenamento')
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+_ultimo_calculo = {}
+_ultimo_calculo_lock = threading.Lock()
+
+register_query('patrimonio.retratos', 'clinicas/{clinica_id}/patrimonio_valor_mensal',
+               range_fields=('mes',), order_by=(('mes', 'DESCENDING'),))
+
+
+def _patrimonio_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('patrimonio')
+
+def _retratos_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('patrimonio_valor_mensal')
+
+def _month_index(when):
+    return when.year * 12 + when.month - 1
+
+def _month_key(index):
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+def _normalize(text):
+    text = unicodedata.normalize('NFKD', str(text or ''))
+    return ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+
+def useful_life_months(item):
+    """Vida útil (meses) do item: a informada ou a padrão do tipo; 0 se não é depreciável."""
+    if item.get('vida_util_meses') is not None:
+        return max(0, int(item['vida_util_meses']))
+    return VIDA_UTIL_PADRAO_ANOS.get(item.get('tipo'), VIDA_UTIL_ANOS_OUTROS) * 12
+
+def depreciation_schedule(item):
+    """
+    Parâmetros da depreciação linear do item: {'inicio' (índice do mês de aquisição ou None), 'vida_util_meses',
+    'valor', 'valor_residual', 'depreciacao_mensal'}. Sem data de aquisição, usa a data de cadastro.
+    """
+    aquisicao = item.get('data_aquisicao') or item.get('data_cadastro')
+    valor = float(item.get('valor') or 0)
+    residual = min(valor, float(item.get('valor_residual') or 0))
+    vida = useful_life_months(item)
+    return {
+        'inicio': _month_index(aquisicao.astimezone(SAO_PAULO_TZ)) if isinstance(aquisicao, datetime.datetime) else None,
+        'vida_util_meses': vida,
+        'valor': valor,
+        'valor_residual': residual,
+        'depreciacao_mensal': round((valor - residual) / vida, 2) if vida else 0.0,
+    }
+
+def book_value(schedule, mes_index):
+    """(depreciação acumulada, valor contábil) no fim do mês mes_index; None se o item ainda não existia."""
+    if schedule['inicio'] is None:
+        return 0.0, schedule['valor']
+    meses = mes_index - schedule['inicio'] + 1
+    if meses <= 0:
+        return None
+    if not schedule['vida_util_meses']:
+        return 0.0, schedule['valor']
+    depreciavel = schedule['valor'] - schedule['valor_residual']
+    acumulada = round(depreciavel * min(meses, schedule['vida_util_meses']) / schedule['vida_util_meses'], 2)
+    return acumulada, round(schedule['valor'] - acumulada, 2)
+
+def _empty_totals():
+    return {'quantidade': 0, 'valor_aquisicao': 0.0, 'depreciacao_acumulada': 0.0, 'valor_contabil': 0.0}
+
+def _add_to(totais, item_valores):
+    totais['quantidade'] += 1
+    for campo in ('valor_aquisicao', 'depreciacao_acumulada', 'valor_contabil'):
+        totais[campo] = round(totais[campo] + item_valores[campo], 2)
+
+def month_snapshot(itens, mes_index):
+    """
+    Retrato do mês para [(item, schedule)]: totais gerais, por tipo e por local dos itens existentes
+    no fim do mês. Itens sem tipo ou local ficam em 'Sem tipo'/'Sem local'.
+    """
+    retrato = dict(_empty_totals(), mes=_month_key(mes_index), por_tipo=defaultdict(_empty_totals),
+                   por_local=defaultdict(_empty_totals))
+    for item, schedule in itens:
+        valores = book_value(schedule, mes_index)
+        if valores is None:
+            continue
+        item_valores = {'valor_aquisicao': schedule['valor'], 'depreciacao_acumulada': valores[0], 'valor_contabil': valores[1]}
+        _add_to(retrato, item_valores)
+        _add_to(retrato['por_tipo'][item.get('tipo') or 'Sem tipo'], item_valores)
+        _add_to(retrato['por_local'][item.get('local_armazenamento') or 'Sem local'], item_valores)
+    retrato['por_tipo'] = dict(retrato['por_tipo'])
+    retrato['por_local'] = dict(retrato['por_local'])
+    return retrato
+
+def compute_valuation(db_instance, clinica_id, progress_callback=None):
+    """
+    Calcula a depreciação de todos os itens numa passada: grava os campos derivados dos itens que
+    mudaram, o retrato do mês atual e os retratos que faltam dos PATRIMONIO_RETRATO_MESES anteriores.
+    Retorna {'itens', 'atualizados', 'retratos'}.
+    """
+    docs = list(_patrimonio_ref(db_instance, clinica_id).select(list(_CAMPOS_INDICE) + [
+        'depreciacao_mensal', 'depreciacao_acumulada', 'valor_contabil']).stream())
+    mes_atual = _month_index(datetime.datetime.now(SAO_PAULO_TZ))
+    itens, escritas = [], []
+    for doc in docs:
+        item = doc.to_dict() or {}
+        schedule = depreciation_schedule(item)
+        itens.append((item, schedule))
+        acumulada, contabil = book_value(schedule, max(mes_atual, schedule['inicio'] or mes_atual))
+        derivados = {'depreciacao_mensal': schedule['depreciacao_mensal'], 'depreciacao_acumulada': acumulada,
+                     'valor_contabil': contabil}
+        if any(item.get(campo) != valor for campo, valor in derivados.items()):
+            escritas.append(('update', doc.reference, derivados))
+
+    primeiro = max(mes_atual - PATRIMONIO_RETRATO_MESES,
+                   min((schedule['inicio'] for _, schedule in itens if schedule['inicio'] is not None), default=mes_atual))
+    existentes = {doc.id for doc in _retratos_ref(db_instance, clinica_id)
+                  .where(filter=FieldFilter('mes', '>=', _month_key(primeiro))).select([]).stream()}
+    retratos = [month_snapshot(itens, mes_index) for mes_index in range(primeiro, mes_atual + 1)
+                if mes_index == mes_atual or _month_key(mes_index) not in existentes]
+    escritas += [('set', _retratos_ref(db_instance, clinica_id).document(retrato['mes']),
+                  dict(retrato, gerado_em=firestore.SERVER_TIMESTAMP)) for retrato in retratos]
+
+    for start in range(0, len(escritas), PATRIMONIO_BATCH_SIZE):
+        batch = db_instance.batch()
+        for operacao, ref, data in escritas[start:start + PATRIMONIO_BATCH_SIZE]:
+            getattr(batch, operacao)(ref, data)
+        batch.commit()
+        if progress_callback:
+            progress_callback(min(start + PATRIMONIO_BATCH_SIZE, len(escritas)), len(escritas))
+    invalidate_asset_index(clinica_id)
+    return {'itens': len(itens), 'atualizados': len(escritas) - len(retratos), 'retratos': len(retratos)}
+
+def schedule_asset_valuation(db_instance, clinica_id, force=False):
+    """
+    Agenda compute_valuation em segundo plano, no máximo uma vez a cada PATRIMONIO_CALCULO_INTERVALO_SEGUNDOS
+    por clínica (a menos que force=True). Retorna o job_id ou None se não foi necessário.
+    """
+    now = time.monotonic()
+    with _ultimo_calculo_lock:
+        if not force and now - _ultimo_calculo.get(clinica_id, float('-inf')) < PATRIMONIO_CALCULO_INTERVALO_SEGUNDOS:
+            return None
+        _ultimo_calculo[clinica_id] = now
+    return start_background_job('Depreciação do patrimônio', compute_valuation, db_instance, clinica_id,
+                                clinica_id=clinica_id)
+
+def valuation_summary(db_instance, clinica_id, meses=1):
+    """
+    Os 'meses' retratos mais recentes (do mais recente para o mais antigo), lidos dos documentos
+    mensais: [{mes, quantidade, valor_aquisicao, depreciacao_acumulada, valor_contabil, por_tipo, por_local}].
+    """
+    query = _retratos_ref(db_instance, clinica_id).order_by('mes', direction=firestore.Query.DESCENDING).limit(meses)
+    return [dict(doc.to_dict() or {}, id=doc.id) for doc in query.stream()]
+
+
+# --- Índice de itens (lista e busca) ---
+
+def asset_index(db_instance, clinica_id):
+    """
+    Itens de patrimônio da clínica com os campos da lista e o valor contábil do mês, ordenados pelo nome e
+    cacheados por PATRIMONIO_INDICE_TTL. Cada item tem 'busca': nome, código, tipo e local normalizados.
+    """
+    now = time.monotonic()
+    with _indices_lock:
+        entry = _indices.get(clinica_id)
+        if entry and entry[0] > now:
+            return entry[1]
+
+    mes_atual = _month_index(datetime.datetime.now(SAO_PAULO_TZ))
+    itens = []
+    for doc in _patrimonio_ref(db_instance, clinica_id).select(list(_CAMPOS_INDICE)).stream():
+        item = dict(doc.to_dict() or {}, id=doc.id)
+        schedule = depreciation_schedule(item)
+        item['depreciacao_acumulada'], item['valor_contabil'] = book_value(schedule, max(mes_atual, schedule['inicio'] or mes_atual))
+        item['vida_util_meses'] = schedule['vida_util_meses']
+        item['busca'] = '\n'.join(_normalize(item.get(campo)) for campo in _CAMPOS_BUSCA)
+        itens.append(item)
+    itens.sort(key=lambda item: str(item.get('nome', '')).casefold())
+    with _indices_lock:
+        _indices[clinica_id] = (now + PATRIMONIO_INDICE_TTL, itens)
+    return itens
+
+def search_assets(itens, search_query):
+    """Itens cujo nome, código, tipo ou local contém search_query (sem acentos e maiúsculas)."""
+    chave = _normalize(search_query).strip()
+    if not chave:
+        return list(itens)
+    return [item for item in itens if chave in item['busca']]
+
+def invalidate_asset_index(clinica_id):
+    """Descarta o índice de itens da clínica após cadastrar, editar ou excluir itens."""
+    with _indices_lock:
+        _indices.pop(clinica_id, None)
@@ -0,0 +1,142 @@
+import csv
+import datetime
+import io
+import json
+from flask import has_request_context, session
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ
+from query_registry import register_query
+
+# =================================================================
+# AUDITORIA DE AGENDAMENTOS (somente inclusão, particionada por mês)
+# =================================================================
+#
+# Cada alteração de agendamento grava um evento em
+# clinicas/{id}/auditoria/{AAAA-MM}/eventos/{auto}, no mesmo batch/transação da alteração.
+# Eventos nunca são alterados. O histórico de um agendamento é uma consulta de grupo de
+# coleções em 'eventos' (clinica_id == X, agendamento_id == Y, ordenada por 'ts'), que
+# precisa do índice composto correspondente.
+
+# Campos comparados entre o antes e o depois de uma alteração
+CAMPOS_AUDITADOS = (
+    'status', 'data_agendamento', 'hora_agendamento', 'duracao_minutos', 'profissional_id', 'profissional_nome',
+    'servico_procedimento_id', 'servico_procedimento_nome', 'servico_procedimento_preco', 'paciente_nome',
+)
+
+# Tamanho da página lida do Firestore durante a exportação
+AUDITORIA_EXPORTACAO_PAGINA = 500
+
+AUDITORIA_HISTORICO_LIMITE = 200
+
+_COLUNAS_CSV = ('ts', 'agendamento_id', 'tipo', 'detalhes', 'status_anterior', 'status_novo', 'usuario_uid', 'usuario_nome', 'origem', 'alteracoes')
+
+
+def partition_key(when=None):
+    """Partição (AAAA-MM, horário de Brasília) de um instante."""
+    when = when or datetime.datetime.now(SAO_PAULO_TZ)
+    return when.astimezone(SAO_PAULO_TZ).strftime('%Y-%m')
+
+def _eventos_ref(db_instance, clinica_id, partition):
+    return db_instance.collection('clinicas').document(clinica_id).collection('auditoria')\
+        .document(partition).collection('eventos')
+
+def audit_ref(db_instance, clinica_id, when=None):
+    """Referência para um novo evento na partição do mês de 'when' (padrão: agora)."""
+    return _eventos_ref(db_instance, clinica_id, partition_key(when)).document()
+
+def _current_user():
+    if has_request_context():
+        return session.get('user_uid'), session.get('user_name')
+    return None, None
+
+def _comparable(value):
+    return value if isinstance(value, (str, int, float, bool)) or value is None else str(value)
+
+def audit_event(clinica_id, agendamento_id, tipo, detalhes, antes=None, depois=None, origem=None, **extra):
+    """
+    Dados de um evento de auditoria. antes/depois: campos do agendamento antes e depois da
+    alteração (parciais são aceitos); só os CAMPOS_AUDITADOS que mudaram são registrados.
+    """
+    antes, depois = antes or {}, depois or {}
+    alteracoes = {
+        campo: {'de': _comparable(antes.get(campo)), 'para': _comparable(depois[campo])}
+        for campo in CAMPOS_AUDITADOS
+        if campo in depois and _comparable(antes.get(campo)) != _comparable(depois[campo])
+    }
+    usuario_uid, usuario_nome = _current_user()
+    event = {
+        'clinica_id': clinica_id,
+        'agendamento_id': agendamento_id,
+        'tipo': tipo,
+        'detalhes': detalhes,
+        'status_anterior': antes.get('status'),
+        'status_novo': depois.get('status', antes.get('status')),
+        'alteracoes': alteracoes,
+        'usuario_uid': usuario_uid,
+        'usuario_nome': usuario_nome,
+        'origem': origem,
+        'ts': datetime.datetime.now(datetime.timezone.utc),
+        'criado_em': firestore.SERVER_TIMESTAMP,
+    }
+    event.update(extra)
+    return event
+
+def audit_operation(db_instance, clinica_id, agendamento_id, tipo, detalhes, antes=None, depois=None, origem=None, **extra):
+    """Operação ('set', referência, evento) no formato usado pelas gravações em lote da recorrência."""
+    return ('set', audit_ref(db_instance, clinica_id),
+            audit_event(clinica_id, agendamento_id, tipo, detalhes, antes, depois, origem, **extra))
+
+
+# --- Leitura ---
+
+def _serialize(event):
+    ts = event.get('ts')
+    return dict(event, ts=ts.astimezone(SAO_PAULO_TZ).isoformat() if isinstance(ts, datetime.datetime) else ts,
+                criado_em=None)
+
+register_query('auditoria.historico_do_agendamento', 'eventos', collection_group=True,
+               equality=('clinica_id', 'agendamento_id'), order_by=('ts',))
+
+def get_appointment_history(db_instance, clinica_id, agendamento_id, limit=AUDITORIA_HISTORICO_LIMITE):
+    """Eventos de um agendamento, do mais antigo ao mais recente (todas as partições)."""
+    query = db_instance.collection_group('eventos')\
+        .where(filter=FieldFilter('clinica_id', '==', clinica_id))\
+        .where(filter=FieldFilter('agendamento_id', '==', agendamento_id))\
+        .order_by('ts').limit(limit)
+    return [dict(_serialize(doc.to_dict() or {}), id=doc.id) for doc in query.stream()]
+
+def months_between(inicio, fim):
+    """Partições AAAA-MM de inicio a fim (datas), inclusive."""
+    index, last = inicio.year * 12 + inicio.month - 1, fim.year * 12 + fim.month - 1
+    return [f"{i // 12:04d}-{i % 12 + 1:02d}" for i in range(index, last + 1)]
+
+def iter_events(db_instance, clinica_id, partitions, page_size=AUDITORIA_EXPORTACAO_PAGINA):
+    """Percorre os eventos das partições em ordem de 'ts', página a página (sem carregar tudo)."""
+    for partition in partitions:
+        query = _eventos_ref(db_instance, clinica_id, partition).order_by('ts').limit(page_size)
+        last = None
+        while True:
+            page = list((query.start_after(last) if last else query).stream())
+            for doc in page:
+                yield dict(_serialize(doc.to_dict() or {}), id=doc.id)
+            if len(page) < page_size:
+                break
+            last = page[-1]
+
+def export_lines(events, formato='jsonl'):
+    """Gera as linhas da exportação (JSON por linha ou CSV com cabeçalho)."""
+    if formato == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(_COLUNAS_CSV)
+        for event in events:
+            writer.writerow([json.dumps(event.get(c), ensure_ascii=False) if c == 'alteracoes' else event.get(c) for c in _COLUNAS_CSV])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        yield buffer.getvalue()
+    else:
+        for event in events:
+            yield json.dumps(event, ensure_ascii=False, default=str) + '\n'
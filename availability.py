@@ -0,0 +1,391 @@
+import bisect
+import datetime
+import threading
+import time
+import pytz
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ
+from audit import audit_event, audit_ref
+from query_registry import register_query
+from appointment_cube import cube_operations
+from financial_reports import invalidate_financial_report, revenue_months
+
+# =================================================================
+# MOTOR DE DISPONIBILIDADE (horarios_disponiveis x agendamentos)
+# =================================================================
+#
+# - Os modelos semanais ficam em profissionais/{id}/horarios_disponiveis
+#   (dia_semana 0=Domingo ... 6=Sábado, hora_inicio/hora_fim 'HH:MM', intervalo_minutos).
+# - Os agendamentos ocupam [data_agendamento_ts, data_agendamento_ts + duracao_minutos).
+# - Os horários ocupados de cada dia ficam numa lista ordenada e mesclada de intervalos
+#   (IntervalSet); a verificação de sobreposição é uma busca binária.
+# - A disponibilidade semanal é cacheada por (clínica, profissional, semana) e invalidada
+#   a cada gravação de agendamento ou de horário.
+
+# Duração usada para agendamentos antigos, gravados sem 'duracao_minutos'
+DURACAO_PADRAO_MINUTOS = 60
+INTERVALO_PADRAO_MINUTOS = 30
+
+# Agendamentos com estes status não ocupam a agenda
+STATUS_QUE_LIBERAM_HORARIO = ('cancelado', 'excluido')
+
+# Quanto antes do início da janela buscar agendamentos que ainda podem estar em andamento
+_JANELA_RETROATIVA = datetime.timedelta(hours=12)
+
+DISPONIBILIDADE_CACHE_TTL = 120  # segundos
+
+# {(clinica_id, profissional_id, segunda-feira ISO): (resultado, expira_em)}
+_availability_cache = {}
+_availability_cache_lock = threading.Lock()
+
+# {clinica_id: versão}: incrementada a cada invalidação; outros caches da agenda a usam na chave
+_agenda_versions = {}
+
+
+class BookingConflictError(Exception):
+    """Agendamento recusado porque o profissional já tem outro atendimento no mesmo horário."""
+
+    def __init__(self, message, conflitos):
+        super().__init__(message)
+        self.conflitos = conflitos
+
+
+class IntervalSet:
+    """Intervalos [início, fim) ordenados e mesclados, com teste de sobreposição por busca binária."""
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(intervals):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def overlaps(self, start, end):
+        # Último intervalo que começa antes do fim do candidato
+        index = bisect.bisect_left(self.starts, end) - 1
+        return index >= 0 and self.ends[index] > start
+
+
+# --- Conversões de data/hora ---
+
+def _parse_time(hhmm):
+    hours, minutes = str(hhmm).split(':')[:2]
+    return datetime.time(int(hours), int(minutes))
+
+def _localize(day, hhmm):
+    return SAO_PAULO_TZ.localize(datetime.datetime.combine(day, _parse_time(hhmm)))
+
+def _to_sao_paulo(value):
+    if value.tzinfo is None:
+        return SAO_PAULO_TZ.localize(value)
+    return value.astimezone(SAO_PAULO_TZ)
+
+def js_weekday(day):
+    """Dia da semana no formato usado em horarios_disponiveis (0=Domingo ... 6=Sábado)."""
+    return (day.weekday() + 1) % 7
+
+def week_bounds(day):
+    """Retorna (segunda-feira, segunda-feira seguinte) da semana que contém 'day'."""
+    if isinstance(day, datetime.datetime):
+        day = day.date()
+    monday = day - datetime.timedelta(days=day.weekday())
+    return monday, monday + datetime.timedelta(days=7)
+
+def appointment_interval(agendamento):
+    """Intervalo [início, fim) de um agendamento, no fuso de São Paulo."""
+    start = agendamento.get('data_agendamento_ts')
+    if isinstance(start, datetime.datetime):
+        start = _to_sao_paulo(start)
+    else:
+        start = _localize(datetime.datetime.strptime(agendamento['data_agendamento'], '%Y-%m-%d').date(),
+                          agendamento['hora_agendamento'])
+    duration = int(agendamento.get('duracao_minutos') or DURACAO_PADRAO_MINUTOS)
+    return start, start + datetime.timedelta(minutes=duration)
+
+def occupies_schedule(agendamento):
+    return str(agendamento.get('status', '')).lower() not in STATUS_QUE_LIBERAM_HORARIO
+
+
+# --- Leitura ---
+
+def _agendamentos_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('agendamentos')
+
+def _booking_entry(agendamento_id, agendamento, start, end):
+    """Entrada de load_bookings para um agendamento, ou None se ele não ocupa [start, end)."""
+    if not occupies_schedule(agendamento):
+        return None
+    try:
+        booking_start, booking_end = appointment_interval(agendamento)
+    except (KeyError, ValueError, TypeError):
+        return None
+    if booking_end <= start or booking_start >= end:
+        return None
+    return {
+        'id': agendamento_id,
+        'inicio': booking_start,
+        'fim': booking_end,
+        'paciente_nome': agendamento.get('paciente_nome'),
+        'data_agendamento': agendamento.get('data_agendamento'),
+        'hora_agendamento': agendamento.get('hora_agendamento'),
+    }
+
+register_query('disponibilidade.agendamentos_do_profissional', 'clinicas/{clinica_id}/agendamentos',
+               equality=('profissional_id',), range_fields=('data_agendamento_ts',))
+
+def load_bookings(db_instance, clinica_id, profissional_id, start, end, ignore_id=None, transaction=None):
+    """
+    Agendamentos do profissional que ocupam algum instante de [start, end), incluindo as
+    ocorrências virtuais das séries (ainda não materializadas).
+    Retorna uma lista ordenada de dicionários {id, inicio, fim, paciente_nome, hora_agendamento}.
+    """
+    # Import local: recurrence depende deste módulo
+    from recurrence import virtual_occurrences
+
+    query = _agendamentos_ref(db_instance, clinica_id)\
+        .where(filter=FieldFilter('profissional_id', '==', profissional_id))\
+        .where(filter=FieldFilter('data_agendamento_ts', '>=', (start - _JANELA_RETROATIVA).astimezone(pytz.utc)))\
+        .where(filter=FieldFilter('data_agendamento_ts', '<', end.astimezone(pytz.utc)))
+    candidates = [(doc.id, doc.to_dict() or {}) for doc in query.stream(transaction=transaction)]
+    candidates += [(ag['id'], ag) for ag in virtual_occurrences(
+        db_instance, clinica_id, _to_sao_paulo(start - _JANELA_RETROATIVA).date(), _to_sao_paulo(end).date(),
+        profissional_id=profissional_id, transaction=transaction)]
+
+    bookings = []
+    for agendamento_id, agendamento in candidates:
+        if agendamento_id == ignore_id:
+            continue
+        booking = _booking_entry(agendamento_id, agendamento, start, end)
+        if booking:
+            bookings.append(booking)
+    bookings.sort(key=lambda b: b['inicio'])
+    return bookings
+
+def load_weekly_templates(db_instance, clinica_id, profissional_id):
+    """Modelos semanais ativos do profissional."""
+    horarios_ref = db_instance.collection('clinicas').document(clinica_id).collection('profissionais')\
+        .document(profissional_id).collection('horarios_disponiveis')
+    templates = []
+    for doc in horarios_ref.where(filter=FieldFilter('ativo', '==', True)).stream():
+        horario = doc.to_dict() or {}
+        try:
+            templates.append({
+                'dia_semana': int(horario['dia_semana']),
+                'hora_inicio': horario['hora_inicio'],
+                'hora_fim': horario['hora_fim'],
+                'intervalo_minutos': int(horario.get('intervalo_minutos') or INTERVALO_PADRAO_MINUTOS),
+            })
+        except (KeyError, ValueError, TypeError) as e:
+            print(f"Horário {doc.id} do profissional {profissional_id} ignorado: {e}")
+    return templates
+
+def find_conflicts(bookings, start, end):
+    """Agendamentos de 'bookings' que se sobrepõem a [start, end)."""
+    return [b for b in bookings if b['inicio'] < end and b['fim'] > start]
+
+
+# --- Cálculo ---
+
+def compute_week_availability(templates, bookings, week_start):
+    """
+    Combina os modelos semanais com os agendamentos da semana.
+    Para cada dia retorna os horários livres (início de cada intervalo do modelo que não
+    se sobrepõe a nenhum agendamento) e os ocupados.
+    """
+    busy = IntervalSet((b['inicio'], b['fim']) for b in bookings)
+    dias = []
+    for offset in range(7):
+        day = week_start + datetime.timedelta(days=offset)
+        weekday = js_weekday(day)
+        livres = []
+        for template in sorted((t for t in templates if t['dia_semana'] == weekday), key=lambda t: t['hora_inicio']):
+            step = datetime.timedelta(minutes=template['intervalo_minutos'])
+            slot_start = _localize(day, template['hora_inicio'])
+            window_end = _localize(day, template['hora_fim'])
+            while slot_start + step <= window_end:
+                if not busy.overlaps(slot_start, slot_start + step):
+                    livres.append(slot_start.strftime('%H:%M'))
+                slot_start += step
+        ocupados = [
+            {
+                'agendamento_id': b['id'],
+                'inicio': b['inicio'].strftime('%H:%M'),
+                'fim': b['fim'].strftime('%H:%M'),
+                'paciente_nome': b['paciente_nome'],
+            }
+            for b in bookings if b['inicio'].date() == day
+        ]
+        dias.append({
+            'data': day.isoformat(),
+            'dia_semana': weekday,
+            'livres': sorted(set(livres)),
+            'ocupados': ocupados,
+        })
+    return dias
+
+def get_weekly_availability(db_instance, clinica_id, profissional_id, day):
+    """Disponibilidade da semana que contém 'day', com cache por (profissional, semana)."""
+    week_start, week_end = week_bounds(day)
+    key = (clinica_id, profissional_id, week_start.isoformat())
+    now = time.monotonic()
+    with _availability_cache_lock:
+        cached = _availability_cache.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+
+    templates = load_weekly_templates(db_instance, clinica_id, profissional_id)
+    bookings = load_bookings(
+        db_instance, clinica_id, profissional_id,
+        SAO_PAULO_TZ.localize(datetime.datetime.combine(week_start, datetime.time.min)),
+        SAO_PAULO_TZ.localize(datetime.datetime.combine(week_end, datetime.time.min)),
+    )
+    result = {
+        'profissional_id': profissional_id,
+        'semana_inicio': week_start.isoformat(),
+        'semana_fim': (week_end - datetime.timedelta(days=1)).isoformat(),
+        'dias': compute_week_availability(templates, bookings, week_start),
+    }
+    with _availability_cache_lock:
+        _availability_cache[key] = (result, now + DISPONIBILIDADE_CACHE_TTL)
+    return result
+
+def invalidate_availability(clinica_id, profissional_id, day=None):
+    """Descarta o cache da semana de 'day' (ou de todas as semanas) do profissional."""
+    with _availability_cache_lock:
+        _agenda_versions[clinica_id] = _agenda_versions.get(clinica_id, 0) + 1
+        if day is not None:
+            _availability_cache.pop((clinica_id, profissional_id, week_bounds(day)[0].isoformat()), None)
+            return
+        for key in [k for k in _availability_cache if k[0] == clinica_id and k[1] == profissional_id]:
+            _availability_cache.pop(key, None)
+
+def invalidate_clinic_availability(clinica_id):
+    """Descarta o cache de todos os profissionais da clínica (quando o profissional não é conhecido)."""
+    with _availability_cache_lock:
+        _agenda_versions[clinica_id] = _agenda_versions.get(clinica_id, 0) + 1
+        for key in [k for k in _availability_cache if k[0] == clinica_id]:
+            _availability_cache.pop(key, None)
+
+def agenda_version(clinica_id):
+    """Versão atual da agenda da clínica (muda a cada gravação de agendamento ou horário)."""
+    with _availability_cache_lock:
+        return _agenda_versions.get(clinica_id, 0)
+
+def invalidate_for_appointment(clinica_id, agendamento):
+    """Invalida a semana ocupada por um agendamento (dados antes ou depois da alteração)."""
+    if agendamento and agendamento.get('profissional_id'):
+        try:
+            invalidate_availability(clinica_id, agendamento['profissional_id'], appointment_interval(agendamento)[0])
+        except (KeyError, ValueError, TypeError):
+            invalidate_availability(clinica_id, agendamento['profissional_id'])
+
+
+# --- Gravação com verificação de conflito ---
+
+def _conflict_message(conflitos):
+    descricoes = [f"{c['inicio'].strftime('%d/%m/%Y %H:%M')}-{c['fim'].strftime('%H:%M')}"
+                  + (f" ({c['paciente_nome']})" if c.get('paciente_nome') else '') for c in conflitos]
+    return "O profissional já possui agendamento neste horário: " + "; ".join(descricoes)
+
+def _interval_or_none(agendamento):
+    try:
+        return appointment_interval(agendamento)
+    except (KeyError, ValueError, TypeError):
+        return None  # Agendamento antigo sem data/hora válidas
+
+def needs_conflict_check(original, merged):
+    """
+    Se a gravação de 'merged' (dados finais) precisa verificar sobreposição: só quando ele passa a ocupar
+    a agenda (criação, reativação) ou muda de horário, duração ou profissional. Assim agendamentos
+    antigos já sobrepostos continuam podendo ser confirmados, concluídos ou editados.
+    """
+    if not merged.get('profissional_id') or not occupies_schedule(merged):
+        return False
+    if not original or not occupies_schedule(original):
+        return True
+    return (original.get('profissional_id') != merged.get('profissional_id')
+            or _interval_or_none(original) != _interval_or_none(merged))
+
+@firestore.transactional
+def _save_in_transaction(transaction, db_instance, clinica_id, doc_ref, data, is_update, audit=None):
+    # O agendamento é relido na transação: conflitos, auditoria, agenda diária e cubo partem do
+    # documento gravado, e uma gravação concorrente faz a transação recomeçar com a versão nova.
+    from daily_agenda import agenda_operations, apply_operations
+
+    original = None
+    if is_update:
+        snapshot = doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            raise google_exceptions.NotFound(f"Agendamento {doc_ref.id} não encontrado.")
+        original = snapshot.to_dict() or {}
+    if callable(data):
+        data = data(original)
+    merged = dict(original or {}, **data)
+    interval = _interval_or_none(merged) if needs_conflict_check(original, merged) else None
+    if interval:
+        start, end = interval
+        bookings = load_bookings(db_instance, clinica_id, merged['profissional_id'], start, end,
+                                 ignore_id=doc_ref.id, transaction=transaction)
+        conflitos = find_conflicts(bookings, start, end)
+        if conflitos:
+            raise BookingConflictError(_conflict_message(conflitos), conflitos)
+    if is_update:
+        transaction.update(doc_ref, data)
+    else:
+        transaction.set(doc_ref, data)
+    if audit:
+        transaction.set(audit_ref(db_instance, clinica_id), audit_event(
+            clinica_id, doc_ref.id, audit['tipo'], audit.get('detalhes', data.get('detalhes_alteracao')),
+            antes=original, depois=data, origem=audit.get('origem')))
+    apply_operations(transaction, agenda_operations(db_instance, clinica_id, doc_ref.id, original, merged)
+                     + cube_operations(db_instance, clinica_id, [(original, merged)]))
+    return original, merged
+
+def save_appointment_checked(db_instance, clinica_id, data, agendamento_id=None, audit=None):
+    """
+    Cria (agendamento_id=None) ou atualiza um agendamento, recusando-o com BookingConflictError
+    se ele se sobrepuser a outro agendamento ativo do mesmo profissional (verificado só quando ele
+    passa a ocupar a agenda ou muda de horário/profissional; veja needs_conflict_check).
+    Em atualizações, o agendamento é lido na mesma transação da verificação e da gravação;
+    'data' pode ser uma função que recebe esses dados atuais e retorna os campos a gravar.
+    Levanta google_exceptions.NotFound se o agendamento a atualizar não existe (ocorrências virtuais
+    de séries precisam ser materializadas antes; veja recurrence.load_occurrence).
+    audit: {'tipo', 'detalhes', 'origem'} do evento de auditoria gravado na mesma transação
+    (sem 'detalhes', usa o 'detalhes_alteracao' dos dados gravados).
+    A agenda diária do profissional (daily_agenda) e o cubo de agendamentos (appointment_cube) também
+    são atualizados na mesma transação.
+    Retorna o ID do agendamento.
+    """
+    agendamentos_ref = _agendamentos_ref(db_instance, clinica_id)
+    doc_ref = agendamentos_ref.document(agendamento_id) if agendamento_id else agendamentos_ref.document()
+    original, merged = _save_in_transaction(db_instance.transaction(), db_instance, clinica_id, doc_ref, data,
+                                            agendamento_id is not None, audit)
+    invalidate_for_appointment(clinica_id, original)
+    invalidate_for_appointment(clinica_id, merged)
+    invalidate_financial_report(clinica_id, *revenue_months(original, merged))
+    return doc_ref.id
+
+def find_series_conflicts(db_instance, clinica_id, profissional_id, intervals, ignore_ids=None):
+    """
+    Verifica de uma vez uma lista de intervalos [(início, fim)] de um mesmo profissional.
+    Faz uma única consulta cobrindo todo o período. Retorna a lista de agendamentos em conflito.
+    ignore_ids: agendamentos que não contam como conflito (ex.: as ocorrências sendo remarcadas).
+    """
+    if not intervals:
+        return []
+    ignore_ids = set(ignore_ids or ())
+    bookings = [b for b in load_bookings(db_instance, clinica_id, profissional_id,
+                                         min(start for start, _ in intervals), max(end for _, end in intervals))
+                if b['id'] not in ignore_ids]
+    busy = IntervalSet((b['inicio'], b['fim']) for b in bookings)
+    conflitos = []
+    for start, end in intervals:
+        if busy.overlaps(start, end):
+            conflitos.extend(c for c in find_conflicts(bookings, start, end) if c not in conflitos)
+    return conflitos
@@ -0,0 +1,72 @@
+from flask import session, request, jsonify, url_for
+import datetime
+
+from utils import get_db, login_required, admin_required, SAO_PAULO_TZ
+from appointment_cube import CUBO_DIMENSOES, cube_slice, parse_period, schedule_cube_rebuild
+
+def _requested_interval():
+    """
+    Datas do recorte: 'periodo' (AAAA-MM, AAAA-Tn ou AAAA) ou inicio e fim (AAAA-MM-DD);
+    padrão: mês atual. Levanta ValueError com a mensagem para o usuário.
+    """
+    if request.args.get('inicio') or request.args.get('fim'):
+        try:
+            inicio = datetime.date.fromisoformat(request.args.get('inicio', ''))
+            fim = datetime.date.fromisoformat(request.args.get('fim') or request.args.get('inicio', ''))
+        except ValueError:
+            raise ValueError('Datas inválidas. Use o formato AAAA-MM-DD.')
+    else:
+        try:
+            inicio, fim = parse_period(request.args.get('periodo') or datetime.datetime.now(SAO_PAULO_TZ).strftime('%Y-%m'))
+        except ValueError:
+            raise ValueError('Período inválido. Use AAAA-MM (mês), AAAA-Tn (trimestre) ou AAAA (ano).')
+    if fim < inicio:
+        raise ValueError('A data final deve ser igual ou posterior à inicial.')
+    return inicio, fim
+
+def register_analytics_routes(app):
+    @app.route('/api/analytics/agendamentos', methods=['GET'], endpoint='analytics_agendamentos')
+    @login_required
+    @admin_required
+    def analytics_agendamentos():
+        """
+        Quantidade e receita dos agendamentos, lidas do cubo mensal.
+        Parâmetros: periodo ou inicio/fim (veja _requested_interval); agrupar (dimensões separadas por
+        vírgula: mes, dia, profissional, servico, status; padrão: profissional); e os filtros repetíveis
+        profissional_id, servico_id e status.
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        agrupar = tuple(d.strip() for d in (request.args.get('agrupar') or 'profissional').split(',') if d.strip())
+        try:
+            inicio, fim = _requested_interval()
+            if any(dimensao not in CUBO_DIMENSOES for dimensao in agrupar):
+                raise ValueError(f"Dimensões aceitas em 'agrupar': {', '.join(CUBO_DIMENSOES)}.")
+        except ValueError as ve:
+            return jsonify({'success': False, 'message': str(ve)}), 400
+        try:
+            resultado = cube_slice(db_instance, clinica_id, inicio, fim, agrupar,
+                                   profissional_ids=request.args.getlist('profissional_id'),
+                                   servico_ids=request.args.getlist('servico_id'),
+                                   status=request.args.getlist('status'))
+        except ValueError as ve:
+            return jsonify({'success': False, 'message': str(ve)}), 400
+        except Exception as e:
+            print(f"ERRO: [analytics_agendamentos] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+        return jsonify({'success': True, 'inicio': inicio.isoformat(), 'fim': fim.isoformat(), 'agrupar': list(agrupar),
+                        **resultado}), 200
+
+    @app.route('/api/analytics/agendamentos/recalcular', methods=['POST'], endpoint='recalcular_analytics_agendamentos')
+    @login_required
+    @admin_required
+    def recalcular_analytics_agendamentos():
+        """Reconstrói em segundo plano o cubo de agendamentos a partir dos agendamentos."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            job_id = schedule_cube_rebuild(db_instance, clinica_id, force=True)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id)}), 202
+        except Exception as e:
+            print(f"ERRO: [recalcular_analytics_agendamentos] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
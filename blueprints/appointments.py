@@ -1,13 +1,31 @@
-from flask import render_template, session, flash, redirect, url_for, request, jsonify
+from flask import render_template, session, flash, redirect, url_for, request, jsonify, Response, stream_with_context
 import datetime
 import pytz
 import json
 from google.cloud.firestore_v1.base_query import FieldFilter
 from google.cloud import firestore # Importar no topo
+from google.api_core import exceptions as google_exceptions
 
 
 # Importar utils
-from utils import get_db, login_required, SAO_PAULO_TZ
+from utils import get_db, login_required, admin_required, SAO_PAULO_TZ
+from availability import (
+    BookingConflictError, DURACAO_PADRAO_MINUTOS, get_weekly_availability, save_appointment_checked, week_bounds,
+)
+from calendar_data import CALENDARIO_MAX_DIAS, get_calendar
+from audit import (
+    AUDITORIA_HISTORICO_LIMITE, export_lines, get_appointment_history, iter_events, months_between,
+)
+from recurrence import (
+    cancel_series_from, create_series, edit_series_from, load_occurrence, schedule_series_roll, virtual_occurrences,
+)
+from query_registry import register_query
+
+# Filtros opcionais da listagem (paciente, profissional, status e período)
+register_query('agendamentos.listar', 'clinicas/{clinica_id}/agendamentos',
+               equality=('profissional_id', 'status'), range_fields=('data_agendamento_ts', 'paciente_nome'),
+               order_by=(('data_agendamento_ts', 'DESCENDING'), 'hora_agendamento'),
+               optional=('profissional_id', 'status', 'data_agendamento_ts', 'paciente_nome'))
 
 
 def register_appointments_routes(app):
@@ -53,17 +71,10 @@ def register_appointments_routes(app):
         }
 
         if not filtros_atuais['data_inicio'] and not filtros_atuais['data_fim']:
-            hoje = datetime.datetime.now(SAO_PAULO_TZ)
-            inicio_mes = hoje.replace(day=1)
-            
-            if inicio_mes.month == 12:
-                proximo_mes_inicio = inicio_mes.replace(year=inicio_mes.year + 1, month=1, day=1)
-            else:
-                proximo_mes_inicio = inicio_mes.replace(month=inicio_mes.month + 1, day=1)
-            fim_mes = proximo_mes_inicio - datetime.timedelta(days=1)
-            
-            filtros_atuais['data_inicio'] = inicio_mes.strftime('%Y-%m-%d')
-            filtros_atuais['data_fim'] = fim_mes.strftime('%Y-%m-%d')
+            # Só a semana visível: as demais são buscadas pelo calendário em /api/agenda/calendario
+            inicio_semana, proxima_semana = week_bounds(datetime.datetime.now(SAO_PAULO_TZ).date())
+            filtros_atuais['data_inicio'] = inicio_semana.strftime('%Y-%m-%d')
+            filtros_atuais['data_fim'] = (proxima_semana - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
 
         query = agendamentos_ref
 
@@ -90,10 +101,32 @@ def register_appointments_routes(app):
             # Ordena por data_agendamento_ts e depois por hora_agendamento para garantir a ordem correta
             docs_stream = query.order_by('data_agendamento_ts', direction=firestore.Query.DESCENDING).order_by('hora_agendamento').stream()
 
-            for doc in docs_stream:
-                ag = doc.to_dict()
+            # Ocorrências de séries além do horizonte de materialização, com os mesmos filtros
+            virtuais = []
+            if filtros_atuais['data_inicio'] and filtros_atuais['data_fim']:
+                try:
+                    virtuais = [
+                        ag for ag in virtual_occurrences(
+                            db_instance, clinica_id,
+                            datetime.date.fromisoformat(filtros_atuais['data_inicio']),
+                            datetime.date.fromisoformat(filtros_atuais['data_fim']),
+                            profissional_id=filtros_atuais['profissional_id'] or None)
+                        if (not filtros_atuais['status'] or ag.get('status') == filtros_atuais['status'])
+                        and str(ag.get('paciente_nome') or '').startswith(filtros_atuais['paciente_nome'])
+                    ]
+                except ValueError:
+                    pass
+
+            documentos = [(doc.id, doc.to_dict()) for doc in docs_stream] + [(ag['id'], ag) for ag in virtuais]
+            if virtuais:
+                def _ordem(item):
+                    ts = (item[1] or {}).get('data_agendamento_ts')
+                    return (-ts.timestamp() if isinstance(ts, datetime.datetime) else 0, (item[1] or {}).get('hora_agendamento') or '')
+                documentos.sort(key=_ordem)
+
+            for doc_id, ag in documentos:
                 if ag:
-                    ag['id'] = doc.id
+                    ag['id'] = doc_id
                     if ag.get('data_agendamento'):
                         try: ag['data_agendamento_fmt'] = datetime.datetime.strptime(ag['data_agendamento'], '%Y-%m-%d').strftime('%d/%m/%Y')
                         except: ag['data_agendamento_fmt'] = ag['data_agendamento']
@@ -109,6 +142,12 @@ def register_appointments_routes(app):
         except Exception as e:
             flash(f'Erro ao listar agendamentos: {e}. Verifique seus índices do Firestore.', 'danger')
             print(f"Erro list_appointments: {e}")
+
+        # Avança o horizonte das séries em segundo plano (no máximo algumas vezes por dia)
+        try:
+            schedule_series_roll(db_instance, clinica_id)
+        except Exception as e:
+            print(f"Erro ao agendar a materialização das séries: {e}")
         
         stats_cards = {
             'confirmado': {'count': 0, 'total_valor': 0.0},
@@ -200,56 +239,30 @@ def register_appointments_routes(app):
 
             profissional_nome = profissional_doc.to_dict().get('nome', 'N/A') if profissional_doc.exists else 'N/A'
             servico_procedimento_nome = servico_procedimento_doc.to_dict().get('nome', 'N/A') if servico_procedimento_doc.exists else 'N/A'
+            duracao_minutos = (servico_procedimento_doc.to_dict().get('duracao_minutos') if servico_procedimento_doc.exists else None) or DURACAO_PADRAO_MINUTOS
             
-            # Lista para armazenar os agendamentos a serem criados
-            agendamentos_a_criar = []
-
             if recorrente:
                 data_inicio_recorrencia = datetime.datetime.strptime(data_agendamento_str, '%Y-%m-%d').date()
                 data_fim_recorrencia = datetime.datetime.strptime(data_fim_recorrencia_str, '%Y-%m-%d').date()
-                
-                # Converte os dias da semana selecionados para inteiros
-                dias_semana_int = [int(d) for d in dias_semana]
-
-                current_date = data_inicio_recorrencia
-                while current_date <= data_fim_recorrencia:
-                    python_weekday = current_date.weekday() # 0=Seg, 1=Ter, ..., 6=Dom
-                    js_equivalent_weekday = (python_weekday + 1) % 7 # 0=Dom, 1=Seg, ..., 6=Sáb
-
-                    if js_equivalent_weekday in dias_semana_int:
-                        dt_agendamento_naive = datetime.datetime.strptime(f"{current_date.strftime('%Y-%m-%d')} {hora_agendamento_str}", "%Y-%m-%d %H:%M")
-                        dt_agendamento_sp = SAO_PAULO_TZ.localize(dt_agendamento_naive)
-                        data_agendamento_ts_utc = dt_agendamento_sp.astimezone(pytz.utc)
-
-                        agendamentos_a_criar.append({
-                            'paciente_id': paciente_doc_id,
-                            'paciente_nome': paciente_nome,
-                            'paciente_numero': paciente_telefone if paciente_telefone else None,
-                            'profissional_id': profissional_id_manual,
-                            'profissional_nome': profissional_nome,
-                            'servico_procedimento_id': servico_procedimento_id_manual,
-                            'servico_procedimento_nome': servico_procedimento_nome,
-                            'data_agendamento': current_date.strftime('%Y-%m-%d'),
-                            'hora_agendamento': hora_agendamento_str,
-                            'data_agendamento_ts': data_agendamento_ts_utc,
-                            'servico_procedimento_preco': preco_servico,
-                            'status': status_manual,
-                            'tipo_agendamento': 'recorrente',
-                            'data_criacao': firestore.SERVER_TIMESTAMP,
-                            'atualizado_em': firestore.SERVER_TIMESTAMP,
-                            'notificacao_pendente': True, # NOVO: Marcar para notificação
-                            'tipo_alteracao': 'novo_agendamento', # NOVO: Tipo de alteração
-                            'detalhes_alteracao': f'Novo agendamento recorrente com {profissional_nome} para {servico_procedimento_nome} em {current_date.strftime("%d/%m/%Y")} às {hora_agendamento_str}.' # NOVO: Detalhes
-                        })
-                    current_date += datetime.timedelta(days=1)
-                
-                if agendamentos_a_criar:
-                    batch = db_instance.batch()
-                    for agendamento_data in agendamentos_a_criar:
-                        new_doc_ref = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos').document()
-                        batch.set(new_doc_ref, agendamento_data)
-                    batch.commit()
-                    flash(f'{len(agendamentos_a_criar)} agendamentos recorrentes registrados com sucesso!', 'success')
+                frequencia = request.form.get('frequencia_recorrencia') or 'semanal'
+
+                # A série é expandida, verificada contra a agenda do profissional e gravada em lotes
+                _, total = create_series(db_instance, clinica_id, {
+                    'paciente_id': paciente_doc_id,
+                    'paciente_nome': paciente_nome,
+                    'paciente_numero': paciente_telefone if paciente_telefone else None,
+                    'profissional_id': profissional_id_manual,
+                    'profissional_nome': profissional_nome,
+                    'servico_procedimento_id': servico_procedimento_id_manual,
+                    'servico_procedimento_nome': servico_procedimento_nome,
+                    'servico_procedimento_preco': preco_servico,
+                    'hora_agendamento': hora_agendamento_str,
+                    'duracao_minutos': duracao_minutos,
+                    'status': status_manual,
+                }, frequencia, [int(d) for d in dias_semana], data_inicio_recorrencia, data_fim_recorrencia)
+
+                if total:
+                    flash(f'{total} agendamentos recorrentes registrados com sucesso!', 'success')
                 else:
                     flash('Nenhum agendamento recorrente foi gerado com os critérios fornecidos.', 'warning')
 
@@ -269,19 +282,27 @@ def register_appointments_routes(app):
                     'data_agendamento': data_agendamento_str,
                     'hora_agendamento': hora_agendamento_str,
                     'data_agendamento_ts': data_agendamento_ts_utc,
+                    'duracao_minutos': duracao_minutos,
                     'servico_procedimento_preco': preco_servico,
                     'status': status_manual,
                     'tipo_agendamento': 'manual_dashboard',
                     'data_criacao': firestore.SERVER_TIMESTAMP,
                     'atualizado_em': firestore.SERVER_TIMESTAMP,
                     'notificacao_pendente': True, # NOVO: Marcar para notificação
+                    'notificacao_proxima_tentativa': firestore.SERVER_TIMESTAMP,
                     'tipo_alteracao': 'novo_agendamento', # NOVO: Tipo de alteração
                     'detalhes_alteracao': f'Novo agendamento com {profissional_nome} para {servico_procedimento_nome} em {data_agendamento_str} às {hora_agendamento_str}.' # NOVO: Detalhes
                 }
                 
-                db_instance.collection('clinicas').document(clinica_id).collection('agendamentos').add(novo_agendamento_dados)
+                save_appointment_checked(db_instance, clinica_id, novo_agendamento_dados, audit={
+                    'tipo': 'novo_agendamento',
+                    'detalhes': novo_agendamento_dados['detalhes_alteracao'],
+                    'origem': 'registrar_atendimento_manual',
+                })
                 flash('Atendimento registrado manualmente com sucesso!', 'success')
 
+        except BookingConflictError as bce:
+            flash(str(bce), 'danger')
         except ValueError as ve:
             flash(f'Erro de valor ao registrar atendimento: {ve}', 'danger')
         except Exception as e:
@@ -303,26 +324,32 @@ def register_appointments_routes(app):
         
         novo_status = data['status']
 
-        try:
-            agendamento_doc_ref = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos').document(agendamento_doc_id)
-            original_agendamento_data = agendamento_doc_ref.get().to_dict()
-
-            if not original_agendamento_data:
-                return jsonify({'success': False, 'error': 'Agendamento não encontrado.'}), 404
-
-            old_status = original_agendamento_data.get('status', 'N/A')
-            
-            # Detalhes da alteração para a notificação
-            detalhes_alteracao = f"Status alterado de '{old_status}' para '{novo_status}' para o agendamento de {original_agendamento_data.get('paciente_nome', 'N/A')} em {original_agendamento_data.get('data_agendamento', 'N/A')} às {original_agendamento_data.get('hora_agendamento', 'N/A')}."
-
-            agendamento_doc_ref.update({
+        def status_update(original):
+            # Os detalhes partem do agendamento lido na transação de save_appointment_checked
+            detalhes_alteracao = f"Status alterado de '{original.get('status', 'N/A')}' para '{novo_status}' para o agendamento de {original.get('paciente_nome', 'N/A')} em {original.get('data_agendamento', 'N/A')} às {original.get('hora_agendamento', 'N/A')}."
+            return {
                 'status': novo_status,
                 'atualizado_em': firestore.SERVER_TIMESTAMP,
                 'notificacao_pendente': True, # NOVO: Marcar para notificação
+                'notificacao_proxima_tentativa': firestore.SERVER_TIMESTAMP,
                 'tipo_alteracao': 'status_alterado', # NOVO: Tipo de alteração
                 'detalhes_alteracao': detalhes_alteracao # NOVO: Detalhes
-            })
+            }
+
+        audit = {'tipo': 'status_alterado', 'origem': 'update_status'}
+        try:
+            # Uma única transação lê o agendamento e grava o status, a auditoria, a agenda diária e o cubo;
+            # reativar um agendamento cancelado volta a ocupar a agenda e verifica conflitos
+            try:
+                save_appointment_checked(db_instance, clinica_id, status_update, agendamento_id=agendamento_doc_id, audit=audit)
+            except google_exceptions.NotFound:
+                # Ocorrência virtual de uma série: materializa e tenta de novo
+                if not load_occurrence(db_instance, clinica_id, agendamento_doc_id):
+                    return jsonify({'success': False, 'error': 'Agendamento não encontrado.'}), 404
+                save_appointment_checked(db_instance, clinica_id, status_update, agendamento_id=agendamento_doc_id, audit=audit)
             return jsonify({'success': True, 'message': f'Status atualizado para "{novo_status}" com sucesso!'}), 200
+        except BookingConflictError as bce:
+            return jsonify({'success': False, 'error': str(bce)}), 409
         except Exception as e:
             print(f'Erro ao alterar o status do agendamento: {e}')
             return jsonify({'success': False, 'error': f'Erro interno ao alterar o status do agendamento: {e}'}), 500
@@ -339,8 +366,7 @@ def register_appointments_routes(app):
             return redirect(url_for('listar_agendamentos'))
 
         try:
-            agendamento_ref = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos').document(agendamento_id)
-            original_agendamento_data = agendamento_ref.get().to_dict()
+            original_agendamento_data = load_occurrence(db_instance, clinica_id, agendamento_id)
 
             if not original_agendamento_data:
                 flash('Agendamento não encontrado para edição.', 'danger')
@@ -366,7 +392,31 @@ def register_appointments_routes(app):
 
             profissional_nome = profissional_doc.to_dict().get('nome', 'N/A') if profissional_doc.exists else 'N/A'
             servico_procedimento_nome = servico_procedimento_doc.to_dict().get('nome', 'N/A') if servico_procedimento_doc.exists else 'N/A'
+            duracao_minutos = (servico_procedimento_doc.to_dict().get('duracao_minutos') if servico_procedimento_doc.exists else None) or DURACAO_PADRAO_MINUTOS
             
+            # "Esta e as seguintes": aplica à série a partir da data original desta ocorrência.
+            # A data não é propagada (cada ocorrência mantém o seu dia); o restante sim.
+            serie_id = original_agendamento_data.get('serie_id')
+            if request.form.get('aplicar_serie') == 'true' and serie_id:
+                a_partir_de = datetime.date.fromisoformat(original_agendamento_data['data_agendamento'])
+                if status_manual == 'cancelado':
+                    total = cancel_series_from(db_instance, clinica_id, serie_id, a_partir_de)
+                    flash(f'{total} agendamentos da série cancelados com sucesso!', 'success')
+                else:
+                    total = edit_series_from(db_instance, clinica_id, serie_id, a_partir_de, {
+                        'paciente_nome': paciente_nome,
+                        'profissional_id': profissional_id_manual,
+                        'profissional_nome': profissional_nome,
+                        'servico_procedimento_id': servico_procedimento_id_manual,
+                        'servico_procedimento_nome': servico_procedimento_nome,
+                        'servico_procedimento_preco': float(preco_str.replace(',', '.')),
+                        'hora_agendamento': hora_agendamento_str,
+                        'duracao_minutos': duracao_minutos,
+                        'status': status_manual,
+                    })
+                    flash(f'{total} agendamentos da série atualizados com sucesso!', 'success')
+                return redirect(url_for('listar_agendamentos'))
+
             # Converter data e hora para timestamp UTC
             dt_agendamento_naive = datetime.datetime.strptime(f"{data_agendamento_str} {hora_agendamento_str}", "%Y-%m-%d %H:%M")
             dt_agendamento_sp = SAO_PAULO_TZ.localize(dt_agendamento_naive)
@@ -398,23 +448,60 @@ def register_appointments_routes(app):
                 'data_agendamento': data_agendamento_str,
                 'hora_agendamento': hora_agendamento_str,
                 'data_agendamento_ts': data_agendamento_ts_utc,
+                'duracao_minutos': duracao_minutos,
                 'servico_procedimento_preco': float(preco_str.replace(',', '.')),
                 'status': status_manual,
                 'atualizado_em': firestore.SERVER_TIMESTAMP,
                 'notificacao_pendente': True, # NOVO: Marcar para notificação
+                'notificacao_proxima_tentativa': firestore.SERVER_TIMESTAMP,
                 'tipo_alteracao': tipo_alteracao, # NOVO: Tipo de alteração
                 'detalhes_alteracao': detalhes_alteracao # NOVO: Detalhes
             }
 
-            agendamento_ref.update(update_data)
+            save_appointment_checked(db_instance, clinica_id, update_data, agendamento_id=agendamento_id,
+                                     audit={'tipo': tipo_alteracao, 'detalhes': detalhes_alteracao, 'origem': 'editar_agendamento'})
             flash('Agendamento atualizado com sucesso!', 'success')
 
+        except BookingConflictError as bce:
+            flash(str(bce), 'danger')
         except Exception as e:
             flash(f'Erro ao atualizar agendamento: {e}', 'danger')
             print(f"Erro edit_appointment: {e}")
             
         return redirect(url_for('listar_agendamentos'))
 
+    @app.route('/agendamentos/serie/<string:serie_id>/cancelar', methods=['POST'], endpoint='cancelar_serie_agendamentos')
+    @login_required
+    def cancelar_serie_agendamentos(serie_id):
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        a_partir_de_str = request.form.get('a_partir_de')
+        try:
+            a_partir_de = datetime.datetime.strptime(a_partir_de_str, '%Y-%m-%d').date() if a_partir_de_str \
+                else datetime.datetime.now(SAO_PAULO_TZ).date()
+            total = cancel_series_from(db_instance, clinica_id, serie_id, a_partir_de)
+            flash(f'{total} agendamentos da série cancelados com sucesso!', 'success')
+        except ValueError as ve:
+            flash(f'Data inválida para cancelar a série: {ve}', 'danger')
+        except Exception as e:
+            flash(f'Erro ao cancelar a série de agendamentos: {e}', 'danger')
+            print(f"Erro cancelar_serie_agendamentos: {e}")
+        return redirect(url_for('listar_agendamentos'))
+
+    @app.route('/agendamentos/series/materializar', methods=['POST'], endpoint='materializar_series_agendamentos')
+    @login_required
+    @admin_required
+    def materializar_series_agendamentos():
+        """Avança já o horizonte de materialização das séries da clínica (em segundo plano)."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            job_id = schedule_series_roll(db_instance, clinica_id, force=True)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id)}), 202
+        except Exception as e:
+            print(f"Erro ao iniciar a materialização das séries: {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
     @app.route('/agendamentos/apagar', methods=['POST'], endpoint='apagar_agendamento')
     @login_required
     def apagar_agendamento():
@@ -426,26 +513,129 @@ def register_appointments_routes(app):
             return redirect(url_for('listar_agendamentos'))
 
         try:
-            agendamento_doc_ref = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos').document(agendamento_id)
-            original_agendamento_data = agendamento_doc_ref.get().to_dict()
-
-            if not original_agendamento_data:
+            # Materializa a ocorrência, se for virtual; a exclusão relê o agendamento na transação
+            if not load_occurrence(db_instance, clinica_id, agendamento_id):
                 flash('Agendamento não encontrado para exclusão.', 'danger')
                 return redirect(url_for('listar_agendamentos'))
 
             # Em vez de apagar o documento, vamos marcá-lo como "excluído" logicamente
             # e definir a notificação pendente.
-            detalhes_alteracao = f"Agendamento de {original_agendamento_data.get('paciente_nome', 'N/A')} para {original_agendamento_data.get('data_agendamento', 'N/A')} às {original_agendamento_data.get('hora_agendamento', 'N/A')} foi APAGADO (excluído logicamente) do sistema."
-            
-            agendamento_doc_ref.update({
-                'status': 'excluido', # Novo status para exclusão lógica
-                'atualizado_em': firestore.SERVER_TIMESTAMP,
-                'notificacao_pendente': True, # NOVO: Marcar para notificação
-                'tipo_alteracao': 'agendamento_excluido', # NOVO: Tipo de alteração
-                'detalhes_alteracao': detalhes_alteracao # NOVO: Detalhes
-            })
+            def exclusion(original):
+                detalhes_alteracao = f"Agendamento de {original.get('paciente_nome', 'N/A')} para {original.get('data_agendamento', 'N/A')} às {original.get('hora_agendamento', 'N/A')} foi APAGADO (excluído logicamente) do sistema."
+                return {
+                    'status': 'excluido', # Novo status para exclusão lógica
+                    'atualizado_em': firestore.SERVER_TIMESTAMP,
+                    'notificacao_pendente': True, # NOVO: Marcar para notificação
+                    'notificacao_proxima_tentativa': firestore.SERVER_TIMESTAMP,
+                    'tipo_alteracao': 'agendamento_excluido', # NOVO: Tipo de alteração
+                    'detalhes_alteracao': detalhes_alteracao # NOVO: Detalhes
+                }
+
+            save_appointment_checked(db_instance, clinica_id, exclusion, agendamento_id=agendamento_id,
+                                     audit={'tipo': 'agendamento_excluido', 'origem': 'apagar_agendamento'})
             flash('Agendamento apagado (logicamente) com sucesso e notificação pendente!', 'success')
         except Exception as e:
             flash(f'Erro ao apagar agendamento: {e}', 'danger')
             print(f"Erro delete_appointment: {e}")
         return redirect(url_for('listar_agendamentos'))
+
+    @app.route('/api/disponibilidade', methods=['GET'], endpoint='api_disponibilidade')
+    @login_required
+    def api_disponibilidade():
+        """
+        Horários livres e ocupados de um profissional na semana.
+        Parâmetros: profissional_id e semana (qualquer data da semana, AAAA-MM-DD; padrão: hoje).
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        profissional_id = request.args.get('profissional_id', '').strip()
+        semana_str = request.args.get('semana', '').strip()
+
+        if not profissional_id:
+            return jsonify({'success': False, 'message': 'Informe o profissional_id.'}), 400
+        try:
+            semana = datetime.datetime.strptime(semana_str, '%Y-%m-%d').date() if semana_str else datetime.datetime.now(SAO_PAULO_TZ).date()
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Semana inválida. Use o formato AAAA-MM-DD.'}), 400
+
+        try:
+            disponibilidade = get_weekly_availability(db_instance, clinica_id, profissional_id, semana)
+            return jsonify(dict(disponibilidade, success=True)), 200
+        except Exception as e:
+            print(f"Erro ao calcular disponibilidade do profissional {profissional_id}: {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/agenda/calendario', methods=['GET'], endpoint='api_calendario')
+    @login_required
+    def api_calendario():
+        """
+        Agendamentos de um intervalo em formato colunar, para o calendário.
+        Parâmetros: inicio e fim (AAAA-MM-DD, inclusive; padrão: semana atual) e
+        profissionais (IDs separados por vírgula; padrão: todos).
+        Responde 304 quando o If-None-Match coincide com o ETag do conteúdo.
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        inicio_str = request.args.get('inicio', '').strip()
+        fim_str = request.args.get('fim', '').strip()
+        profissionais = [p.strip() for p in request.args.get('profissionais', '').split(',') if p.strip()]
+
+        try:
+            inicio = datetime.datetime.strptime(inicio_str, '%Y-%m-%d').date() if inicio_str \
+                else week_bounds(datetime.datetime.now(SAO_PAULO_TZ).date())[0]
+            fim = datetime.datetime.strptime(fim_str, '%Y-%m-%d').date() if fim_str else inicio + datetime.timedelta(days=6)
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Datas inválidas. Use o formato AAAA-MM-DD.'}), 400
+        if fim < inicio or (fim - inicio).days >= CALENDARIO_MAX_DIAS:
+            return jsonify({'success': False, 'message': f'Intervalo inválido: informe até {CALENDARIO_MAX_DIAS} dias.'}), 400
+
+        try:
+            payload, etag = get_calendar(db_instance, clinica_id, inicio, fim, profissionais)
+            response = jsonify(payload)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response.make_conditional(request)
+        except Exception as e:
+            print(f"Erro ao carregar o calendário de {inicio} a {fim}: {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/agendamentos/<string:agendamento_id>/historico', methods=['GET'], endpoint='historico_agendamento')
+    @login_required
+    def historico_agendamento(agendamento_id):
+        """Eventos de auditoria de um agendamento, do mais antigo ao mais recente."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            limite = min(request.args.get('limite', AUDITORIA_HISTORICO_LIMITE, type=int), AUDITORIA_HISTORICO_LIMITE)
+            eventos = get_appointment_history(db_instance, clinica_id, agendamento_id, limit=limite)
+            return jsonify({'success': True, 'eventos': eventos}), 200
+        except Exception as e:
+            print(f"Erro ao carregar o histórico do agendamento {agendamento_id}: {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}. Verifique seus índices do Firestore.'}), 500
+
+    @app.route('/api/auditoria/exportar', methods=['GET'], endpoint='exportar_auditoria')
+    @login_required
+    @admin_required
+    def exportar_auditoria():
+        """
+        Exporta os eventos de auditoria por streaming, sem montar o arquivo em memória.
+        Parâmetros: inicio e fim (AAAA-MM; padrão: mês atual) e formato (jsonl ou csv).
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        formato = request.args.get('formato', 'jsonl')
+        mes_atual = datetime.datetime.now(SAO_PAULO_TZ).strftime('%Y-%m')
+        try:
+            inicio = datetime.datetime.strptime(request.args.get('inicio') or mes_atual, '%Y-%m').date()
+            fim = datetime.datetime.strptime(request.args.get('fim') or request.args.get('inicio') or mes_atual, '%Y-%m').date()
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Meses inválidos. Use o formato AAAA-MM.'}), 400
+        if fim < inicio or formato not in ('jsonl', 'csv'):
+            return jsonify({'success': False, 'message': 'Intervalo ou formato inválido.'}), 400
+
+        partitions = months_between(inicio, fim)
+        lines = export_lines(iter_events(db_instance, clinica_id, partitions), formato)
+        filename = f"auditoria_{partitions[0]}_{partitions[-1]}.{formato}"
+        mimetype = 'text/csv' if formato == 'csv' else 'application/x-ndjson'
+        return Response(stream_with_context(lines), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
@@ -6,6 +6,27 @@ import pytz
 
 # Importar utils
 from utils import get_db, login_required, admin_required, SAO_PAULO_TZ, convert_doc_to_dict, parse_date_input
+from query_registry import register_query
+from payables import (
+    FLUXO_SEMANAS_PADRAO, PayableError, cash_flow_projection, create_payable, delete_payable, due_month,
+    mark_payables_paid, matches_search, monthly_due_totals, pending_ids_in_month, schedule_payable_totals,
+    search_fields_ready, search_plan, update_payable,
+)
+from payable_series import (
+    FREQUENCIAS_RECORRENTES, RecurringPayableError, create_series, end_series, list_series, reference_name,
+    reference_options, schedule_recurring_payables,
+)
+from stock_history import month_range
+
+register_query('contas_a_pagar.listar', 'clinicas/{clinica_id}/contas_a_pagar',
+               equality=('status',), range_fields=('data_vencimento',), order_by=('data_vencimento',),
+               optional=('status', 'data_vencimento'))
+
+# Semanas da projeção exibida na página de contas
+CONTAS_PAGINA_SEMANAS = 4
+
+# Máximo de contas por chamada da baixa em lote
+CONTAS_BAIXA_MAX = 1000
 
 def register_contas_a_pagar_routes(app):
     @app.route('/contas_a_pagar', endpoint='listar_contas_a_pagar')
@@ -22,23 +43,28 @@ def register_contas_a_pagar_routes(app):
         
         query = contas_ref.order_by('data_vencimento', direction=firestore.Query.ASCENDING) # Ordena por vencimento
 
-        # Aplica filtros de status
+        # Aplica filtros de status (o índice composto status + data_vencimento está em firestore.indexes.json).
+        # Uma conta vence no fim do dia: 'vencida' é pendente com vencimento antes de hoje.
+        hoje = datetime.datetime.now(SAO_PAULO_TZ).date()
+        hoje_dt = SAO_PAULO_TZ.localize(datetime.datetime.combine(hoje, datetime.time.min))
         if filter_status == 'pendente':
             query = query.where(filter=FieldFilter('status', '==', 'pendente'))
         elif filter_status == 'paga':
             query = query.where(filter=FieldFilter('status', '==', 'paga'))
         elif filter_status == 'vencida':
-            # Para "vencida", precisamos comparar com a data atual
-            # No Firestore, não podemos fazer query de "menor que" em campos não indexados sem um índice composto.
-            # A forma mais robusta é filtrar por status 'pendente' e depois filtrar por data no Python.
-            # Ou, se houver um índice composto para 'status' e 'data_vencimento', podemos usar:
-            # query = query.where(filter=FieldFilter('status', '==', 'pendente')).where(filter=FieldFilter('data_vencimento', '<', datetime.datetime.now(SAO_PAULO_TZ)))
-            # Por simplicidade e para evitar problemas de índice complexos, faremos o filtro final em Python.
-            query = query.where(filter=FieldFilter('status', '==', 'pendente')) # Primeiro filtra pendentes
-        
+            query = query.where(filter=FieldFilter('status', '==', 'pendente'))\
+                         .where(filter=FieldFilter('data_vencimento', '<', hoje_dt))
+
+        # Busca: a palavra mais longa filtra no índice (busca_termos); as demais são conferidas nas contas lidas.
+        # Enquanto a tarefa diária não gravou os termos das contas antigas, todas as palavras são conferidas em Python.
+        termo, palavras = search_plan(search_query)
+        resumo = None
         try:
+            if termo and search_fields_ready(db_instance, clinica_id):
+                query = query.where(filter=FieldFilter('busca_termos', 'array_contains', termo))
+            elif termo:
+                palavras = [termo] + palavras
             docs = query.stream()
-            hoje_dt = datetime.datetime.now(SAO_PAULO_TZ)
 
             for doc in docs:
                 conta = doc.to_dict()
@@ -48,36 +74,26 @@ def register_contas_a_pagar_routes(app):
                     # Formatar data de vencimento
                     if 'data_vencimento' in conta and isinstance(conta['data_vencimento'], datetime.datetime):
                         conta['data_vencimento_fmt'] = conta['data_vencimento'].strftime('%d/%m/%Y')
-                        # Verifica se está vencida (apenas para status 'pendente')
-                        if filter_status == 'vencida' and conta['status'] == 'pendente' and conta['data_vencimento'] < hoje_dt:
-                            contas_lista.append(conta)
-                        elif filter_status != 'vencida': # Adiciona se não for filtro de vencida
-                            contas_lista.append(conta)
                     else:
                         conta['data_vencimento_fmt'] = 'N/A'
-                        if filter_status != 'vencida': # Adiciona mesmo sem data de vencimento se não for filtro de vencida
-                            contas_lista.append(conta)
-
-            # Filtrar por search_query (nome do produto, nome do patrimônio ou descrição)
-            if search_query:
-                contas_lista = [c for c in contas_lista if \
-                                search_query.lower() in c.get('descricao', '').lower() or \
-                                search_query.lower() in c.get('produto_nome', '').lower() or \
-                                search_query.lower() in c.get('patrimonio_nome', '').lower()] # NOVO: Busca por nome do patrimônio
-            
-            # Re-filtrar para "vencida" se não foi feito acima ou para garantir
-            if filter_status == 'vencida':
-                contas_lista = [c for c in contas_lista if c.get('status') == 'pendente' and c.get('data_vencimento') and c['data_vencimento'] < hoje_dt]
-            
-            # Ordenar a lista final (se necessário, já ordenado por data_vencimento na query)
-            # contas_lista.sort(key=lambda x: x.get('data_vencimento', datetime.datetime.max.replace(tzinfo=SAO_PAULO_TZ))) # Garante que N/A vão para o final
+                    contas_lista.append(conta)
+
+            # Filtrar por search_query (prefixos das palavras da descrição, do produto e do patrimônio)
+            if palavras:
+                contas_lista = [c for c in contas_lista if matches_search(c, palavras)]
+
+            # Resumo do mês, vencidas e próximas semanas, lidos dos totais mantidos a cada gravação
+            resumo = cash_flow_projection(db_instance, clinica_id, CONTAS_PAGINA_SEMANAS, hoje)
+            resumo['mes'] = monthly_due_totals(db_instance, clinica_id, [due_month(hoje_dt)])[0]
+            schedule_payable_totals(db_instance, clinica_id)
+            schedule_recurring_payables(db_instance, clinica_id)
 
         except Exception as e:
             flash(f'Erro ao listar contas a pagar: {e}. Verifique seus índices do Firestore.', 'danger')
             print(f"ERRO: [listar_contas_a_pagar] {e}")
         
         # Passa SAO_PAULO_TZ para o template
-        return render_template('contas_a_pagar.html', contas=contas_lista, search_query=search_query, filter_status=filter_status, now=hoje_dt, SAO_PAULO_TZ=SAO_PAULO_TZ)
+        return render_template('contas_a_pagar.html', contas=contas_lista, search_query=search_query, filter_status=filter_status, now=hoje_dt, SAO_PAULO_TZ=SAO_PAULO_TZ, resumo=resumo)
 
     @app.route('/contas_a_pagar/nova', methods=['GET', 'POST'], endpoint='adicionar_conta_a_pagar')
     @login_required
@@ -116,19 +132,19 @@ def register_contas_a_pagar_routes(app):
                 if produto_id:
                     conta_data['produto_id'] = produto_id
                     # Opcional: buscar nome do produto se produto_id for fornecido
-                    produto_doc = db_instance.collection('clinicas').document(clinica_id).collection('estoque_produtos').document(produto_id).get()
-                    if produto_doc.exists:
-                        conta_data['produto_nome'] = produto_doc.to_dict().get('nome')
+                    produto_nome = reference_name(db_instance, clinica_id, 'produtos', produto_id)
+                    if produto_nome:
+                        conta_data['produto_nome'] = produto_nome
                 
                 # NOVO: Adiciona vínculo com patrimônio
                 if patrimonio_id:
                     conta_data['patrimonio_id'] = patrimonio_id
-                    patrimonio_doc = db_instance.collection('clinicas').document(clinica_id).collection('patrimonio').document(patrimonio_id).get()
-                    if patrimonio_doc.exists:
-                        conta_data['patrimonio_nome'] = patrimonio_doc.to_dict().get('nome')
+                    patrimonio_nome = reference_name(db_instance, clinica_id, 'patrimonio', patrimonio_id)
+                    if patrimonio_nome:
+                        conta_data['patrimonio_nome'] = patrimonio_nome
 
 
-                db_instance.collection('clinicas').document(clinica_id).collection('contas_a_pagar').add(conta_data)
+                create_payable(db_instance, clinica_id, conta_data)
                 flash('Conta a pagar adicionada com sucesso!', 'success')
                 return redirect(url_for('listar_contas_a_pagar'))
             except ValueError:
@@ -137,28 +153,15 @@ def register_contas_a_pagar_routes(app):
                 flash(f'Erro ao adicionar conta a pagar: {e}', 'danger')
                 print(f"ERRO: [adicionar_conta_a_pagar] {e}")
         
-        # Carrega produtos ativos e itens de patrimônio para o select no formulário (opcional)
-        produtos_ativos = []
-        patrimonio_itens = [] # NOVO
+        # Produtos ativos e itens de patrimônio para o select no formulário (opcional), lidos do cache
+        opcoes = {'produtos': [], 'patrimonio': []}
         try:
-            docs_produtos = db_instance.collection('clinicas').document(clinica_id).collection('estoque_produtos').where(filter=FieldFilter('ativo', '==', True)).order_by('nome').stream()
-            for doc in docs_produtos:
-                p_data = doc.to_dict()
-                if p_data:
-                    produtos_ativos.append({'id': doc.id, 'nome': p_data.get('nome', doc.id)})
-            
-            # NOVO: Busca itens de patrimônio
-            docs_patrimonio = db_instance.collection('clinicas').document(clinica_id).collection('patrimonio').order_by('nome').stream()
-            for doc in docs_patrimonio:
-                item_data = doc.to_dict()
-                if item_data:
-                    patrimonio_itens.append({'id': doc.id, 'nome': item_data.get('nome', doc.id)})
-
+            opcoes = reference_options(db_instance, clinica_id)
         except Exception as e:
             print(f"ERRO: [adicionar_conta_a_pagar GET] Erro ao carregar produtos/patrimônio: {e}")
             flash('Erro ao carregar produtos/patrimônio para vincular.', 'warning')
 
-        return render_template('conta_a_pagar_form.html', conta=None, action_url=url_for('adicionar_conta_a_pagar'), produtos_ativos=produtos_ativos, patrimonio_itens=patrimonio_itens)
+        return render_template('conta_a_pagar_form.html', conta=None, action_url=url_for('adicionar_conta_a_pagar'), produtos_ativos=opcoes['produtos'], patrimonio_itens=opcoes['patrimonio'])
 
     @app.route('/contas_a_pagar/editar/<string:conta_doc_id>', methods=['GET', 'POST'], endpoint='editar_conta_a_pagar')
     @login_required
@@ -167,7 +170,7 @@ def register_contas_a_pagar_routes(app):
         db_instance = get_db()
         clinica_id = session['clinica_id']
         conta_ref = db_instance.collection('clinicas').document(clinica_id).collection('contas_a_pagar').document(conta_doc_id)
-        
+
         if request.method == 'POST':
             descricao = request.form['descricao'].strip()
             valor_str = request.form.get('valor', '0').strip()
@@ -199,9 +202,9 @@ def register_contas_a_pagar_routes(app):
                 # Lógica para produto_id
                 if produto_id:
                     update_data['produto_id'] = produto_id
-                    produto_doc = db_instance.collection('clinicas').document(clinica_id).collection('estoque_produtos').document(produto_id).get()
-                    if produto_doc.exists:
-                        update_data['produto_nome'] = produto_doc.to_dict().get('nome')
+                    produto_nome = reference_name(db_instance, clinica_id, 'produtos', produto_id)
+                    if produto_nome:
+                        update_data['produto_nome'] = produto_nome
                 else:
                     update_data['produto_id'] = firestore.DELETE_FIELD
                     update_data['produto_nome'] = firestore.DELETE_FIELD
@@ -209,17 +212,20 @@ def register_contas_a_pagar_routes(app):
                 # NOVO: Lógica para patrimonio_id
                 if patrimonio_id:
                     update_data['patrimonio_id'] = patrimonio_id
-                    patrimonio_doc = db_instance.collection('clinicas').document(clinica_id).collection('patrimonio').document(patrimonio_id).get()
-                    if patrimonio_doc.exists:
-                        update_data['patrimonio_nome'] = patrimonio_doc.to_dict().get('nome')
+                    patrimonio_nome = reference_name(db_instance, clinica_id, 'patrimonio', patrimonio_id)
+                    if patrimonio_nome:
+                        update_data['patrimonio_nome'] = patrimonio_nome
                 else:
                     update_data['patrimonio_id'] = firestore.DELETE_FIELD
                     update_data['patrimonio_nome'] = firestore.DELETE_FIELD
 
 
-                conta_ref.update(update_data)
+                update_payable(db_instance, clinica_id, conta_doc_id, update_data)
                 flash('Conta a pagar atualizada com sucesso!', 'success')
                 return redirect(url_for('listar_contas_a_pagar'))
+            except PayableError as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('listar_contas_a_pagar'))
             except ValueError:
                 flash('Valor deve ser um número válido.', 'danger')
             except Exception as e:
@@ -237,28 +243,15 @@ def register_contas_a_pagar_routes(app):
                     else:
                         conta['data_vencimento_input'] = ''
                     
-                    # Carrega produtos ativos e itens de patrimônio para o select no formulário
-                    produtos_ativos = []
-                    patrimonio_itens = [] # NOVO
+                    # Produtos ativos e itens de patrimônio para o select no formulário, lidos do cache
+                    opcoes = {'produtos': [], 'patrimonio': []}
                     try:
-                        docs_produtos = db_instance.collection('clinicas').document(clinica_id).collection('estoque_produtos').where(filter=FieldFilter('ativo', '==', True)).order_by('nome').stream()
-                        for doc in docs_produtos:
-                            p_data = doc.to_dict()
-                            if p_data:
-                                produtos_ativos.append({'id': doc.id, 'nome': p_data.get('nome', doc.id)})
-                        
-                        # NOVO: Busca itens de patrimônio
-                        docs_patrimonio = db_instance.collection('clinicas').document(clinica_id).collection('patrimonio').order_by('nome').stream()
-                        for doc in docs_patrimonio:
-                            item_data = doc.to_dict()
-                            if item_data:
-                                patrimonio_itens.append({'id': doc.id, 'nome': item_data.get('nome', doc.id)})
-
+                        opcoes = reference_options(db_instance, clinica_id)
                     except Exception as e:
                         print(f"ERRO: [editar_conta_a_pagar GET] Erro ao carregar produtos/patrimônio: {e}")
                         flash('Erro ao carregar produtos/patrimônio para vincular.', 'warning')
 
-                    return render_template('conta_a_pagar_form.html', conta=conta, action_url=url_for('editar_conta_a_pagar', conta_doc_id=conta_doc_id), produtos_ativos=produtos_ativos, patrimonio_itens=patrimonio_itens)
+                    return render_template('conta_a_pagar_form.html', conta=conta, action_url=url_for('editar_conta_a_pagar', conta_doc_id=conta_doc_id), produtos_ativos=opcoes['produtos'], patrimonio_itens=opcoes['patrimonio'])
             else:
                 flash('Conta a pagar não encontrada.', 'danger')
                 return redirect(url_for('listar_contas_a_pagar'))
@@ -273,10 +266,11 @@ def register_contas_a_pagar_routes(app):
     def marcar_conta_paga(conta_doc_id):
         db_instance = get_db()
         clinica_id = session['clinica_id']
-        conta_ref = db_instance.collection('clinicas').document(clinica_id).collection('contas_a_pagar').document(conta_doc_id)
         try:
-            conta_ref.update({'status': 'paga', 'data_pagamento': datetime.datetime.now(SAO_PAULO_TZ), 'atualizado_em': firestore.SERVER_TIMESTAMP})
+            update_payable(db_instance, clinica_id, conta_doc_id, {'status': 'paga', 'data_pagamento': datetime.datetime.now(SAO_PAULO_TZ), 'atualizado_em': firestore.SERVER_TIMESTAMP})
             flash('Conta a pagar marcada como paga com sucesso!', 'success')
+        except PayableError as e:
+            flash(str(e), 'danger')
         except Exception as e:
             flash(f'Erro ao marcar conta como paga: {e}', 'danger')
             print(f"ERRO: [marcar_conta_paga] {e}")
@@ -289,10 +283,201 @@ def register_contas_a_pagar_routes(app):
         db_instance = get_db()
         clinica_id = session['clinica_id']
         try:
-            db_instance.collection('clinicas').document(clinica_id).collection('contas_a_pagar').document(conta_doc_id).delete()
+            delete_payable(db_instance, clinica_id, conta_doc_id)
             flash('Conta a pagar excluída com sucesso!', 'success')
+        except PayableError as e:
+            flash(str(e), 'danger')
         except Exception as e:
             flash(f'Erro ao excluir conta a pagar: {e}.', 'danger')
             print(f"ERRO: [excluir_conta_a_pagar] {e}")
         return redirect(url_for('listar_contas_a_pagar'))
 
+    @app.route('/api/contas_a_pagar/fluxo_caixa', methods=['GET'], endpoint='fluxo_caixa_contas_a_pagar')
+    @login_required
+    @admin_required
+    def fluxo_caixa_contas_a_pagar():
+        """
+        Projeção do fluxo de caixa: valores pendentes por semana a partir de hoje e o total já vencido.
+        Parâmetro: semanas (padrão 8).
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            semanas = int(request.args.get('semanas', FLUXO_SEMANAS_PADRAO))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Parâmetro semanas inválido.'}), 400
+        try:
+            projecao = cash_flow_projection(db_instance, clinica_id, semanas)
+            return jsonify(dict(projecao, success=True))
+        except Exception as e:
+            print(f"ERRO: [fluxo_caixa_contas_a_pagar] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/contas_a_pagar/totais_mensais', methods=['GET'], endpoint='totais_mensais_contas_a_pagar')
+    @login_required
+    @admin_required
+    def totais_mensais_contas_a_pagar():
+        """
+        Valor e quantidade de contas por status e mês de vencimento, lidos dos totais mensais.
+        Parâmetros: meses (padrão 12, até 36) e depois (meses futuros incluídos, padrão 3).
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            meses = max(1, min(int(request.args.get('meses', 12)), 36))
+            depois = max(0, min(int(request.args.get('depois', 3)), 12))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Parâmetros inválidos.'}), 400
+        try:
+            hoje = datetime.datetime.now(SAO_PAULO_TZ).date()
+            ultimo = hoje.replace(day=1)
+            for _ in range(depois):
+                ultimo = (ultimo + datetime.timedelta(days=32)).replace(day=1)
+            return jsonify({'success': True, 'meses': monthly_due_totals(db_instance, clinica_id, month_range(ultimo, meses + depois))})
+        except Exception as e:
+            print(f"ERRO: [totais_mensais_contas_a_pagar] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/contas_a_pagar/totais_mensais/recalcular', methods=['POST'], endpoint='recalcular_totais_contas_a_pagar')
+    @login_required
+    @admin_required
+    def recalcular_totais_contas_a_pagar():
+        """Recalcula em segundo plano os totais mensais e os termos de busca a partir das contas."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            job_id = schedule_payable_totals(db_instance, clinica_id, force=True)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id)}), 202
+        except Exception as e:
+            print(f"ERRO: [recalcular_totais_contas_a_pagar] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/contas_a_pagar/marcar_pagas', methods=['POST'], endpoint='marcar_contas_pagas')
+    @login_required
+    @admin_required
+    def marcar_contas_pagas():
+        """
+        Baixa em lote: marca como pagas as contas pendentes informadas em JSON, por 'conta_ids' (lista)
+        ou por 'mes' (AAAA-MM: todas as pendentes que vencem no mês). Contas já pagas são ignoradas.
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        data = request.get_json(silent=True) or {}
+        conta_ids = data.get('conta_ids')
+        mes = str(data.get('mes') or '').strip()
+        if conta_ids is not None and (not isinstance(conta_ids, list) or not all(isinstance(i, str) and i for i in conta_ids)):
+            return jsonify({'success': False, 'message': 'conta_ids deve ser uma lista de ids.'}), 400
+        if conta_ids is None and not mes:
+            return jsonify({'success': False, 'message': 'Informe conta_ids ou mes.'}), 400
+        try:
+            if conta_ids is None:
+                datetime.datetime.strptime(mes, '%Y-%m')
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Mês inválido (use AAAA-MM).'}), 400
+
+        try:
+            if conta_ids is None:
+                conta_ids = pending_ids_in_month(db_instance, clinica_id, mes)
+            if len(conta_ids) > CONTAS_BAIXA_MAX:
+                return jsonify({'success': False, 'message': f'Baixe no máximo {CONTAS_BAIXA_MAX} contas por vez.'}), 400
+            pagas = mark_payables_paid(db_instance, clinica_id, conta_ids)
+            return jsonify({'success': True, 'pagas': pagas, 'ignoradas': len(set(conta_ids)) - pagas})
+        except Exception as e:
+            print(f"ERRO: [marcar_contas_pagas] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/contas_a_pagar/recorrentes', methods=['GET'], endpoint='listar_contas_recorrentes')
+    @login_required
+    @admin_required
+    def listar_contas_recorrentes():
+        """Séries de contas recorrentes (ativas; todas com encerradas=1)."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            series = list_series(db_instance, clinica_id, request.args.get('encerradas') == '1')
+            return jsonify({'success': True, 'series': series})
+        except Exception as e:
+            print(f"ERRO: [listar_contas_recorrentes] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/contas_a_pagar/recorrentes', methods=['POST'], endpoint='criar_conta_recorrente')
+    @login_required
+    @admin_required
+    def criar_conta_recorrente():
+        """
+        Cria uma série de contas recorrentes (JSON: descricao, valor, frequencia, data_inicio, data_fim
+        opcional, produto_id e patrimonio_id opcionais) e grava as contas até o horizonte.
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        data = request.get_json(silent=True) or {}
+        frequencia = str(data.get('frequencia') or 'mensal').strip()
+        data_inicio = parse_date_input(str(data.get('data_inicio') or '').strip())
+        data_fim = parse_date_input(str(data.get('data_fim') or '').strip())
+        if not data_inicio:
+            return jsonify({'success': False, 'message': 'Data inicial inválida.'}), 400
+        if data.get('data_fim') and not data_fim:
+            return jsonify({'success': False, 'message': 'Data final inválida.'}), 400
+        try:
+            valor = float(str(data.get('valor') or '0').replace(',', '.'))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Valor deve ser um número válido.'}), 400
+
+        serie_data = {
+            'descricao': str(data.get('descricao') or '').strip(),
+            'valor': valor,
+            'usuario_responsavel': session.get('user_name', 'N/A'),
+        }
+        try:
+            # Vínculos opcionais, com os nomes lidos do cache do formulário
+            opcoes = reference_options(db_instance, clinica_id)
+            for campo, chave in (('produto', 'produtos'), ('patrimonio', 'patrimonio')):
+                vinculo_id = str(data.get(f'{campo}_id') or '').strip()
+                if vinculo_id:
+                    nomes = {item['id']: item['nome'] for item in opcoes[chave]}
+                    if vinculo_id not in nomes:
+                        return jsonify({'success': False, 'message': f'{campo.capitalize()} não encontrado.'}), 400
+                    serie_data.update({f'{campo}_id': vinculo_id, f'{campo}_nome': nomes[vinculo_id]})
+
+            serie_id, geradas = create_series(db_instance, clinica_id, serie_data, frequencia, data_inicio.date(),
+                                              data_fim.date() if data_fim else None)
+            return jsonify({'success': True, 'serie_id': serie_id, 'contas_geradas': geradas}), 201
+        except RecurringPayableError as e:
+            return jsonify({'success': False, 'message': str(e), 'frequencias': list(FREQUENCIAS_RECORRENTES)}), 400
+        except Exception as e:
+            print(f"ERRO: [criar_conta_recorrente] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/contas_a_pagar/recorrentes/<string:serie_id>/encerrar', methods=['POST'], endpoint='encerrar_conta_recorrente')
+    @login_required
+    @admin_required
+    def encerrar_conta_recorrente(serie_id):
+        """Encerra a série (padrão: a partir de hoje; JSON opcional 'a_partir_de') e exclui as contas pendentes seguintes."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        data = request.get_json(silent=True) or {}
+        a_partir_de = parse_date_input(str(data.get('a_partir_de') or '').strip())
+        if data.get('a_partir_de') and not a_partir_de:
+            return jsonify({'success': False, 'message': 'Data inválida.'}), 400
+        try:
+            excluidas = end_series(db_instance, clinica_id, serie_id, a_partir_de.date() if a_partir_de else None)
+            return jsonify({'success': True, 'contas_excluidas': excluidas})
+        except RecurringPayableError as e:
+            return jsonify({'success': False, 'message': str(e)}), 404
+        except Exception as e:
+            print(f"ERRO: [encerrar_conta_recorrente] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/contas_a_pagar/recorrentes/gerar', methods=['POST'], endpoint='gerar_contas_recorrentes')
+    @login_required
+    @admin_required
+    def gerar_contas_recorrentes():
+        """Avança em segundo plano o horizonte de todas as séries ativas, gravando as contas que faltam."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            job_id = schedule_recurring_payables(db_instance, clinica_id, force=True)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id)}), 202
+        except Exception as e:
+            print(f"ERRO: [gerar_contas_recorrentes] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
@@ -0,0 +1,145 @@
+from flask import Blueprint, render_template, session, flash, redirect, url_for, request, jsonify, Response, stream_with_context
+import datetime
+
+from utils import get_db, login_required, admin_required, SAO_PAULO_TZ, start_background_job, resolve_professional_names
+from daily_agenda import (
+    AGENDA_EXPORTACAO_MAX_DIAS, get_day, ical_lines, iter_sessions, rebuild_daily_agendas, schedule_agenda_rebuild,
+)
+from recurrence import horizon_end
+
+daily_agenda_bp = Blueprint('daily_agenda', __name__)
+
+# Período exportado quando o cliente não informa as datas
+_EXPORTACAO_DIAS_PADRAO = 90
+
+def _parse_date(value, default):
+    if not value:
+        return default
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+def _resolve_professional(db_instance):
+    """
+    Profissional cuja agenda será exibida: o escolhido pelo admin (parâmetro profissional_id)
+    ou o do usuário logado. Retorna (profissional_id, mensagem de erro).
+    """
+    if session.get('user_role') == 'admin':
+        return request.args.get('profissional_id') or None, None
+    user_doc = db_instance.collection('User').document(session.get('user_uid')).get(field_paths=['profissional_id'])
+    profissional_id = (user_doc.to_dict() or {}).get('profissional_id') if user_doc.exists else None
+    if not profissional_id:
+        return None, "Sua conta de usuário não está associada a um perfil de profissional. Contate o administrador."
+    return profissional_id, None
+
+@daily_agenda_bp.route('/agenda/hoje', methods=['GET'], endpoint='agenda_hoje')
+@login_required
+def agenda_hoje():
+    """
+    Agenda do dia de um profissional, lida de um único documento pré-calculado (ou dos agendamentos,
+    enquanto as agendas da clínica ainda estão sendo construídas).
+    """
+    db_instance = get_db()
+    clinica_id = session['clinica_id']
+    is_admin = session.get('user_role') == 'admin'
+    hoje = datetime.datetime.now(SAO_PAULO_TZ).date()
+
+    try:
+        dia = _parse_date(request.args.get('data'), hoje)
+    except ValueError:
+        flash("Formato de data inválido. Use YYYY-MM-DD.", "danger")
+        dia = hoje
+
+    sessoes, professionals, profissional_nome = [], [], None
+    try:
+        profissional_id, erro = _resolve_professional(db_instance)
+        if erro:
+            flash(erro, "danger")
+            return redirect(url_for('index'))
+        if is_admin:
+            for prof_doc in db_instance.collection('clinicas').document(clinica_id).collection('profissionais').select(['nome']).stream():
+                professionals.append({'id': prof_doc.id, 'nome': (prof_doc.to_dict() or {}).get('nome', 'N/A')})
+        schedule_agenda_rebuild(db_instance, clinica_id)
+        if profissional_id:
+            sessoes = get_day(db_instance, clinica_id, profissional_id, dia)
+            profissional_nome = resolve_professional_names(db_instance, clinica_id, [profissional_id]).get(profissional_id, 'N/A')
+    except Exception as e:
+        flash(f"Erro ao carregar a agenda do dia: {e}", "danger")
+        print(f"Erro agenda_hoje: {e}")
+        profissional_id = None
+
+    return render_template(
+        'agenda_hoje.html',
+        sessoes=sessoes,
+        dia=dia,
+        dia_anterior=(dia - datetime.timedelta(days=1)).isoformat(),
+        dia_seguinte=(dia + datetime.timedelta(days=1)).isoformat(),
+        is_hoje=(dia == hoje),
+        profissional_id=profissional_id,
+        profissional_nome=profissional_nome,
+        professionals=professionals,
+        is_admin=is_admin,
+    )
+
+@daily_agenda_bp.route('/agenda/exportar.ics', methods=['GET'], endpoint='exportar_agenda_ical')
+@login_required
+def exportar_agenda_ical():
+    """
+    Exporta a agenda do profissional em iCalendar, gerada e enviada aos poucos.
+    Parâmetros: inicio e fim (AAAA-MM-DD; padrão: hoje e os próximos 90 dias), profissional_id (admins).
+    """
+    db_instance = get_db()
+    clinica_id = session['clinica_id']
+    hoje = datetime.datetime.now(SAO_PAULO_TZ).date()
+    try:
+        inicio = _parse_date(request.args.get('inicio'), hoje)
+        fim = _parse_date(request.args.get('fim'), inicio + datetime.timedelta(days=_EXPORTACAO_DIAS_PADRAO))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Formato de data inválido. Use YYYY-MM-DD.'}), 400
+    if fim < inicio or (fim - inicio).days + 1 > AGENDA_EXPORTACAO_MAX_DIAS:
+        return jsonify({'success': False, 'message': f'Informe um período de até {AGENDA_EXPORTACAO_MAX_DIAS} dias.'}), 400
+
+    try:
+        profissional_id, erro = _resolve_professional(db_instance)
+        if erro:
+            return jsonify({'success': False, 'message': erro}), 403
+        if not profissional_id:
+            return jsonify({'success': False, 'message': 'Informe o profissional_id.'}), 400
+        profissional_nome = resolve_professional_names(db_instance, clinica_id, [profissional_id]).get(profissional_id)
+        if not profissional_nome:
+            return jsonify({'success': False, 'message': 'Profissional não encontrado.'}), 404
+        schedule_agenda_rebuild(db_instance, clinica_id)
+    except Exception as e:
+        print(f"Erro ao preparar a exportação da agenda: {e}")
+        return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    lines = ical_lines(iter_sessions(db_instance, clinica_id, profissional_id, inicio, fim),
+                       f"Agenda - {profissional_nome}")
+    filename = f"agenda_{profissional_id}_{inicio.isoformat()}_{fim.isoformat()}.ics"
+    return Response(stream_with_context(lines), mimetype='text/calendar',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@daily_agenda_bp.route('/api/agenda/reconstruir', methods=['POST'], endpoint='reconstruir_agendas_diarias')
+@login_required
+@admin_required
+def reconstruir_agendas_diarias():
+    """
+    Recalcula em segundo plano as agendas diárias a partir dos agendamentos.
+    Parâmetros (formulário): inicio e fim (AAAA-MM-DD; padrão: últimos 30 dias até o horizonte das séries).
+    """
+    db_instance = get_db()
+    clinica_id = session['clinica_id']
+    hoje = datetime.datetime.now(SAO_PAULO_TZ).date()
+    try:
+        inicio = _parse_date(request.form.get('inicio'), hoje - datetime.timedelta(days=30))
+        fim = _parse_date(request.form.get('fim'), horizon_end())
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Formato de data inválido. Use YYYY-MM-DD.'}), 400
+    if fim < inicio:
+        return jsonify({'success': False, 'message': 'A data final deve ser posterior à inicial.'}), 400
+
+    try:
+        job_id = start_background_job('Reconstrução das agendas diárias', rebuild_daily_agendas,
+                                      db_instance, clinica_id, inicio, fim, clinica_id=clinica_id)
+        return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id)}), 202
+    except Exception as e:
+        print(f"Erro ao iniciar a reconstrução das agendas diárias: {e}")
+        return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
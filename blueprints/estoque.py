@@ -2,10 +2,34 @@ from flask import render_template, session, flash, redirect, url_for, request, j
 from google.cloud.firestore_v1.base_query import FieldFilter
 from google.cloud import firestore
 import datetime
+import itertools
 import pytz
 
 # Importar utils
-from utils import get_db, login_required, admin_required, SAO_PAULO_TZ, convert_doc_to_dict, parse_date_input
+from utils import get_db, login_required, admin_required, SAO_PAULO_TZ, convert_doc_to_dict, parse_date_input, start_background_job
+from query_registry import register_query
+from stock_ledger import (
+    LOTE_MAX_LINHAS, TIPOS_MOVIMENTACAO, StockMovementError, apply_movements, below_minimum, invalidate_product_index,
+    iter_file_rows, list_lots, lot_history, normalize_name, product_index, record_movement, refresh_stock_flags, schedule_stock_reconciliation,
+    validate_movements,
+)
+from stock_history import (
+    CONSUMO_MESES_MAXIMO, CONSUMO_MESES_PADRAO, HISTORICO_JANELA_MAXIMA_DIAS, HISTORICO_JANELA_PADRAO_DIAS,
+    HISTORICO_PRODUTOS_MAX, history_page, matching_products, month_range, monthly_totals, rebuild_monthly_totals,
+)
+from stock_alerts import (
+    ALERTA_VENCIMENTO_DIAS, alert_counts, catalog_fields, get_expiry_alerts, invalidate_alert_counts,
+    schedule_stock_alerts, search_bounds, start_of_day,
+)
+
+register_query('estoque.listar', 'clinicas/{clinica_id}/estoque_produtos',
+               range_fields=('nome_busca',), optional=('nome_busca',))
+register_query('estoque.listar_estoque_baixo', 'clinicas/{clinica_id}/estoque_produtos',
+               equality=('ativo', 'abaixo_minimo'), range_fields=('nome_busca',), optional=('nome_busca',))
+register_query('estoque.vencidos', 'clinicas/{clinica_id}/estoque_produtos',
+               range_fields=('vence_em',), python_filter='busca por nome dentro dos produtos vencidos')
+register_query('estoque.produtos_ativos_por_nome', 'clinicas/{clinica_id}/estoque_produtos',
+               equality=('ativo',), order_by=('nome',))
 
 def register_estoque_routes(app):
     @app.route('/estoque', endpoint='listar_estoque')
@@ -17,63 +41,75 @@ def register_estoque_routes(app):
         produtos_lista = []
         
         search_query = request.args.get('search', '').strip()
-        filter_type = request.args.get('filter', 'todos').strip() # 'todos', 'estoque_baixo', 'vencidos'
+        filter_type = request.args.get('filter', 'todos').strip() # 'todos', 'estoque_baixo', 'vencidos', 'a_vencer'
 
-        print(f"DEBUG: [listar_estoque] Iniciando listagem de estoque para clinica_id: {clinica_id}")
-        print(f"DEBUG: [listar_estoque] Search Query: '{search_query}', Filter Type: '{filter_type}'")
+        # Obtenha a data atual uma vez, já no fuso horário correto
+        hoje_data = datetime.datetime.now(SAO_PAULO_TZ).date() 
+        alertas = {'estoque_baixo': 0, 'vencidos': 0, 'total': 0}
+        vencimentos = None
 
         try:
-            # A consulta inicial pode ser mais ampla e o filtro aplicado em Python
-            # para lidar com 'vencidos' que compara com a data atual.
-            # Não adicione order_by aqui se não for estritamente necessário para evitar índices extras
-            # O order_by('nome') já está no final para a lista Python
-            docs = produtos_ref.stream() 
-            
-            # Obtenha a data atual uma vez, já no fuso horário correto
-            hoje_data = datetime.datetime.now(SAO_PAULO_TZ).date() 
-
-            for doc in docs:
-                produto = doc.to_dict()
-                if produto:
-                    produto['id'] = doc.id
-                    
-                    # Formatar data de validade para exibição no frontend
-                    if 'data_validade' in produto and isinstance(produto['data_validade'], datetime.datetime):
-                        produto['data_validade_fmt'] = produto['data_validade'].strftime('%d/%m/%Y')
-                        produto['data_validade_obj'] = produto['data_validade'].date() # Para comparação no Jinja
-                    else:
-                        produto['data_validade_fmt'] = 'N/A' # Se não houver data ou formato inválido
-                        produto['data_validade_obj'] = None
-
-
-                    # Aplicar filtros
-                    if filter_type == 'estoque_baixo':
-                        if produto.get('quantidade_atual', 0) <= produto.get('estoque_minimo', 0):
-                            produtos_lista.append(produto)
-                    elif filter_type == 'vencidos':
-                        # Verifica se a data de validade existe e é anterior à data atual
-                        if produto.get('data_validade_obj') and produto['data_validade_obj'] < hoje_data:
-                            produtos_lista.append(produto)
-                    else: # 'todos' ou qualquer outro filtro padrão
+            # As abas e a busca usam os campos desnormalizados (abaixo_minimo, vence_em, nome_busca),
+            # mantidos pelas movimentações e pelo cadastro, em vez de percorrer todos os produtos
+            if filter_type == 'a_vencer':
+                # Lista de lotes pré-calculada pela tarefa diária de alertas (um item por lote)
+                vencimentos = get_expiry_alerts(db_instance, clinica_id) or {}
+                produtos_lista = [dict(item, ativo=True, data_validade=item.get('vence_em'),
+                                       lote_descricao=f"Lote {item.get('marca') or item.get('lote_id', '')[:8]}")
+                                  for item in vencimentos.get('a_vencer', [])]
+            else:
+                query = produtos_ref
+                if filter_type == 'estoque_baixo':
+                    # Mesmo critério do contador de alertas (alert_counts): só produtos ativos
+                    query = query.where(filter=FieldFilter('ativo', '==', True))\
+                        .where(filter=FieldFilter('abaixo_minimo', '==', True))
+                elif filter_type == 'vencidos':
+                    query = query.where(filter=FieldFilter('vence_em', '<', start_of_day(hoje_data)))
+                if search_query and filter_type != 'vencidos':
+                    inicio, fim = search_bounds(search_query)
+                    query = query.where(filter=FieldFilter('nome_busca', '>=', inicio)).where(filter=FieldFilter('nome_busca', '<=', fim))
+                for doc in query.stream():
+                    produto = doc.to_dict()
+                    if produto:
+                        produto['id'] = doc.id
                         produtos_lista.append(produto)
+
+            # Os vencidos são poucos: a busca por prefixo é aplicada sobre eles, sem uma segunda desigualdade
+            if search_query and filter_type in ('vencidos', 'a_vencer'):
+                inicio, _ = search_bounds(search_query)
+                produtos_lista = [p for p in produtos_lista if normalize_name(p.get('nome')).startswith(inicio)]
+
+            for produto in produtos_lista:
+                # Formatar data de validade para exibição no frontend
+                if isinstance(produto.get('data_validade'), datetime.datetime):
+                    data_validade = produto['data_validade'].astimezone(SAO_PAULO_TZ)
+                    produto['data_validade_fmt'] = data_validade.strftime('%d/%m/%Y')
+                    produto['data_validade_obj'] = data_validade.date() # Para comparação no Jinja
                 else:
-                    print(f"DEBUG: [listar_estoque] Documento vazio encontrado: {doc.id}")
+                    produto['data_validade_fmt'] = 'N/A' # Se não houver data ou formato inválido
+                    produto['data_validade_obj'] = None
 
-            # Se houver uma query de busca, filtre a lista final (após os filtros de aba)
-            if search_query:
-                produtos_lista = [p for p in produtos_lista if search_query.lower() in p.get('nome', '').lower()]
-            
-            # Ordenar a lista final por nome para consistência
-            produtos_lista.sort(key=lambda x: x.get('nome', '').lower())
+            # Ordenar a lista final por nome para consistência (a_vencer já vem por data de validade)
+            if filter_type != 'a_vencer':
+                produtos_lista.sort(key=lambda x: x.get('nome', '').lower())
 
-            print(f"DEBUG: [listar_estoque] Produtos encontrados após filtros e busca: {len(produtos_lista)}")
+            alertas = alert_counts(db_instance, clinica_id)
 
         except Exception as e:
             flash(f'Erro ao listar produtos do estoque: {e}. Verifique seus índices do Firestore.', 'danger')
             print(f"ERRO: [listar_estoque] {e}") # Log mais detalhado
         
+        # Confere os saldos contra o livro de movimentações e recalcula os vencimentos
+        # em segundo plano (no máximo uma vez por dia)
+        try:
+            schedule_stock_reconciliation(db_instance, clinica_id)
+            schedule_stock_alerts(db_instance, clinica_id)
+        except Exception as e:
+            print(f"Erro ao agendar as tarefas diárias do estoque: {e}")
+
         # Passar a data atual para o template para a lógica de "Vencidos" no frontend
-        return render_template('estoque.html', produtos=produtos_lista, search_query=search_query, filter_type=filter_type, now=hoje_data)
+        return render_template('estoque.html', produtos=produtos_lista, search_query=search_query, filter_type=filter_type,
+                               now=hoje_data, alertas=alertas, vencimentos=vencimentos, alerta_dias=ALERTA_VENCIMENTO_DIAS)
 
     @app.route('/estoque/novo', methods=['GET', 'POST'], endpoint='adicionar_produto_estoque')
     @login_required
@@ -107,8 +143,13 @@ def register_estoque_routes(app):
                     'quantidade_atual': 0, # Novo produto começa com 0 em estoque
                     'data_validade': data_validade_dt if data_validade_dt else None, # Armazena como datetime.datetime
                     'ativo': ativo,
+                    'abaixo_minimo': below_minimum(0, estoque_minimo),
+                    'vence_em': None, # Validade do primeiro lote aberto; o produto começa sem lotes
+                    **catalog_fields(nome),
                     'criado_em': firestore.SERVER_TIMESTAMP
                 })
+                invalidate_product_index(clinica_id)
+                invalidate_alert_counts(clinica_id)
                 flash('Produto adicionado ao estoque com sucesso!', 'success')
                 return redirect(url_for('listar_estoque'))
             except ValueError:
@@ -146,6 +187,7 @@ def register_estoque_routes(app):
                     'estoque_minimo': estoque_minimo,
                     'unidade_medida': unidade_medida if unidade_medida else None,
                     'ativo': ativo,
+                    **catalog_fields(nome),
                     'atualizado_em': firestore.SERVER_TIMESTAMP
                 }
                 # Atualiza ou remove o campo data_validade
@@ -155,6 +197,10 @@ def register_estoque_routes(app):
                     update_data['data_validade'] = firestore.DELETE_FIELD # Remove o campo se estiver vazio
 
                 produto_ref.update(update_data)
+                # O estoque mínimo e a validade do saldo sem lote podem ter mudado: reconfere os alertas
+                refresh_stock_flags(db_instance, clinica_id, [produto_doc_id])
+                invalidate_product_index(clinica_id)
+                invalidate_alert_counts(clinica_id)
                 flash('Produto do estoque atualizado com sucesso!', 'success')
                 return redirect(url_for('listar_estoque'))
             except ValueError:
@@ -198,6 +244,8 @@ def register_estoque_routes(app):
                     current_status = data.get('ativo', False)    
                     new_status = not current_status
                     produto_ref.update({'ativo': new_status, 'atualizado_em': firestore.SERVER_TIMESTAMP})
+                    invalidate_product_index(clinica_id)
+                    invalidate_alert_counts(clinica_id)
                     flash(f'Produto {"ativado" if new_status else "desativado"} com sucesso!', 'success')
                 else:
                     flash('Dados do produto inválidos.', 'danger')
@@ -224,6 +272,8 @@ def register_estoque_routes(app):
                 return redirect(url_for('listar_estoque'))
 
             db_instance.collection('clinicas').document(clinica_id).collection('estoque_produtos').document(produto_doc_id).delete()
+            invalidate_product_index(clinica_id)
+            invalidate_alert_counts(clinica_id)
             flash('Produto do estoque excluído com sucesso!', 'success')
         except Exception as e:
             flash(f'Erro ao excluir produto do estoque: {e}.', 'danger')
@@ -236,16 +286,6 @@ def register_estoque_routes(app):
         db_instance = get_db()
         clinica_id = session['clinica_id']
         
-        produtos_ativos_lista = []
-        try:
-            produtos_docs = db_instance.collection('clinicas').document(clinica_id).collection('estoque_produtos').where(filter=FieldFilter('ativo', '==', True)).order_by('nome').stream()
-            for doc in produtos_docs:
-                p_data = doc.to_dict()
-                if p_data: produtos_ativos_lista.append({'id': doc.id, 'nome': p_data.get('nome', doc.id), 'quantidade_atual': p_data.get('quantidade_atual', 0)})
-        except Exception as e:
-            flash('Erro ao carregar produtos ativos para movimentação.', 'danger')
-            print(f"ERRO: [movimentar_estoque GET] ao carregar produtos: {e}")
-
         if request.method == 'POST':
             try:
                 produto_id = request.form['produto_id']
@@ -279,71 +319,30 @@ def register_estoque_routes(app):
                         flash('Formato de data de vencimento inválido. Use AAAA-MM-DD.', 'danger')
                         return redirect(url_for('listar_estoque') + '#movimentacaoEstoqueModal') # Redireciona para o modal
 
-                produto_ref = db_instance.collection('clinicas').document(clinica_id).collection('estoque_produtos').document(produto_id)
-                produto_doc = produto_ref.get()
-                if not produto_doc.exists:
-                    flash('Produto não encontrado para movimentação.', 'danger')
-                    return redirect(url_for('listar_estoque'))
-                
-                produto_data = produto_doc.to_dict()
-                quantidade_atual = produto_data.get('quantidade_atual', 0)
-                produto_nome = produto_data.get('nome', 'N/A')
-
-                if tipo_movimentacao == 'entrada':
-                    nova_quantidade = quantidade_atual + quantidade
-                elif tipo_movimentacao == 'saida':
-                    if quantidade_atual < quantidade:
-                        flash('Quantidade em estoque insuficiente para esta saída.', 'danger')
-                        return redirect(url_for('listar_estoque') + '#movimentacaoEstoqueModal') # Redireciona para o modal
-                    nova_quantidade = quantidade_atual - quantidade
-                else:
+                if tipo_movimentacao not in TIPOS_MOVIMENTACAO:
                     flash('Tipo de movimentação inválido.', 'danger')
                     return redirect(url_for('listar_estoque'))
 
-                # Atualiza a quantidade atual do produto
-                produto_ref.update({'quantidade_atual': nova_quantidade, 'atualizado_em': firestore.SERVER_TIMESTAMP})
-
-                # Registra a movimentação
-                db_instance.collection('clinicas').document(clinica_id).collection('estoque_movimentacoes').add({
-                    'produto_id': produto_id,
-                    'produto_nome': produto_nome,
-                    'tipo_movimentacao': tipo_movimentacao,
-                    'quantidade': quantidade,
-                    'quantidade_apos_movimento': nova_quantidade,
-                    'marca': marca if marca else None,
-                    'preco_total': preco_total if preco_total else None,
-                    'data_vencimento': data_vencimento if data_vencimento else None, # Armazenado como datetime.datetime
-                    'criar_conta_pagar': criar_conta_pagar,
-                    'data_movimentacao': datetime.datetime.now(SAO_PAULO_TZ),
-                    'usuario_responsavel': session.get('user_name', 'N/A')
-                })
-
-                # Lógica para criar Conta a Pagar
-                if tipo_movimentacao == 'entrada' and criar_conta_pagar:
-                    if preco_total <= 0 and not data_vencimento:
-                        flash('Para criar uma Conta a Pagar, o Preço Total ou a Data de Vencimento são obrigatórios.', 'warning')
-                        # Não impede a movimentação de estoque, apenas avisa sobre a conta a pagar
-                    else:
-                        try:
-                            db_instance.collection('clinicas').document(clinica_id).collection('contas_a_pagar').add({
-                                'descricao': f'Compra de estoque: {produto_nome} (Qtd: {quantidade})',
-                                'produto_id': produto_id,
-                                'produto_nome': produto_nome,
-                                'valor': preco_total,
-                                'data_vencimento': data_vencimento if data_vencimento else None,
-                                'status': 'pendente', # Ou 'aberto', 'a_pagar'
-                                'data_lancamento': datetime.datetime.now(SAO_PAULO_TZ),
-                                'usuario_responsavel': session.get('user_name', 'N/A')
-                            })
-                            flash('Conta a Pagar criada com sucesso!', 'info')
-                        except Exception as e:
-                            flash(f'Erro ao criar Conta a Pagar: {e}', 'danger')
-                            print(f"ERRO: [movimentar_estoque POST] Erro ao criar Conta a Pagar: {e}")
-
-
-                flash(f'Movimentação de estoque de {produto_nome} ({tipo_movimentacao}) registrada com sucesso!', 'success')
+                # A conta a pagar só é criada em entradas com preço ou vencimento
+                criar_conta = tipo_movimentacao == 'entrada' and criar_conta_pagar
+                if criar_conta and preco_total <= 0 and not data_vencimento:
+                    flash('Para criar uma Conta a Pagar, o Preço Total ou a Data de Vencimento são obrigatórios.', 'warning')
+                    criar_conta = False
+
+                # Saldo, lançamento e conta a pagar são gravados juntos (ou nada é gravado)
+                resultado = record_movement(db_instance, clinica_id, produto_id, tipo_movimentacao, quantidade,
+                                            marca=marca, preco_total=preco_total, data_vencimento=data_vencimento,
+                                            criar_conta_pagar=criar_conta, usuario=session.get('user_name', 'N/A'))
+                invalidate_alert_counts(clinica_id)
+                if resultado['conta_id']:
+                    flash('Conta a Pagar criada com sucesso!', 'info')
+
+                flash(f"Movimentação de estoque de {resultado['produto_nome']} ({tipo_movimentacao}) registrada com sucesso!", 'success')
                 return redirect(url_for('listar_estoque'))
 
+            except StockMovementError as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('listar_estoque') + '#movimentacaoEstoqueModal') # Redireciona para o modal
             except ValueError:
                 flash('Quantidade e preço devem ser números válidos.', 'danger')
                 return redirect(url_for('listar_estoque') + '#movimentacaoEstoqueModal') # Redireciona para o modal
@@ -352,43 +351,260 @@ def register_estoque_routes(app):
                 print(f"ERRO: [movimentar_estoque POST] {e}")
                 return redirect(url_for('listar_estoque') + '#movimentacaoEstoqueModal') # Redireciona para o modal
         
+        # A lista de produtos só é necessária para exibir o formulário (o POST sempre redireciona)
+        produtos_ativos_lista = []
+        try:
+            produtos_docs = db_instance.collection('clinicas').document(clinica_id).collection('estoque_produtos').where(filter=FieldFilter('ativo', '==', True)).order_by('nome').stream()
+            for doc in produtos_docs:
+                p_data = doc.to_dict()
+                if p_data: produtos_ativos_lista.append({'id': doc.id, 'nome': p_data.get('nome', doc.id), 'quantidade_atual': p_data.get('quantidade_atual', 0)})
+        except Exception as e:
+            flash('Erro ao carregar produtos ativos para movimentação.', 'danger')
+            print(f"ERRO: [movimentar_estoque GET] ao carregar produtos: {e}")
+
         return render_template('movimentacao_estoque_form.html', produtos=produtos_ativos_lista, action_url=url_for('movimentar_estoque'))
 
+    @app.route('/api/estoque/reconciliar', methods=['POST'], endpoint='reconciliar_estoque')
+    @login_required
+    @admin_required
+    def reconciliar_estoque():
+        """Recalcula em segundo plano os saldos a partir do livro e marca os produtos divergentes."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            job_id = schedule_stock_reconciliation(db_instance, clinica_id, force=True)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id)}), 202
+        except Exception as e:
+            print(f"ERRO: [reconciliar_estoque] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/estoque/alertas/recalcular', methods=['POST'], endpoint='recalcular_alertas_estoque')
+    @login_required
+    @admin_required
+    def recalcular_alertas_estoque():
+        """Recalcula em segundo plano as listas de produtos vencidos e a vencer (estoque_alertas/vencimentos)."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            job_id = schedule_stock_alerts(db_instance, clinica_id, force=True)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id)}), 202
+        except Exception as e:
+            print(f"ERRO: [recalcular_alertas_estoque] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/estoque/produtos/<string:produto_id>/lotes', methods=['GET'], endpoint='listar_lotes_produto')
+    @login_required
+    def listar_lotes_produto(produto_id):
+        """Lotes do produto na ordem de consumo (FEFO). Parâmetro: todos=1 inclui os lotes esgotados."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            lotes = list_lots(db_instance, clinica_id, produto_id, incluir_esgotados=request.args.get('todos') == '1')
+            return jsonify({'success': True, 'lotes': [{
+                'id': lote['id'],
+                'marca': lote.get('marca'),
+                'quantidade_inicial': lote.get('quantidade_inicial', 0),
+                'quantidade_atual': lote.get('quantidade_atual', 0),
+                'esgotado': lote.get('esgotado', False),
+                'origem': lote.get('origem'),
+                'data_validade': lote['data_validade'].astimezone(SAO_PAULO_TZ).strftime('%Y-%m-%d') if lote.get('data_validade') else None,
+            } for lote in lotes]})
+        except Exception as e:
+            print(f"ERRO: [listar_lotes_produto] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/estoque/produtos/<string:produto_id>/lotes/<string:lote_id>/historico', methods=['GET'], endpoint='historico_lote')
+    @login_required
+    def historico_lote(produto_id, lote_id):
+        """Movimentações que criaram ou consumiram o lote, com a quantidade movimentada no lote."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            movimentacoes = []
+            for mov in lot_history(db_instance, clinica_id, produto_id, lote_id):
+                no_lote = next((item for item in mov.get('lotes', []) if item.get('lote_id') == lote_id), {})
+                movimentacoes.append({
+                    'id': mov['id'],
+                    'tipo_movimentacao': mov.get('tipo_movimentacao'),
+                    'quantidade': no_lote.get('quantidade', 0),
+                    'quantidade_movimentacao': mov.get('quantidade', 0),
+                    'usuario_responsavel': mov.get('usuario_responsavel'),
+                    'data_movimentacao': mov['data_movimentacao'].astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M') if isinstance(mov.get('data_movimentacao'), datetime.datetime) else None,
+                })
+            return jsonify({'success': True, 'movimentacoes': movimentacoes})
+        except Exception as e:
+            print(f"ERRO: [historico_lote] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/estoque/movimentacoes/lote', methods=['POST'], endpoint='movimentar_estoque_lote')
+    @login_required
+    def movimentar_estoque_lote():
+        """
+        Movimenta vários produtos de uma vez.
+        JSON: {movimentos: [{produto_id | produto, tipo, quantidade, marca, preco_total, data_vencimento}],
+               criar_conta_pagar: bool, conta_data_vencimento: 'AAAA-MM-DD'}.
+        As linhas válidas são gravadas; as inválidas voltam em 'erros' com o número da linha (a partir de 1).
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        data = request.get_json(silent=True) or {}
+        movimentos = data.get('movimentos')
+        if not isinstance(movimentos, list) or not movimentos:
+            return jsonify({'success': False, 'message': 'Informe a lista de movimentos.'}), 400
+        if len(movimentos) > LOTE_MAX_LINHAS:
+            return jsonify({'success': False, 'message': f'Envie no máximo {LOTE_MAX_LINHAS} movimentos por vez.'}), 400
+        conta_data_vencimento = parse_date_input(data.get('conta_data_vencimento'))
+
+        try:
+            validos, erros = validate_movements(product_index(db_instance, clinica_id),
+                                                ((linha, row if isinstance(row, dict) else {}) for linha, row in enumerate(movimentos, start=1)))
+            if not validos:
+                return jsonify({'success': False, 'message': 'Nenhum movimento válido.', 'erros': erros}), 400
+            resultado = apply_movements(db_instance, clinica_id, validos, criar_conta_pagar=bool(data.get('criar_conta_pagar')),
+                                        conta_data_vencimento=conta_data_vencimento, usuario=session.get('user_name', 'N/A'))
+            invalidate_alert_counts(clinica_id)
+            resultado['erros'] = sorted(erros + resultado['erros'], key=lambda erro: erro['linha'])
+            return jsonify(dict(resultado, success=True))
+        except Exception as e:
+            print(f"ERRO: [movimentar_estoque_lote] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/estoque/importar', methods=['POST'], endpoint='importar_movimentacoes_estoque')
+    @login_required
+    def importar_movimentacoes_estoque():
+        """
+        Importa movimentações de um arquivo .csv ou .xlsx (campo 'arquivo'), com as colunas produto
+        (ou produto_id), tipo, quantidade e, opcionalmente, marca, preco_total e data_vencimento.
+        O arquivo é validado durante o envio; a gravação roda em segundo plano (202 com job_id).
+        Formulário: criar_conta_pagar ('1' para gerar uma conta consolidada) e conta_data_vencimento.
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        arquivo = request.files.get('arquivo')
+        if not arquivo or not arquivo.filename:
+            return jsonify({'success': False, 'message': 'Envie o arquivo da movimentação.'}), 400
+
+        try:
+            rows = itertools.islice(iter_file_rows(arquivo), LOTE_MAX_LINHAS + 1)
+            validos, erros = validate_movements(product_index(db_instance, clinica_id), rows)
+        except StockMovementError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        except Exception as e:
+            print(f"ERRO: [importar_movimentacoes_estoque] leitura do arquivo: {e}")
+            return jsonify({'success': False, 'message': f'Não foi possível ler o arquivo: {e}'}), 400
+        if len(validos) + len(erros) > LOTE_MAX_LINHAS:
+            return jsonify({'success': False, 'message': f'O arquivo deve ter no máximo {LOTE_MAX_LINHAS} linhas.'}), 400
+        if not validos:
+            return jsonify({'success': False, 'message': 'Nenhuma linha válida no arquivo.', 'erros': erros}), 400
+
+        try:
+            job_id = start_background_job('Importação de movimentações de estoque', apply_movements,
+                                          db_instance, clinica_id, validos,
+                                          criar_conta_pagar=request.form.get('criar_conta_pagar') == '1',
+                                          conta_data_vencimento=parse_date_input(request.form.get('conta_data_vencimento', '').strip()),
+                                          usuario=session.get('user_name', 'N/A'), clinica_id=clinica_id)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id),
+                            'linhas_validas': len(validos), 'erros': erros}), 202
+        except Exception as e:
+            print(f"ERRO: [importar_movimentacoes_estoque] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
     @app.route('/estoque/movimentacoes_historico', methods=['GET'], endpoint='historico_movimentacoes')
     @login_required
     def historico_movimentacoes():
+        """
+        Histórico paginado de movimentações numa janela de datas.
+        Parâmetros: inicio e fim (AAAA-MM-DD; padrão: últimos 30 dias), type, search (início do nome do
+        produto), produto_id e cursor (id do último lançamento da página anterior).
+        """
         db_instance = get_db()
         clinica_id = session['clinica_id']
         movimentacoes_lista = []
+        proximo_cursor = None
         
         search_query = request.args.get('search', '').strip()
         filter_type = request.args.get('type', '').strip() # 'entrada', 'saida'
-        
-        query = db_instance.collection('clinicas').document(clinica_id).collection('estoque_movimentacoes').order_by('data_movimentacao', direction=firestore.Query.DESCENDING)
+        produto_id = request.args.get('produto_id', '').strip()
+        cursor = request.args.get('cursor', '').strip() or None
+        hoje = datetime.datetime.now(SAO_PAULO_TZ).date()
+        if filter_type not in TIPOS_MOVIMENTACAO:
+            filter_type = ''
 
-        if search_query:
-            query = query.where(filter=FieldFilter('produto_nome', '>=', search_query)).where(filter=FieldFilter('produto_nome', '<=', search_query + '\uf8ff'))
-        if filter_type:
-            query = query.where(filter=FieldFilter('tipo_movimentacao', '==', filter_type))
+        try:
+            fim = datetime.datetime.strptime(request.args['fim'], '%Y-%m-%d').date() if request.args.get('fim') else hoje
+            inicio = datetime.datetime.strptime(request.args['inicio'], '%Y-%m-%d').date() if request.args.get('inicio') \
+                else fim - datetime.timedelta(days=HISTORICO_JANELA_PADRAO_DIAS - 1)
+        except ValueError:
+            flash('Formato de data inválido. Use AAAA-MM-DD.', 'danger')
+            fim = hoje
+            inicio = fim - datetime.timedelta(days=HISTORICO_JANELA_PADRAO_DIAS - 1)
+        if inicio > fim or (fim - inicio).days + 1 > HISTORICO_JANELA_MAXIMA_DIAS:
+            flash(f'Informe um período de até {HISTORICO_JANELA_MAXIMA_DIAS} dias.', 'warning')
+            inicio = fim - datetime.timedelta(days=HISTORICO_JANELA_PADRAO_DIAS - 1)
 
         try:
-            docs = query.stream()
-            for doc in docs:
-                mov = doc.to_dict()
-                if mov:
-                    mov['id'] = doc.id
-                    if 'data_movimentacao' in mov and isinstance(mov['data_movimentacao'], datetime.datetime):
-                        mov['data_movimentacao_fmt'] = mov['data_movimentacao'].astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M')
-                    if 'data_vencimento' in mov and isinstance(mov['data_vencimento'], datetime.datetime): # Alterado para datetime.datetime
-                        mov['data_vencimento_fmt'] = mov['data_vencimento'].strftime('%d/%m/%Y')
-                    else:
-                        mov['data_vencimento_fmt'] = 'N/A' # Garante 'N/A' se não for datetime.datetime
-                    movimentacoes_lista.append(mov)
+            produto_ids = [produto_id] if produto_id else None
+            if search_query and not produto_id:
+                produto_ids, truncado = matching_products(product_index(db_instance, clinica_id), search_query)
+                if truncado:
+                    flash(f'Muitos produtos correspondem à busca; exibindo os {HISTORICO_PRODUTOS_MAX} primeiros. Refine o nome.', 'info')
+            if produto_ids != []:
+                movimentacoes_lista, proximo_cursor = history_page(db_instance, clinica_id, inicio, fim, filter_type or None,
+                                                                   produto_ids, request.args.get('limit'), cursor)
+            for mov in movimentacoes_lista:
+                if 'data_movimentacao' in mov and isinstance(mov['data_movimentacao'], datetime.datetime):
+                    mov['data_movimentacao_fmt'] = mov['data_movimentacao'].astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M')
+                if 'data_vencimento' in mov and isinstance(mov['data_vencimento'], datetime.datetime): # Alterado para datetime.datetime
+                    mov['data_vencimento_fmt'] = mov['data_vencimento'].strftime('%d/%m/%Y')
+                else:
+                    mov['data_vencimento_fmt'] = 'N/A' # Garante 'N/A' se não for datetime.datetime
         except Exception as e:
             flash(f'Erro ao listar histórico de movimentações: {e}.', 'danger')
             print(f"ERRO: [historico_movimentacoes] {e}")
-        
-        return render_template('estoque_movimentacoes.html', movimentacoes=movimentacoes_lista, search_query=search_query, filter_type=filter_type)
+
+        filtros = {'inicio': inicio.isoformat(), 'fim': fim.isoformat(), 'type': filter_type, 'search': search_query, 'produto_id': produto_id}
+        filtros = {chave: valor for chave, valor in filtros.items() if valor}
+        return render_template('estoque_movimentacoes.html', movimentacoes=movimentacoes_lista, search_query=search_query,
+                               filter_type=filter_type, produto_id=produto_id, inicio=inicio.isoformat(), fim=fim.isoformat(),
+                               pagina_seguinte_url=url_for('historico_movimentacoes', cursor=proximo_cursor, **filtros) if proximo_cursor else None,
+                               primeira_pagina_url=url_for('historico_movimentacoes', **filtros) if cursor else None)
+
+    @app.route('/api/estoque/consumo_mensal', methods=['GET'], endpoint='consumo_mensal_estoque')
+    @login_required
+    def consumo_mensal_estoque():
+        """
+        Entradas e saídas por mês, a partir dos totais mensais (gráfico de consumo).
+        Parâmetros: produto_id (opcional; padrão: todos os produtos) e meses (padrão 12).
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            meses = int(request.args.get('meses', CONSUMO_MESES_PADRAO))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Parâmetro meses inválido.'}), 400
+        meses = max(1, min(meses, CONSUMO_MESES_MAXIMO))
+        try:
+            hoje = datetime.datetime.now(SAO_PAULO_TZ).date()
+            totais = monthly_totals(db_instance, clinica_id, month_range(hoje, meses), request.args.get('produto_id') or None)
+            return jsonify({'success': True, 'meses': totais})
+        except Exception as e:
+            print(f"ERRO: [consumo_mensal_estoque] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/api/estoque/consumo_mensal/reconstruir', methods=['POST'], endpoint='reconstruir_consumo_mensal')
+    @login_required
+    @admin_required
+    def reconstruir_consumo_mensal():
+        """Recalcula em segundo plano os totais mensais a partir dos lançamentos (e o campo 'mes' dos antigos)."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            job_id = start_background_job('Reconstrução dos totais mensais de estoque', rebuild_monthly_totals,
+                                          db_instance, clinica_id, clinica_id=clinica_id)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id)}), 202
+        except Exception as e:
+            print(f"ERRO: [reconstruir_consumo_mensal] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
 
     # NOVO ENDPOINT DE API PARA PRODUTOS ATIVOS (para o modal de movimentação)
     @app.route('/api/estoque/produtos_ativos', methods=['GET'], endpoint='api_produtos_ativos')
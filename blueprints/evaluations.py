@@ -1,6 +1,6 @@
 from flask import Blueprint, render_template, session, redirect, url_for, flash, request, jsonify
 # Importar login_required e admin_required do utils
-from utils import login_required, admin_required, get_db, convert_doc_to_dict, SAO_PAULO_TZ, parse_date_input, get_all_protocols_with_items, get_patient_evaluations, create_evaluation, add_protocol_to_evaluation, get_evaluation_details, save_evaluation_task_response, update_evaluation_status, delete_evaluation, get_protocol_by_id, delete_linked_protocol_and_tasks, save_evaluation_scoring_response
+from utils import login_required, admin_required, get_db, convert_doc_to_dict, SAO_PAULO_TZ, parse_date_input, get_all_protocols_with_items, get_patient_evaluations, create_evaluation, add_protocol_to_evaluation, get_evaluation_details, save_evaluation_task_response, VersionConflictError, update_evaluation_status, delete_evaluation, evaluation_delete_counts, get_protocol_by_id, delete_linked_protocol_and_tasks, save_evaluation_scoring_response
 import datetime
 import json
 from reportlab.lib.pagesizes import letter
@@ -10,10 +10,16 @@ from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from reportlab.lib.colors import black
 import io
 from google.cloud import firestore # Importar firestore aqui
+from google.api_core import exceptions as google_exceptions
 from reportlab.lib.units import inch # Importar para espaçamento
+from query_registry import register_query
 
 evaluations_bp = Blueprint('evaluations', __name__)
 
+register_query('avaliacoes.tarefas_snapshot',
+               'clinicas/{clinica_id}/pacientes/{paciente_id}/avaliacoes/{avaliacao_id}/protocolos_vinculados/{protocolo_id}/tarefas_snapshot',
+               order_by=('nivel', 'ordem'))
+
 @evaluations_bp.route('/avaliacoes', methods=['GET'])
 @login_required
 def list_patients_for_evaluation():
@@ -363,7 +369,8 @@ def api_link_protocol_to_evaluation():
 def api_save_task_response():
     """
     API para salvar a resposta de uma tarefa específica dentro de uma avaliação.
-    Recebe patient_id, evaluation_id, task_id, response_value, additional_info.
+    Recebe patient_id, evaluation_id, task_id, response_value, additional_info e, opcionalmente,
+    rev (revisão da tarefa vista pelo cliente). Em caso de conflito retorna 409 com o diff.
     """
     data = request.get_json()
     patient_id = data.get('patient_id')
@@ -377,12 +384,23 @@ def api_save_task_response():
     if not all([patient_id, evaluation_id, task_id]):
         return jsonify({'success': False, 'message': 'Dados incompletos para salvar resposta da tarefa.'}), 400
 
-    success = save_evaluation_task_response(clinica_id, patient_id, evaluation_id, task_id, response_value, additional_info)
+    expected_rev = data.get('rev')
+    if expected_rev is not None:
+        try:
+            expected_rev = int(expected_rev)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': "Revisão ('rev') inválida."}), 400
 
-    if success:
-        return jsonify({'success': True, 'message': 'Resposta da tarefa salva com sucesso!'})
-    else:
+    try:
+        new_rev = save_evaluation_task_response(clinica_id, patient_id, evaluation_id, task_id, response_value, additional_info, expected_rev)
+    except VersionConflictError as e:
+        return jsonify({'success': False, 'message': str(e), 'conflitos': e.conflicts}), 409
+    except google_exceptions.NotFound:
+        return jsonify({'success': False, 'message': 'Tarefa não encontrada na avaliação.'}), 404
+    except Exception as e:
+        print(f"Erro ao salvar resposta da tarefa {task_id} na avaliação {evaluation_id}: {e}")
         return jsonify({'success': False, 'message': 'Erro ao salvar resposta da tarefa.'}), 500
+    return jsonify({'success': True, 'message': 'Resposta da tarefa salva com sucesso!', 'rev': new_rev})
 
 @evaluations_bp.route('/api/avaliacoes/finalizar/<patient_id>/<evaluation_id>', methods=['POST'])
 @login_required
@@ -403,14 +421,19 @@ def api_finalize_evaluation(patient_id, evaluation_id):
 @admin_required # Apenas administradores podem excluir avaliações completas
 def api_delete_evaluation(patient_id, evaluation_id):
     """
-    API para excluir uma avaliação.
+    API para excluir uma avaliação. As subcoleções são apagadas em segundo plano (job_id/status_url
+    na resposta); com ?dry_run=1, só retorna as contagens por coleção.
     """
     clinica_id = session['clinica_id']
-    success = delete_evaluation(clinica_id, patient_id, evaluation_id)
-
-    if success:
-        return jsonify({'success': True, 'message': 'Avaliação excluída com sucesso!'})
-    else:
+    try:
+        if request.args.get('dry_run') == '1':
+            contagem = evaluation_delete_counts(clinica_id, patient_id, evaluation_id)
+            return jsonify({'success': True, 'dry_run': True, 'contagem': contagem})
+        job_id = delete_evaluation(clinica_id, patient_id, evaluation_id)
+        return jsonify({'success': True, 'message': 'Avaliação excluída com sucesso!', 'job_id': job_id,
+                        'status_url': url_for('status_job', job_id=job_id)})
+    except Exception as e:
+        print(f"Erro ao excluir avaliação {evaluation_id} do paciente {patient_id}: {e}")
         return jsonify({'success': False, 'message': 'Erro ao excluir avaliação.'}), 500
 
 @evaluations_bp.route('/api/avaliacoes/desvincular_protocolo/<patient_id>/<evaluation_id>/<linked_protocol_instance_id>', methods=['DELETE']) 
@@ -1,226 +1,50 @@
 from flask import render_template, session, flash, redirect, url_for, request, jsonify
 import datetime
-import uuid
 from google.cloud.firestore_v1.base_query import FieldFilter
 from google.cloud import firestore
 import base64
 from io import BytesIO
 from PyPDF2 import PdfReader, PdfWriter
 
-from utils import get_db, login_required, admin_required, SAO_PAULO_TZ, convert_doc_to_dict
+from utils import get_db, login_required, admin_required, SAO_PAULO_TZ, convert_doc_to_dict, VersionConflictError, resolve_professional_names
+from pei_repository import PeiRepository
+from query_registry import register_query
 
 # =================================================================
-# FUNÇÕES DE TRANSAÇÃO (Helpers) - MANTENHA AS SUAS FUNÇÕES EXISTENTES AQUI
+# FUNÇÕES AUXILIARES DE PEI (leitura e escrita via PeiRepository)
 # =================================================================
 
-@firestore.transactional
-def _delete_goal_transaction(transaction, pei_ref, goal_id_to_delete):
-    snapshot = pei_ref.get(transaction=transaction)
-    if not snapshot.exists: raise Exception("PEI não encontrado.")
-    goals = snapshot.to_dict().get('goals', [])
-    updated_goals = [goal for goal in goals if goal.get('id') != goal_id_to_delete]
-    if len(goals) == len(updated_goals): raise Exception("Meta não encontrada para exclusão.")
-    transaction.update(pei_ref, {'goals': updated_goals})
-
-@firestore.transactional
-def _update_target_status_transaction(transaction, pei_ref, goal_id, target_id, concluido):
-    snapshot = pei_ref.get(transaction=transaction)
-    if not snapshot.exists:
-        raise Exception("PEI não encontrado.")
-
-    pei_data = snapshot.to_dict()
-    goals = pei_data.get('goals', [])
-    
-    goal_found = False
-    for goal in goals:
-        if goal.get('id') == goal_id:
-            goal_found = True
-            target_found = False
-            for target in goal.get('targets', []):
-                if target.get('id') == target_id:
-                    target_found = True
-                    
-                    if new_target_status is not None:
-                        target['status'] = new_target_status
-                        if new_target_status == 'finalizada' and 'aids' in target:
-                            for aid in target['aids']:
-                                aid['status'] = 'finalizada'
-                                aid['attempts_count'] = int(aid.get('attempts_count', 0))
-
-                    if aid_id is not None and 'aids' in target:
-                        aid_found = False
-                        for aid in target['aids']:
-                            if aid.get('id') == aid_id:
-                                aid_found = True
-                                if new_attempts_count is not None:
-                                    try:
-                                        aid['attempts_count'] = int(new_attempts_count)
-                                    except (ValueError, TypeError) as e:
-                                        raise Exception(f"Valor inválido para tentativas: {new_attempts_count}. Erro: {e}")
-                                break
-                        if not aid_found:
-                            raise Exception("Ajuda (Aid) não encontrada no alvo.")
-                    break
-            if not target_found:
-                raise Exception("Alvo não encontrado na meta.")
-            break
-    if not goal_found:
-        raise Exception("Meta não encontrada no PEI.")
-        
-    transaction.update(pei_ref, {'goals': goals})
-
-@firestore.transactional
-def _finalize_goal_transaction(transaction, pei_ref, goal_id_to_finalize):
-    snapshot = pei_ref.get(transaction=transaction)
-    if not snapshot.exists: raise Exception("PEI não encontrado.")
-    goals = snapshot.to_dict().get('goals', [])
-    goal_found = False
-    for goal in goals:
-        if goal.get('id') == goal_id_to_finalize:
-            goal['status'] = 'finalizado'
-            for target in goal.get('targets', []):
-                if not target.get('concluido', False):
-                    target['concluido'] = True
-                if 'aids' in target:
-                    for aid in target['aids']:
-                        aid['status'] = 'finalizada'
-                        aid['attempts_count'] = int(aid.get('attempts_count', 0))
-            goal_found = True
-            break
-    if not goal_found: raise Exception("Meta não encontrada para finalizar.")
-    transaction.update(pei_ref, {'goals': goals})
-
-@firestore.transactional
-def _finalize_pei_transaction(transaction, pei_ref):
-    snapshot = pei_ref.get(transaction=transaction)
-    if not snapshot.exists:
-        raise Exception("PEI não encontrado.")
-    
-    pei_data = snapshot.to_dict()
-    updated_goals = pei_data.get('goals', [])
-    
-    for goal in updated_goals:
-        if goal.get('status') == 'ativo':
-            goal['status'] = 'finalizado'
-            for target in goal.get('targets', []):
-                if not target.get('concluido', False):
-                    target['concluido'] = True
-                if 'aids' in target:
-                    for aid in target['aids']:
-                        aid['status'] = 'finalizada'
-
-    transaction.update(pei_ref, {
-        'status': 'finalizado', 
-        'data_finalizacao': datetime.datetime.now(SAO_PAULO_TZ),
-        'goals': updated_goals 
-    })
-
-@firestore.transactional
-def _add_target_to_goal_transaction(transaction, pei_ref, goal_id, new_target_description):
-    snapshot = pei_ref.get(transaction=transaction)
-    if not snapshot.exists:
-        raise Exception("PEI não encontrado.")
-    
-    pei_data = snapshot.to_dict()
-    goals = pei_data.get('goals', [])
-    
-    fixed_aids = [
-        {'id': str(uuid.uuid4()), 'description': 'Ajuda Física Total', 'attempts_count': 0, 'status': 'pendente'},
-        {'id': str(uuid.uuid4()), 'description': 'Ajuda Física Parcial', 'attempts_count': 0, 'status': 'pendente'},
-        {'id': str(uuid.uuid4()), 'description': 'Ajuda Gestual', 'attempts_count': 0, 'status': 'pendente'},
-        {'id': str(uuid.uuid4()), 'description': 'Ajuda Ecóica', 'attempts_count': 0, 'status': 'pendente'},
-        {'id': str(uuid.uuid4()), 'description': 'Independente', 'attempts_count': 0, 'status': 'pendente'},
-    ]
-
-    goal_found = False
-    for goal in goals:
-        if goal.get('id') == goal_id:
-            goal_found = True
-            new_target = {
-                'id': str(uuid.uuid4()), 
-                'descricao': new_target_description,
-                'concluido': False,
-                'status': 'pendente',
-                'aids': fixed_aids
-            }
-            if 'targets' not in goal:
-                goal['targets'] = []
-            goal['targets'].append(new_target)
-            break
-            
-    if not goal_found:
-        raise Exception("Meta não encontrada no PEI.")
-        
-    transaction.update(pei_ref, {'goals': goals})
-
-@firestore.transactional
-def _add_pei_activity_transaction(transaction, pei_ref, activity_content, user_name):
-    snapshot = pei_ref.get(transaction=transaction)
-    if not snapshot.exists:
-        raise Exception("PEI not found.")
-
-    activities = snapshot.to_dict().get('activities', [])
-    new_activity = {
-        'id': str(uuid.uuid4()),
-        'content': activity_content,
-        'timestamp': datetime.datetime.now(SAO_PAULO_TZ),
-        'user_name': user_name
-    }
-    activities.append(new_activity)
-    transaction.update(pei_ref, {'activities': activities})
-
-@firestore.transactional
-def _update_target_and_aid_data_transaction(transaction, pei_ref, goal_id, target_id, aid_id=None, new_attempts_count=None, new_help_content=None, new_target_status=None):
-    snapshot = pei_ref.get(transaction=transaction)
-    if not snapshot.exists:
-        raise Exception("PEI não encontrado.")
-
-    pei_data = snapshot.to_dict()
-    goals = pei_data.get('goals', [])
-    
-    goal_found = False
-    for goal in goals:
-        if goal.get('id') == goal_id:
-            goal_found = True
-            target_found = False
-            for target in goal.get('targets', []):
-                if target.get('id') == target_id:
-                    target_found = True
-                    
-                    if new_target_status is not None:
-                        target['status'] = new_target_status
-                        if new_target_status == 'finalizada' and 'aids' in target:
-                            for aid in target['aids']:
-                                aid['status'] = 'finalizada'
-                                aid['attempts_count'] = int(aid.get('attempts_count', 0))
-
-                    if aid_id is not None and 'aids' in target:
-                        aid_found = False
-                        for aid in target['aids']:
-                            if aid.get('id') == aid_id:
-                                aid_found = True
-                                if new_attempts_count is not None:
-                                    try:
-                                        aid['attempts_count'] = int(new_attempts_count)
-                                    except (ValueError, TypeError) as e:
-                                        raise Exception(f"Valor inválido para tentativas: {new_attempts_count}. Erro: {e}")
-                                break
-                        if not aid_found:
-                            raise Exception("Ajuda (Aid) não encontrada no alvo.")
-                    break
-            if not target_found:
-                raise Exception("Alvo não encontrado na meta.")
-            break
-    if not goal_found:
-        raise Exception("Meta não encontrada no PEI.")
-        
-    transaction.update(pei_ref, {'goals': goals})
+def _prepare_prontuario_pei(repository, pei_doc):
+    """Formata um PEI para o prontuário, com metas/alvos/ajudas e atividades."""
+    pei = convert_doc_to_dict(pei_doc)
+    if 'data_criacao' in pei and isinstance(pei['data_criacao'], datetime.datetime):
+        pei['data_criacao'] = pei['data_criacao'].strftime('%d/%m/%Y %H:%M')
+    else:
+        pei['data_criacao'] = pei.get('data_criacao', 'N/A')
+    if isinstance(pei.get('doc_reference'), firestore.DocumentReference):
+        pei['doc_reference'] = pei['doc_reference'].path
+    pei['profissionais_nomes_associados_fmt'] = ", ".join(pei.get('profissionais_nomes_associados', ['N/A']))
+    pei['goals'] = repository.goals_for_display(pei_doc.reference, repository.get_tree(pei_doc))
+    pei['activities'], pei['activities_next_cursor'] = repository.get_activities_page(pei_doc.id)
+    for internal_field in ('metas', 'layout', 'schema_version'):
+        pei.pop(internal_field, None)
+    return pei
+
+def _list_prontuario_peis(db_instance, clinica_id, paciente_doc_id, professional_id=None):
+    """Retorna os PEIs do paciente formatados para as respostas JSON do prontuário."""
+    repository = PeiRepository(db_instance, clinica_id)
+    peis_query = repository.query_for_patient(paciente_doc_id, professional_id).order_by('data_criacao', direction=firestore.Query.DESCENDING)
+    return [_prepare_prontuario_pei(repository, doc) for doc in peis_query.stream()]
 
 
 # =================================================================
 # FUNÇÃO DE REGISTO DE ROTAS
 # =================================================================
 
+register_query('prontuario.peis_do_paciente', 'clinicas/{clinica_id}/peis',
+               equality=('paciente_id',), array_contains='profissionais_ids',
+               order_by=(('data_criacao', 'DESCENDING'),), optional=('profissionais_ids',))
+
 def register_medical_records_routes(app):
 
     # --- ROTAS DE BUSCA E VISUALIZAÇÃO DE PRONTUÁRIO ---
@@ -366,31 +190,11 @@ def register_medical_records_routes(app):
 
             peis_query = peis_query.order_by('data_criacao', direction=firestore.Query.DESCENDING)
 
+            repository = PeiRepository(db_instance, clinica_id)
             for pei_doc in peis_query.stream():
-                pei = convert_doc_to_dict(pei_doc)
-                if 'data_criacao' in pei and isinstance(pei['data_criacao'], datetime.datetime):
-                    pei['data_criacao'] = pei['data_criacao'].strftime('%d/%m/%Y %H:%M')
-                else:
-                    pei['data_criacao'] = pei.get('data_criacao', 'N/A')
+                pei = _prepare_prontuario_pei(repository, pei_doc)
+                print(f"DEBUG: PEI ID: {pei['id']}, PEI Título: {pei.get('titulo')}, PEI Profissionais IDs: {pei.get('profissionais_ids')}")
 
-                pei['profissionais_nomes_associados_fmt'] = ", ".join(pei.get('profissionais_nomes_associados', ['N/A']))
-                
-                print(f"DEBUG: PEI ID: {pei['id']}, PEI Título: {pei['titulo']}, PEI Profissionais IDs: {pei.get('profissionais_ids')}")
-
-                if 'activities' in pei and isinstance(pei['activities'], list):
-                    for activity in pei['activities']:
-                        activity_ts = activity.get('timestamp')
-                        if isinstance(activity_ts, datetime.datetime):
-                            activity['timestamp_fmt'] = activity_ts.astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M')
-                        elif isinstance(activity_ts, str):
-                            try:
-                                naive_dt = datetime.datetime.strptime(activity_ts, '%Y-%m-%dT%H:%M:%S')
-                                activity['timestamp_fmt'] = naive_dt.strftime('%d/%m/%Y %H:%M')
-                            except (ValueError, TypeError):
-                                activity['timestamp_fmt'] = 'Data Inválida'
-                        else:
-                            activity['timestamp_fmt'] = 'N/A'
-                
                 if pei.get('status') == 'finalizado':
                     peis_finalizados.append(pei)
                 else:
@@ -688,30 +492,15 @@ def register_medical_records_routes(app):
                 flash('Formato de data de criação inválido.', 'danger')
                 return redirect(url_for('ver_prontuario', paciente_doc_id=paciente_doc_id))
             
-            profissionais_nomes_associados = []
-            for prof_id in profissionais_ids_selecionados:
-                profissional_ref = db_instance.collection(f'clinicas/{clinica_id}/profissionais').document(prof_id)
-                profissional_doc = profissional_ref.get()
-                if profissional_doc.exists:
-                    profissionais_nomes_associados.append(profissional_doc.to_dict().get('nome', 'N/A'))
-                else:
-                    profissionais_nomes_associados.append(f"Profissional Desconhecido ({prof_id})")
-
-            peis_ref = db_instance.collection('clinicas').document(clinica_id).collection('peis')
-            
-            new_pei_data = {
-                'paciente_id': paciente_doc_id, 
-                'titulo': titulo,
-                'data_criacao': data_criacao_obj, 
-                'status': 'ativo',
-                'goals': [], 
-                'activities': [],
-                'criado_em': datetime.datetime.now(SAO_PAULO_TZ), 
-                'profissional_criador_nome': session.get('user_name', 'N/A'),
-                'profissionais_ids': profissionais_ids_selecionados,
-                'profissionais_nomes_associados': profissionais_nomes_associados
-            }
-            peis_ref.add(new_pei_data)
+            professional_names = resolve_professional_names(db_instance, clinica_id, profissionais_ids_selecionados)
+            profissionais_nomes_associados = [
+                professional_names.get(prof_id, f"Profissional Desconhecido ({prof_id})") for prof_id in profissionais_ids_selecionados
+            ]
+
+            PeiRepository(db_instance, clinica_id).create(
+                paciente_doc_id, titulo, data_criacao_obj, profissionais_ids_selecionados, session.get('user_name', 'N/A'),
+                extra_fields={'profissionais_nomes_associados': profissionais_nomes_associados}
+            )
             flash('PEI adicionado com sucesso!', 'success')
         except Exception as e:
             flash(f'Erro ao adicionar PEI: {e}', 'danger')
@@ -728,8 +517,12 @@ def register_medical_records_routes(app):
             pei_id = request.form.get('pei_id')
             if not pei_id:
                 flash('ID do PEI não fornecido.', 'danger')
+            elif request.args.get('dry_run') == '1':
+                return jsonify({'success': True, 'dry_run': True,
+                                'contagem': PeiRepository(db_instance, clinica_id).delete_counts(pei_id)}), 200
             else:
-                db_instance.collection('clinicas').document(clinica_id).collection('peis').document(pei_id).delete()
+                # Subcoleções apagadas em segundo plano (veja PeiRepository.delete)
+                PeiRepository(db_instance, clinica_id).delete(pei_id)
                 flash('PEI excluído com sucesso!', 'success')
         except Exception as e:
             flash(f'Erro ao excluir PEI: {e}', 'danger')
@@ -770,33 +563,9 @@ def register_medical_records_routes(app):
                 if logged_in_professional_id not in associated_professionals_ids:
                     return jsonify({'success': False, 'message': 'Você não tem permissão para finalizar este PEI.'}), 403
             
-            _finalize_pei_transaction(db_instance.transaction(), pei_ref)
+            PeiRepository(db_instance, clinica_id).finalize_pei(pei_id)
             
-            all_peis = []
-            peis_query = db_instance.collection('clinicas').document(clinica_id).collection('peis').where(filter=FieldFilter('paciente_id', '==', paciente_doc_id)).order_by('data_criacao', direction=firestore.Query.DESCENDING)
-            if not is_admin and logged_in_professional_id:
-                peis_query = peis_query.where(filter=FieldFilter('profissionais_ids', 'array_contains', logged_in_professional_id))
-
-            for doc in peis_query.stream():
-                pei_data_converted = convert_doc_to_dict(doc)
-                if 'data_criacao' in pei_data_converted and isinstance(pei_data_converted['data_criacao'], datetime.datetime):
-                    pei_data_converted['data_criacao'] = pei_data_converted['data_criacao'].strftime('%d/%m/%Y %H:%M')
-                pei_data_converted['profissionais_nomes_associados_fmt'] = ", ".join(pei_data_converted.get('profissionais_nomes_associados', ['N/A']))
-
-                if 'activities' in pei_data_converted and isinstance(pei_data_converted['activities'], list):
-                    for activity in pei_data_converted['activities']:
-                        activity_ts = activity.get('timestamp')
-                        if isinstance(activity_ts, datetime.datetime):
-                            activity['timestamp_fmt'] = activity_ts.astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M')
-                        elif isinstance(activity_ts, str):
-                            try:
-                                naive_dt = datetime.datetime.strptime(activity_ts, '%Y-%m-%dT%H:%M:%S')
-                                activity['timestamp_fmt'] = naive_dt.strftime('%d/%m/%Y %H:%M')
-                            except (ValueError, TypeError):
-                                activity['timestamp_fmt'] = 'Data Inválida'
-                        else:
-                            activity['timestamp_fmt'] = 'N/A'
-                all_peis.append(pei_data_converted)
+            all_peis = _list_prontuario_peis(db_instance, clinica_id, paciente_doc_id, None if is_admin else logged_in_professional_id)
 
             return jsonify({'success': True, 'message': 'PEI finalizado com sucesso!', 'peis': all_peis}), 200
         except Exception as e:
@@ -818,31 +587,8 @@ def register_medical_records_routes(app):
             if not pei_id or not descricao_goal:
                 flash('Dados insuficientes para adicionar meta.', 'danger')
             else:
-                pei_ref = db_instance.collection('clinicas').document(clinica_id).collection('peis').document(pei_id)
-                new_targets = []
-                fixed_aids_template = [
-                    {'id': str(uuid.uuid4()), 'description': 'Ajuda Física Total', 'attempts_count': 0, 'status': 'pendente'},
-                    {'id': str(uuid.uuid4()), 'description': 'Ajuda Física Parcial', 'attempts_count': 0, 'status': 'pendente'},
-                    {'id': str(uuid.uuid4()), 'description': 'Ajuda Gestual', 'attempts_count': 0, 'status': 'pendente'},
-                    {'id': str(uuid.uuid4()), 'description': 'Ajuda Ecóica', 'attempts_count': 0, 'status': 'pendente'},
-                    {'id': str(uuid.uuid4()), 'description': 'Independente', 'attempts_count': 0, 'status': 'pendente'},
-                ]
-                for desc in targets_desc:
-                    if desc.strip():
-                        new_targets.append({
-                            'id': str(uuid.uuid4()),
-                            'descricao': desc.strip(),
-                            'concluido': False,
-                            'status': 'pendente',
-                            'aids': [aid.copy() for aid in fixed_aids_template]
-                        })
-                new_goal = {
-                    'id': str(uuid.uuid4()), 
-                    'descricao': descricao_goal.strip(),
-                    'status': 'ativo',
-                    'targets': new_targets
-                }
-                pei_ref.update({'goals': firestore.ArrayUnion([new_goal])})
+                # Sem seleção de ajudas no prontuário: cada alvo recebe as cinco ajudas padrão
+                PeiRepository(db_instance, clinica_id).add_goal(pei_id, descricao_goal, targets_desc)
                 flash('Meta adicionada com sucesso ao PEI!', 'success')
         except Exception as e:
             flash(f'Erro ao adicionar meta: {e}', 'danger')
@@ -864,39 +610,11 @@ def register_medical_records_routes(app):
             if not all([pei_id, goal_id, target_description]):
                 return jsonify({'success': False, 'message': 'Dados insuficientes para adicionar alvo.'}), 400
 
-            pei_ref = db_instance.collection('clinicas').document(clinica_id).collection('peis').document(pei_id)
-            transaction = db_instance.transaction()
-            
-            _add_target_to_goal_transaction(transaction, pei_ref, goal_id, target_description)
-            transaction.commit()
+            PeiRepository(db_instance, clinica_id).add_target(pei_id, goal_id, target_description)
             
-            all_peis = []
             user_role = session.get('user_role')
             logged_in_professional_id = session.get('professional_id')
-            peis_query = db_instance.collection('clinicas').document(clinica_id).collection('peis').where(filter=FieldFilter('paciente_id', '==', paciente_doc_id)).order_by('data_criacao', direction=firestore.Query.DESCENDING)
-            if user_role == 'medico' and not (user_role == 'admin') and logged_in_professional_id:
-                peis_query = peis_query.where(filter=FieldFilter('profissionais_ids', 'array_contains', logged_in_professional_id))
-
-            for doc in peis_query.stream():
-                pei_data_converted = convert_doc_to_dict(doc)
-                if 'data_criacao' in pei_data_converted and isinstance(pei_data_converted['data_criacao'], datetime.datetime):
-                    pei_data_converted['data_criacao'] = pei_data_converted['data_criacao'].strftime('%d/%m/%Y %H:%M')
-                pei_data_converted['profissionais_nomes_associados_fmt'] = ", ".join(pei_data_converted.get('profissionais_nomes_associados', ['N/A']))
-
-                if 'activities' in pei_data_converted and isinstance(pei_data_converted['activities'], list):
-                    for activity in pei_data_converted['activities']:
-                        activity_ts = activity.get('timestamp')
-                        if isinstance(activity_ts, datetime.datetime):
-                            activity['timestamp_fmt'] = activity_ts.astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M')
-                        elif isinstance(activity_ts, str):
-                            try:
-                                naive_dt = datetime.datetime.strptime(activity_ts, '%Y-%m-%dT%H:%M:%S')
-                                activity['timestamp_fmt'] = naive_dt.strftime('%d/%m/%Y %H:%M')
-                            except (ValueError, TypeError):
-                                activity['timestamp_fmt'] = 'Data Inválida'
-                        else:
-                            activity['timestamp_fmt'] = 'N/A'
-                all_peis.append(pei_data_converted)
+            all_peis = _list_prontuario_peis(db_instance, clinica_id, paciente_doc_id, logged_in_professional_id if user_role == 'medico' else None)
 
             return jsonify({'success': True, 'message': 'Alvo adicionado com sucesso!', 'peis': all_peis}), 200
 
@@ -916,10 +634,7 @@ def register_medical_records_routes(app):
             if not pei_id or not goal_id:
                 flash('Dados insuficientes para excluir meta.', 'danger')
             else:
-                pei_ref = db_instance.collection('clinicas').document(clinica_id).collection('peis').document(pei_id)
-                transaction = db_instance.transaction()
-                _delete_goal_transaction(transaction, pei_ref, goal_id)
-                transaction.commit()
+                PeiRepository(db_instance, clinica_id).delete_goal(pei_id, goal_id)
                 flash('Meta excluída com sucesso!', 'success')
         except Exception as e:
             flash(f'Erro ao excluir meta: {e}', 'danger')
@@ -961,35 +676,9 @@ def register_medical_records_routes(app):
                 if logged_in_professional_id not in associated_professionals_ids:
                     return jsonify({'success': False, 'message': 'Você não tem permissão para finalizar esta meta.'}), 403
 
-            transaction = db_instance.transaction()
-            _finalize_goal_transaction(transaction, pei_ref, goal_id)
-            transaction.commit()
-
-            all_peis = []
-            peis_query = db_instance.collection('clinicas').document(clinica_id).collection('peis').where(filter=FieldFilter('paciente_id', '==', paciente_doc_id)).order_by('data_criacao', direction=firestore.Query.DESCENDING)
-            if not is_admin and logged_in_professional_id:
-                peis_query = peis_query.where(filter=FieldFilter('profissionais_ids', 'array_contains', logged_in_professional_id))
-
-            for doc in peis_query.stream():
-                pei_data_converted = convert_doc_to_dict(doc)
-                if 'data_criacao' in pei_data_converted and isinstance(pei_data_converted['data_criacao'], datetime.datetime):
-                    pei_data_converted['data_criacao'] = pei_data_converted['data_criacao'].strftime('%d/%m/%Y %H:%M')
-                pei_data_converted['profissionais_nomes_associados_fmt'] = ", ".join(pei_data_converted.get('profissionais_nomes_associados', ['N/A']))
-
-                if 'activities' in pei_data_converted and isinstance(pei_data_converted['activities'], list):
-                    for activity in pei_data_converted['activities']:
-                        activity_ts = activity.get('timestamp')
-                        if isinstance(activity_ts, datetime.datetime):
-                            activity['timestamp_fmt'] = activity_ts.astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M')
-                        elif isinstance(activity_ts, str):
-                            try:
-                                naive_dt = datetime.datetime.strptime(activity_ts, '%Y-%m-%dT%H:%M:%S')
-                                activity['timestamp_fmt'] = naive_dt.strftime('%d/%m/%Y %H:%M')
-                            except (ValueError, TypeError):
-                                activity['timestamp_fmt'] = 'Data Inválida'
-                        else:
-                            activity['timestamp_fmt'] = 'N/A'
-                all_peis.append(pei_data_converted)
+            PeiRepository(db_instance, clinica_id).finalize_goal(pei_id, goal_id)
+
+            all_peis = _list_prontuario_peis(db_instance, clinica_id, paciente_doc_id, None if is_admin else logged_in_professional_id)
 
             return jsonify({'success': True, 'message': 'Meta finalizada com sucesso!', 'peis': all_peis}), 200
         except Exception as e:
@@ -1038,37 +727,15 @@ def register_medical_records_routes(app):
                 if logged_in_professional_id not in associated_professionals_ids:
                     return jsonify({'success': False, 'message': 'Você não tem permissão para atualizar o status deste alvo.'}), 403
 
-            transaction = db_instance.transaction()
-            _update_target_and_aid_data_transaction(transaction, pei_ref, goal_id, target_id, aid_id, new_attempts_count, new_help_content, new_target_status)
-            transaction.commit()
+            revs = data.get('revs') if isinstance(data.get('revs'), dict) else None
+            PeiRepository(db_instance, clinica_id).update_target_and_aid(pei_id, goal_id, target_id, aid_id, new_attempts_count, new_target_status,
+                                                                         expected_revs=revs)
             
-            all_peis = []
-            peis_query = db_instance.collection('clinicas').document(clinica_id).collection('peis').where(filter=FieldFilter('paciente_id', '==', paciente_doc_id)).order_by('data_criacao', direction=firestore.Query.DESCENDING)
-            if not is_admin and logged_in_professional_id:
-                peis_query = peis_query.where(filter=FieldFilter('profissionais_ids', 'array_contains', logged_in_professional_id))
-
-            for doc in peis_query.stream():
-                pei_data_converted = convert_doc_to_dict(doc)
-                if 'data_criacao' in pei_data_converted and isinstance(pei_data_converted['data_criacao'], datetime.datetime):
-                    pei_data_converted['data_criacao'] = pei_data_converted['data_criacao'].strftime('%d/%m/%Y %H:%M')
-                pei_data_converted['profissionais_nomes_associados_fmt'] = ", ".join(pei_data_converted.get('profissionais_nomes_associados', ['N/A']))
-
-                if 'activities' in pei_data_converted and isinstance(pei_data_converted['activities'], list):
-                    for activity in pei_data_converted['activities']:
-                        activity_ts = activity.get('timestamp')
-                        if isinstance(activity_ts, datetime.datetime):
-                            activity['timestamp_fmt'] = activity_ts.astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M')
-                        elif isinstance(activity_ts, str):
-                            try:
-                                naive_dt = datetime.datetime.strptime(activity_ts, '%Y-%m-%dT%H:%M:%S')
-                                activity['timestamp_fmt'] = naive_dt.strftime('%d/%m/%Y %H:%M')
-                            except (ValueError, TypeError):
-                                activity['timestamp_fmt'] = 'Data Inválida'
-                        else:
-                            activity['timestamp_fmt'] = 'N/A'
-                all_peis.append(pei_data_converted)
+            all_peis = _list_prontuario_peis(db_instance, clinica_id, paciente_doc_id, None if is_admin else logged_in_professional_id)
 
             return jsonify({'success': True, 'message': 'Alvo atualizado com sucesso!', 'peis': all_peis}), 200
+        except VersionConflictError as e:
+            return jsonify({'success': False, 'message': str(e), 'conflitos': e.conflicts}), 409
         except Exception as e:
             print(f"Erro ao atualizar tentativas/ajuda/status do alvo: {e}")
             return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
@@ -1110,33 +777,9 @@ def register_medical_records_routes(app):
                     return jsonify({'success': False, 'message': 'Você não tem permissão para adicionar atividades a este PEI.'}), 403
 
             user_name = session.get('user_name', 'Desconhecido')
-            _add_pei_activity_transaction(db_instance.transaction(), pei_ref, activity_content, user_name)
-            
-            all_peis = []
-            peis_query = db_instance.collection('clinicas').document(clinica_id).collection('peis').where(filter=FieldFilter('paciente_id', '==', paciente_doc_id)).order_by('data_criacao', direction=firestore.Query.DESCENDING)
-            if not is_admin and logged_in_professional_id:
-                peis_query = peis_query.where(filter=FieldFilter('profissionais_ids', 'array_contains', logged_in_professional_id))
+            PeiRepository(db_instance, clinica_id).add_activity(pei_id, activity_content, user_name, paciente_id=paciente_doc_id)
             
-            for doc in peis_query.stream():
-                pei_data_converted = convert_doc_to_dict(doc)
-                if 'data_criacao' in pei_data_converted and isinstance(pei_data_converted['data_criacao'], datetime.datetime):
-                    pei_data_converted['data_criacao'] = pei_data_converted['data_criacao'].strftime('%d/%m/%Y %H:%M')
-                pei_data_converted['profissionais_nomes_associados_fmt'] = ", ".join(pei_data_converted.get('profissionais_nomes_associados', ['N/A']))
-
-                if 'activities' in pei_data_converted and isinstance(pei_data_converted['activities'], list):
-                    for activity in pei_data_converted['activities']:
-                        activity_ts = activity.get('timestamp')
-                        if isinstance(activity_ts, datetime.datetime):
-                            activity['timestamp_fmt'] = activity_ts.astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M')
-                        elif isinstance(activity_ts, str):
-                            try:
-                                naive_dt = datetime.datetime.strptime(activity_ts, '%Y-%m-%dT%H:%M:%S')
-                                activity['timestamp_fmt'] = naive_dt.strftime('%d/%m/%Y %H:%M')
-                            except (ValueError, TypeError):
-                                activity['timestamp_fmt'] = 'Data Inválida'
-                        else:
-                            activity['timestamp_fmt'] = 'N/A'
-                all_peis.append(pei_data_converted)
+            all_peis = _list_prontuario_peis(db_instance, clinica_id, paciente_doc_id, None if is_admin else logged_in_professional_id)
 
             return jsonify({'success': True, 'message': 'Atividade adicionada com sucesso!', 'peis': all_peis}), 200
 
@@ -1186,37 +829,15 @@ def register_medical_records_routes(app):
                 if logged_in_professional_id not in associated_professionals_ids:
                     return jsonify({'success': False, 'message': 'Você não tem permissão para atualizar o status deste alvo.'}), 403
 
-            transaction = db_instance.transaction()
-            _update_target_and_aid_data_transaction(transaction, pei_ref, goal_id, target_id, aid_id, new_attempts_count, new_help_content, new_target_status)
-            transaction.commit()
+            revs = data.get('revs') if isinstance(data.get('revs'), dict) else None
+            PeiRepository(db_instance, clinica_id).update_target_and_aid(pei_id, goal_id, target_id, aid_id, new_attempts_count, new_target_status,
+                                                                         expected_revs=revs)
             
-            all_peis = []
-            peis_query = db_instance.collection('clinicas').document(clinica_id).collection('peis').where(filter=FieldFilter('paciente_id', '==', paciente_doc_id)).order_by('data_criacao', direction=firestore.Query.DESCENDING)
-            if not is_admin and logged_in_professional_id:
-                peis_query = peis_query.where(filter=FieldFilter('profissionais_ids', 'array_contains', logged_in_professional_id))
-
-            for doc in peis_query.stream():
-                pei_data_converted = convert_doc_to_dict(doc)
-                if 'data_criacao' in pei_data_converted and isinstance(pei_data_converted['data_criacao'], datetime.datetime):
-                    pei_data_converted['data_criacao'] = pei_data_converted['data_criacao'].strftime('%d/%m/%Y %H:%M')
-                pei_data_converted['profissionais_nomes_associados_fmt'] = ", ".join(pei_data_converted.get('profissionais_nomes_associados', ['N/A']))
-
-                if 'activities' in pei_data_converted and isinstance(pei_data_converted['activities'], list):
-                    for activity in pei_data_converted['activities']:
-                        activity_ts = activity.get('timestamp')
-                        if isinstance(activity_ts, datetime.datetime):
-                            activity['timestamp_fmt'] = activity_ts.astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M')
-                        elif isinstance(activity_ts, str):
-                            try:
-                                naive_dt = datetime.datetime.strptime(activity_ts, '%Y-%m-%dT%H:%M:%S')
-                                activity['timestamp_fmt'] = naive_dt.strftime('%d/%m/%Y %H:%M')
-                            except (ValueError, TypeError):
-                                activity['timestamp_fmt'] = 'Data Inválida'
-                        else:
-                            activity['timestamp_fmt'] = 'N/A'
-                all_peis.append(pei_data_converted)
+            all_peis = _list_prontuario_peis(db_instance, clinica_id, paciente_doc_id, None if is_admin else logged_in_professional_id)
 
             return jsonify({'success': True, 'message': 'Alvo atualizado com sucesso!', 'peis': all_peis}), 200
+        except VersionConflictError as e:
+            return jsonify({'success': False, 'message': str(e), 'conflitos': e.conflicts}), 409
         except Exception as e:
             print(f"Erro ao atualizar tentativas/ajuda/status do alvo: {e}")
             return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
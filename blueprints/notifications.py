@@ -0,0 +1,31 @@
+from flask import Blueprint, jsonify, session, url_for
+
+from utils import get_db, login_required, admin_required, start_background_job
+from notifications import dispatch_pending, get_channels, get_metrics
+
+notifications_bp = Blueprint('notifications', __name__)
+
+@notifications_bp.route('/api/notificacoes/processar', methods=['POST'], endpoint='processar_notificacoes')
+@login_required
+@admin_required
+def processar_notificacoes():
+    """Executa agora um ciclo do outbox de notificações da clínica (em segundo plano)."""
+    db_instance = get_db()
+    clinica_id = session['clinica_id']
+    try:
+        job_id = start_background_job('Envio de notificações de agendamentos', dispatch_pending, db_instance, clinica_id, clinica_id=clinica_id)
+        return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id)}), 202
+    except Exception as e:
+        print(f"Erro ao iniciar o envio de notificações: {e}")
+        return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+@notifications_bp.route('/api/notificacoes/metricas', methods=['GET'], endpoint='metricas_notificacoes')
+@login_required
+@admin_required
+def metricas_notificacoes():
+    """Contadores do despachante de notificações neste processo."""
+    return jsonify({
+        'success': True,
+        'metricas': get_metrics(),
+        'canais': [channel.name for channel in get_channels()],
+    }), 200
@@ -6,7 +6,7 @@ from google.cloud import firestore # Importar no topo
 
 
 # Importar utils
-from utils import get_db, login_required, SAO_PAULO_TZ, parse_date_input
+from utils import get_db, login_required, SAO_PAULO_TZ, parse_date_input, cascade_delete, start_cascade_delete_job
 
 
 def register_patients_routes(app):
@@ -377,12 +377,27 @@ def register_patients_routes(app):
                 return jsonify({'success': False, 'message': 'Paciente não encontrado'}), 404
             
             paciente_nome = paciente_doc.to_dict().get('nome', 'Paciente')
-            
-            # Excluir o paciente
+
+            # Raízes da exclusão: o paciente (com avaliações, prontuários, documentos etc.) e seus PEIs
+            peis_query = db_instance.collection('clinicas').document(clinica_id).collection('peis').where(filter=FieldFilter('paciente_id', '==', paciente_doc_id))
+            root_refs = [paciente_ref] + [doc.reference for doc in peis_query.stream()]
+
+            dry_run = request.args.get('dry_run') == '1'
+            if dry_run:
+                contagem = cascade_delete(db_instance, root_refs, dry_run=True)
+                return jsonify({'success': True, 'dry_run': True, 'contagem': contagem}), 200
+
+            # Remove o paciente da listagem imediatamente; as subárvores são apagadas em segundo plano
             paciente_ref.delete()
+            job_id = start_cascade_delete_job(db_instance, root_refs, f'Exclusão do paciente {paciente_nome}', clinica_id=clinica_id)
             
             flash(f'Paciente {paciente_nome} excluído com sucesso.', 'success')
-            return jsonify({'success': True, 'message': f'Paciente {paciente_nome} excluído com sucesso'}), 200
+            return jsonify({
+                'success': True,
+                'message': f'Paciente {paciente_nome} excluído com sucesso',
+                'job_id': job_id,
+                'status_url': url_for('status_job', job_id=job_id)
+            }), 200
             
         except Exception as e:
             print(f"Erro ao excluir paciente: {e}")
@@ -6,6 +6,10 @@ import pytz
 
 # Importar utils
 from utils import get_db, login_required, admin_required, SAO_PAULO_TZ, convert_doc_to_dict, parse_date_input
+from payables import create_payable, delete_payable, update_payable
+from asset_valuation import (
+    asset_index, invalidate_asset_index, schedule_asset_valuation, search_assets, useful_life_months, valuation_summary,
+)
 
 patrimonio_bp = Blueprint('patrimonio', __name__)
 
@@ -24,34 +28,21 @@ def register_patrimonio_routes(app):
         """
         db_instance = get_db()
         clinica_id = session['clinica_id']
-        patrimonio_ref = db_instance.collection('clinicas').document(clinica_id).collection('patrimonio')
         patrimonio_lista = []
 
         search_query = request.args.get('search', '').strip()
 
-        query = patrimonio_ref.order_by('nome', direction=firestore.Query.ASCENDING)
-
         try:
-            docs = query.stream()
-            for doc in docs:
-                item = doc.to_dict()
-                if item:
-                    item['id'] = doc.id
-                    # Formatar data de aquisição para exibição
-                    if 'data_aquisicao' in item and isinstance(item['data_aquisicao'], datetime.datetime):
-                        item['data_aquisicao_fmt'] = item['data_aquisicao'].strftime('%d/%m/%Y')
-                    else:
-                        item['data_aquisicao_fmt'] = 'N/A'
-                    
-                    # Adicionar à lista se corresponder à busca
-                    if search_query:
-                        if (search_query.lower() in item.get('nome', '').lower() or
-                            search_query.lower() in item.get('codigo', '').lower() or
-                            search_query.lower() in item.get('tipo', '').lower() or
-                            search_query.lower() in item.get('local_armazenamento', '').lower()):
-                            patrimonio_lista.append(item)
-                    else:
-                        patrimonio_lista.append(item)
+            # Lista e busca a partir do índice de itens em cache (já ordenado por nome, com o valor contábil)
+            for item in search_assets(asset_index(db_instance, clinica_id), search_query):
+                item = dict(item)
+                # Formatar data de aquisição para exibição
+                if 'data_aquisicao' in item and isinstance(item['data_aquisicao'], datetime.datetime):
+                    item['data_aquisicao_fmt'] = item['data_aquisicao'].strftime('%d/%m/%Y')
+                else:
+                    item['data_aquisicao_fmt'] = 'N/A'
+                patrimonio_lista.append(item)
+            schedule_asset_valuation(db_instance, clinica_id)
 
         except Exception as e:
             flash(f'Erro ao listar patrimônio: {e}. Verifique seus índices do Firestore.', 'danger')
@@ -76,6 +67,8 @@ def register_patrimonio_routes(app):
             data_aquisicao_str = request.form.get('data_aquisicao', '').strip()
             local_armazenamento = request.form.get('local_armazenamento', '').strip()
             valor_str = request.form.get('valor', '0').strip()
+            vida_util_str = request.form.get('vida_util_anos', '').strip()
+            valor_residual_str = request.form.get('valor_residual', '').strip()
             observacao = request.form.get('observacao', '').strip()
             # Verifica se o checkbox foi marcado
             criar_conta_pagar = 'criar_conta_pagar' in request.form 
@@ -87,6 +80,9 @@ def register_patrimonio_routes(app):
             try:
                 # Converte o valor para float, tratando a vírgula como separador decimal
                 valor = float(valor_str.replace(',', '.')) if valor_str else 0.0
+                # Vida útil em branco: a padrão do tipo (asset_valuation.VIDA_UTIL_PADRAO_ANOS)
+                vida_util_meses = round(float(vida_util_str.replace(',', '.')) * 12) if vida_util_str else None
+                valor_residual = float(valor_residual_str.replace(',', '.')) if valor_residual_str else 0.0
                 
                 data_aquisicao_dt = None
                 if data_aquisicao_str:
@@ -100,6 +96,8 @@ def register_patrimonio_routes(app):
                     'data_aquisicao': data_aquisicao_dt,
                     'local_armazenamento': local_armazenamento,
                     'valor': valor,
+                    'vida_util_meses': vida_util_meses,
+                    'valor_residual': valor_residual,
                     'observacao': observacao,
                     'data_cadastro': datetime.datetime.now(SAO_PAULO_TZ),
                     'usuario_cadastro': session.get('user_name', 'N/A')
@@ -107,6 +105,8 @@ def register_patrimonio_routes(app):
 
                 # Adiciona o item de patrimônio e obtém sua referência
                 new_patrimonio_ref = db_instance.collection('clinicas').document(clinica_id).collection('patrimonio').add(patrimonio_data)[1]
+                invalidate_asset_index(clinica_id)
+                schedule_asset_valuation(db_instance, clinica_id, force=True)
                 
                 # Se a opção de criar conta a pagar foi marcada e o valor é maior que zero, cria a conta
                 if criar_conta_pagar and valor > 0:
@@ -120,7 +120,7 @@ def register_patrimonio_routes(app):
                         'patrimonio_id': new_patrimonio_ref.id, # Vincula ao ID do patrimônio recém-criado
                         'patrimonio_nome': nome # Salva o nome para fácil referência
                     }
-                    db_instance.collection('clinicas').document(clinica_id).collection('contas_a_pagar').add(contas_a_pagar_data)
+                    create_payable(db_instance, clinica_id, contas_a_pagar_data)
                     flash('Item de patrimônio e conta a pagar adicionados com sucesso!', 'success')
                 else:
                     flash('Item de patrimônio adicionado com sucesso!', 'success')
@@ -152,6 +152,8 @@ def register_patrimonio_routes(app):
             data_aquisicao_str = request.form.get('data_aquisicao', '').strip()
             local_armazenamento = request.form.get('local_armazenamento', '').strip()
             valor_str = request.form.get('valor', '0').strip()
+            vida_util_str = request.form.get('vida_util_anos', '').strip()
+            valor_residual_str = request.form.get('valor_residual', '').strip()
             observacao = request.form.get('observacao', '').strip()
             # Verifica se o checkbox foi marcado
             criar_conta_pagar = 'criar_conta_pagar' in request.form 
@@ -163,6 +165,9 @@ def register_patrimonio_routes(app):
             try:
                 # Converte o valor para float, tratando a vírgula como separador decimal
                 valor = float(valor_str.replace(',', '.')) if valor_str else 0.0
+                # Vida útil em branco: a padrão do tipo (asset_valuation.VIDA_UTIL_PADRAO_ANOS)
+                vida_util_meses = round(float(vida_util_str.replace(',', '.')) * 12) if vida_util_str else None
+                valor_residual = float(valor_residual_str.replace(',', '.')) if valor_residual_str else 0.0
                 
                 data_aquisicao_dt = None
                 if data_aquisicao_str:
@@ -176,11 +181,15 @@ def register_patrimonio_routes(app):
                     'data_aquisicao': data_aquisicao_dt,
                     'local_armazenamento': local_armazenamento,
                     'valor': valor,
+                    'vida_util_meses': vida_util_meses,
+                    'valor_residual': valor_residual,
                     'observacao': observacao,
                     'atualizado_em': firestore.SERVER_TIMESTAMP
                 }
 
                 item_ref.update(update_data)
+                invalidate_asset_index(clinica_id)
+                schedule_asset_valuation(db_instance, clinica_id, force=True)
 
                 # Lógica para criar/atualizar conta a pagar vinculada
                 if criar_conta_pagar and valor > 0:
@@ -201,12 +210,11 @@ def register_patrimonio_routes(app):
 
                     if contas_existentes:
                         # Atualiza a conta existente
-                        conta_existente_ref = contas_existentes[0].reference
-                        conta_existente_ref.update(contas_a_pagar_data)
+                        update_payable(db_instance, clinica_id, contas_existentes[0].id, contas_a_pagar_data)
                         flash('Item de patrimônio e conta a pagar vinculada atualizados com sucesso!', 'success')
                     else:
                         # Cria uma nova conta se não existir
-                        db_instance.collection('clinicas').document(clinica_id).collection('contas_a_pagar').add(contas_a_pagar_data)
+                        create_payable(db_instance, clinica_id, contas_a_pagar_data)
                         flash('Item de patrimônio atualizado e nova conta a pagar criada!', 'success')
                 else:
                     # Se o checkbox não foi marcado, mas existia uma conta vinculada, você pode optar por removê-la ou não fazer nada.
@@ -231,6 +239,9 @@ def register_patrimonio_routes(app):
                         item['data_aquisicao_input'] = item['data_aquisicao'].strftime('%Y-%m-%d')
                     else:
                         item['data_aquisicao_input'] = ''
+                    if item.get('vida_util_meses') is not None:
+                        item['vida_util_anos_input'] = f"{item['vida_util_meses'] / 12:g}"
+                    item['vida_util_padrao_anos'] = f"{useful_life_months({'tipo': item.get('tipo')}) / 12:g}"
                     
                     # Verifica se já existe uma conta a pagar para este patrimônio para pré-marcar o checkbox
                     contas_existentes_query = db_instance.collection('clinicas').document(clinica_id).collection('contas_a_pagar').where(filter=FieldFilter('patrimonio_id', '==', item_doc_id)).limit(1).stream()
@@ -258,15 +269,56 @@ def register_patrimonio_routes(app):
             # Opcional: Remover contas a pagar vinculadas ao patrimônio
             contas_vinculadas_query = db_instance.collection('clinicas').document(clinica_id).collection('contas_a_pagar').where(filter=FieldFilter('patrimonio_id', '==', item_doc_id)).stream()
             for conta_doc in contas_vinculadas_query:
-                conta_doc.reference.delete()
+                delete_payable(db_instance, clinica_id, conta_doc.id)
                 print(f"Conta a pagar vinculada {conta_doc.id} excluída.")
 
             db_instance.collection('clinicas').document(clinica_id).collection('patrimonio').document(item_doc_id).delete()
+            invalidate_asset_index(clinica_id)
+            schedule_asset_valuation(db_instance, clinica_id, force=True)
             flash('Item de patrimônio e contas a pagar vinculadas (se houver) excluídos com sucesso!', 'success')
         except Exception as e:
             flash(f'Erro ao excluir item de patrimônio: {e}.', 'danger')
             print(f"ERRO: [excluir_patrimonio] {e}")
         return redirect(url_for('patrimonio.listar_patrimonio'))
 
+    @patrimonio_bp.route('/api/patrimonio/resumo', methods=['GET'], endpoint='resumo_patrimonio')
+    @login_required
+    @admin_required
+    def resumo_patrimonio():
+        """
+        Valor de aquisição, depreciação acumulada e valor contábil do patrimônio, no total e por tipo e local,
+        lidos do retrato mensal mais recente. Parâmetro meses (padrão 1, até 60): quantos retratos retornar.
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            meses = max(1, min(int(request.args.get('meses', 1)), 60))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Parâmetro meses inválido.'}), 400
+        try:
+            retratos = valuation_summary(db_instance, clinica_id, meses)
+            mes_atual = datetime.datetime.now(SAO_PAULO_TZ).strftime('%Y-%m')
+            # Sem o retrato do mês atual, agenda o cálculo e responde com o mais recente disponível
+            job_id = None if retratos and retratos[0].get('mes') == mes_atual else schedule_asset_valuation(db_instance, clinica_id)
+            return jsonify({'success': True, 'atual': retratos[0] if retratos else None, 'retratos': retratos,
+                            'job_id': job_id})
+        except Exception as e:
+            print(f"ERRO: [resumo_patrimonio] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @patrimonio_bp.route('/api/patrimonio/depreciacao/recalcular', methods=['POST'], endpoint='recalcular_depreciacao_patrimonio')
+    @login_required
+    @admin_required
+    def recalcular_depreciacao_patrimonio():
+        """Recalcula em segundo plano a depreciação dos itens e o retrato do mês."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            job_id = schedule_asset_valuation(db_instance, clinica_id, force=True)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id)}), 202
+        except Exception as e:
+            print(f"ERRO: [recalcular_depreciacao_patrimonio] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
     app.register_blueprint(patrimonio_bp)
 
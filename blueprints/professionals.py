@@ -2,7 +2,7 @@ from flask import render_template, session, flash, redirect, url_for, request
 from google.cloud.firestore_v1.base_query import FieldFilter
 from google.cloud import firestore
 
-from utils import get_db, login_required, admin_required, permission_required, convert_doc_to_dict
+from utils import get_db, login_required, admin_required, permission_required, convert_doc_to_dict, invalidate_professional_names
 
 def register_professionals_routes(app):
     @app.route('/profissionais', endpoint='listar_profissionais')
@@ -93,6 +93,7 @@ def register_professionals_routes(app):
                         'cargo_id': cargo_id, # NOVO: Atualiza o cargo_id
                         'atualizado_em': firestore.SERVER_TIMESTAMP
                     })
+                    invalidate_professional_names(clinica_id, profissional_doc_id)
                     flash('Profissional atualizado com sucesso!', 'success')
                     return redirect(url_for('listar_profissionais'))
             except Exception as e:
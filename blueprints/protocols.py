@@ -1,11 +1,14 @@
 import uuid
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
 from google.cloud.firestore_v1.base_query import FieldFilter
-from utils import get_db, login_required # Importar get_db e login_required
+from utils import get_db, login_required, cascade_delete, start_cascade_delete_job # Importar get_db e login_required
 from datetime import datetime # Importar datetime para a data de inclusão
 
 protocols_bp = Blueprint('protocols', __name__, template_folder='../templates')
 
+# Subcoleções de um protocolo (recriadas a cada edição)
+PROTOCOLO_SUBCOLECOES = ('etapas', 'niveis', 'habilidades', 'pontuacao', 'tarefas_testes')
+
 @protocols_bp.route('/protocols')
 @login_required
 def list_protocols():
@@ -232,14 +235,6 @@ def get_protocol_form_content(protocol_id):
     return render_template('protocolo_form_modal_content.html', protocol=protocol)
 
 
-def delete_subcollection_docs(protocol_ref, subcollection_name):
-    """
-    Função auxiliar para deletar todos os documentos de uma subcoleção.
-    """
-    docs = protocol_ref.collection(subcollection_name).stream()
-    for doc in docs:
-        doc.reference.delete()
-
 @protocols_bp.route('/protocols/save', methods=['POST'])
 @login_required
 def save_protocol():
@@ -284,12 +279,9 @@ def save_protocol():
             protocol_ref.update(main_protocol_data)
             flash('Protocolo atualizado com sucesso!', 'success')
             
-            # Ao atualizar, deleta as subcoleções existentes para recriá-las
-            delete_subcollection_docs(protocol_ref, 'etapas')
-            delete_subcollection_docs(protocol_ref, 'niveis')
-            delete_subcollection_docs(protocol_ref, 'habilidades')
-            delete_subcollection_docs(protocol_ref, 'pontuacao')
-            delete_subcollection_docs(protocol_ref, 'tarefas_testes')
+            # Ao atualizar, deleta as subcoleções existentes para recriá-las (antes de recriar, por isso na requisição)
+            cascade_delete(db, [doc_ref for nome in PROTOCOLO_SUBCOLECOES
+                                for doc_ref in protocol_ref.collection(nome).list_documents()])
 
         else:
             # Adicionar novo protocolo e obter o ID gerado
@@ -411,7 +403,8 @@ def save_protocol():
 @login_required
 def delete_protocol(protocol_id):
     """
-    Rota para excluir um protocolo do Firestore.
+    Rota para excluir um protocolo do Firestore. As subcoleções são apagadas em segundo plano
+    (job_id/status_url na resposta); com ?dry_run=1, só retorna as contagens por coleção.
     """
     print(f"DEBUG: Tentando excluir protocolo com ID: {protocol_id}") # Log de depuração
 
@@ -429,24 +422,23 @@ def delete_protocol(protocol_id):
     
     try:
         # Verifica se o protocolo existe antes de tentar deletar
-        if not protocol_ref.get().exists:
+        protocol_doc = protocol_ref.get()
+        if not protocol_doc.exists:
             print(f"DEBUG: Protocolo com ID {protocol_id} não encontrado.")
          
             return jsonify(success=False, message='Protocolo não encontrado.'), 404
 
-        print(f"DEBUG: Deletando subcoleções para o protocolo ID: {protocol_id}")
-        # Deleta todas as subcoleções antes de deletar o documento principal
-        delete_subcollection_docs(protocol_ref, 'etapas')
-        delete_subcollection_docs(protocol_ref, 'niveis')
-        delete_subcollection_docs(protocol_ref, 'habilidades')
-        delete_subcollection_docs(protocol_ref, 'pontuacao')
-        delete_subcollection_docs(protocol_ref, 'tarefas_testes')
-        print(f"DEBUG: Subcoleções deletadas para o protocolo ID: {protocol_id}")
+        if request.args.get('dry_run') == '1':
+            contagem = cascade_delete(db, [protocol_ref], dry_run=True)
+            return jsonify(success=True, dry_run=True, contagem=contagem)
 
+        # Remove o protocolo da listagem imediatamente; as subcoleções são apagadas em segundo plano
         protocol_ref.delete()
         print(f"DEBUG: Protocolo principal deletado: {protocol_id}")
-     
-        return jsonify(success=True, message='Protocolo excluído com sucesso!')
+        job_id = start_cascade_delete_job(db, [protocol_ref], f"Exclusão do protocolo {protocol_doc.to_dict().get('nome') or protocol_id}", clinica_id=clinica_id)
+
+        return jsonify(success=True, message='Protocolo excluído com sucesso!', job_id=job_id,
+                       status_url=url_for('status_job', job_id=job_id))
     except Exception as e:
         print(f"DEBUG: Erro ao excluir protocolo do Firestore: {e}")
      
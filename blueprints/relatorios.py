@@ -0,0 +1,108 @@
+from flask import session, request, jsonify, url_for, Response, stream_with_context
+import datetime
+
+from utils import get_db, login_required, admin_required, SAO_PAULO_TZ
+from financial_reports import (
+    RELATORIO_MESES_MAXIMO, cached_report_pdf, csv_lines, period_months, report_filename, report_summary,
+    report_version, schedule_report_pdf,
+)
+
+def _requested_months():
+    """
+    Meses do período pedido (parâmetros inicio e fim, AAAA-MM; padrão: mês atual).
+    Levanta ValueError com a mensagem para o usuário.
+    """
+    mes_atual = datetime.datetime.now(SAO_PAULO_TZ).strftime('%Y-%m')
+    inicio_str = request.values.get('inicio') or mes_atual
+    try:
+        inicio = datetime.datetime.strptime(inicio_str, '%Y-%m').date()
+        fim = datetime.datetime.strptime(request.values.get('fim') or inicio_str, '%Y-%m').date()
+    except ValueError:
+        raise ValueError('Meses inválidos. Use o formato AAAA-MM.')
+    meses = period_months(inicio, fim)
+    if not meses:
+        raise ValueError('O mês final deve ser igual ou posterior ao inicial.')
+    if len(meses) > RELATORIO_MESES_MAXIMO:
+        raise ValueError(f'O período pode ter no máximo {RELATORIO_MESES_MAXIMO} meses.')
+    return meses
+
+def register_relatorios_routes(app):
+    @app.route('/api/relatorios/financeiro', methods=['GET'], endpoint='resumo_relatorio_financeiro')
+    @login_required
+    @admin_required
+    def resumo_relatorio_financeiro():
+        """Receitas, despesas, custo de estoque e resultado por mês do período (inicio e fim, AAAA-MM)."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            meses = _requested_months()
+        except ValueError as ve:
+            return jsonify({'success': False, 'message': str(ve)}), 400
+        try:
+            return jsonify({'success': True, 'inicio': meses[0], 'fim': meses[-1],
+                            **report_summary(db_instance, clinica_id, meses)}), 200
+        except Exception as e:
+            print(f"ERRO: [resumo_relatorio_financeiro] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}. Verifique seus índices do Firestore.'}), 500
+
+    @app.route('/relatorios/financeiro/csv', methods=['GET'], endpoint='exportar_relatorio_financeiro_csv')
+    @login_required
+    @admin_required
+    def exportar_relatorio_financeiro_csv():
+        """Lançamentos do período e resumo mensal em CSV, por streaming."""
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            meses = _requested_months()
+        except ValueError as ve:
+            return jsonify({'success': False, 'message': str(ve)}), 400
+        return Response(stream_with_context(csv_lines(db_instance, clinica_id, meses)), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={report_filename(meses, "csv")}'})
+
+    @app.route('/api/relatorios/financeiro/pdf', methods=['POST'], endpoint='gerar_relatorio_financeiro_pdf')
+    @login_required
+    @admin_required
+    def gerar_relatorio_financeiro_pdf():
+        """
+        Gera o PDF do período em segundo plano. Se um PDF da versão atual dos dados já existe, responde
+        200 só com o endereço de download (que inclui a versão).
+        """
+        db_instance = get_db()
+        clinica_id = session['clinica_id']
+        try:
+            meses = _requested_months()
+        except ValueError as ve:
+            return jsonify({'success': False, 'message': str(ve)}), 400
+        versao = report_version(clinica_id, meses)
+        download_url = url_for('baixar_relatorio_financeiro_pdf', inicio=meses[0], fim=meses[-1], versao=versao)
+        if cached_report_pdf(clinica_id, meses, versao) is not None:
+            return jsonify({'success': True, 'download_url': download_url}), 200
+        try:
+            job_id = schedule_report_pdf(db_instance, clinica_id, meses, versao)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('status_job', job_id=job_id),
+                            'download_url': download_url}), 202
+        except Exception as e:
+            print(f"ERRO: [gerar_relatorio_financeiro_pdf] {e}")
+            return jsonify({'success': False, 'message': f'Erro interno: {e}'}), 500
+
+    @app.route('/relatorios/financeiro/pdf', methods=['GET'], endpoint='baixar_relatorio_financeiro_pdf')
+    @login_required
+    @admin_required
+    def baixar_relatorio_financeiro_pdf():
+        """
+        PDF gerado por gerar_relatorio_financeiro_pdf (parâmetro versao do download_url; padrão: a versão
+        atual); 404 se ainda não foi gerado ou já saiu do cache.
+        """
+        clinica_id = session['clinica_id']
+        try:
+            meses = _requested_months()
+        except ValueError as ve:
+            return jsonify({'success': False, 'message': str(ve)}), 400
+        versao = request.args.get('versao', type=int)
+        pdf = cached_report_pdf(clinica_id, meses, report_version(clinica_id, meses) if versao is None else versao)
+        if pdf is None:
+            return jsonify({'success': False, 'message': 'Relatório não disponível. Gere o PDF novamente.'}), 404
+        return pdf, 200, {
+            'Content-Type': 'application/pdf',
+            'Content-Disposition': f'attachment; filename={report_filename(meses, "pdf")}'
+        }
@@ -6,6 +6,14 @@ from google.cloud import firestore
 
 # Importar utils
 from utils import get_db, login_required, admin_required, SAO_PAULO_TZ
+from availability import invalidate_availability
+from query_registry import register_query
+
+
+register_query('profissionais.ativos_por_nome', 'clinicas/{clinica_id}/profissionais',
+               equality=('ativo',), order_by=('nome',))
+register_query('horarios.do_profissional', 'clinicas/{clinica_id}/profissionais/{profissional_id}/horarios_disponiveis',
+               order_by=('dia_semana', 'hora_inicio'))
 
 
 def register_schedules_routes(app): # Agora é uma função que recebe o app
@@ -90,6 +98,7 @@ def register_schedules_routes(app): # Agora é uma função que recebe o app
                         horario_data['intervalo_minutos'] = intervalo_minutos
 
                     db_instance.collection('clinicas').document(clinica_id).collection('profissionais').document(profissional_id_selecionado).collection('horarios_disponiveis').add(horario_data)
+                    invalidate_availability(clinica_id, profissional_id_selecionado)
                     flash('Horário adicionado com sucesso!', 'success')
                     return redirect(url_for('listar_horarios'))
             except ValueError:
@@ -151,6 +160,7 @@ def register_schedules_routes(app): # Agora é uma função que recebe o app
                         horario_data_update['intervalo_minutos'] = firestore.DELETE_FIELD
 
                     horario_ref.update(horario_data_update)
+                    invalidate_availability(clinica_id, profissional_doc_id)
                     flash('Horário atualizado com sucesso!', 'success')
                     return redirect(url_for('listar_horarios'))
             except ValueError:
@@ -197,6 +207,7 @@ def register_schedules_routes(app): # Agora é uma função que recebe o app
         clinica_id = session['clinica_id']
         try:
             db_instance.collection('clinicas').document(clinica_id).collection('profissionais').document(profissional_doc_id).collection('horarios_disponiveis').document(horario_doc_id).delete()
+            invalidate_availability(clinica_id, profissional_doc_id)
             flash('Horário disponível excluído com sucesso!', 'success')
         except Exception as e:
             flash(f'Erro ao excluir horário: {e}', 'danger')
@@ -218,6 +229,7 @@ def register_schedules_routes(app): # Agora é uma função que recebe o app
                     current_status = data.get('ativo', False)    
                     new_status = not current_status
                     horario_ref.update({'ativo': new_status, 'atualizado_em': firestore.SERVER_TIMESTAMP})
+                    invalidate_availability(clinica_id, profissional_doc_id)
                     flash(f'Horário {"ativado" if new_status else "desativado"} com sucesso!', 'success')
                 else:
                     flash('Dados de horário inválidos.', 'danger')
@@ -5,6 +5,9 @@ from google.cloud import firestore # Importar no topo
 
 # Importar utils
 from utils import get_db, login_required, admin_required
+from query_registry import register_query
+
+register_query('usuarios.da_clinica', 'User', equality=('clinica_id',), order_by=('email',))
 
 def register_users_routes(app):
     @app.route('/usuarios', endpoint='listar_usuarios')
@@ -1,24 +1,44 @@
 from flask import Blueprint, render_template, session, flash, redirect, url_for, request, jsonify
 import datetime
-from google.cloud.firestore_v1.base_query import FieldFilter
-from google.cloud import firestore
-from utils import get_db, login_required, SAO_PAULO_TZ, convert_doc_to_dict
+from utils import get_db, login_required, SAO_PAULO_TZ
+from weekly_planner import (
+    PlannerAccessError, associate_goal, dissociate_goal, load_planner_context, load_week, pei_titles,
+    save_week_associations,
+)
 
 weekly_planning_bp = Blueprint('weekly_planning', __name__)
 
-def _convert_doc_references_to_paths(data):
-    """
-    Converte referências de documentos do Firestore em seus caminhos (strings)
-    para que possam ser serializadas para JSON.
-    """
-    if isinstance(data, dict):
-        return {k: _convert_doc_references_to_paths(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [_convert_doc_references_to_paths(elem) for elem in data]
-    elif isinstance(data, firestore.DocumentReference):
-        return data.path
-    else:
-        return data
+def _week_bounds(start_date_str, end_date_str, on_error=None):
+    """Intervalo da semana (início 00:00 e fim 23:59:59). Sem datas, usa a semana atual."""
+    today = datetime.datetime.now(SAO_PAULO_TZ)
+    start_date = None
+    if start_date_str:
+        try:
+            start_date = SAO_PAULO_TZ.localize(datetime.datetime.strptime(start_date_str, '%Y-%m-%d'))
+        except ValueError:
+            if on_error:
+                on_error("Formato de data inicial inválido. Use YYYY-MM-DD.")
+    if start_date is None:
+        start_date = today - datetime.timedelta(days=today.weekday())
+        start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    end_date = None
+    if end_date_str:
+        try:
+            end_date = SAO_PAULO_TZ.localize(datetime.datetime.strptime(end_date_str, '%Y-%m-%d'))
+        except ValueError:
+            if on_error:
+                on_error("Formato de data final inválido. Use YYYY-MM-DD.")
+    if end_date is None:
+        end_date = start_date + datetime.timedelta(days=6)
+    end_date = end_date.replace(hour=23, minute=59, second=59, microsecond=999)
+    return start_date, end_date
+
+def _week_professional_filter(is_admin, context):
+    """Profissional usado no filtro dos agendamentos: o escolhido pelo admin ou o próprio profissional."""
+    if is_admin:
+        return request.args.get('professional_id') or None
+    return context['profissional_id_logado']
 
 @weekly_planning_bp.route('/pacientes/<patient_id>/planejamento_semanal', methods=['GET'], endpoint='planejamento_semanal')
 @login_required
@@ -27,234 +47,112 @@ def planejamento_semanal(patient_id):
     Renderiza a página de planejamento semanal para um paciente específico.
     Carrega metas ativas e agendamentos da semana para o paciente.
     Permite filtragem por data e profissional (para admins).
+    O contexto que não depende da semana vem do cache do serviço de planejamento; trocar de
+    semana consulta apenas os agendamentos (e as metas associadas a eles).
     """
     db_instance = get_db()
     clinica_id = session['clinica_id']
-    user_role = session.get('user_role')
-    user_uid = session.get('user_uid')
-    
-    # Adiciona a URL da logo da clínica à sessão
+    is_admin = session.get('user_role') == 'admin'
+
     try:
-        clinica_doc = db_instance.collection('clinicas').document(clinica_id).get()
-        if clinica_doc.exists:
-            session['clinica_url_logo'] = clinica_doc.to_dict().get('url_logo', '')
-        else:
-            session['clinica_url_logo'] = ''
+        context = load_planner_context(db_instance, clinica_id, patient_id, session.get('user_uid'), is_admin)
+    except PlannerAccessError as e:
+        flash(str(e), "danger")
+        return redirect(url_for('listar_pacientes'))
     except Exception as e:
-        print(f"Erro ao carregar URL da logo da clínica: {e}")
-        session['clinica_url_logo'] = ''
-
-    profissional_id_logado = None
-    # Verifica se o usuário logado é um profissional e obtém seu ID
-    if user_role != 'admin':
-        try:
-            user_doc = db_instance.collection('User').document(user_uid).get()
-            if user_doc.exists:
-                profissional_id_logado = user_doc.to_dict().get('profissional_id')
-            if not profissional_id_logado:
-                flash("Sua conta de usuário não está associada a um perfil de profissional. Contate o administrador.", "danger")
-                return redirect(url_for('listar_pacientes'))
-        except Exception as e:
-            flash(f"Erro ao buscar informações do profissional: {e}", "danger")
-            return redirect(url_for('listar_pacientes'))
-
-    # Busca os dados do paciente
-    patient_ref = db_instance.collection('clinicas').document(clinica_id).collection('pacientes').document(patient_id)
-    patient_doc = patient_ref.get()
-    if not patient_doc.exists:
+        flash(f"Erro ao carregar planejamento do paciente: {e}", "danger")
+        print(f"Erro ao carregar contexto do planejamento: {e}")
+        return redirect(url_for('listar_pacientes'))
+    if context is None:
         flash("Paciente não encontrado.", "danger")
         return redirect(url_for('listar_pacientes'))
-    
-    patient_data = convert_doc_to_dict(patient_doc)
-
-    # Define o período de busca para agendamentos (semana atual por padrão ou filtros)
-    start_date_str = request.args.get('start_date')
-    end_date_str = request.args.get('end_date')
-    filter_professional_id = request.args.get('professional_id')
-
-    today = datetime.datetime.now(SAO_PAULO_TZ)
-    if start_date_str:
-        try:
-            start_date = SAO_PAULO_TZ.localize(datetime.datetime.strptime(start_date_str, '%Y-%m-%d'))
-        except ValueError:
-            flash("Formato de data inicial inválido. Use YYYY-MM-DD.", "danger")
-            start_date = today - datetime.timedelta(days=today.weekday())
-            start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-    else:
-        start_date = today - datetime.timedelta(days=today.weekday())
-        start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    if end_date_str:
-        try:
-            end_date = SAO_PAULO_TZ.localize(datetime.datetime.strptime(end_date_str, '%Y-%m-%d'))
-            end_date = end_date.replace(hour=23, minute=59, second=59, microsecond=999)
-        except ValueError:
-            flash("Formato de data final inválido. Use YYYY-MM-DD.", "danger")
-            end_date = start_date + datetime.timedelta(days=6)
-            end_date = end_date.replace(hour=23, minute=59, second=59, microsecond=999)
-    else:
-        end_date = start_date + datetime.timedelta(days=6)
-        end_date = end_date.replace(hour=23, minute=59, second=59, microsecond=999)
-
-    metas_ativas = []
-    try:
-        # Busca PEIs ativos para o paciente, filtrando por profissional se não for admin
-        peis_query = db_instance.collection('clinicas').document(clinica_id).collection('peis').where(
-            filter=FieldFilter('paciente_id', '==', patient_id)
-        ).where(
-            filter=FieldFilter('status', '==', 'Ativo')
-        )
-        
-        if user_role != 'admin' and profissional_id_logado:
-            peis_query = peis_query.where(
-                filter=FieldFilter('profissionais_ids', 'array_contains', profissional_id_logado)
-            )
 
-        peis_docs = peis_query.stream()
+    # Adiciona a URL da logo da clínica à sessão
+    session['clinica_url_logo'] = context['url_logo']
 
-        for pei_doc in peis_docs:
-            pei_id = pei_doc.id
-            pei_title = pei_doc.to_dict().get('titulo', 'PEI sem Título')
-            metas_ref = pei_doc.reference.collection('metas')
-            metas_docs = metas_ref.stream()
-            for meta_doc in metas_docs:
-                meta_data = convert_doc_to_dict(meta_doc)
-                if meta_data and meta_data.get('status') == 'Ativo':
-                    meta_data['id'] = meta_doc.id
-                    meta_data['pei_id'] = pei_id
-                    meta_data['pei_title'] = pei_title
-                    
-                    alvos_meta = []
-                    alvos_ref = meta_doc.reference.collection('alvos')
-                    alvos_docs = alvos_ref.stream()
-                    for alvo_doc in alvos_docs:
-                        alvo_data = convert_doc_to_dict(alvo_doc)
-                        if alvo_data:
-                            alvo_data['id'] = alvo_doc.id
-                            alvos_meta.append(alvo_data)
-                    meta_data['alvos'] = alvos_meta
-                    
-                    metas_ativas.append(_convert_doc_references_to_paths(meta_data))
-    except Exception as e:
-        flash(f"Erro ao carregar metas do paciente: {e}", "danger")
-        print(f"Erro ao carregar metas: {e}")
+    start_date, end_date = _week_bounds(request.args.get('start_date'), request.args.get('end_date'),
+                                        on_error=lambda message: flash(message, "danger"))
 
     agendamentos_semana = []
     try:
-        # Busca agendamentos para o paciente dentro do período e filtros
-        agendamentos_query = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos').where(
-            filter=FieldFilter('paciente_id', '==', patient_id)
-        ).where(
-            filter=FieldFilter('data_agendamento_ts', '>=', start_date)
-        ).where(
-            filter=FieldFilter('data_agendamento_ts', '<=', end_date)
+        agendamentos_semana = load_week(
+            db_instance, clinica_id, patient_id, start_date, end_date,
+            profissional_id=_week_professional_filter(is_admin, context),
+            pei_titles_known={meta['pei_id']: meta['pei_title'] for meta in context['metas_ativas']},
         )
-        
-        if user_role == 'admin' and filter_professional_id:
-            agendamentos_query = agendamentos_query.where(
-                filter=FieldFilter('profissional_id', '==', filter_professional_id)
-            )
-        elif user_role != 'admin' and profissional_id_logado:
-            agendamentos_query = agendamentos_query.where(
-                filter=FieldFilter('profissional_id', '==', profissional_id_logado)
-            )
-
-        agendamentos_docs = agendamentos_query.order_by('data_agendamento_ts').order_by('hora_agendamento').stream()
-        
-        for ag_doc in agendamentos_docs:
-            ag_data = convert_doc_to_dict(ag_doc)
-            if ag_data:
-                ag_data['id'] = ag_doc.id
-                if ag_data.get('data_agendamento_ts'):
-                    ag_data['data_formatada'] = ag_data['data_agendamento_ts'].strftime('%d/%m/%Y')
-                
-                # Carrega metas já associadas a este agendamento
-                ag_data['metas_associadas'] = []
-                metas_associadas_ref = ag_doc.reference.collection('metas_associadas')
-                metas_associadas_docs = metas_associadas_ref.stream()
-                for meta_assoc_doc in metas_associadas_docs:
-                    meta_assoc_data = convert_doc_to_dict(meta_assoc_doc)
-                    if meta_assoc_data:
-                        # Busca o título do PEI para exibição
-                        pei_ref = db_instance.collection('clinicas').document(clinica_id).collection('peis').document(meta_assoc_data.get('pei_id'))
-                        pei_doc = pei_ref.get()
-                        if pei_doc.exists:
-                            meta_assoc_data['pei_title'] = pei_doc.to_dict().get('titulo', 'PEI sem Título')
-                        else:
-                            meta_assoc_data['pei_title'] = 'PEI não encontrado'
-                        
-                        # Converte referências de documentos para caminhos para envio ao template
-                        if 'ref_meta' in meta_assoc_data and isinstance(meta_assoc_data['ref_meta'], firestore.DocumentReference):
-                            meta_assoc_data['ref_meta'] = meta_assoc_data['ref_meta'].path
-                        if 'ref_pei' in meta_assoc_data and isinstance(meta_assoc_data['ref_pei'], firestore.DocumentReference):
-                            meta_assoc_data['ref_pei'] = meta_assoc_data['ref_pei'].path
-                        if 'ref_agendamentos' in meta_assoc_data and isinstance(meta_assoc_data['ref_agendamentos'], firestore.DocumentReference):
-                            meta_assoc_data['ref_agendamentos'] = meta_assoc_data['ref_agendamentos'].path
-
-                        ag_data['metas_associadas'].append(meta_assoc_data)
-
-                # Busca o nome do profissional para exibição
-                if ag_data.get('profissional_id'):
-                    prof_doc = db_instance.collection('clinicas').document(clinica_id).collection('profissionais').document(ag_data['profissional_id']).get()
-                    if prof_doc.exists:
-                        ag_data['profissional_nome'] = prof_doc.to_dict().get('nome', 'Desconhecido')
-                    else:
-                        ag_data['profissional_nome'] = 'Desconhecido'
-                else:
-                    ag_data['profissional_nome'] = 'Não Atribuído'
-                
-                agendamentos_semana.append(_convert_doc_references_to_paths(ag_data))
     except Exception as e:
         flash(f"Erro ao carregar agendamentos da semana: {e}", "danger")
         print(f"Erro ao carregar agendamentos da semana: {e}")
 
-    professionals = []
-    if user_role == 'admin':
-        try:
-            prof_docs = db_instance.collection('clinicas').document(clinica_id).collection('profissionais').stream()
-            for prof_doc in prof_docs:
-                prof_data = convert_doc_to_dict(prof_doc)
-                if prof_data:
-                    prof_data['id'] = prof_doc.id
-                    professionals.append(prof_data)
-        except Exception as e:
-            print(f"Erro ao carregar lista de profissionais para admin: {e}")
-
-    logged_in_professional_name = 'N/A'
-    if profissional_id_logado:
-        try:
-            prof_doc = db_instance.collection('clinicas').document(clinica_id).collection('profissionais').document(profissional_id_logado).get()
-            if prof_doc.exists:
-                logged_in_professional_name = prof_doc.to_dict().get('nome', 'N/A')
-        except Exception as e:
-            print(f"Erro ao buscar nome do profissional logado: {e}")
-
     return render_template(
         'weekly_planning.html',
-        patient=patient_data,
-        metas_ativas=metas_ativas,
+        patient=context['patient'],
+        metas_ativas=context['metas_ativas'],
         agendamentos_semana=agendamentos_semana,
         current_week_start=start_date.strftime('%Y-%m-%d'),
         current_week_end=end_date.strftime('%Y-%m-%d'),
-        is_admin=(user_role == 'admin'),
-        is_professional=(user_role == 'profissional'),
-        logged_in_professional_id=profissional_id_logado,
-        logged_in_professional_name=logged_in_professional_name,
-        professionals=professionals
+        is_admin=is_admin,
+        is_professional=(session.get('user_role') == 'profissional'),
+        logged_in_professional_id=context['profissional_id_logado'],
+        logged_in_professional_name=context['profissional_nome_logado'],
+        professionals=context['professionals']
     )
 
+@weekly_planning_bp.route('/api/pacientes/<patient_id>/planejamento_semanal', methods=['GET'])
+@login_required
+def planejamento_semanal_snapshot(patient_id):
+    """
+    Retorna em JSON o planejamento de uma semana (start_date/end_date, professional_id para admins).
+    Com incluir_metas=false as metas ativas não são enviadas (útil ao navegar entre semanas).
+    """
+    db_instance = get_db()
+    clinica_id = session['clinica_id']
+    is_admin = session.get('user_role') == 'admin'
+
+    errors = []
+    start_date, end_date = _week_bounds(request.args.get('start_date'), request.args.get('end_date'), on_error=errors.append)
+    if errors:
+        return jsonify({"success": False, "message": errors[0]}), 400
+
+    try:
+        context = load_planner_context(db_instance, clinica_id, patient_id, session.get('user_uid'), is_admin)
+        if context is None:
+            return jsonify({"success": False, "message": "Paciente não encontrado."}), 404
+        agendamentos_semana = load_week(
+            db_instance, clinica_id, patient_id, start_date, end_date,
+            profissional_id=_week_professional_filter(is_admin, context),
+            pei_titles_known={meta['pei_id']: meta['pei_title'] for meta in context['metas_ativas']},
+        )
+    except PlannerAccessError as e:
+        return jsonify({"success": False, "message": str(e)}), 403
+    except Exception as e:
+        print(f"Erro ao montar planejamento semanal: {e}")
+        return jsonify({"success": False, "message": f"Erro interno do servidor: {e}"}), 500
+
+    snapshot = {
+        "success": True,
+        "inicio": start_date.strftime('%Y-%m-%d'),
+        "fim": end_date.strftime('%Y-%m-%d'),
+        "agendamentos": [
+            dict(ag, data_agendamento_ts=ag['data_agendamento_ts'].isoformat())
+            if isinstance(ag.get('data_agendamento_ts'), datetime.datetime) else ag
+            for ag in agendamentos_semana
+        ],
+    }
+    if request.args.get('incluir_metas', 'true') != 'false':
+        snapshot["metas_ativas"] = context['metas_ativas']
+    return jsonify(snapshot), 200
+
 @weekly_planning_bp.route('/api/planejamento_semanal/associar_meta', methods=['POST'])
 @login_required
 def associar_meta_agendamento():
     """
     Associa ou desassocia uma meta a um agendamento.
-    Recebe agendamento_id, meta_id, meta_nome, pei_id e a ação (associar/desassociar).
-    Agora salva referências de documento do Firestore.
+    Recebe agendamento_id, meta_id, meta_nome, pei_id (e opcionalmente pei_title) e a ação (associar/desassociar).
+    Associações antigas (ID automático) também contam: não são duplicadas e são removidas.
     """
     db_instance = get_db()
     clinica_id = session['clinica_id']
-    user_role = session.get('user_role')
-    user_uid = session.get('user_uid')
 
     data = request.json
 
@@ -268,51 +166,73 @@ def associar_meta_agendamento():
         return jsonify({"success": False, "message": "Dados incompletos."}), 400
 
     try:
-        agendamento_ref = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos').document(agendamento_id)
-        meta_ref = db_instance.collection('clinicas').document(clinica_id).collection('peis').document(pei_id).collection('metas').document(meta_id)
-        pei_ref = db_instance.collection('clinicas').document(clinica_id).collection('peis').document(pei_id)
-        
-        metas_associadas_subcollection_ref = agendamento_ref.collection('metas_associadas')
-
-        meta_to_associate_data = {
-            'meta_id': meta_id,
-            'meta_nome': meta_nome,
-            'pei_id': pei_id,
-            'ref_meta': meta_ref,  # Salva como DocumentReference
-            'ref_pei': pei_ref,    # Salva como DocumentReference
-            'ref_agendamentos': agendamento_ref, # Salva como DocumentReference
-            'timestamp': firestore.SERVER_TIMESTAMP
-        }
-
         if action == 'associar':
-            existing_meta_query = metas_associadas_subcollection_ref.where(
-                filter=FieldFilter('meta_id', '==', meta_id)
-            ).limit(1).stream()
-            
-            existing_meta_docs = list(existing_meta_query)
-
-            if not existing_meta_docs:
-                metas_associadas_subcollection_ref.add(meta_to_associate_data)
-                return jsonify({"success": True, "message": "Meta associada com sucesso!"}), 200
-            else:
+            pei_title = data.get('pei_title') or pei_titles(db_instance, clinica_id, [pei_id]).get(pei_id, 'PEI não encontrado')
+            if not associate_goal(db_instance, clinica_id, agendamento_id, meta_id, meta_nome, pei_id, pei_title):
                 return jsonify({"success": False, "message": "Meta já associada a este agendamento."}), 409
+            return jsonify({"success": True, "message": "Meta associada com sucesso!"}), 200
         
         elif action == 'desassociar':
-            meta_to_delete_query = metas_associadas_subcollection_ref.where(
-                filter=FieldFilter('meta_id', '==', meta_id)
-            ).limit(1).stream()
-            
-            meta_to_delete_docs = list(meta_to_delete_query)
-
-            if meta_to_delete_docs:
-                for doc in meta_to_delete_docs:
-                    doc.reference.delete()
-                return jsonify({"success": True, "message": "Meta desassociada com sucesso!"}), 200
-            else:
+            if not dissociate_goal(db_instance, clinica_id, agendamento_id, meta_id):
                 return jsonify({"success": False, "message": "Meta não encontrada neste agendamento para desassociar."}), 404
+            return jsonify({"success": True, "message": "Meta desassociada com sucesso!"}), 200
         
         else:
             return jsonify({"success": False, "message": "Ação inválida."}), 400
 
     except Exception as e:
         return jsonify({"success": False, "message": f"Erro interno do servidor: {e}"}), 500
+
+@weekly_planning_bp.route('/api/planejamento_semanal/associacoes', methods=['POST'])
+@login_required
+def salvar_associacoes_semana():
+    """
+    Salva de uma vez as associações de metas da semana.
+    Recebe {"associacoes": {agendamento_id: [{meta_id, meta_nome, pei_id}, ...]}} com o conjunto
+    completo de metas de cada agendamento enviado; o servidor compara com o estado atual e grava
+    somente as inclusões e remoções, em lote.
+    """
+    db_instance = get_db()
+    clinica_id = session['clinica_id']
+    user_role = session.get('user_role')
+    user_uid = session.get('user_uid')
+
+    data = request.json or {}
+    associacoes = data.get('associacoes')
+    if not isinstance(associacoes, dict) or not associacoes:
+        return jsonify({"success": False, "message": "Nenhuma associação informada."}), 400
+
+    desired = {}
+    for agendamento_id, metas in associacoes.items():
+        if not agendamento_id or not isinstance(metas, list):
+            return jsonify({"success": False, "message": "Dados incompletos."}), 400
+        desired[agendamento_id] = []
+        for meta in metas:
+            if not isinstance(meta, dict) or not all(meta.get(campo) for campo in ('meta_id', 'meta_nome', 'pei_id')):
+                return jsonify({"success": False, "message": "Dados incompletos."}), 400
+            desired[agendamento_id].append({campo: meta[campo] for campo in ('meta_id', 'meta_nome', 'pei_id')})
+
+    try:
+        # Confere, numa leitura em lote, se os agendamentos existem e se o profissional pode alterá-los
+        agendamentos_ref = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos')
+        agendamentos = {
+            doc.id: doc.to_dict() or {}
+            for doc in db_instance.get_all([agendamentos_ref.document(ag_id) for ag_id in desired], field_paths=['profissional_id'])
+            if doc.exists
+        }
+        faltando = [ag_id for ag_id in desired if ag_id not in agendamentos]
+        if faltando:
+            return jsonify({"success": False, "message": f"Agendamento(s) não encontrado(s): {', '.join(faltando)}"}), 404
+
+        if user_role != 'admin':
+            user_doc = db_instance.collection('User').document(user_uid).get()
+            profissional_id_logado = user_doc.to_dict().get('profissional_id') if user_doc.exists else None
+            if not profissional_id_logado or any(ag.get('profissional_id') != profissional_id_logado for ag in agendamentos.values()):
+                return jsonify({"success": False, "message": "Você não pode alterar metas de agendamentos de outros profissionais."}), 403
+
+        resumo = save_week_associations(db_instance, clinica_id, desired)
+        return jsonify({"success": True, "message": "Planejamento salvo com sucesso!", **resumo}), 200
+
+    except Exception as e:
+        print(f"Erro ao salvar associações da semana: {e}")
+        return jsonify({"success": False, "message": f"Erro interno do servidor: {e}"}), 500
@@ -0,0 +1,172 @@
+import datetime
+import hashlib
+import json
+import threading
+import time
+import pytz
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ
+from availability import DURACAO_PADRAO_MINUTOS, agenda_version
+from recurrence import virtual_occurrences
+from query_registry import register_query
+
+# =================================================================
+# DADOS DO CALENDÁRIO (formato colunar)
+# =================================================================
+#
+# Cada agendamento do intervalo ocupa a mesma posição em arrays paralelos
+# ('colunas'); nomes e IDs repetidos (pacientes, profissionais, serviços, status)
+# ficam uma única vez em 'dicionarios' e as colunas guardam só o índice.
+# O resultado é cacheado por (clínica, intervalo, profissionais) e descartado
+# quando a versão da agenda da clínica muda (qualquer gravação de agendamento).
+
+# Status conhecidos, na ordem dos códigos. Status desconhecidos recebem os códigos seguintes.
+STATUS_CODIGOS = ('confirmado', 'concluido', 'pendente', 'cancelado')
+
+# Maior intervalo aceito por requisição (dias)
+CALENDARIO_MAX_DIAS = 42
+
+CALENDARIO_CACHE_TTL = 60  # segundos
+
+# Limite de valores de um filtro 'in' do Firestore
+_LIMITE_FILTRO_IN = 30
+
+_CAMPOS_CONSULTADOS = [
+    'data_agendamento', 'hora_agendamento', 'duracao_minutos', 'status',
+    'paciente_id', 'paciente_nome', 'paciente_numero', 'profissional_id', 'profissional_nome',
+    'servico_procedimento_id', 'servico_procedimento_nome', 'servico_procedimento_preco', 'serie_id',
+]
+
+# {(clinica_id, inicio, fim, profissionais): (versão, expira_em, payload, etag)}
+_calendar_cache = {}
+_calendar_cache_lock = threading.Lock()
+
+
+class _Dictionary:
+    """Lista de valores únicos; index() devolve a posição de cada valor, acrescentando os novos."""
+
+    def __init__(self, initial=()):
+        self.values = list(initial)
+        self._positions = {value: index for index, value in enumerate(self.values)}
+
+    def index(self, value):
+        if value not in self._positions:
+            self._positions[value] = len(self.values)
+            self.values.append(value)
+        return self._positions[value]
+
+
+def _minutes(hhmm):
+    hours, minutes = str(hhmm).split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+register_query('calendario.agendamentos_do_periodo', 'clinicas/{clinica_id}/agendamentos',
+               equality=('profissional_id',), range_fields=('data_agendamento_ts',), optional=('profissional_id',),
+               python_filter="mais profissionais que o limite do filtro 'in' são filtrados após a leitura")
+
+def _load_appointments(db_instance, clinica_id, inicio, fim, profissional_ids):
+    start = SAO_PAULO_TZ.localize(datetime.datetime.combine(inicio, datetime.time.min)).astimezone(pytz.utc)
+    end = SAO_PAULO_TZ.localize(datetime.datetime.combine(fim + datetime.timedelta(days=1), datetime.time.min)).astimezone(pytz.utc)
+    query = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos')\
+        .where(filter=FieldFilter('data_agendamento_ts', '>=', start))\
+        .where(filter=FieldFilter('data_agendamento_ts', '<', end))
+    if profissional_ids and len(profissional_ids) <= _LIMITE_FILTRO_IN:
+        query = query.where(filter=FieldFilter('profissional_id', 'in', list(profissional_ids)))
+    appointments = [dict(doc.to_dict() or {}, id=doc.id) for doc in query.select(_CAMPOS_CONSULTADOS).stream()]
+    appointments += virtual_occurrences(db_instance, clinica_id, inicio, fim,
+                                        profissional_id=profissional_ids[0] if len(profissional_ids or ()) == 1 else None)
+    if profissional_ids:
+        wanted = set(profissional_ids)
+        appointments = [ag for ag in appointments if ag.get('profissional_id') in wanted]
+    return appointments
+
+def build_calendar_payload(appointments, inicio, fim):
+    """Monta o JSON colunar a partir de uma lista de agendamentos (dicionários com 'id')."""
+    dias = [(inicio + datetime.timedelta(days=offset)).isoformat() for offset in range((fim - inicio).days + 1)]
+    dia_index = {dia: index for index, dia in enumerate(dias)}
+    status = _Dictionary(STATUS_CODIGOS)
+    pacientes, profissionais, servicos, series = _Dictionary(), _Dictionary(), _Dictionary(), _Dictionary()
+    numeros_pacientes, nomes_profissionais, nomes_servicos = {}, {}, {}
+    colunas = {nome: [] for nome in ('id', 'dia', 'inicio', 'duracao', 'status', 'paciente',
+                                     'profissional', 'servico', 'preco', 'serie', 'virtual')}
+
+    rows = []
+    for ag in appointments:
+        if ag.get('status') == 'excluido' or ag.get('data_agendamento') not in dia_index:
+            continue
+        try:
+            rows.append((ag['data_agendamento'], _minutes(ag['hora_agendamento']), ag))
+        except (KeyError, ValueError, TypeError):
+            continue  # Agendamento antigo sem hora válida
+    rows.sort(key=lambda row: (row[0], row[1]))
+
+    for dia, inicio_min, ag in rows:
+        paciente = pacientes.index((ag.get('paciente_id'), ag.get('paciente_nome')))
+        numeros_pacientes.setdefault(paciente, ag.get('paciente_numero'))
+        profissional = profissionais.index(ag.get('profissional_id') or '')
+        nomes_profissionais.setdefault(profissional, ag.get('profissional_nome'))
+        servico = servicos.index(ag.get('servico_procedimento_id') or '')
+        nomes_servicos.setdefault(servico, ag.get('servico_procedimento_nome'))
+
+        colunas['id'].append(ag['id'])
+        colunas['dia'].append(dia_index[dia])
+        colunas['inicio'].append(inicio_min)
+        colunas['duracao'].append(int(ag.get('duracao_minutos') or DURACAO_PADRAO_MINUTOS))
+        colunas['status'].append(status.index(str(ag.get('status') or 'pendente')))
+        colunas['paciente'].append(paciente)
+        colunas['profissional'].append(profissional)
+        colunas['servico'].append(servico)
+        colunas['preco'].append(float(ag.get('servico_procedimento_preco') or 0))
+        colunas['serie'].append(series.index(ag['serie_id']) if ag.get('serie_id') else -1)
+        colunas['virtual'].append(1 if ag.get('virtual') else 0)
+
+    return {
+        'success': True,
+        'inicio': inicio.isoformat(),
+        'fim': fim.isoformat(),
+        'dias': dias,
+        'total': len(rows),
+        'colunas': colunas,
+        'dicionarios': {
+            'status': status.values,
+            'pacientes': {
+                'ids': [paciente_id for paciente_id, _ in pacientes.values],
+                'nomes': [nome for _, nome in pacientes.values],
+                'numeros': [numeros_pacientes[i] for i in range(len(pacientes.values))],
+            },
+            'profissionais': {
+                'ids': profissionais.values,
+                'nomes': [nomes_profissionais[i] for i in range(len(profissionais.values))],
+            },
+            'servicos': {
+                'ids': servicos.values,
+                'nomes': [nomes_servicos[i] for i in range(len(servicos.values))],
+            },
+            'series': series.values,
+        },
+    }
+
+def get_calendar(db_instance, clinica_id, inicio, fim, profissional_ids=None):
+    """
+    Dados colunares do calendário entre inicio e fim (inclusive), opcionalmente só de alguns
+    profissionais. Retorna (payload, etag); o ETag é o hash do conteúdo.
+    """
+    profissional_ids = tuple(sorted(set(profissional_ids or ())))
+    key = (clinica_id, inicio.isoformat(), fim.isoformat(), profissional_ids)
+    version = agenda_version(clinica_id)
+    now = time.monotonic()
+    with _calendar_cache_lock:
+        cached = _calendar_cache.get(key)
+        if cached and cached[0] == version and cached[1] > now:
+            return cached[2], cached[3]
+
+    payload = build_calendar_payload(
+        _load_appointments(db_instance, clinica_id, inicio, fim, profissional_ids), inicio, fim)
+    etag = hashlib.sha1(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+    with _calendar_cache_lock:
+        # Remove entradas vencidas ou de versões antigas para o cache não crescer indefinidamente
+        for stale in [k for k, v in _calendar_cache.items() if v[1] <= now or (k[0] == clinica_id and v[0] != version)]:
+            _calendar_cache.pop(stale, None)
+        _calendar_cache[key] = (version, now + CALENDARIO_CACHE_TTL, payload, etag)
+    return payload, etag
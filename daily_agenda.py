@@ -0,0 +1,392 @@
+import datetime
+import threading
+import time
+import pytz
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ, start_background_job
+from availability import DURACAO_PADRAO_MINUTOS, appointment_interval
+from query_registry import register_query
+
+# =================================================================
+# AGENDA DIÁRIA PRÉ-CALCULADA POR PROFISSIONAL
+# =================================================================
+#
+# Um documento por profissional e dia em clinicas/{id}/agendas_diarias/{profissional_id}_{AAAA-MM-DD}:
+#   {'profissional_id', 'data', 'sessoes': {agendamento_id: {inicio, duracao, paciente..., status}}}
+# As sessões ficam num mapa por ID do agendamento para que cada gravação de agendamento atualize
+# a agenda às cegas (set com merge), no mesmo batch/transação, sem ler o documento do dia.
+# A lista ordenada por horário é montada na leitura. Agendamentos excluídos saem da agenda;
+# cancelados continuam nela, com o status.
+# As agendas são construídas uma vez por clínica (build_daily_agendas, agendado automaticamente
+# por schedule_agenda_rebuild) e registradas em agendas_diarias_controle/geral com AGENDA_VERSAO e
+# o primeiro dia coberto. Enquanto não estão prontas, e para dias anteriores ao primeiro coberto,
+# a leitura consulta 'agendamentos' diretamente.
+
+AGENDAS_COLLECTION = 'agendas_diarias'
+
+# Dias lidos por página na exportação iCalendar
+AGENDA_EXPORTACAO_PAGINA = 31
+
+# Maior intervalo aceito na exportação (dias)
+AGENDA_EXPORTACAO_MAX_DIAS = 366
+
+# Gravações por lote na reconstrução
+AGENDA_BATCH_SIZE = 400
+
+# Dias recalculados na construção automática: os AGENDA_RECONSTRUCAO_DIAS anteriores a hoje até o
+# horizonte de materialização das séries
+AGENDA_RECONSTRUCAO_DIAS = 366
+
+# Intervalo mínimo (segundos) entre duas construções automáticas de uma clínica
+AGENDA_RECONSTRUCAO_INTERVALO_SEGUNDOS = 3600
+
+# Incrementar quando o formato das sessões mudar: força a reconstrução
+AGENDA_VERSAO = 1
+
+_ICAL_STATUS = {'confirmado': 'CONFIRMED', 'concluido': 'CONFIRMED', 'pendente': 'TENTATIVE', 'cancelado': 'CANCELLED'}
+
+
+# {clinica_id: primeiro dia coberto (ISO)} das clínicas com as agendas construídas na versão atual
+_prontas = {}
+_prontas_lock = threading.Lock()
+_ultima_reconstrucao = {}
+_ultima_reconstrucao_lock = threading.Lock()
+
+
+def _agendas_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection(AGENDAS_COLLECTION)
+
+def _controle_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('agendas_diarias_controle').document('geral')
+
+def agenda_ref(db_instance, clinica_id, profissional_id, data):
+    """Documento da agenda do profissional no dia 'data' (date ou 'AAAA-MM-DD')."""
+    data = data.isoformat() if isinstance(data, datetime.date) else data
+    return _agendas_ref(db_instance, clinica_id).document(f"{profissional_id}_{data}")
+
+def _agenda_key(agendamento):
+    if not agendamento or agendamento.get('status') == 'excluido':
+        return None
+    if not agendamento.get('profissional_id') or not agendamento.get('data_agendamento'):
+        return None
+    return agendamento['profissional_id'], agendamento['data_agendamento']
+
+def session_entry(agendamento):
+    """Resumo de um agendamento guardado na agenda do dia."""
+    return {
+        'inicio': agendamento.get('hora_agendamento'),
+        'duracao': int(agendamento.get('duracao_minutos') or DURACAO_PADRAO_MINUTOS),
+        'paciente_id': agendamento.get('paciente_id'),
+        'paciente_nome': agendamento.get('paciente_nome'),
+        'paciente_numero': agendamento.get('paciente_numero'),
+        'servico_nome': agendamento.get('servico_procedimento_nome'),
+        'status': agendamento.get('status'),
+        'serie_id': agendamento.get('serie_id'),
+    }
+
+def agenda_operations(db_instance, clinica_id, agendamento_id, antes=None, depois=None):
+    """
+    Gravações [('merge', referência, dados)] que levam a agenda diária de 'antes' para 'depois'
+    (dados completos do agendamento; None quando ele não existia/deixou de existir).
+    Remarcações para outro dia ou profissional tiram a sessão do dia antigo.
+    """
+    old_key, new_key = _agenda_key(antes), _agenda_key(depois)
+    operations = []
+    if old_key and old_key != new_key:
+        operations.append(('merge', agenda_ref(db_instance, clinica_id, *old_key), {
+            'sessoes': {agendamento_id: firestore.DELETE_FIELD},
+            'atualizado_em': firestore.SERVER_TIMESTAMP,
+        }))
+    if new_key:
+        operations.append(('merge', agenda_ref(db_instance, clinica_id, *new_key), {
+            'profissional_id': new_key[0],
+            'data': new_key[1],
+            'sessoes': {agendamento_id: session_entry(depois)},
+            'atualizado_em': firestore.SERVER_TIMESTAMP,
+        }))
+    return operations
+
+def apply_operations(writer, operations):
+    """Aplica as gravações da agenda num batch ou transação."""
+    for _, doc_ref, data in operations:
+        writer.set(doc_ref, data, merge=True)
+
+
+# --- Leitura ---
+
+def _sorted_sessions(agenda_data):
+    # Entradas sem 'inicio' vêm de uma mudança de status de um agendamento que não estava na agenda
+    sessoes = [dict(sessao, id=agendamento_id, data=agenda_data.get('data'))
+               for agendamento_id, sessao in (agenda_data.get('sessoes') or {}).items() if sessao.get('inicio')]
+    sessoes.sort(key=lambda sessao: (str(sessao['inicio']), sessao['id']))
+    return sessoes
+
+def agendas_coverage(db_instance, clinica_id):
+    """
+    Primeiro dia (ISO) coberto pelas agendas diárias da clínica, ou None se elas ainda não foram
+    construídas na versão atual (a resposta positiva fica em memória).
+    """
+    with _prontas_lock:
+        if clinica_id in _prontas:
+            return _prontas[clinica_id]
+    controle = (_controle_ref(db_instance, clinica_id).get(field_paths=['versao', 'primeiro_dia']).to_dict() or {})
+    if controle.get('versao', 0) < AGENDA_VERSAO or not controle.get('primeiro_dia'):
+        return None
+    with _prontas_lock:
+        _prontas[clinica_id] = controle['primeiro_dia']
+    return controle['primeiro_dia']
+
+def _covered(db_instance, clinica_id, data):
+    primeiro_dia = agendas_coverage(db_instance, clinica_id)
+    return primeiro_dia is not None and data.isoformat() >= primeiro_dia
+
+register_query('agenda_diaria.agendamentos_sem_agenda', 'clinicas/{clinica_id}/agendamentos',
+               equality=('profissional_id',), range_fields=('data_agendamento_ts',), order_by=('data_agendamento_ts',))
+
+def _professional_appointments(db_instance, clinica_id, profissional_id, inicio, fim):
+    """Consulta dos agendamentos do profissional de inicio a fim (datas), em ordem de horário."""
+    start = SAO_PAULO_TZ.localize(datetime.datetime.combine(inicio, datetime.time.min)).astimezone(pytz.utc)
+    end = SAO_PAULO_TZ.localize(datetime.datetime.combine(fim + datetime.timedelta(days=1), datetime.time.min)).astimezone(pytz.utc)
+    return db_instance.collection('clinicas').document(clinica_id).collection('agendamentos')\
+        .where(filter=FieldFilter('profissional_id', '==', profissional_id))\
+        .where(filter=FieldFilter('data_agendamento_ts', '>=', start))\
+        .where(filter=FieldFilter('data_agendamento_ts', '<', end))\
+        .order_by('data_agendamento_ts')
+
+def _sessions_from_appointments(db_instance, clinica_id, profissional_id, inicio, fim):
+    """Sessões de inicio a fim (datas) lidas de 'agendamentos', para os dias sem agenda construída."""
+    for ag_doc in _professional_appointments(db_instance, clinica_id, profissional_id, inicio, fim).stream():
+        agendamento = ag_doc.to_dict() or {}
+        key = _agenda_key(agendamento)
+        if key and agendamento.get('hora_agendamento'):
+            yield dict(session_entry(agendamento), id=ag_doc.id, data=key[1])
+
+def get_day(db_instance, clinica_id, profissional_id, data):
+    """
+    Sessões do profissional no dia (date), ordenadas por horário (uma única leitura). Dias ainda não
+    cobertos pelas agendas construídas são lidos de 'agendamentos'.
+    """
+    agenda_doc = agenda_ref(db_instance, clinica_id, profissional_id, data).get()
+    if agenda_doc.exists:
+        return _sorted_sessions(agenda_doc.to_dict() or {})
+    if _covered(db_instance, clinica_id, data):
+        return []
+    sessoes = list(_sessions_from_appointments(db_instance, clinica_id, profissional_id, data, data))
+    sessoes.sort(key=lambda sessao: (str(sessao['inicio']), sessao['id']))
+    return sessoes
+
+register_query('agenda_diaria.dias_do_profissional', 'clinicas/{clinica_id}/agendas_diarias',
+               equality=('profissional_id',), range_fields=('data',), order_by=('data',))
+
+def iter_days(db_instance, clinica_id, profissional_id, inicio, fim, page_size=AGENDA_EXPORTACAO_PAGINA):
+    """Percorre, em ordem, as sessões do profissional de inicio a fim (datas), página a página."""
+    query = _agendas_ref(db_instance, clinica_id)\
+        .where(filter=FieldFilter('profissional_id', '==', profissional_id))\
+        .where(filter=FieldFilter('data', '>=', inicio.isoformat()))\
+        .where(filter=FieldFilter('data', '<=', fim.isoformat()))\
+        .order_by('data').limit(page_size)
+    last = None
+    while True:
+        page = list((query.start_after(last) if last else query).stream())
+        for agenda_doc in page:
+            yield from _sorted_sessions(agenda_doc.to_dict() or {})
+        if len(page) < page_size:
+            break
+        last = page[-1]
+
+def iter_sessions(db_instance, clinica_id, profissional_id, inicio, fim):
+    """
+    Sessões de inicio a fim. Depois do horizonte de materialização as séries ainda não têm
+    agendamentos gravados; essas ocorrências são calculadas e entram no fim, marcadas como virtuais.
+    Os dias anteriores ao primeiro coberto pelas agendas construídas (todos, se elas ainda não
+    existem) são lidos de 'agendamentos'.
+    """
+    from recurrence import horizon_end, virtual_occurrences
+
+    primeiro_dia = agendas_coverage(db_instance, clinica_id)
+    inicio_agendas = max(inicio, datetime.date.fromisoformat(primeiro_dia)) if primeiro_dia else fim + datetime.timedelta(days=1)
+    if inicio < inicio_agendas:
+        yield from _sessions_from_appointments(db_instance, clinica_id, profissional_id, inicio,
+                                               min(fim, inicio_agendas - datetime.timedelta(days=1)))
+    if inicio_agendas <= fim:
+        yield from iter_days(db_instance, clinica_id, profissional_id, inicio_agendas, fim)
+    inicio_virtual = max(inicio, horizon_end() + datetime.timedelta(days=1))
+    if inicio_virtual <= fim:
+        ocorrencias = virtual_occurrences(db_instance, clinica_id, inicio_virtual, fim, profissional_id=profissional_id)
+        for ocorrencia in sorted(ocorrencias, key=lambda o: (o['data_agendamento'], o['hora_agendamento'])):
+            yield dict(session_entry(ocorrencia), id=ocorrencia['id'], data=ocorrencia['data_agendamento'], virtual=True)
+
+
+# --- Exportação iCalendar ---
+
+def _ical_text(value):
+    return str(value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _ical_fold(line):
+    """Quebra linhas maiores que 75 octetos (RFC 5545, 3.1)."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts, current = [], ''
+    for char in line:
+        if len((current + char).encode('utf-8')) > (75 if not parts else 74):
+            parts.append(current)
+            current = ''
+        current += char
+    parts.append(current)
+    return '\r\n '.join(parts) + '\r\n'
+
+def _ical_utc(value):
+    return value.astimezone(pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def ical_lines(sessions, calendar_name, uid_domain='clinica-on'):
+    """Gera o arquivo .ics linha a linha a partir de um iterável de sessões (sem carregar tudo)."""
+    dtstamp = _ical_utc(datetime.datetime.now(SAO_PAULO_TZ))
+    yield _ical_fold('BEGIN:VCALENDAR')
+    yield _ical_fold('VERSION:2.0')
+    yield _ical_fold('PRODID:-//Clinica On//Agenda//PT-BR')
+    yield _ical_fold('CALSCALE:GREGORIAN')
+    yield _ical_fold('METHOD:PUBLISH')
+    yield _ical_fold(f'X-WR-CALNAME:{_ical_text(calendar_name)}')
+    yield _ical_fold('X-WR-TIMEZONE:America/Sao_Paulo')
+    for sessao in sessions:
+        try:
+            start, end = appointment_interval({'data_agendamento': sessao['data'], 'hora_agendamento': sessao['inicio'],
+                                               'duracao_minutos': sessao.get('duracao')})
+        except (KeyError, ValueError, TypeError):
+            continue  # Sessão antiga sem hora válida
+        resumo = sessao.get('paciente_nome') or 'Atendimento'
+        if sessao.get('servico_nome'):
+            resumo += f" - {sessao['servico_nome']}"
+        yield _ical_fold('BEGIN:VEVENT')
+        yield _ical_fold(f"UID:{sessao['id']}@{uid_domain}")
+        yield _ical_fold(f'DTSTAMP:{dtstamp}')
+        yield _ical_fold(f'DTSTART:{_ical_utc(start)}')
+        yield _ical_fold(f'DTEND:{_ical_utc(end)}')
+        yield _ical_fold(f'SUMMARY:{_ical_text(resumo)}')
+        yield _ical_fold(f"STATUS:{_ICAL_STATUS.get(sessao.get('status'), 'CONFIRMED')}")
+        yield _ical_fold('END:VEVENT')
+    yield _ical_fold('END:VCALENDAR')
+
+
+# --- Reconstrução ---
+
+@firestore.transactional
+def _rebuild_day_in_transaction(transaction, db_instance, clinica_id, profissional_id, data):
+    """
+    Recalcula a agenda de um profissional num dia lendo os agendamentos e o documento na mesma transação.
+    Usada quando o lote da reconstrução foi recusado porque um agendamento do dia foi gravado no meio.
+    """
+    day_ref = agenda_ref(db_instance, clinica_id, profissional_id, data)
+    atual = day_ref.get(transaction=transaction)
+    day = datetime.date.fromisoformat(data)
+    sessoes = {}
+    for ag_doc in _professional_appointments(db_instance, clinica_id, profissional_id, day, day).stream(transaction=transaction):
+        agendamento = ag_doc.to_dict() or {}
+        if _agenda_key(agendamento) == (profissional_id, data):
+            sessoes[ag_doc.id] = session_entry(agendamento)
+    if sessoes:
+        if (atual.to_dict() or {}).get('sessoes') != sessoes:
+            transaction.set(day_ref, {'profissional_id': profissional_id, 'data': data, 'sessoes': sessoes,
+                                      'atualizado_em': firestore.SERVER_TIMESTAMP})
+    elif atual.exists:
+        transaction.delete(day_ref)
+
+def rebuild_daily_agendas(db_instance, clinica_id, data_inicio, data_fim, progress_callback=None):
+    """
+    Recalcula as agendas diárias de todos os profissionais de data_inicio a data_fim a partir dos
+    agendamentos (para a carga inicial ou para corrigir divergências). Retorna as contagens.
+    As agendas existentes são lidas antes dos agendamentos e cada gravação leva como pré-condição o
+    update_time lido (ou a inexistência do documento): se um agendamento gravado no meio já mexeu
+    na agenda do dia, o lote é recusado e os seus dias são refeitos um a um em transações.
+    """
+    existentes = {}
+    for doc in _agendas_ref(db_instance, clinica_id)\
+            .where(filter=FieldFilter('data', '>=', data_inicio.isoformat()))\
+            .where(filter=FieldFilter('data', '<=', data_fim.isoformat())).stream():
+        agenda_data = doc.to_dict() or {}
+        existentes[(agenda_data.get('profissional_id'), agenda_data.get('data'))] = (doc, agenda_data.get('sessoes'))
+
+    start = SAO_PAULO_TZ.localize(datetime.datetime.combine(data_inicio, datetime.time.min)).astimezone(pytz.utc)
+    end = SAO_PAULO_TZ.localize(datetime.datetime.combine(data_fim + datetime.timedelta(days=1), datetime.time.min)).astimezone(pytz.utc)
+    query = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos')\
+        .where(filter=FieldFilter('data_agendamento_ts', '>=', start))\
+        .where(filter=FieldFilter('data_agendamento_ts', '<', end))\
+        .select(['data_agendamento', 'hora_agendamento', 'duracao_minutos', 'status', 'profissional_id', 'paciente_id',
+                 'paciente_nome', 'paciente_numero', 'servico_procedimento_nome', 'serie_id'])
+
+    agendas = {}
+    for ag_doc in query.stream():
+        agendamento = ag_doc.to_dict() or {}
+        key = _agenda_key(agendamento)
+        if key:
+            agendas.setdefault(key, {})[ag_doc.id] = session_entry(agendamento)
+
+    # (chave, sessões ou None para apagar); agendas iguais às lidas não são regravadas
+    mudancas = [(key, sessoes) for key, sessoes in agendas.items()
+                if key not in existentes or existentes[key][1] != sessoes]
+    mudancas += [(key, None) for key in existentes if key not in agendas]
+    refeitas = 0
+    for index in range(0, len(mudancas), AGENDA_BATCH_SIZE):
+        lote = mudancas[index:index + AGENDA_BATCH_SIZE]
+        batch = db_instance.batch()
+        for key, sessoes in lote:
+            if key not in existentes:
+                batch.create(agenda_ref(db_instance, clinica_id, *key), {
+                    'profissional_id': key[0], 'data': key[1], 'sessoes': sessoes, 'atualizado_em': firestore.SERVER_TIMESTAMP,
+                })
+                continue
+            option = db_instance.write_option(last_update_time=existentes[key][0].update_time)
+            if sessoes is None:
+                batch.delete(existentes[key][0].reference, option=option)
+            else:
+                # update substitui o mapa 'sessoes' inteiro e, ao contrário de set, aceita a pré-condição
+                batch.update(existentes[key][0].reference, {
+                    'profissional_id': key[0], 'data': key[1], 'sessoes': sessoes, 'atualizado_em': firestore.SERVER_TIMESTAMP,
+                }, option=option)
+        try:
+            batch.commit()
+        except (google_exceptions.FailedPrecondition, google_exceptions.AlreadyExists):
+            for key, _ in lote:
+                _rebuild_day_in_transaction(db_instance.transaction(), db_instance, clinica_id, *key)
+            refeitas += len(lote)
+        if progress_callback:
+            progress_callback(min(index + AGENDA_BATCH_SIZE, len(mudancas)), len(mudancas))
+    return {'agendas_gravadas': sum(1 for _, sessoes in mudancas if sessoes is not None),
+            'agendas_removidas': sum(1 for _, sessoes in mudancas if sessoes is None),
+            'agendas_refeitas': refeitas}
+
+def build_daily_agendas(db_instance, clinica_id, progress_callback=None):
+    """
+    Construção inicial: recalcula as agendas dos AGENDA_RECONSTRUCAO_DIAS anteriores a hoje até o
+    horizonte das séries e registra a versão e o primeiro dia coberto.
+    """
+    from recurrence import horizon_end
+
+    hoje = datetime.datetime.now(SAO_PAULO_TZ).date()
+    primeiro_dia = hoje - datetime.timedelta(days=AGENDA_RECONSTRUCAO_DIAS)
+    resultado = rebuild_daily_agendas(db_instance, clinica_id, primeiro_dia, horizon_end(hoje), progress_callback)
+    _controle_ref(db_instance, clinica_id).set({'versao': AGENDA_VERSAO, 'primeiro_dia': primeiro_dia.isoformat(),
+                                                'gerado_em': firestore.SERVER_TIMESTAMP}, merge=True)
+    with _prontas_lock:
+        _prontas[clinica_id] = primeiro_dia.isoformat()
+    return resultado
+
+def schedule_agenda_rebuild(db_instance, clinica_id, force=False):
+    """
+    Agenda build_daily_agendas em segundo plano se as agendas da clínica ainda não foram construídas na
+    versão atual (ou se force=True), no máximo uma vez a cada AGENDA_RECONSTRUCAO_INTERVALO_SEGUNDOS.
+    Retorna o job_id ou None se não foi necessário.
+    """
+    if not force and agendas_coverage(db_instance, clinica_id) is not None:
+        return None
+    now = time.monotonic()
+    with _ultima_reconstrucao_lock:
+        if not force and now - _ultima_reconstrucao.get(clinica_id, float('-inf')) < AGENDA_RECONSTRUCAO_INTERVALO_SEGUNDOS:
+            return None
+        _ultima_reconstrucao[clinica_id] = now
+    return start_background_job('Construção das agendas diárias', build_daily_agendas, db_instance, clinica_id,
+                                clinica_id=clinica_id)
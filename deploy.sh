@@ -5,6 +5,9 @@ cd $PROJECT_DIR
  
 git pull
  
+# Não reinicia com firestore.indexes.json desatualizado em relação às consultas declaradas
+python3 query_registry.py --verificar || { echo "Deploy interrompido: rode 'python query_registry.py --gerar' e faça o deploy dos índices."; exit 1; }
+ 
 sudo systemctl restart clinica.service
  
  
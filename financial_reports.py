@@ -0,0 +1,356 @@
+import csv
+import datetime
+import io
+import threading
+import time
+from google.cloud.firestore_v1.base_query import FieldFilter
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import inch
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from utils import SAO_PAULO_TZ, start_background_job
+from query_registry import register_query
+
+# =================================================================
+# RELATÓRIOS FINANCEIROS (RESULTADO DO PERÍODO)
+# =================================================================
+#
+# O resultado de um período (meses AAAA-MM) junta três fontes, lidas como streams em ordem de data,
+# sem carregar as coleções em memória:
+#   - receitas: agendamentos concluídos (servico_procedimento_preco), pela data do atendimento;
+#   - despesas: contas_a_pagar pelo mês de vencimento (contas sem vencimento ficam de fora);
+#   - custo de estoque: entradas com preco_total que não geraram conta a pagar (as que geraram já
+#     estão nas despesas).
+# O CSV é gerado linha a linha na resposta; o PDF (reportlab) traz o resumo mensal e é montado
+# num job em segundo plano.
+# O resumo fica em cache por (clínica, período), válido enquanto a versão do período (soma das versões
+# dos seus meses) não muda. availability, recurrence, payables e stock_ledger incrementam a versão dos
+# meses afetados (invalidate_financial_report) ao gravar agendamentos concluídos, contas e entradas.
+# Cada PDF fica guardado com a versão a partir da qual foi gerado: o download o entrega mesmo que os
+# dados tenham mudado depois.
+
+# Status de agendamento que contam como receita
+RELATORIO_STATUS_RECEITA = ('concluido',)
+
+# Maior período aceito por relatório (meses)
+RELATORIO_MESES_MAXIMO = 24
+
+RELATORIO_CACHE_TTL = 600  # segundos
+RELATORIO_CACHE_MAX = 64   # períodos guardados no cache (somando as clínicas)
+
+_COLUNAS_CSV = ('data', 'categoria', 'descricao', 'status', 'valor')
+
+# {(clinica_id, primeiro mês, último mês): {'versao', 'expira_em', 'resumo'}}
+_report_cache = {}
+# {(clinica_id, primeiro mês, último mês, versão): {'expira_em', 'pdf'}}
+_report_pdfs = {}
+# {(clinica_id, mês): versão}
+_report_versions = {}
+_report_cache_lock = threading.Lock()
+
+register_query('relatorios.receitas', 'clinicas/{clinica_id}/agendamentos',
+               equality=('status',), range_fields=('data_agendamento_ts',), order_by=('data_agendamento_ts',))
+register_query('relatorios.despesas', 'clinicas/{clinica_id}/contas_a_pagar',
+               range_fields=('data_vencimento',), order_by=('data_vencimento',))
+register_query('relatorios.custos_estoque', 'clinicas/{clinica_id}/estoque_movimentacoes',
+               equality=('tipo_movimentacao',), range_fields=('data_movimentacao',), order_by=('data_movimentacao',))
+
+
+def _clinica_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id)
+
+def period_months(inicio, fim):
+    """Meses (AAAA-MM) de inicio a fim (datas), inclusive."""
+    index, last = inicio.year * 12 + inicio.month - 1, fim.year * 12 + fim.month - 1
+    return [f"{i // 12:04d}-{i % 12 + 1:02d}" for i in range(index, last + 1)]
+
+def _period_bounds(meses):
+    """Início do primeiro mês e início do mês seguinte ao último, no horário de Brasília."""
+    primeiro = datetime.datetime.strptime(meses[0], '%Y-%m')
+    ultimo = datetime.datetime.strptime(meses[-1], '%Y-%m')
+    seguinte = (ultimo + datetime.timedelta(days=32)).replace(day=1)
+    return SAO_PAULO_TZ.localize(primeiro), SAO_PAULO_TZ.localize(seguinte)
+
+def _valor(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _entry(categoria, quando, descricao, valor, status=None):
+    quando = quando.astimezone(SAO_PAULO_TZ)
+    return {'data': quando.strftime('%Y-%m-%d'), 'mes': quando.strftime('%Y-%m'), 'categoria': categoria,
+            'descricao': descricao, 'status': status, 'valor': round(valor, 2)}
+
+
+# --- Leitura das fontes ---
+
+def iter_revenue(db_instance, clinica_id, meses):
+    """Agendamentos concluídos do período, em ordem de data, como lançamentos de receita."""
+    inicio, fim = _period_bounds(meses)
+    query = _clinica_ref(db_instance, clinica_id).collection('agendamentos')\
+        .where(filter=FieldFilter('status', 'in', list(RELATORIO_STATUS_RECEITA)))\
+        .where(filter=FieldFilter('data_agendamento_ts', '>=', inicio))\
+        .where(filter=FieldFilter('data_agendamento_ts', '<', fim))\
+        .order_by('data_agendamento_ts')\
+        .select(['data_agendamento_ts', 'status', 'servico_procedimento_nome', 'servico_procedimento_preco',
+                 'paciente_nome', 'profissional_nome'])
+    for doc in query.stream():
+        ag = doc.to_dict() or {}
+        if not isinstance(ag.get('data_agendamento_ts'), datetime.datetime):
+            continue
+        descricao = f"{ag.get('servico_procedimento_nome') or 'Atendimento'} - {ag.get('paciente_nome') or 'N/A'}"
+        if ag.get('profissional_nome'):
+            descricao += f" ({ag['profissional_nome']})"
+        yield _entry('receita', ag['data_agendamento_ts'], descricao, _valor(ag.get('servico_procedimento_preco')),
+                     ag.get('status'))
+
+def revenue_months(*agendamentos):
+    """Meses (AAAA-MM) em que os agendamentos (dados completos, ou None) contam como receita."""
+    return {ag['data_agendamento_ts'].astimezone(SAO_PAULO_TZ).strftime('%Y-%m') for ag in agendamentos
+            if ag and ag.get('status') in RELATORIO_STATUS_RECEITA
+            and isinstance(ag.get('data_agendamento_ts'), datetime.datetime)}
+
+def iter_expenses(db_instance, clinica_id, meses):
+    """Contas a pagar com vencimento no período, em ordem de vencimento, como lançamentos de despesa."""
+    inicio, fim = _period_bounds(meses)
+    query = _clinica_ref(db_instance, clinica_id).collection('contas_a_pagar')\
+        .where(filter=FieldFilter('data_vencimento', '>=', inicio))\
+        .where(filter=FieldFilter('data_vencimento', '<', fim))\
+        .order_by('data_vencimento')\
+        .select(['data_vencimento', 'descricao', 'valor', 'status'])
+    for doc in query.stream():
+        conta = doc.to_dict() or {}
+        if not isinstance(conta.get('data_vencimento'), datetime.datetime):
+            continue
+        yield _entry('despesa', conta['data_vencimento'], conta.get('descricao') or 'Conta a pagar',
+                     _valor(conta.get('valor')), conta.get('status'))
+
+def iter_stock_costs(db_instance, clinica_id, meses):
+    """Entradas de estoque do período com preço e sem conta a pagar, como lançamentos de custo."""
+    inicio, fim = _period_bounds(meses)
+    query = _clinica_ref(db_instance, clinica_id).collection('estoque_movimentacoes')\
+        .where(filter=FieldFilter('tipo_movimentacao', '==', 'entrada'))\
+        .where(filter=FieldFilter('data_movimentacao', '>=', inicio))\
+        .where(filter=FieldFilter('data_movimentacao', '<', fim))\
+        .order_by('data_movimentacao')\
+        .select(['data_movimentacao', 'produto_nome', 'quantidade', 'preco_total', 'criar_conta_pagar'])
+    for doc in query.stream():
+        mov = doc.to_dict() or {}
+        if mov.get('criar_conta_pagar') or not mov.get('preco_total'):
+            continue
+        if not isinstance(mov.get('data_movimentacao'), datetime.datetime):
+            continue
+        yield _entry('estoque', mov['data_movimentacao'],
+                     f"Compra de estoque: {mov.get('produto_nome') or 'N/A'} (Qtd: {mov.get('quantidade', 0)})",
+                     _valor(mov.get('preco_total')))
+
+def iter_entries(db_instance, clinica_id, meses, progress_callback=None):
+    """Lançamentos das três fontes, uma após a outra (cada uma em ordem de data)."""
+    fontes = (iter_revenue, iter_expenses, iter_stock_costs)
+    for index, fonte in enumerate(fontes):
+        yield from fonte(db_instance, clinica_id, meses)
+        if progress_callback:
+            progress_callback(index + 1, len(fontes))
+
+
+# --- Resumo ---
+
+def _empty_month(mes):
+    return {'mes': mes, 'receita': 0.0, 'atendimentos': 0, 'despesas': 0.0, 'contas': 0,
+            'custo_estoque': 0.0, 'entradas_estoque': 0, 'resultado': 0.0}
+
+class ReportAccumulator:
+    """Totais por mês dos lançamentos vistos; a memória usada depende só da quantidade de meses."""
+
+    _CAMPOS = {'receita': ('receita', 'atendimentos'), 'despesa': ('despesas', 'contas'),
+               'estoque': ('custo_estoque', 'entradas_estoque')}
+
+    def __init__(self, meses):
+        self.meses = {mes: _empty_month(mes) for mes in meses}
+
+    def add(self, entry):
+        totais = self.meses.get(entry['mes'])
+        if totais is None:
+            return entry
+        campo_valor, campo_qtd = self._CAMPOS[entry['categoria']]
+        totais[campo_valor] += entry['valor']
+        totais[campo_qtd] += 1
+        return entry
+
+    def result(self):
+        """{'meses': [totais de cada mês], 'totais': soma do período}."""
+        meses = []
+        soma = _empty_month(None)
+        for totais in self.meses.values():
+            mes = dict(totais)
+            mes['resultado'] = mes['receita'] - mes['despesas'] - mes['custo_estoque']
+            for campo, valor in mes.items():
+                if campo != 'mes':
+                    soma[campo] += valor
+            meses.append({campo: round(valor, 2) if isinstance(valor, float) else valor for campo, valor in mes.items()})
+        soma.pop('mes')
+        return {'meses': meses, 'totais': {campo: round(valor, 2) if isinstance(valor, float) else valor
+                                            for campo, valor in soma.items()}}
+
+
+# --- Cache ---
+
+def _cache_key(clinica_id, meses):
+    return clinica_id, meses[0], meses[-1]
+
+def _fingerprint(clinica_id, meses):
+    # As versões dos meses só aumentam: a soma muda sempre que alguma delas muda
+    with _report_cache_lock:
+        return sum(_report_versions.get((clinica_id, mes), 0) for mes in meses)
+
+def report_version(clinica_id, meses):
+    """Versão atual dos dados do período (veja generate_report_pdf e cached_report_pdf)."""
+    return _fingerprint(clinica_id, meses)
+
+def invalidate_financial_report(clinica_id, *meses):
+    """Descarta os relatórios da clínica que incluem algum dos meses (AAAA-MM); outros valores são ignorados."""
+    with _report_cache_lock:
+        for mes in meses:
+            if isinstance(mes, str) and len(mes) == 7:
+                _report_versions[(clinica_id, mes)] = _report_versions.get((clinica_id, mes), 0) + 1
+
+def _prune(cache, now):
+    # Chamado com _report_cache_lock: tira os vencidos e, acima de RELATORIO_CACHE_MAX, os mais antigos
+    for stale in [k for k, v in cache.items() if v['expira_em'] <= now]:
+        cache.pop(stale, None)
+    while len(cache) > RELATORIO_CACHE_MAX:
+        cache.pop(min(cache, key=lambda k: cache[k]['expira_em']), None)
+
+def _cached_summary(clinica_id, meses):
+    versao = _fingerprint(clinica_id, meses)
+    with _report_cache_lock:
+        cached = _report_cache.get(_cache_key(clinica_id, meses))
+        if cached and cached['versao'] == versao and cached['expira_em'] > time.monotonic():
+            return cached['resumo']
+    return None
+
+def _store_summary(clinica_id, meses, versao, resumo):
+    # Dados lidos com uma versão antiga (alguma gravação no meio da leitura) não entram no cache
+    if _fingerprint(clinica_id, meses) != versao:
+        return
+    now = time.monotonic()
+    with _report_cache_lock:
+        _report_cache[_cache_key(clinica_id, meses)] = {'versao': versao, 'expira_em': now + RELATORIO_CACHE_TTL,
+                                                        'resumo': resumo}
+        _prune(_report_cache, now)
+
+def report_summary(db_instance, clinica_id, meses, progress_callback=None):
+    """Resumo mensal do período (ReportAccumulator.result), do cache quando ainda válido."""
+    resumo = _cached_summary(clinica_id, meses)
+    if resumo is not None:
+        return resumo
+    versao = _fingerprint(clinica_id, meses)
+    acumulador = ReportAccumulator(meses)
+    for entry in iter_entries(db_instance, clinica_id, meses, progress_callback):
+        acumulador.add(entry)
+    resumo = acumulador.result()
+    _store_summary(clinica_id, meses, versao, resumo)
+    return resumo
+
+
+# --- CSV ---
+
+def _csv_line(writer, buffer, row):
+    writer.writerow(row)
+    line = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    return line
+
+def csv_lines(db_instance, clinica_id, meses):
+    """
+    Linhas do CSV: os lançamentos do período e, ao final, o resumo por mês (somado durante a leitura).
+    O resumo calculado aqui também abastece o cache.
+    """
+    versao = _fingerprint(clinica_id, meses)
+    acumulador = ReportAccumulator(meses)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    yield _csv_line(writer, buffer, _COLUNAS_CSV)
+    for entry in iter_entries(db_instance, clinica_id, meses):
+        acumulador.add(entry)
+        yield _csv_line(writer, buffer, [entry['data'], entry['categoria'], entry['descricao'], entry['status'] or '',
+                                         f"{entry['valor']:.2f}"])
+
+    resumo = acumulador.result()
+    _store_summary(clinica_id, meses, versao, resumo)
+    yield _csv_line(writer, buffer, [])
+    yield _csv_line(writer, buffer, ('mes', 'receita', 'despesas', 'custo_estoque', 'resultado'))
+    for mes in resumo['meses'] + [dict(resumo['totais'], mes='total')]:
+        yield _csv_line(writer, buffer, [mes['mes']] + [f"{mes[campo]:.2f}" for campo in
+                                                         ('receita', 'despesas', 'custo_estoque', 'resultado')])
+
+
+# --- PDF ---
+
+def _moeda(valor):
+    return "R$ {:,.2f}".format(valor).replace(',', '_').replace('.', ',').replace('_', '.')
+
+def render_pdf(resumo, meses):
+    """PDF (bytes) com o resumo mensal do período."""
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=landscape(A4), title='Relatório Financeiro')
+    styles = getSampleStyleSheet()
+    periodo = meses[0] if len(meses) == 1 else f"{meses[0]} a {meses[-1]}"
+    story = [Paragraph("Relatório Financeiro", styles['Title']),
+             Paragraph(f"Período: {periodo}", styles['Heading2']),
+             Paragraph(f"Gerado em {datetime.datetime.now(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M')}", styles['Normal']),
+             Spacer(1, 0.3 * inch)]
+
+    linhas = [['Mês', 'Receita', 'Atendimentos', 'Despesas', 'Contas', 'Custo de estoque', 'Resultado']]
+    for mes in resumo['meses'] + [dict(resumo['totais'], mes='Total')]:
+        linhas.append([mes['mes'], _moeda(mes['receita']), mes['atendimentos'], _moeda(mes['despesas']), mes['contas'],
+                       _moeda(mes['custo_estoque']), _moeda(mes['resultado'])])
+    tabela = Table(linhas, repeatRows=1)
+    tabela.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#343a40')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -2), [colors.white, colors.HexColor('#f2f2f2')]),
+    ]))
+    story.append(tabela)
+    story.append(Spacer(1, 0.2 * inch))
+    story.append(Paragraph("Receitas: agendamentos concluídos. Despesas: contas a pagar pelo vencimento. "
+                           "Custo de estoque: entradas com preço que não geraram conta a pagar.", styles['Italic']))
+    doc.build(story)
+    return buffer.getvalue()
+
+def report_filename(meses, extensao):
+    return f"relatorio_financeiro_{meses[0]}_{meses[-1]}.{extensao}"
+
+def generate_report_pdf(db_instance, clinica_id, meses, versao, progress_callback=None):
+    """
+    Monta o PDF do período e o guarda com 'versao' (report_version lida antes da geração), mesmo que
+    os dados mudem durante a leitura. Retorna {'arquivo', 'tamanho', 'totais', 'versao'}.
+    """
+    resumo = report_summary(db_instance, clinica_id, meses, progress_callback)
+    pdf = render_pdf(resumo, meses)
+    now = time.monotonic()
+    with _report_cache_lock:
+        _report_pdfs[_cache_key(clinica_id, meses) + (versao,)] = {'expira_em': now + RELATORIO_CACHE_TTL, 'pdf': pdf}
+        _prune(_report_pdfs, now)
+    return {'arquivo': report_filename(meses, 'pdf'), 'tamanho': len(pdf), 'totais': resumo['totais'], 'versao': versao}
+
+def cached_report_pdf(clinica_id, meses, versao):
+    """Bytes do PDF do período gerado com 'versao', se ainda guardado; senão None."""
+    with _report_cache_lock:
+        cached = _report_pdfs.get(_cache_key(clinica_id, meses) + (versao,))
+        if cached and cached['expira_em'] > time.monotonic():
+            return cached['pdf']
+    return None
+
+def schedule_report_pdf(db_instance, clinica_id, meses, versao):
+    """Agenda generate_report_pdf em segundo plano e retorna o job_id."""
+    return start_background_job('Relatório financeiro (PDF)', generate_report_pdf, db_instance, clinica_id, meses,
+                                versao, clinica_id=clinica_id)
@@ -0,0 +1,356 @@
+import abc
+import datetime
+import json
+import os
+import threading
+import time
+import urllib.request
+import uuid
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ
+from query_registry import register_query
+
+# =================================================================
+# OUTBOX DE NOTIFICAÇÕES DE AGENDAMENTOS
+# =================================================================
+#
+# As rotas de agendamento marcam o documento com notificacao_pendente=True,
+# notificacao_proxima_tentativa=SERVER_TIMESTAMP, tipo_alteracao e detalhes_alteracao. O despachante:
+# 1. busca os pendentes já liberados (notificacao_pendente == True e notificacao_proxima_tentativa <= agora,
+#    em ordem de notificacao_proxima_tentativa): toda gravação que marca o flag também grava
+#    notificacao_proxima_tentativa, e os que estão em backoff ou sob lease ficam fora da consulta;
+# 2. reivindica cada um gravando 'notificacao_lease_ate' (e adiando notificacao_proxima_tentativa para o
+#    fim do lease) com precondição de update_time, para que dois processos não enviem o mesmo agendamento;
+# 3. agrupa por paciente e série (uma série nova vira uma única mensagem, não uma por ocorrência);
+#    várias alterações no mesmo agendamento já chegam coalescidas: só o estado atual é enviado;
+# 4. entrega a cada canal registrado (arquivo local e, se configurado, webhook);
+# 5. limpa o flag em lotes, com precondição: se o agendamento mudou durante o envio, o flag
+#    fica e a versão nova sai no próximo ciclo.
+# Falhas de entrega reagendam o agendamento com backoff exponencial até NOTIFICACOES_MAX_TENTATIVAS.
+
+NOTIFICACOES_LOTE = 200
+NOTIFICACOES_LEASE_SEGUNDOS = 120
+NOTIFICACOES_MAX_TENTATIVAS = 8
+NOTIFICACOES_BACKOFF_BASE_SEGUNDOS = 30
+NOTIFICACOES_BACKOFF_MAX_SEGUNDOS = 3600
+
+# Intervalo do despachante contínuo: cai para o mínimo quando há trabalho e dobra até o máximo quando não há
+DESPACHANTE_INTERVALO_MIN_SEGUNDOS = 5
+DESPACHANTE_INTERVALO_MAX_SEGUNDOS = 300
+
+# Limite de operações por batch (o Firestore aceita até 500)
+_BATCH_SIZE = 400
+
+_channels = []
+_channels_lock = threading.Lock()
+
+_metrics = {
+    'ciclos': 0,
+    'agendamentos_processados': 0,
+    'notificacoes_enviadas': 0,
+    'falhas_envio': 0,
+    'descartadas': 0,
+    'leases_perdidos': 0,
+    'ultimo_ciclo_em': None,
+    'ultimo_ciclo_segundos': 0.0,
+    'ultimo_ciclo_por_segundo': 0.0,
+}
+_metrics_lock = threading.Lock()
+
+# Clínicas cujos pendentes antigos (sem notificacao_proxima_tentativa) já foram completados neste processo
+_schedule_backfilled = set()
+_schedule_backfilled_lock = threading.Lock()
+
+register_query('notificacoes.pendentes', 'clinicas/{clinica_id}/agendamentos',
+               equality=('notificacao_pendente',), range_fields=('notificacao_proxima_tentativa',),
+               order_by=('notificacao_proxima_tentativa',))
+register_query('notificacoes.pendentes_sem_proxima_tentativa', 'clinicas/{clinica_id}/agendamentos',
+               equality=('notificacao_pendente',))
+
+
+# --- Canais ---
+
+class NotificationChannel(abc.ABC):
+    """Canal de entrega. send() recebe uma notificação e deve levantar exceção em caso de falha."""
+    name = 'canal'
+
+    @abc.abstractmethod
+    def send(self, notification):
+        """Entrega a notificação (dicionário montado por group_notifications)."""
+
+
+class FileChannel(NotificationChannel):
+    """Acrescenta cada notificação como uma linha JSON num arquivo local (substituto de SMS/WhatsApp)."""
+    name = 'arquivo'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, notification):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        line = json.dumps(notification, ensure_ascii=False, default=str)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as outbox_file:
+            outbox_file.write(line + '\n')
+
+
+class WebhookChannel(NotificationChannel):
+    """Envia cada notificação por POST JSON para uma URL."""
+    name = 'webhook'
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, notification):
+        body = json.dumps(notification, ensure_ascii=False, default=str).encode('utf-8')
+        webhook_request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(webhook_request, timeout=self.timeout) as response:
+            if response.status >= 300:
+                raise Exception(f"Webhook respondeu HTTP {response.status}")
+
+
+def register_channel(channel):
+    """Acrescenta um canal de entrega (ex.: integração de SMS)."""
+    with _channels_lock:
+        _channels.append(channel)
+
+def get_channels():
+    """Canais registrados; na primeira chamada, configura os padrões a partir do ambiente."""
+    with _channels_lock:
+        if not _channels:
+            _channels.append(FileChannel(os.environ.get(
+                'NOTIFICACOES_ARQUIVO', os.path.join(os.path.dirname(__file__), 'instance', 'notificacoes.jsonl'))))
+            if os.environ.get('NOTIFICACOES_WEBHOOK_URL'):
+                _channels.append(WebhookChannel(os.environ['NOTIFICACOES_WEBHOOK_URL']))
+        return list(_channels)
+
+
+# --- Métricas ---
+
+def _record_cycle(processed, sent, failed, dropped, lost, elapsed):
+    with _metrics_lock:
+        _metrics['ciclos'] += 1
+        _metrics['agendamentos_processados'] += processed
+        _metrics['notificacoes_enviadas'] += sent
+        _metrics['falhas_envio'] += failed
+        _metrics['descartadas'] += dropped
+        _metrics['leases_perdidos'] += lost
+        _metrics['ultimo_ciclo_em'] = datetime.datetime.now(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M:%S')
+        _metrics['ultimo_ciclo_segundos'] = round(elapsed, 3)
+        _metrics['ultimo_ciclo_por_segundo'] = round(processed / elapsed, 2) if elapsed > 0 else 0.0
+
+def get_metrics():
+    """Contadores acumulados do despachante neste processo."""
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+# --- Despacho ---
+
+def _backoff_seconds(tentativas):
+    return min(NOTIFICACOES_BACKOFF_BASE_SEGUNDOS * (2 ** max(tentativas - 1, 0)), NOTIFICACOES_BACKOFF_MAX_SEGUNDOS)
+
+def _as_utc(value):
+    return value.astimezone(datetime.timezone.utc) if isinstance(value, datetime.datetime) else None
+
+def _commit_in_chunks(db_instance, writes):
+    """
+    Grava [(referência, dados, update_time esperado)] em batches. Se um batch falhar pela
+    precondição, grava seus itens um a um. Retorna {referência.id: update_time gravado}.
+    """
+    results = {}
+    for index in range(0, len(writes), _BATCH_SIZE):
+        chunk = writes[index:index + _BATCH_SIZE]
+        batch = db_instance.batch()
+        for doc_ref, data, update_time in chunk:
+            batch.update(doc_ref, data, option=db_instance.write_option(last_update_time=update_time))
+        try:
+            for (doc_ref, _, _), write_result in zip(chunk, batch.commit()):
+                results[doc_ref.id] = write_result.update_time
+        except google_exceptions.FailedPrecondition:
+            for doc_ref, data, update_time in chunk:
+                try:
+                    results[doc_ref.id] = doc_ref.update(data, option=db_instance.write_option(last_update_time=update_time)).update_time
+                except (google_exceptions.FailedPrecondition, google_exceptions.NotFound):
+                    continue  # Alterado por outro processo: fica para o próximo ciclo
+    return results
+
+def _claim(db_instance, docs, worker_id, now):
+    """Reivindica os agendamentos livres. Retorna [(snapshot, dados, update_time do lease)]."""
+    lease_until = now + datetime.timedelta(seconds=NOTIFICACOES_LEASE_SEGUNDOS)
+    candidates = []
+    for doc in docs:
+        data = doc.to_dict() or {}
+        lease = _as_utc(data.get('notificacao_lease_ate'))
+        proxima = _as_utc(data.get('notificacao_proxima_tentativa'))
+        if (lease and lease > now) or (proxima and proxima > now):
+            continue
+        candidates.append((doc, data))
+    # Adiar a próxima tentativa para o fim do lease tira o agendamento da consulta dos outros processos;
+    # se este processo cair, ele volta a ser buscado quando o lease expira
+    claimed = _commit_in_chunks(db_instance, [
+        (doc.reference, {'notificacao_lease_ate': lease_until, 'notificacao_lease_por': worker_id,
+                         'notificacao_proxima_tentativa': lease_until}, doc.update_time)
+        for doc, _ in candidates
+    ])
+    return [(doc, data, claimed[doc.id]) for doc, data in candidates if doc.id in claimed], len(candidates) - len(claimed)
+
+def group_notifications(clinica_id, claimed):
+    """
+    Agrupa os agendamentos reivindicados por (paciente, série). Agendamentos avulsos formam
+    grupos próprios. Retorna [(notificação, [itens do grupo])].
+    """
+    groups = {}
+    for item in claimed:
+        doc, data, _ = item
+        paciente = data.get('paciente_id') or data.get('paciente_nome') or ''
+        key = (paciente, data.get('serie_id') or doc.id, data.get('tipo_alteracao'))
+        groups.setdefault(key, []).append(item)
+
+    notifications = []
+    for (_, serie_ou_id, tipo_alteracao), items in groups.items():
+        items.sort(key=lambda item: (item[1].get('data_agendamento') or '', item[1].get('hora_agendamento') or ''))
+        first = items[0][1]
+        agendamentos = [{
+            'id': doc.id,
+            'data_agendamento': data.get('data_agendamento'),
+            'hora_agendamento': data.get('hora_agendamento'),
+            'status': data.get('status'),
+            'profissional_nome': data.get('profissional_nome'),
+            'servico_procedimento_nome': data.get('servico_procedimento_nome'),
+            'detalhes_alteracao': data.get('detalhes_alteracao'),
+        } for doc, data, _ in items]
+        if len(items) == 1:
+            mensagem = first.get('detalhes_alteracao') or 'Agendamento atualizado.'
+        else:
+            datas = ', '.join(f"{a['data_agendamento']} {a['hora_agendamento']}" for a in agendamentos)
+            mensagem = f"{len(items)} agendamentos ({tipo_alteracao or 'atualizado'}): {datas}."
+        notifications.append(({
+            'id': uuid.uuid4().hex,
+            'clinica_id': clinica_id,
+            'paciente_id': first.get('paciente_id'),
+            'paciente_nome': first.get('paciente_nome'),
+            'paciente_numero': first.get('paciente_numero'),
+            'tipo_alteracao': tipo_alteracao,
+            'serie_id': first.get('serie_id'),
+            'mensagem': mensagem,
+            'agendamentos': agendamentos,
+            'gerada_em': datetime.datetime.now(SAO_PAULO_TZ).isoformat(),
+        }, items))
+    return notifications
+
+def backfill_pending_schedule(db_instance, clinica_id):
+    """
+    Grava notificacao_proxima_tentativa nos pendentes que não a têm (marcados antes de o campo existir),
+    para que entrem na consulta do despachante. Roda uma vez por clínica em cada processo.
+    Retorna quantos agendamentos foram completados.
+    """
+    with _schedule_backfilled_lock:
+        if clinica_id in _schedule_backfilled:
+            return 0
+        _schedule_backfilled.add(clinica_id)
+    query = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos')\
+        .where(filter=FieldFilter('notificacao_pendente', '==', True))\
+        .select(['notificacao_proxima_tentativa'])
+    writes = [(doc.reference, {'notificacao_proxima_tentativa': firestore.SERVER_TIMESTAMP}, doc.update_time)
+              for doc in query.stream() if not (doc.to_dict() or {}).get('notificacao_proxima_tentativa')]
+    return len(_commit_in_chunks(db_instance, writes))
+
+def dispatch_pending(db_instance, clinica_id, limit=NOTIFICACOES_LOTE, worker_id=None, progress_callback=None):
+    """
+    Executa um ciclo do outbox para a clínica: reivindica até 'limit' agendamentos pendentes cuja
+    próxima tentativa já chegou (os mais antigos primeiro), entrega as notificações e limpa os flags.
+    Retorna um resumo do ciclo.
+    """
+    started = time.monotonic()
+    worker_id = worker_id or f"{os.getpid()}-{threading.get_ident()}"
+    backfill_pending_schedule(db_instance, clinica_id)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    query = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos')\
+        .where(filter=FieldFilter('notificacao_pendente', '==', True))\
+        .where(filter=FieldFilter('notificacao_proxima_tentativa', '<=', now))\
+        .order_by('notificacao_proxima_tentativa').limit(limit)
+    claimed, lost = _claim(db_instance, list(query.stream()), worker_id, now)
+
+    channels = get_channels()
+    cleared, retries = [], []
+    sent = failed = dropped = 0
+    notifications = group_notifications(clinica_id, claimed)
+    for index, (notification, items) in enumerate(notifications):
+        try:
+            for channel in channels:
+                channel.send(notification)
+            sent += 1
+            cleared += [(doc.reference, {
+                'notificacao_pendente': False,
+                'notificacao_enviada_em': firestore.SERVER_TIMESTAMP,
+                'notificacao_tentativas': 0,
+                'notificacao_lease_ate': firestore.DELETE_FIELD,
+                'notificacao_lease_por': firestore.DELETE_FIELD,
+                'notificacao_proxima_tentativa': firestore.DELETE_FIELD,
+            }, lease_time) for doc, _, lease_time in items]
+        except Exception as e:
+            failed += 1
+            print(f"Falha ao entregar notificação de {notification.get('paciente_nome')} (clínica {clinica_id}): {e}")
+            for doc, data, lease_time in items:
+                tentativas = int(data.get('notificacao_tentativas') or 0) + 1
+                update = {
+                    'notificacao_tentativas': tentativas,
+                    'notificacao_ultimo_erro': str(e)[:500],
+                    'notificacao_lease_ate': firestore.DELETE_FIELD,
+                    'notificacao_lease_por': firestore.DELETE_FIELD,
+                }
+                if tentativas >= NOTIFICACOES_MAX_TENTATIVAS:
+                    update.update({'notificacao_pendente': False, 'notificacao_falhou': True})
+                    dropped += 1
+                else:
+                    update['notificacao_proxima_tentativa'] = now + datetime.timedelta(seconds=_backoff_seconds(tentativas))
+                retries.append((doc.reference, update, lease_time))
+        if progress_callback:
+            progress_callback(index + 1, len(notifications))
+
+    _commit_in_chunks(db_instance, cleared + retries)
+    elapsed = time.monotonic() - started
+    _record_cycle(len(claimed), sent, failed, dropped, lost, elapsed)
+    return {
+        'agendamentos': len(claimed),
+        'notificacoes_enviadas': sent,
+        'falhas': failed,
+        'descartadas': dropped,
+        'leases_perdidos': lost,
+        'segundos': round(elapsed, 3),
+    }
+
+def dispatch_all_clinics(db_instance, limit=NOTIFICACOES_LOTE):
+    """Um ciclo do outbox para cada clínica. Retorna a quantidade de agendamentos processados."""
+    processed = 0
+    for clinica_ref in db_instance.collection('clinicas').list_documents():
+        try:
+            processed += dispatch_pending(db_instance, clinica_ref.id, limit=limit)['agendamentos']
+        except Exception as e:
+            print(f"Erro no outbox de notificações da clínica {clinica_ref.id}: {e}")
+    return processed
+
+def start_dispatcher(db_instance):
+    """
+    Inicia o despachante contínuo numa thread. Sem trabalho, o intervalo entre ciclos dobra
+    até DESPACHANTE_INTERVALO_MAX_SEGUNDOS; havendo trabalho, volta ao mínimo.
+    """
+    def _loop():
+        interval = DESPACHANTE_INTERVALO_MIN_SEGUNDOS
+        while True:
+            try:
+                processed = dispatch_all_clinics(db_instance)
+            except Exception as e:
+                print(f"Erro no despachante de notificações: {e}")
+                processed = 0
+            interval = DESPACHANTE_INTERVALO_MIN_SEGUNDOS if processed else min(interval * 2, DESPACHANTE_INTERVALO_MAX_SEGUNDOS)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=_loop, name='despachante-notificacoes', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,239 @@
+import calendar
+import datetime
+import threading
+import time
+import uuid
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ, start_background_job
+from query_registry import register_query
+from payables import contas_ref, create_payables, delete_pending_payables
+from recurrence import occurrence_id
+from stock_ledger import product_index
+from asset_valuation import asset_index
+
+# =================================================================
+# CONTAS A PAGAR RECORRENTES
+# =================================================================
+#
+# Cada série (aluguel, salário, assinatura...) fica em clinicas/{id}/contas_recorrentes/{serie_id}
+# com a frequência, o valor e os dados comuns das contas. As contas são documentos normais em
+# contas_a_pagar, com 'serie_id' e ID determinístico '{serie_id}_{AAAAMMDD}'.
+#
+# Só as contas até 'gerada_ate' (horizonte móvel de CONTAS_RECORRENTES_HORIZONTE_DIAS) existem; uma
+# tarefa diária avança o horizonte de todas as séries ativas, gravando as novas contas em batches.
+# Encerrar uma série remove as contas pendentes a partir da data de encerramento.
+
+# Quantos dias à frente de hoje ficam gravados como contas
+CONTAS_RECORRENTES_HORIZONTE_DIAS = 90
+
+# Intervalo mínimo (segundos) entre duas gerações automáticas de uma clínica
+CONTAS_RECORRENTES_INTERVALO_SEGUNDOS = 24 * 3600
+
+# Frequências -> (unidade, passo). Nas mensais, o dia de vencimento é o de data_inicio
+# (ou o último dia do mês, quando o mês é mais curto).
+FREQUENCIAS_RECORRENTES = {
+    'semanal': ('dias', 7),
+    'quinzenal': ('dias', 14),
+    'mensal': ('meses', 1),
+    'trimestral': ('meses', 3),
+    'anual': ('meses', 12),
+}
+
+# Campos da série copiados para cada conta
+_CAMPOS_DA_CONTA = ('descricao', 'valor', 'usuario_responsavel', 'produto_id', 'produto_nome',
+                    'patrimonio_id', 'patrimonio_nome')
+
+_ultima_geracao = {}
+_ultima_geracao_lock = threading.Lock()
+
+register_query('contas_recorrentes.ativas', 'clinicas/{clinica_id}/contas_recorrentes',
+               equality=('ativa',))
+register_query('contas_recorrentes.pendentes_da_serie', 'clinicas/{clinica_id}/contas_a_pagar',
+               equality=('serie_id', 'status'), range_fields=('data_vencimento',))
+
+
+class RecurringPayableError(Exception):
+    """Série recusada ou inexistente: frequência, valor ou datas inválidos."""
+
+
+def _series_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('contas_recorrentes')
+
+def horizon_end(today=None):
+    """Último vencimento que deve estar gravado."""
+    today = today or datetime.datetime.now(SAO_PAULO_TZ).date()
+    return today + datetime.timedelta(days=CONTAS_RECORRENTES_HORIZONTE_DIAS)
+
+def due_dates(frequencia, data_inicio, data_fim, a_partir_de=None):
+    """
+    Vencimentos da série entre data_inicio e data_fim (inclusive); com a_partir_de, só os a partir
+    dele. O primeiro vencimento calculado já é o do período de a_partir_de, sem percorrer os anteriores.
+    """
+    unidade, passo = FREQUENCIAS_RECORRENTES[frequencia]
+    lower = max(data_inicio, a_partir_de) if a_partir_de else data_inicio
+    if data_fim < lower:
+        return []
+    if unidade == 'dias':
+        first = data_inicio + datetime.timedelta(days=passo * -(-(lower - data_inicio).days // passo))
+        count = (data_fim - first).days // passo + 1 if first <= data_fim else 0
+        return [first + datetime.timedelta(days=passo * k) for k in range(count)]
+
+    anchor_index = data_inicio.year * 12 + data_inicio.month - 1
+    index = anchor_index + max(0, (lower.year * 12 + lower.month - 1 - anchor_index) // passo * passo)
+    dates = []
+    while True:
+        ano, mes = divmod(index, 12)
+        day = datetime.date(ano, mes + 1, min(data_inicio.day, calendar.monthrange(ano, mes + 1)[1]))
+        if day > data_fim:
+            return dates
+        if day >= lower:
+            dates.append(day)
+        index += passo
+
+def build_payable(serie_id, serie_data, day, agora=None):
+    """Conta a pagar da série com vencimento em 'day'."""
+    conta = {campo: serie_data[campo] for campo in _CAMPOS_DA_CONTA if serie_data.get(campo) is not None}
+    conta.update({
+        'data_vencimento': SAO_PAULO_TZ.localize(datetime.datetime.combine(day, datetime.time.min)),
+        'status': 'pendente',
+        'data_lancamento': agora or datetime.datetime.now(SAO_PAULO_TZ),
+        'serie_id': serie_id,
+    })
+    return conta
+
+def _generate(db_instance, clinica_id, serie_ref, serie_data, update_time, until):
+    """
+    Grava as contas da série com vencimento até 'until'. update_time: da leitura de serie_data.
+    Retorna quantas foram gravadas (0 se a série mudou desde a leitura).
+    """
+    gerada_ate = datetime.date.fromisoformat(serie_data['gerada_ate'])
+    if serie_data.get('data_fim'):
+        until = min(until, datetime.date.fromisoformat(serie_data['data_fim']))
+    if until <= gerada_ate:
+        return 0
+    dates = due_dates(serie_data['frequencia'], datetime.date.fromisoformat(serie_data['data_inicio']), until,
+                      a_partir_de=gerada_ate + datetime.timedelta(days=1))
+    agora = datetime.datetime.now(SAO_PAULO_TZ)
+    contas = [(contas_ref(db_instance, clinica_id).document(occurrence_id(serie_ref.id, day)),
+               build_payable(serie_ref.id, serie_data, day, agora)) for day in dates]
+    # O marcador vai no último batch: se algo falhar antes, a próxima rodada regrava as mesmas IDs.
+    # A pré-condição recusa o batch (e os totais) se outra rodada já avançou a série desde a leitura:
+    # as contas que ela gravou são as mesmas, e os totais já foram somados por ela.
+    try:
+        return create_payables(db_instance, clinica_id, contas,
+                               depois=[(serie_ref, {'gerada_ate': until.isoformat()}, update_time)])
+    except google_exceptions.FailedPrecondition:
+        print(f"Série de contas {serie_ref.id} alterada durante a geração; fica para a próxima rodada.")
+        return 0
+
+def generate_recurring_payables(db_instance, clinica_id, progress_callback=None):
+    """
+    Avança o horizonte de todas as séries ativas da clínica, gravando as contas que vencem até horizon_end().
+    Retorna {'series': quantidade avançada, 'contas': quantidade gravada}.
+    """
+    limite = horizon_end()
+    pendentes = []
+    for doc in _series_ref(db_instance, clinica_id).where(filter=FieldFilter('ativa', '==', True)).stream():
+        serie_data = doc.to_dict() or {}
+        try:
+            fim = min(limite, datetime.date.fromisoformat(serie_data['data_fim'])) if serie_data.get('data_fim') else limite
+            if datetime.date.fromisoformat(serie_data['gerada_ate']) < fim:
+                pendentes.append((doc.reference, serie_data, doc.update_time))
+        except (KeyError, ValueError, TypeError) as e:
+            print(f"Série de contas {doc.id} ignorada na geração: {e}")
+
+    total = 0
+    for index, (serie_ref, serie_data, update_time) in enumerate(pendentes):
+        total += _generate(db_instance, clinica_id, serie_ref, serie_data, update_time, limite)
+        if progress_callback:
+            progress_callback(index + 1, len(pendentes))
+    return {'series': len(pendentes), 'contas': total}
+
+def schedule_recurring_payables(db_instance, clinica_id, force=False):
+    """
+    Agenda generate_recurring_payables em segundo plano, no máximo uma vez a cada
+    CONTAS_RECORRENTES_INTERVALO_SEGUNDOS por clínica (a menos que force=True).
+    Retorna o job_id ou None se não foi necessário.
+    """
+    now = time.monotonic()
+    with _ultima_geracao_lock:
+        if not force and now - _ultima_geracao.get(clinica_id, float('-inf')) < CONTAS_RECORRENTES_INTERVALO_SEGUNDOS:
+            return None
+        _ultima_geracao[clinica_id] = now
+    return start_background_job('Geração de contas recorrentes', generate_recurring_payables, db_instance, clinica_id,
+                                clinica_id=clinica_id)
+
+
+# --- Operações ---
+
+def create_series(db_instance, clinica_id, serie_data, frequencia, data_inicio, data_fim=None):
+    """
+    Cria uma série e grava as contas que vencem até o horizonte (as seguintes são geradas pela tarefa diária).
+    serie_data: descricao, valor e, opcionalmente, usuario_responsavel e os vínculos com produto/patrimônio.
+    Retorna (serie_id, quantidade de contas gravadas).
+    """
+    if frequencia not in FREQUENCIAS_RECORRENTES:
+        raise RecurringPayableError(f"Frequência inválida: '{frequencia}'.")
+    if not serie_data.get('descricao') or not (serie_data.get('valor') or 0) > 0:
+        raise RecurringPayableError('Descrição e valor maior que zero são obrigatórios.')
+    if data_fim and data_fim < data_inicio:
+        raise RecurringPayableError('A data final deve ser posterior à data inicial.')
+
+    serie_ref = _series_ref(db_instance, clinica_id).document(uuid.uuid4().hex)
+    serie_doc = dict(serie_data, **{
+        'frequencia': frequencia,
+        'data_inicio': data_inicio.isoformat(),
+        'data_fim': data_fim.isoformat() if data_fim else None,
+        'gerada_ate': (data_inicio - datetime.timedelta(days=1)).isoformat(),
+        'ativa': True,
+        'criado_em': firestore.SERVER_TIMESTAMP,
+    })
+    write_result = serie_ref.set(serie_doc)
+    return serie_ref.id, _generate(db_instance, clinica_id, serie_ref, serie_doc, write_result.update_time, horizon_end())
+
+def list_series(db_instance, clinica_id, incluir_encerradas=False):
+    """Séries da clínica (as ativas, ou todas), como dicionários com 'id', ordenadas pela descrição."""
+    query = _series_ref(db_instance, clinica_id)
+    if not incluir_encerradas:
+        query = query.where(filter=FieldFilter('ativa', '==', True))
+    series = [dict(doc.to_dict() or {}, id=doc.id) for doc in query.stream()]
+    return sorted(series, key=lambda serie: str(serie.get('descricao', '')).casefold())
+
+def end_series(db_instance, clinica_id, serie_id, a_partir_de=None):
+    """
+    Encerra a série na véspera de a_partir_de (padrão: hoje) e exclui as contas pendentes que vencem a
+    partir dele; as pagas são mantidas. Retorna a quantidade de contas excluídas.
+    """
+    a_partir_de = a_partir_de or datetime.datetime.now(SAO_PAULO_TZ).date()
+    serie_ref = _series_ref(db_instance, clinica_id).document(serie_id)
+    serie_doc = serie_ref.get()
+    if not serie_doc.exists:
+        raise RecurringPayableError('Série de contas não encontrada.')
+    serie_ref.update({'ativa': False, 'data_fim': (a_partir_de - datetime.timedelta(days=1)).isoformat(),
+                      'atualizado_em': firestore.SERVER_TIMESTAMP})
+    inicio = SAO_PAULO_TZ.localize(datetime.datetime.combine(a_partir_de, datetime.time.min))
+    query = contas_ref(db_instance, clinica_id).where(filter=FieldFilter('serie_id', '==', serie_id))\
+        .where(filter=FieldFilter('status', '==', 'pendente'))\
+        .where(filter=FieldFilter('data_vencimento', '>=', inicio)).select([])
+    return delete_pending_payables(db_instance, clinica_id, [doc.id for doc in query.stream()])
+
+
+# --- Dados de referência do formulário ---
+
+def reference_options(db_instance, clinica_id):
+    """
+    Opções dos selects do formulário de contas, sem ler as coleções a cada página: os produtos ativos vêm
+    do índice de produtos do estoque e os itens de patrimônio do índice de patrimônio (ambos em cache).
+    Retorna {'produtos': [{id, nome}], 'patrimonio': [{id, nome}]}, ordenados pelo nome.
+    """
+    produtos = [{'id': produto_id, 'nome': produto['nome']}
+                for produto_id, produto in product_index(db_instance, clinica_id)['por_id'].items() if produto['ativo']]
+    patrimonio = [{'id': item['id'], 'nome': item.get('nome', item['id'])} for item in asset_index(db_instance, clinica_id)]
+    return {'produtos': sorted(produtos, key=lambda item: str(item['nome']).casefold()), 'patrimonio': patrimonio}
+
+def reference_name(db_instance, clinica_id, chave, item_id):
+    """Nome do produto (chave 'produtos') ou item de patrimônio (chave 'patrimonio'), pelo cache; None se não existe."""
+    return next((item['nome'] for item in reference_options(db_instance, clinica_id)[chave] if item['id'] == item_id), None)
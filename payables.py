@@ -0,0 +1,448 @@
+import datetime
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ, start_background_job
+from query_registry import register_query
+from financial_reports import invalidate_financial_report
+
+# =================================================================
+# CONTAS A PAGAR: TOTAIS, VENCIDAS E FLUXO DE CAIXA
+# =================================================================
+#
+# Toda gravação em contas_a_pagar passa pelas funções deste módulo (create_payable(s), update_payable,
+# delete_payable e as operações em lote sobre contas pendentes), que atualizam no mesmo batch/transação
+# os totais do mês de vencimento (contas_resumo_mensal/{AAAA-MM}: valor e quantidade por status). A página de contas e as APIs leem esses totais em vez das contas:
+#   - vencidas: pendentes de meses anteriores (totais) + pendentes do mês atual com vencimento antes
+#     de hoje (consulta indexada por status e data_vencimento);
+#   - fluxo de caixa: pendentes a vencer, por semana, numa consulta por intervalo em data_vencimento.
+# A busca usa busca_termos (prefixos das palavras de descrição, produto e patrimônio, sem acentos)
+# com array_contains. Uma tarefa diária recalcula os totais e grava os termos de contas antigas.
+# Cada gravação também invalida, para os meses afetados, o cache dos relatórios financeiros.
+
+CONTAS_BATCH_SIZE = 400
+
+# Contas lidas e alteradas por transação nas operações em lote (cada uma soma também os totais do mês)
+CONTAS_LOTE_TRANSACAO = 200
+
+# Status com totais mensais; contas sem vencimento ficam no mês CONTAS_SEM_VENCIMENTO
+CONTAS_STATUS = ('pendente', 'paga')
+CONTAS_SEM_VENCIMENTO = 'sem_vencimento'
+
+# Tamanho mínimo e máximo dos prefixos gravados em busca_termos
+CONTAS_BUSCA_PREFIXO_MIN = 1
+CONTAS_BUSCA_PREFIXO_MAX = 15
+
+# Semanas da projeção de fluxo de caixa (padrão e máximo)
+FLUXO_SEMANAS_PADRAO = 8
+FLUXO_SEMANAS_MAXIMO = 26
+
+# Intervalo mínimo (segundos) entre dois recálculos automáticos dos totais de uma clínica
+CONTAS_RESUMO_INTERVALO_SEGUNDOS = 24 * 3600
+
+# Versão dos campos de busca; contas gravadas antes dela são atualizadas uma vez pela tarefa diária
+CONTAS_CAMPOS_VERSAO = 1
+
+_ultimo_resumo = {}
+_ultimo_resumo_lock = threading.Lock()
+
+_CAMPOS_BUSCA = ('descricao', 'produto_nome', 'patrimonio_nome')
+_CAMPOS_TOTAIS = ('status', 'valor', 'data_vencimento')
+
+register_query('contas_a_pagar.buscar', 'clinicas/{clinica_id}/contas_a_pagar',
+               equality=('status',), array_contains='busca_termos', range_fields=('data_vencimento',),
+               order_by=('data_vencimento',), optional=('status', 'data_vencimento'),
+               python_filter='demais palavras da busca (prefixos)')
+register_query('contas_a_pagar.pendentes_por_vencimento', 'clinicas/{clinica_id}/contas_a_pagar',
+               equality=('status',), range_fields=('data_vencimento',))
+register_query('contas_a_pagar.resumo_mensal', 'clinicas/{clinica_id}/contas_resumo_mensal',
+               range_fields=('mes',))
+register_query('contas_a_pagar.do_mes', 'clinicas/{clinica_id}/contas_a_pagar',
+               range_fields=('data_vencimento',))
+register_query('contas_a_pagar.sem_vencimento', 'clinicas/{clinica_id}/contas_a_pagar',
+               equality=('data_vencimento',))
+
+
+class PayableError(Exception):
+    """Conta a pagar inexistente."""
+
+
+def _clinica_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id)
+
+def contas_ref(db_instance, clinica_id):
+    return _clinica_ref(db_instance, clinica_id).collection('contas_a_pagar')
+
+def _resumo_mensal_ref(db_instance, clinica_id):
+    return _clinica_ref(db_instance, clinica_id).collection('contas_resumo_mensal')
+
+def _controle_ref(db_instance, clinica_id):
+    return _clinica_ref(db_instance, clinica_id).collection('contas_resumo').document('geral')
+
+def _start_of_day(dia):
+    return SAO_PAULO_TZ.localize(datetime.datetime.combine(dia, datetime.time.min))
+
+def due_month(data_vencimento):
+    """Mês (AAAA-MM, horário de Brasília) do vencimento, ou CONTAS_SEM_VENCIMENTO."""
+    if not isinstance(data_vencimento, datetime.datetime):
+        return CONTAS_SEM_VENCIMENTO
+    return data_vencimento.astimezone(SAO_PAULO_TZ).strftime('%Y-%m')
+
+def _words(text):
+    text = unicodedata.normalize('NFKD', str(text or ''))
+    return re.findall(r'\w+', ''.join(c for c in text if not unicodedata.combining(c)).casefold())
+
+def search_terms(*texts):
+    """Prefixos (CONTAS_BUSCA_PREFIXO_MIN a CONTAS_BUSCA_PREFIXO_MAX letras) das palavras dos textos."""
+    termos = set()
+    for text in texts:
+        for palavra in _words(text):
+            palavra = palavra[:CONTAS_BUSCA_PREFIXO_MAX]
+            termos.update(palavra[:tamanho] for tamanho in range(CONTAS_BUSCA_PREFIXO_MIN, len(palavra) + 1))
+    return sorted(termos)
+
+def _search_fields(conta):
+    return {'busca_termos': search_terms(*(conta.get(campo) for campo in _CAMPOS_BUSCA))}
+
+def search_plan(search_query):
+    """
+    Divide a busca em (termo consultado com array_contains, palavras conferidas em Python).
+    O termo é a palavra mais longa; retorna (None, []) para uma busca vazia.
+    """
+    palavras = [palavra[:CONTAS_BUSCA_PREFIXO_MAX] for palavra in _words(search_query)]
+    if not palavras:
+        return None, []
+    termo = max(palavras, key=len)
+    return termo, [palavra for palavra in palavras if palavra != termo]
+
+def matches_search(conta, palavras):
+    """Todas as palavras são prefixo de alguma palavra da conta (descrição, produto ou patrimônio)."""
+    termos = set(conta.get('busca_termos') or _search_fields(conta)['busca_termos'])
+    return all(palavra in termos for palavra in palavras)
+
+def _totals_delta(deltas, conta, sinal):
+    status = conta.get('status')
+    if status in CONTAS_STATUS:
+        campos = deltas.setdefault(due_month(conta.get('data_vencimento')), defaultdict(int))
+        campos[f'{status}_valor'] += sinal * (conta.get('valor') or 0)
+        campos[f'{status}_qtd'] += sinal
+    return deltas
+
+def _write_totals(writer, db_instance, clinica_id, deltas):
+    # Uma escrita por mês, mesmo quando a conta sai e volta ao mesmo total
+    for mes, campos in deltas.items():
+        data = {campo: firestore.Increment(valor) for campo, valor in campos.items()}
+        data.update({'mes': mes, 'atualizado_em': firestore.SERVER_TIMESTAMP})
+        writer.set(_resumo_mensal_ref(db_instance, clinica_id).document(mes), data, merge=True)
+    invalidate_financial_report(clinica_id, *deltas)
+
+def add_payable_totals(writer, db_instance, clinica_id, conta, sinal=1):
+    """Soma (sinal=1) ou retira (sinal=-1) a conta dos totais do mês de vencimento, via Increment."""
+    _write_totals(writer, db_instance, clinica_id, _totals_delta({}, conta, sinal))
+
+def create_payable(db_instance, clinica_id, conta_data, writer=None, conta_ref=None):
+    """
+    Grava uma nova conta com os termos de busca e a soma nos totais do mês. Com 'writer' (batch ou
+    transação do chamador), só agenda as escritas; sem ele, grava num batch próprio. Retorna a referência.
+    """
+    conta_ref = conta_ref or contas_ref(db_instance, clinica_id).document()
+    batch = writer or db_instance.batch()
+    batch.set(conta_ref, dict(conta_data, **_search_fields(conta_data)))
+    add_payable_totals(batch, db_instance, clinica_id, conta_data)
+    if writer is None:
+        batch.commit()
+    return conta_ref
+
+@firestore.transactional
+def _update_in_transaction(transaction, db_instance, clinica_id, conta_ref, changes):
+    snapshot = conta_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        raise PayableError('Conta a pagar não encontrada.')
+    anterior = snapshot.to_dict() or {}
+    atual = {campo: valor for campo, valor in dict(anterior, **changes).items() if valor is not firestore.DELETE_FIELD}
+    update = dict(changes)
+    if any(campo in changes for campo in _CAMPOS_BUSCA):
+        update.update(_search_fields(atual))
+    transaction.update(conta_ref, update)
+    if any(anterior.get(campo) != atual.get(campo) for campo in _CAMPOS_TOTAIS):
+        deltas = _totals_delta(_totals_delta({}, anterior, -1), atual, 1)
+        _write_totals(transaction, db_instance, clinica_id, deltas)
+    return atual
+
+def update_payable(db_instance, clinica_id, conta_id, changes):
+    """
+    Altera a conta e, se status, valor ou vencimento mudaram, move seus valores entre os totais mensais
+    (leitura e escritas na mesma transação). Levanta PayableError se a conta não existe.
+    """
+    return _update_in_transaction(db_instance.transaction(), db_instance, clinica_id,
+                                  contas_ref(db_instance, clinica_id).document(conta_id), changes)
+
+@firestore.transactional
+def _delete_in_transaction(transaction, db_instance, clinica_id, conta_ref):
+    snapshot = conta_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        raise PayableError('Conta a pagar não encontrada.')
+    transaction.delete(conta_ref)
+    add_payable_totals(transaction, db_instance, clinica_id, snapshot.to_dict() or {}, -1)
+
+def delete_payable(db_instance, clinica_id, conta_id):
+    """Exclui a conta e a retira dos totais do mês. Levanta PayableError se a conta não existe."""
+    _delete_in_transaction(db_instance.transaction(), db_instance, clinica_id,
+                           contas_ref(db_instance, clinica_id).document(conta_id))
+
+def create_payables(db_instance, clinica_id, contas, depois=()):
+    """
+    Grava várias contas novas [(referência, dados)] em batches de até CONTAS_BATCH_SIZE. Os totais
+    mensais (somados por mês) e as escritas 'depois' [(referência, dados de update, last_update_time
+    ou None)] vão no último batch: se um batch anterior falhar, regravar as mesmas referências não soma
+    nada duas vezes. Com last_update_time, o update só vale se o documento não mudou desde então; senão
+    o último batch inteiro é recusado (FailedPrecondition) e nenhum total é somado.
+    Retorna a quantidade de contas gravadas.
+    """
+    deltas = {}
+    for _, conta_data in contas:
+        _totals_delta(deltas, conta_data, 1)
+    batch, size = db_instance.batch(), 0
+    for conta_ref, conta_data in contas:
+        if size >= CONTAS_BATCH_SIZE - len(deltas) - len(depois):
+            batch.commit()
+            batch, size = db_instance.batch(), 0
+        batch.set(conta_ref, dict(conta_data, **_search_fields(conta_data)))
+        size += 1
+    _write_totals(batch, db_instance, clinica_id, deltas)
+    for ref, data, last_update_time in depois:
+        if last_update_time:
+            batch.update(ref, data, option=db_instance.write_option(last_update_time=last_update_time))
+        else:
+            batch.update(ref, data)
+    batch.commit()
+    return len(contas)
+
+@firestore.transactional
+def _pending_chunk_in_transaction(transaction, db_instance, clinica_id, refs, changes):
+    # changes None exclui as contas; senão, aplica as alterações. Só contas pendentes são afetadas.
+    deltas, afetadas = {}, 0
+    for snapshot in transaction.get_all(refs):
+        conta = snapshot.to_dict() if snapshot.exists else None
+        if not conta or conta.get('status') != 'pendente':
+            continue
+        _totals_delta(deltas, conta, -1)
+        if changes is None:
+            transaction.delete(snapshot.reference)
+        else:
+            transaction.update(snapshot.reference, changes)
+            _totals_delta(deltas, dict(conta, **changes), 1)
+        afetadas += 1
+    _write_totals(transaction, db_instance, clinica_id, deltas)
+    return afetadas
+
+def _apply_to_pending(db_instance, clinica_id, conta_ids, changes):
+    conta_ids = list(dict.fromkeys(conta_ids))
+    afetadas = 0
+    for start in range(0, len(conta_ids), CONTAS_LOTE_TRANSACAO):
+        refs = [contas_ref(db_instance, clinica_id).document(conta_id) for conta_id in conta_ids[start:start + CONTAS_LOTE_TRANSACAO]]
+        afetadas += _pending_chunk_in_transaction(db_instance.transaction(), db_instance, clinica_id, refs, changes)
+    return afetadas
+
+def mark_payables_paid(db_instance, clinica_id, conta_ids, data_pagamento=None):
+    """
+    Marca como pagas as contas pendentes de conta_ids, em transações de até CONTAS_LOTE_TRANSACAO contas
+    (contas inexistentes ou já pagas são ignoradas). Retorna a quantidade de contas pagas.
+    """
+    return _apply_to_pending(db_instance, clinica_id, conta_ids, {
+        'status': 'paga',
+        'data_pagamento': data_pagamento or datetime.datetime.now(SAO_PAULO_TZ),
+        'atualizado_em': firestore.SERVER_TIMESTAMP,
+    })
+
+def delete_pending_payables(db_instance, clinica_id, conta_ids):
+    """Exclui as contas pendentes de conta_ids (as pagas são mantidas). Retorna a quantidade excluída."""
+    return _apply_to_pending(db_instance, clinica_id, conta_ids, None)
+
+def pending_ids_in_month(db_instance, clinica_id, mes):
+    """Ids das contas pendentes com vencimento no mês 'mes' (AAAA-MM)."""
+    inicio = datetime.datetime.strptime(mes, '%Y-%m').date()
+    fim = (inicio + datetime.timedelta(days=32)).replace(day=1)
+    query = contas_ref(db_instance, clinica_id).where(filter=FieldFilter('status', '==', 'pendente'))\
+        .where(filter=FieldFilter('data_vencimento', '>=', _start_of_day(inicio)))\
+        .where(filter=FieldFilter('data_vencimento', '<', _start_of_day(fim))).select([])
+    return [doc.id for doc in query.stream()]
+
+def _pendentes_entre(db_instance, clinica_id, inicio, fim):
+    return contas_ref(db_instance, clinica_id).where(filter=FieldFilter('status', '==', 'pendente'))\
+        .where(filter=FieldFilter('data_vencimento', '>=', inicio))\
+        .where(filter=FieldFilter('data_vencimento', '<', fim))\
+        .select(['valor', 'data_vencimento'])
+
+def _empty_totals(mes):
+    totais = {'mes': mes}
+    for status in CONTAS_STATUS:
+        totais.update({f'{status}_valor': 0, f'{status}_qtd': 0})
+    return totais
+
+def monthly_due_totals(db_instance, clinica_id, meses):
+    """Totais por status de cada mês de 'meses' (AAAA-MM, em ordem): [{mes, pendente_valor, pendente_qtd, paga_valor, paga_qtd}]."""
+    if not meses:
+        return []
+    totais = {mes: _empty_totals(mes) for mes in meses}
+    query = _resumo_mensal_ref(db_instance, clinica_id).where(filter=FieldFilter('mes', '>=', meses[0]))\
+        .where(filter=FieldFilter('mes', '<=', meses[-1]))
+    for doc in query.stream():
+        data = doc.to_dict() or {}
+        if data.get('mes') in totais:
+            totais[data['mes']].update({campo: data.get(campo) or 0 for campo in totais[data['mes']] if campo != 'mes'})
+    return [totais[mes] for mes in meses]
+
+def overdue_totals(db_instance, clinica_id, hoje=None):
+    """
+    Contas pendentes vencidas (vencimento antes de hoje): {'quantidade', 'valor'}. Os meses anteriores
+    vêm dos totais mensais; só as pendentes do mês atual já vencidas são lidas, por intervalo indexado.
+    """
+    hoje = hoje or datetime.datetime.now(SAO_PAULO_TZ).date()
+    mes_atual = hoje.strftime('%Y-%m')
+    quantidade, valor = 0, 0
+    anteriores = _resumo_mensal_ref(db_instance, clinica_id).where(filter=FieldFilter('mes', '<', mes_atual))\
+        .select(['pendente_valor', 'pendente_qtd'])
+    for doc in anteriores.stream():
+        data = doc.to_dict() or {}
+        quantidade += data.get('pendente_qtd') or 0
+        valor += data.get('pendente_valor') or 0
+    for doc in _pendentes_entre(db_instance, clinica_id, _start_of_day(hoje.replace(day=1)), _start_of_day(hoje)).stream():
+        quantidade += 1
+        valor += (doc.to_dict() or {}).get('valor') or 0
+    return {'quantidade': quantidade, 'valor': round(valor, 2)}
+
+def cash_flow_projection(db_instance, clinica_id, semanas=FLUXO_SEMANAS_PADRAO, hoje=None):
+    """
+    Valores pendentes a pagar por semana, a partir de hoje: {'vencidas': overdue_totals, 'semanas':
+    [{inicio, fim, quantidade, valor}]} (datas ISO, fim inclusive), numa consulta por intervalo.
+    """
+    hoje = hoje or datetime.datetime.now(SAO_PAULO_TZ).date()
+    semanas = max(1, min(int(semanas), FLUXO_SEMANAS_MAXIMO))
+    buckets = [{'inicio': (hoje + datetime.timedelta(weeks=i)).isoformat(),
+                'fim': (hoje + datetime.timedelta(weeks=i + 1, days=-1)).isoformat(),
+                'quantidade': 0, 'valor': 0} for i in range(semanas)]
+    fim = _start_of_day(hoje + datetime.timedelta(weeks=semanas))
+    for doc in _pendentes_entre(db_instance, clinica_id, _start_of_day(hoje), fim).stream():
+        conta = doc.to_dict() or {}
+        semana = (conta['data_vencimento'].astimezone(SAO_PAULO_TZ).date() - hoje).days // 7
+        if 0 <= semana < semanas:
+            buckets[semana]['quantidade'] += 1
+            buckets[semana]['valor'] += conta.get('valor') or 0
+    for bucket in buckets:
+        bucket['valor'] = round(bucket['valor'], 2)
+    return {'vencidas': overdue_totals(db_instance, clinica_id, hoje), 'semanas': buckets}
+
+def _month_query(db_instance, clinica_id, mes):
+    """Contas com vencimento no mês 'mes' (AAAA-MM) ou, para CONTAS_SEM_VENCIMENTO, sem vencimento."""
+    query = contas_ref(db_instance, clinica_id)
+    if mes == CONTAS_SEM_VENCIMENTO:
+        query = query.where(filter=FieldFilter('data_vencimento', '==', None))
+    else:
+        inicio = datetime.datetime.strptime(mes, '%Y-%m').date()
+        fim = (inicio + datetime.timedelta(days=32)).replace(day=1)
+        query = query.where(filter=FieldFilter('data_vencimento', '>=', _start_of_day(inicio)))\
+            .where(filter=FieldFilter('data_vencimento', '<', _start_of_day(fim)))
+    return query.select(list(_CAMPOS_TOTAIS))
+
+@firestore.transactional
+def _rebuild_month_in_transaction(transaction, db_instance, clinica_id, mes):
+    """
+    Recalcula os totais de um mês lendo as contas e o documento de totais na mesma transação: uma conta
+    gravada no meio (que também incrementa os totais) faz a transação ser repetida, sem perder o incremento.
+    Retorna True se os totais mudaram.
+    """
+    resumo_doc_ref = _resumo_mensal_ref(db_instance, clinica_id).document(mes)
+    atual = resumo_doc_ref.get(transaction=transaction)
+    total = _empty_totals(mes)
+    for doc in _month_query(db_instance, clinica_id, mes).stream(transaction=transaction):
+        conta = doc.to_dict() or {}
+        if conta.get('status') in CONTAS_STATUS and due_month(conta.get('data_vencimento')) == mes:
+            total[f"{conta['status']}_valor"] += conta.get('valor') or 0
+            total[f"{conta['status']}_qtd"] += 1
+    campos = [campo for campo in total if campo != 'mes']
+    if not any(total[campo] for campo in campos):
+        if atual.exists:
+            transaction.delete(resumo_doc_ref)
+        return atual.exists
+    atual_data = atual.to_dict() or {}
+    if atual.exists and all(round(atual_data.get(campo) or 0, 2) == round(total[campo], 2) for campo in campos):
+        return False
+    transaction.set(resumo_doc_ref, dict(total, atualizado_em=firestore.SERVER_TIMESTAMP))
+    return True
+
+def _update_search_fields(db_instance, pendentes):
+    """
+    Grava busca_termos [(snapshot, campos)] em batches, com precondição no update_time lido: uma conta
+    alterada depois da leitura já recebeu os termos novos na própria gravação e fica como está.
+    """
+    for start in range(0, len(pendentes), CONTAS_BATCH_SIZE):
+        chunk = pendentes[start:start + CONTAS_BATCH_SIZE]
+        batch = db_instance.batch()
+        for doc, campos in chunk:
+            batch.update(doc.reference, campos, option=db_instance.write_option(last_update_time=doc.update_time))
+        try:
+            batch.commit()
+        except google_exceptions.FailedPrecondition:
+            for doc, campos in chunk:
+                try:
+                    doc.reference.update(campos, option=db_instance.write_option(last_update_time=doc.update_time))
+                except (google_exceptions.FailedPrecondition, google_exceptions.NotFound):
+                    continue
+
+def rebuild_payable_totals(db_instance, clinica_id, progress_callback=None):
+    """
+    Recalcula contas_resumo_mensal a partir das contas e grava busca_termos nas contas que não o têm
+    (ou que o têm desatualizado). Cada mês (os que têm contas e os que já têm totais) é recalculado
+    numa transação própria, então gravações concorrentes não são sobrescritas; totais de meses sem
+    contas são removidos. Retorna {'contas', 'meses', 'meses_corrigidos'} (quantidades processadas).
+    """
+    meses = set()
+    sem_termos = []
+    contas = 0
+    for doc in contas_ref(db_instance, clinica_id).select(list(_CAMPOS_TOTAIS + _CAMPOS_BUSCA) + ['busca_termos']).stream():
+        conta = doc.to_dict() or {}
+        contas += 1
+        campos = _search_fields(conta)
+        if conta.get('busca_termos') != campos['busca_termos']:
+            sem_termos.append((doc, campos))
+        if conta.get('status') in CONTAS_STATUS:
+            meses.add(due_month(conta.get('data_vencimento')))
+    _update_search_fields(db_instance, sem_termos)
+
+    meses.update(doc.id for doc in _resumo_mensal_ref(db_instance, clinica_id).select([]).stream())
+    corrigidos = []
+    for index, mes in enumerate(sorted(meses)):
+        if _rebuild_month_in_transaction(db_instance.transaction(), db_instance, clinica_id, mes):
+            corrigidos.append(mes)
+        if progress_callback:
+            progress_callback(index + 1, len(meses))
+    if corrigidos:
+        invalidate_financial_report(clinica_id, *corrigidos)
+    _controle_ref(db_instance, clinica_id).set({'campos_versao': CONTAS_CAMPOS_VERSAO,
+                                                'gerado_em': firestore.SERVER_TIMESTAMP}, merge=True)
+    return {'contas': contas, 'meses': len(meses), 'meses_corrigidos': len(corrigidos)}
+
+def search_fields_ready(db_instance, clinica_id):
+    """As contas da clínica já têm busca_termos da versão atual (a tarefa diária já rodou)?"""
+    controle = _controle_ref(db_instance, clinica_id).get(field_paths=['campos_versao'])
+    return (controle.to_dict() or {}).get('campos_versao', 0) >= CONTAS_CAMPOS_VERSAO
+
+def schedule_payable_totals(db_instance, clinica_id, force=False):
+    """
+    Agenda rebuild_payable_totals em segundo plano, no máximo uma vez a cada CONTAS_RESUMO_INTERVALO_SEGUNDOS
+    por clínica (a menos que force=True). Retorna o job_id ou None se não foi necessário.
+    """
+    now = time.monotonic()
+    with _ultimo_resumo_lock:
+        if not force and now - _ultimo_resumo.get(clinica_id, float('-inf')) < CONTAS_RESUMO_INTERVALO_SEGUNDOS:
+            return None
+        _ultimo_resumo[clinica_id] = now
+    return start_background_job('Totais das contas a pagar', rebuild_payable_totals, db_instance, clinica_id,
+                                clinica_id=clinica_id)
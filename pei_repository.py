@@ -0,0 +1,869 @@
+import copy
+import datetime
+import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ, convert_doc_to_dict, cascade_delete, start_cascade_delete_job, VersionConflictError
+from query_registry import register_query
+
+# =================================================================
+# REPOSITÓRIO ÚNICO DE PEIs
+# =================================================================
+#
+# Layout de armazenamento (schema_version 2):
+#   - 'embutido': a árvore metas -> alvos -> ajudas fica no próprio documento do PEI,
+#     no campo 'metas'. Ler um PEI custa uma única leitura.
+#   - 'subcolecoes': quando a árvore passa dos limites abaixo, ela é "derramada" para as
+#     subcoleções metas/alvos/ajudas (mesmo formato usado antes da unificação).
+#
+# Documentos antigos sem o campo 'layout' são lidos normalmente:
+#   - com o campo 'goals' (modelo embutido do prontuário: goals -> targets -> aids);
+#   - sem ele, a partir das subcoleções metas/alvos/ajudas.
+# migrate_peis() normaliza todos para o layout atual.
+#
+# As atividades (linha do tempo) ficam na subcoleção 'activities' do PEI, nome herdado do
+# blueprint de PEIs, onde os dados existentes já estão; a migração move para ela os arrays
+# 'activities' embutidos pelo prontuário.
+#
+# Concorrência otimista:
+#   - o PEI e cada nó da árvore (meta, alvo, ajuda) têm um contador 'rev', incrementado
+#     sempre que o nó muda;
+#   - as gravações não usam transação de leitura: o PEI é lido uma vez e gravado num batch
+#     com pré-condição no update_time do documento. Se outro usuário gravou no meio, a
+#     alteração é reaplicada sobre a versão nova;
+#   - o cliente pode enviar as revisões que viu ({id_do_nó: rev}). Se algum desses nós mudou,
+#     a gravação é recusada com VersionConflictError, que carrega o diff para o cliente mesclar.
+
+PEI_SCHEMA_VERSION = 2
+PEI_LAYOUT_EMBUTIDO = 'embutido'
+PEI_LAYOUT_SUBCOLECOES = 'subcolecoes'
+PEI_LAYOUT_LEGADO = 'legado'
+
+# Limites para manter a árvore embutida (o Firestore aceita no máximo 1 MiB por documento)
+PEI_EMBED_MAX_BYTES = 512 * 1024
+PEI_EMBED_MAX_NODES = 1000
+
+# Tentativas de gravação condicional antes de desistir (cada uma relê o PEI e reaplica a alteração)
+PEI_MAX_TENTATIVAS_ESCRITA = 5
+
+# Atividades carregadas por página na linha do tempo do PEI
+PEI_ATIVIDADES_POR_PAGINA = 20
+PEI_ATIVIDADES_LIMITE_MAXIMO = 100
+
+# Dias que uma meta permanece em 'Manutenção' antes de ser reativada automaticamente
+PEI_DIAS_MANUTENCAO = 15
+
+# Consultas de grupo de coleções executadas em paralelo ao carregar várias árvores
+PEI_LEITURA_MAX_WORKERS = 3
+
+# Limite de valores de um filtro 'in' do Firestore
+_LIMITE_FILTRO_IN = 30
+
+AJUDAS_PADRAO = [
+    {'sigla': 'AFT', 'description': 'Ajuda Física Total', 'id_ordenacao': 1},
+    {'sigla': 'AFP', 'description': 'Ajuda Física Parcial', 'id_ordenacao': 2},
+    {'sigla': 'AG', 'description': 'Ajuda Gestual', 'id_ordenacao': 3},
+    {'sigla': 'AE', 'description': 'Ajuda Ecóica', 'id_ordenacao': 4},
+    {'sigla': 'I', 'description': 'Independente', 'id_ordenacao': 5},
+]
+
+# Status minúsculos do modelo antigo do prontuário -> status usados pelo módulo de PEIs
+_STATUS_LEGADO = {
+    'ativo': 'Ativo',
+    'pendente': 'Pendente',
+    'andamento': 'Andamento',
+    'finalizada': 'Finalizado',
+}
+
+# Campos de ligação gravados nos documentos das subcoleções (não fazem parte da árvore)
+_CAMPOS_DE_LIGACAO = ('doc_reference', 'pei_id', 'meta_id', 'alvo_id', 'ajuda_id')
+
+
+def _new_node_id():
+    return uuid.uuid4().hex
+
+
+# Versão local dos PEIs de cada clínica, incrementada a cada gravação feita por este processo.
+# Caches derivados de PEIs (ex.: metas do planejamento semanal) comparam a versão para se descartar.
+_pei_versions = {}
+_pei_versions_lock = threading.Lock()
+
+def pei_version(clinica_id):
+    with _pei_versions_lock:
+        return _pei_versions.get(clinica_id, 0)
+
+def _bump_pei_version(clinica_id):
+    with _pei_versions_lock:
+        _pei_versions[clinica_id] = _pei_versions.get(clinica_id, 0) + 1
+
+
+def normalize_status(status):
+    """Converte status do modelo antigo (minúsculos) para os status atuais."""
+    if isinstance(status, str):
+        return _STATUS_LEGADO.get(status, status)
+    return status
+
+
+def _sigla_from_description(description):
+    for ajuda in AJUDAS_PADRAO:
+        if description and ajuda['description'].lower() == str(description).lower():
+            return ajuda['sigla']
+    return None
+
+
+def _strip_link_fields(raw, children_keys):
+    node = {k: v for k, v in (raw or {}).items() if k not in _CAMPOS_DE_LIGACAO and k not in children_keys}
+    if 'status' in node:
+        node['status'] = normalize_status(node['status'])
+    return node
+
+
+def _normalize_aid(raw, default_id=None):
+    aid = _strip_link_fields(raw, ())
+    aid['id'] = (raw or {}).get('id') or (raw or {}).get('ajuda_id') or default_id or _new_node_id()
+    if not aid.get('sigla'):
+        aid['sigla'] = _sigla_from_description(aid.get('description'))
+    aid.setdefault('status', 'Pendente')
+    aid['attempts_count'] = int(aid.get('attempts_count') or 0)
+    aid.setdefault('quant_max', None)
+    return aid
+
+
+def _normalize_target(raw, default_id=None):
+    target = _strip_link_fields(raw, ('aids', 'ajudas', 'concluido', 'Concluido'))
+    target['id'] = (raw or {}).get('id') or (raw or {}).get('alvo_id') or default_id or _new_node_id()
+    if (raw or {}).get('concluido') and target.get('status') in (None, 'Pendente'):
+        target['status'] = 'Finalizado'
+    target.setdefault('status', 'Pendente')
+    target['ajudas'] = [_normalize_aid(a) for a in (raw or {}).get('ajudas', (raw or {}).get('aids', [])) or []]
+    return target
+
+
+def _normalize_goal(raw, default_id=None):
+    goal = _strip_link_fields(raw, ('targets', 'alvos'))
+    goal['id'] = (raw or {}).get('id') or (raw or {}).get('meta_id') or default_id or _new_node_id()
+    goal.setdefault('status', 'Ativo')
+    goal.setdefault('data_primeira_finalizacao', None)
+    goal.setdefault('reactivated_count', 0)
+    goal['alvos'] = [_normalize_target(t) for t in (raw or {}).get('alvos', (raw or {}).get('targets', [])) or []]
+    return goal
+
+
+def new_aids(aids_data=None):
+    """
+    Cria as ajudas de um alvo. Sem aids_data, usa as cinco ajudas padrão.
+    aids_data: lista de dicionários com 'sigla' e, opcionalmente, 'quant_max'.
+    """
+    if aids_data is None:
+        aids_data = [dict(a, quant_max=None) for a in AJUDAS_PADRAO]
+    ajudas = []
+    for aid_data in aids_data:
+        aid = dict(aid_data)
+        padrao = next((a for a in AJUDAS_PADRAO if a['sigla'] == aid.get('sigla')), None)
+        if padrao:
+            aid.setdefault('description', padrao['description'])
+            aid.setdefault('id_ordenacao', padrao['id_ordenacao'])
+        aid['id'] = _new_node_id()
+        aid['status'] = aid.get('status') or 'Pendente'
+        aid['attempts_count'] = int(aid.get('attempts_count') or 0)
+        aid.setdefault('quant_max', None)
+        ajudas.append(aid)
+    return ajudas
+
+
+def tree_stats(metas):
+    """Retorna (quantidade de nós, tamanho aproximado em bytes) de uma árvore de metas."""
+    nodes = 0
+    for meta in metas:
+        nodes += 1
+        for alvo in meta.get('alvos', []):
+            nodes += 1 + len(alvo.get('ajudas', []))
+    size = len(json.dumps(metas, default=str).encode('utf-8'))
+    return nodes, size
+
+
+def fits_embedded(metas):
+    nodes, size = tree_stats(metas)
+    return nodes <= PEI_EMBED_MAX_NODES and size <= PEI_EMBED_MAX_BYTES
+
+
+def resolve_layout(pei_data):
+    """Identifica como a árvore de metas de um PEI está armazenada."""
+    layout = (pei_data or {}).get('layout')
+    if layout in (PEI_LAYOUT_EMBUTIDO, PEI_LAYOUT_SUBCOLECOES):
+        return layout
+    if 'goals' in (pei_data or {}):
+        return PEI_LAYOUT_LEGADO
+    return PEI_LAYOUT_SUBCOLECOES
+
+
+def find_goal(metas, goal_id):
+    goal = next((m for m in metas if m.get('id') == goal_id), None)
+    if goal is None:
+        raise Exception("Meta não encontrada no PEI.")
+    return goal
+
+
+def find_target(metas, goal_id, target_id):
+    goal = find_goal(metas, goal_id)
+    target = next((a for a in goal.get('alvos', []) if a.get('id') == target_id), None)
+    if target is None:
+        raise Exception("Alvo não encontrado na meta.")
+    return goal, target
+
+
+def _as_sao_paulo_datetime(value):
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except (ValueError, TypeError):
+            return None
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return SAO_PAULO_TZ.localize(value)
+        return value.astimezone(SAO_PAULO_TZ)
+    return None
+
+
+# --- Regras de ciclo de vida (operam sobre a árvore em memória) ---
+
+def _set_goal_children(goal, target_status, aid_status, reset_attempts=False):
+    for alvo in goal.get('alvos', []):
+        alvo['status'] = target_status
+        for ajuda in alvo.get('ajudas', []):
+            ajuda['status'] = aid_status
+            if reset_attempts:
+                ajuda['attempts_count'] = 0
+
+
+def apply_finalize_goal(goal):
+    """
+    Primeira finalização: a meta vai para 'Manutenção' e alvos/ajudas são reiniciados.
+    Finalizações seguintes (após reativação): a meta é 'Finalizado' definitivamente.
+    """
+    if goal.get('reactivated_count', 0) == 0:
+        goal['status'] = 'Manutenção'
+        goal['data_primeira_finalizacao'] = datetime.datetime.now(SAO_PAULO_TZ)
+        goal['reactivated_count'] = 1
+        _set_goal_children(goal, 'Pendente', 'Pendente', reset_attempts=True)
+    else:
+        goal['status'] = 'Finalizado'
+        _set_goal_children(goal, 'Finalizado', 'Finalizado')
+
+
+def apply_reactivate_goal(goal):
+    """Volta uma meta em 'Manutenção' para 'Ativo', incrementando reactivated_count."""
+    goal['status'] = 'Ativo'
+    goal['reactivated_count'] = goal.get('reactivated_count', 0) + 1
+    _set_goal_children(goal, 'Pendente', 'Pendente', reset_attempts=True)
+
+
+def apply_activate_goal(goal):
+    goal['status'] = 'Ativo'
+    _set_goal_children(goal, 'Pendente', 'Pendente')
+
+
+def apply_finalize_pei(metas):
+    for goal in metas:
+        if goal.get('status') in ('Ativo', 'Manutenção'):
+            goal['status'] = 'finalizado'
+            _set_goal_children(goal, 'Finalizado', 'Finalizado')
+
+
+def apply_update_target_and_aid(metas, goal_id, target_id, aid_id=None, new_attempts_count=None, new_target_status=None):
+    _, target = find_target(metas, goal_id, target_id)
+    if new_target_status is not None:
+        new_target_status = normalize_status(new_target_status)
+        target['status'] = new_target_status
+        if new_target_status == 'Finalizado':
+            for ajuda in target.get('ajudas', []):
+                ajuda['status'] = 'Finalizado'
+
+    if aid_id is not None:
+        ajuda = next((a for a in target.get('ajudas', []) if a.get('id') == aid_id), None)
+        if ajuda is None:
+            raise Exception("Ajuda (Aid) não encontrada no alvo.")
+        if new_attempts_count is not None:
+            try:
+                ajuda['attempts_count'] = max(0, int(new_attempts_count))
+            except (ValueError, TypeError) as e:
+                raise Exception(f"Valor inválido para tentativas: {new_attempts_count}. Erro: {e}")
+
+
+def goals_due_for_reactivation(metas, now=None):
+    """Retorna as metas em 'Manutenção' há pelo menos PEI_DIAS_MANUTENCAO dias."""
+    now = now or datetime.datetime.now(SAO_PAULO_TZ)
+    due = []
+    for goal in metas:
+        if goal.get('status') != 'Manutenção':
+            continue
+        first_finalization = _as_sao_paulo_datetime(goal.get('data_primeira_finalizacao'))
+        if first_finalization and (now - first_finalization).days >= PEI_DIAS_MANUTENCAO:
+            due.append(goal)
+    return due
+
+
+def format_activity_timestamp(timestamp):
+    """Formata a data de uma atividade como exibida na linha do tempo."""
+    if isinstance(timestamp, datetime.datetime):
+        return _as_sao_paulo_datetime(timestamp).strftime('%d/%m/%Y %H:%M')
+    if isinstance(timestamp, str):
+        try:
+            return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S').strftime('%d/%m/%Y %H:%M')
+        except (ValueError, TypeError):
+            return 'Data Inválida'
+    return 'N/A'
+
+
+def _node_fields(node):
+    """Campos próprios de um nó (sem filhos e sem o contador de revisão)."""
+    return {k: v for k, v in node.items() if k not in ('alvos', 'ajudas', 'rev')}
+
+
+def _index_tree(metas):
+    """Retorna {id: (tipo, nó)} para todas as metas, alvos e ajudas da árvore."""
+    index = {}
+    for goal in metas:
+        index[goal['id']] = ('meta', goal)
+        for target in goal.get('alvos', []):
+            index[target['id']] = ('alvo', target)
+            for aid in target.get('ajudas', []):
+                index[aid['id']] = ('ajuda', aid)
+    return index
+
+
+def bump_revisions(before, after):
+    """Incrementa 'rev' dos nós alterados ou criados em 'after' em relação a 'before'."""
+    previous = _index_tree(before)
+    for node_id, (_, node) in _index_tree(after).items():
+        old = previous.get(node_id)
+        if old is None:
+            node['rev'] = 1
+        elif _node_fields(old[1]) != _node_fields(node):
+            node['rev'] = int(old[1].get('rev') or 0) + 1
+        else:
+            node['rev'] = int(old[1].get('rev') or 0)
+
+
+def find_conflicts(before, after, expected_revs):
+    """
+    Compara as revisões vistas pelo cliente com as atuais.
+    Para cada nó em conflito devolve um diff mesclável: os campos atuais no servidor
+    e os campos que a alteração do cliente pretendia mudar.
+    """
+    if not expected_revs:
+        return []
+    current = _index_tree(before)
+    proposed = _index_tree(after)
+    conflicts = []
+    for node_id, expected_rev in expected_revs.items():
+        try:
+            expected_rev = int(expected_rev)
+        except (ValueError, TypeError):
+            continue
+        node_type, node = current.get(node_id, (None, None))
+        current_rev = int(node.get('rev') or 0) if node is not None else None
+        if current_rev == expected_rev:
+            continue
+        proposed_fields = {}
+        if node_id in proposed:
+            new_fields = _node_fields(proposed[node_id][1])
+            old_fields = _node_fields(node) if node is not None else {}
+            proposed_fields = {k: v for k, v in new_fields.items() if old_fields.get(k) != v}
+        conflicts.append({
+            'id': node_id,
+            'tipo': node_type or (proposed[node_id][0] if node_id in proposed else None),
+            'rev_esperada': expected_rev,
+            'rev_atual': current_rev,
+            'atual': _node_fields(node) if node is not None else None,
+            'proposto': proposed_fields,
+        })
+    return conflicts
+
+
+register_query('peis.do_paciente', 'clinicas/{clinica_id}/peis',
+               equality=('paciente_id', 'status'), array_contains='profissionais_ids',
+               optional=('status', 'profissionais_ids'))
+# Leitura das árvores em subcoleções (get_trees): uma consulta de grupo de coleções por nível
+register_query('peis.arvore.metas', 'metas', collection_group=True, equality=('pei_id',))
+register_query('peis.arvore.alvos', 'alvos', collection_group=True, equality=('pei_id',))
+register_query('peis.arvore.ajudas', 'ajudas', collection_group=True, equality=('pei_id',))
+
+
+class PeiRepository:
+    """
+    Ponto único de leitura e escrita de PEIs (metas, alvos e ajudas), usado tanto
+    pelo módulo de PEIs quanto pelas rotas de PEI do prontuário.
+    """
+
+    def __init__(self, db_instance, clinica_id):
+        self.db = db_instance
+        self.clinica_id = clinica_id
+        self.peis_ref = db_instance.collection('clinicas').document(clinica_id).collection('peis')
+
+    def ref(self, pei_id):
+        return self.peis_ref.document(pei_id)
+
+    # --- Leitura ---
+
+    def query_for_patient(self, paciente_id, professional_id=None, status=None):
+        query = self.peis_ref.where(filter=FieldFilter('paciente_id', '==', paciente_id))
+        if status:
+            query = query.where(filter=FieldFilter('status', '==', status))
+        if professional_id:
+            query = query.where(filter=FieldFilter('profissionais_ids', 'array_contains', professional_id))
+        return query
+
+    def load_tree(self, pei_ref, pei_data):
+        """Retorna a árvore normalizada de metas (metas -> alvos -> ajudas) de um PEI."""
+        layout = resolve_layout(pei_data)
+        if layout == PEI_LAYOUT_EMBUTIDO:
+            return [_normalize_goal(m) for m in pei_data.get('metas', [])]
+        if layout == PEI_LAYOUT_LEGADO:
+            return [_normalize_goal(g) for g in pei_data.get('goals', [])]
+        return self._read_subcollection_tree(pei_ref)
+
+    def get_tree(self, pei_snapshot):
+        return self.load_tree(pei_snapshot.reference, pei_snapshot.to_dict() or {})
+
+    def get_trees(self, pei_snapshots, include_aids=True):
+        """
+        Árvores de vários PEIs: {pei_id: metas}. PEIs embutidos não custam leituras; os PEIs em
+        subcoleções são lidos juntos, com uma consulta de grupo de coleções por nível (metas, alvos
+        e, se include_aids, ajudas) executadas em paralelo, em vez de um stream por meta e por alvo.
+        """
+        trees, spilled = {}, {}
+        for snapshot in pei_snapshots:
+            pei_data = snapshot.to_dict() or {}
+            if resolve_layout(pei_data) == PEI_LAYOUT_SUBCOLECOES:
+                spilled[snapshot.id] = snapshot.reference
+            else:
+                trees[snapshot.id] = self.load_tree(snapshot.reference, pei_data)
+        if not spilled:
+            return trees
+
+        levels = ('metas', 'alvos', 'ajudas') if include_aids else ('metas', 'alvos')
+        with ThreadPoolExecutor(max_workers=PEI_LEITURA_MAX_WORKERS) as executor:
+            metas_docs, alvos_docs, *ajudas_docs = executor.map(lambda level: self._collection_group_docs(level, list(spilled)), levels)
+
+        aids_by_target = {}
+        for ajuda_doc in (ajudas_docs[0] if ajudas_docs else []):
+            aid = _normalize_aid(ajuda_doc.to_dict(), default_id=ajuda_doc.id)
+            aid['id'] = ajuda_doc.id
+            aids_by_target.setdefault(ajuda_doc.reference.parent.parent.path, []).append(aid)
+        targets_by_goal = {}
+        for alvo_doc in alvos_docs:
+            target = _normalize_target(alvo_doc.to_dict(), default_id=alvo_doc.id)
+            target['id'] = alvo_doc.id
+            target['ajudas'] = aids_by_target.get(alvo_doc.reference.path, [])
+            targets_by_goal.setdefault(alvo_doc.reference.parent.parent.path, []).append(target)
+        for meta_doc in metas_docs:
+            goal = _normalize_goal(meta_doc.to_dict(), default_id=meta_doc.id)
+            goal['id'] = meta_doc.id
+            goal['alvos'] = targets_by_goal.get(meta_doc.reference.path, [])
+            trees.setdefault(meta_doc.reference.parent.parent.id, []).append(goal)
+
+        # Documentos antigos sem o campo 'pei_id' não aparecem nas consultas de grupo: lê pelo caminho
+        for pei_id, pei_ref in spilled.items():
+            if pei_id not in trees:
+                trees[pei_id] = self._read_subcollection_tree(pei_ref)
+        return trees
+
+    def _collection_group_docs(self, collection_id, pei_ids):
+        # O grupo de coleções é global: mantém só os documentos sob os PEIs desta clínica
+        prefix = self.db.collection('clinicas').document(self.clinica_id).path + '/peis/'
+        docs = []
+        for start in range(0, len(pei_ids), _LIMITE_FILTRO_IN):
+            query = self.db.collection_group(collection_id)\
+                .where(filter=FieldFilter('pei_id', 'in', pei_ids[start:start + _LIMITE_FILTRO_IN]))
+            docs.extend(doc for doc in query.stream() if doc.reference.path.startswith(prefix))
+        return docs
+
+    def _read_subcollection_tree(self, pei_ref):
+        metas = []
+        for meta_doc in pei_ref.collection('metas').stream():
+            goal = _normalize_goal(meta_doc.to_dict(), default_id=meta_doc.id)
+            goal['id'] = meta_doc.id
+            goal['alvos'] = []
+            for alvo_doc in meta_doc.reference.collection('alvos').stream():
+                target = _normalize_target(alvo_doc.to_dict(), default_id=alvo_doc.id)
+                target['id'] = alvo_doc.id
+                target['ajudas'] = []
+                for ajuda_doc in alvo_doc.reference.collection('ajudas').stream():
+                    aid = _normalize_aid(ajuda_doc.to_dict(), default_id=ajuda_doc.id)
+                    aid['id'] = ajuda_doc.id
+                    target['ajudas'].append(aid)
+                goal['alvos'].append(target)
+            metas.append(goal)
+        return metas
+
+    # --- Escrita ---
+
+    def _flatten_for_subcollections(self, pei_ref, metas):
+        """Converte a árvore em {caminho: (referência, campos)} no formato das subcoleções."""
+        flat = {}
+        for goal in metas:
+            goal_ref = pei_ref.collection('metas').document(goal['id'])
+            goal_fields = {k: v for k, v in goal.items() if k not in ('id', 'alvos')}
+            goal_fields.update({'meta_id': goal['id'], 'pei_id': pei_ref.id, 'doc_reference': pei_ref})
+            flat[goal_ref.path] = (goal_ref, goal_fields)
+            for target in goal.get('alvos', []):
+                target_ref = goal_ref.collection('alvos').document(target['id'])
+                target_fields = {k: v for k, v in target.items() if k not in ('id', 'ajudas')}
+                target_fields.update({'alvo_id': target['id'], 'meta_id': goal['id'], 'pei_id': pei_ref.id, 'doc_reference': goal_ref})
+                flat[target_ref.path] = (target_ref, target_fields)
+                for aid in target.get('ajudas', []):
+                    aid_ref = target_ref.collection('ajudas').document(aid['id'])
+                    aid_fields = {k: v for k, v in aid.items() if k != 'id'}
+                    aid_fields.update({'ajuda_id': aid['id'], 'alvo_id': target['id'], 'meta_id': goal['id'], 'pei_id': pei_ref.id, 'doc_reference': target_ref})
+                    flat[aid_ref.path] = (aid_ref, aid_fields)
+        return flat
+
+    def write_tree(self, writer, pei_ref, pei_data, before, after, pei_updates=None, option=None):
+        """
+        Grava a árvore 'after' usando writer (batch).
+        Mantém o layout embutido enquanto a árvore couber; caso contrário, derrama para subcoleções,
+        gravando só os nós alterados/criados e apagando os removidos.
+        option: pré-condição aplicada à atualização do documento do PEI. Como o batch é atômico,
+        ela protege também as gravações nas subcoleções.
+        """
+        updates = dict(pei_updates or {})
+        layout = resolve_layout(pei_data)
+
+        if layout != PEI_LAYOUT_SUBCOLECOES and fits_embedded(after):
+            updates.update({'metas': after, 'layout': PEI_LAYOUT_EMBUTIDO, 'schema_version': PEI_SCHEMA_VERSION})
+            if layout == PEI_LAYOUT_LEGADO:
+                updates['goals'] = firestore.DELETE_FIELD
+            writer.update(pei_ref, updates, option=option)
+            return
+
+        # Layout em subcoleções (PEIs grandes ou ainda não migrados)
+        if layout == PEI_LAYOUT_SUBCOLECOES:
+            previous = self._flatten_for_subcollections(pei_ref, before)
+        else:
+            previous = {}  # Derramando a partir do layout embutido: nada existe nas subcoleções
+        current = self._flatten_for_subcollections(pei_ref, after)
+
+        for path, (doc_ref, fields) in current.items():
+            old = previous.get(path)
+            if old is None or old[1] != fields:
+                writer.set(doc_ref, fields)
+        for path, (doc_ref, _) in previous.items():
+            if path not in current:
+                writer.delete(doc_ref)
+
+        updates.update({'layout': PEI_LAYOUT_SUBCOLECOES, 'schema_version': PEI_SCHEMA_VERSION})
+        if 'metas' in pei_data:
+            updates['metas'] = firestore.DELETE_FIELD
+        if 'goals' in pei_data:
+            updates['goals'] = firestore.DELETE_FIELD
+        writer.update(pei_ref, updates, option=option)
+
+    def mutate(self, pei_id, mutator, expected_revs=None):
+        """
+        Aplica mutator(metas, pei_data) à árvore do PEI e grava com pré-condição no update_time.
+        O mutator pode retornar {'pei_updates': {...}, 'retorno': ...}.
+        expected_revs: {id_do_nó: rev} vistos pelo cliente; se algum mudou, levanta VersionConflictError.
+        """
+        pei_ref = self.ref(pei_id)
+        for tentativa in range(1, PEI_MAX_TENTATIVAS_ESCRITA + 1):
+            snapshot = pei_ref.get()
+            if not snapshot.exists:
+                raise Exception("PEI não encontrado.")
+            pei_data = snapshot.to_dict() or {}
+            before = self.load_tree(pei_ref, pei_data)
+            after = copy.deepcopy(before)
+            result = mutator(after, pei_data) or {}
+            bump_revisions(before, after)
+
+            conflicts = find_conflicts(before, after, expected_revs)
+            if conflicts:
+                raise VersionConflictError("O PEI foi alterado por outro usuário. Revise as alterações e tente novamente.", conflicts)
+
+            pei_updates = dict(result.get('pei_updates') or {})
+            pei_updates['rev'] = int(pei_data.get('rev') or 0) + 1
+            batch = self.db.batch()
+            self.write_tree(batch, pei_ref, pei_data, before, after, pei_updates,
+                            option=self.db.write_option(last_update_time=snapshot.update_time))
+            try:
+                batch.commit()
+                _bump_pei_version(self.clinica_id)
+                return result.get('retorno')
+            except google_exceptions.FailedPrecondition:
+                print(f"PEI {pei_id} alterado durante a gravação (tentativa {tentativa}). Reaplicando alteração.")
+        raise Exception("O PEI está sendo alterado simultaneamente por outros usuários. Tente novamente.")
+
+    # --- Operações ---
+
+    def create(self, paciente_id, titulo, data_criacao, profissionais_ids, criador_nome, extra_fields=None):
+        data = {
+            'paciente_id': paciente_id,
+            'titulo': titulo,
+            'data_criacao': data_criacao,
+            'status': 'Ativo',
+            'criado_em': datetime.datetime.now(SAO_PAULO_TZ),
+            'profissional_criador_nome': criador_nome,
+            'profissionais_ids': profissionais_ids,
+            'doc_reference': self.db.collection('clinicas').document(self.clinica_id),
+            'metas': [],
+            'rev': 0,
+            'layout': PEI_LAYOUT_EMBUTIDO,
+            'schema_version': PEI_SCHEMA_VERSION,
+        }
+        data.update(extra_fields or {})
+        _, pei_ref = self.peis_ref.add(data)
+        _bump_pei_version(self.clinica_id)
+        return pei_ref.id
+
+    def delete_counts(self, pei_id):
+        """Documentos que delete() apagaria, por coleção (cascade_delete com dry_run)."""
+        return cascade_delete(self.db, [self.ref(pei_id)], dry_run=True)
+
+    def delete(self, pei_id, descricao=None):
+        """
+        Remove o PEI da listagem imediatamente e agenda a exclusão das subcoleções (metas antigas,
+        atividades) em segundo plano. Retorna o job_id.
+        """
+        pei_ref = self.ref(pei_id)
+        pei_ref.delete()
+        _bump_pei_version(self.clinica_id)
+        return start_cascade_delete_job(self.db, [pei_ref], descricao or f'Exclusão do PEI {pei_id}',
+                                        clinica_id=self.clinica_id)
+
+    def add_goal(self, pei_id, descricao, targets_desc, aids_data=None):
+        goal_id = _new_node_id()
+
+        def _mutator(metas, pei_data):
+            metas.append({
+                'id': goal_id,
+                'descricao': descricao.strip(),
+                'status': 'Ativo',
+                'data_primeira_finalizacao': None,
+                'reactivated_count': 0,
+                'alvos': [
+                    {'id': _new_node_id(), 'descricao': desc.strip(), 'status': 'Pendente', 'ajudas': new_aids(aids_data)}
+                    for desc in targets_desc if desc and desc.strip()
+                ],
+            })
+        self.mutate(pei_id, _mutator)
+        return goal_id
+
+    def add_target(self, pei_id, goal_id, descricao, aids_data=None):
+        target_id = _new_node_id()
+
+        def _mutator(metas, pei_data):
+            find_goal(metas, goal_id).setdefault('alvos', []).append(
+                {'id': target_id, 'descricao': descricao.strip(), 'status': 'Pendente', 'ajudas': new_aids(aids_data)}
+            )
+        self.mutate(pei_id, _mutator)
+        return target_id
+
+    def delete_goal(self, pei_id, goal_id, expected_revs=None):
+        def _mutator(metas, pei_data):
+            find_goal(metas, goal_id)
+            metas[:] = [m for m in metas if m.get('id') != goal_id]
+        self.mutate(pei_id, _mutator, expected_revs)
+
+    def delete_target(self, pei_id, goal_id, target_id, expected_revs=None):
+        def _mutator(metas, pei_data):
+            goal, _ = find_target(metas, goal_id, target_id)
+            goal['alvos'] = [a for a in goal.get('alvos', []) if a.get('id') != target_id]
+        self.mutate(pei_id, _mutator, expected_revs)
+
+    def finalize_goal(self, pei_id, goal_id, expected_revs=None):
+        self.mutate(pei_id, lambda metas, pei_data: apply_finalize_goal(find_goal(metas, goal_id)), expected_revs)
+
+    def activate_goal(self, pei_id, goal_id, expected_revs=None):
+        self.mutate(pei_id, lambda metas, pei_data: apply_activate_goal(find_goal(metas, goal_id)), expected_revs)
+
+    def finalize_pei(self, pei_id):
+        def _mutator(metas, pei_data):
+            apply_finalize_pei(metas)
+            return {'pei_updates': {'status': 'finalizado', 'data_finalizacao': datetime.datetime.now(SAO_PAULO_TZ)}}
+        self.mutate(pei_id, _mutator)
+
+    def update_target_and_aid(self, pei_id, goal_id, target_id, aid_id=None, new_attempts_count=None, new_target_status=None,
+                              expected_revs=None):
+        self.mutate(pei_id, lambda metas, pei_data: apply_update_target_and_aid(
+            metas, goal_id, target_id, aid_id, new_attempts_count, new_target_status), expected_revs)
+
+    def reactivate_expired_goals(self, pei_snapshot):
+        """
+        Reativa as metas em 'Manutenção' há PEI_DIAS_MANUTENCAO dias ou mais.
+        Só abre transação se houver alguma meta vencida. Retorna as descrições reativadas.
+        """
+        if not goals_due_for_reactivation(self.get_tree(pei_snapshot)):
+            return []
+
+        def _mutator(metas, pei_data):
+            due = goals_due_for_reactivation(metas)
+            for goal in due:
+                apply_reactivate_goal(goal)
+            return {'retorno': [goal.get('descricao', goal['id']) for goal in due]}
+        return self.mutate(pei_snapshot.id, _mutator)
+
+    def add_activity(self, pei_id, content, user_name, paciente_id=None):
+        """Registra uma atividade já com a data formatada para exibição."""
+        pei_ref = self.ref(pei_id)
+        activity_ref = pei_ref.collection('activities').document()
+        timestamp = datetime.datetime.now(SAO_PAULO_TZ)
+        activity_ref.set({
+            'content': content,
+            'timestamp': timestamp,
+            'timestamp_fmt': format_activity_timestamp(timestamp),
+            'user_name': user_name,
+            'pei_id': pei_id,
+            'paciente_id': paciente_id,
+            'activity_id': activity_ref.id,
+            'doc_reference': pei_ref,
+        })
+        return activity_ref.id
+
+    def get_activities_page(self, pei_id, limit=PEI_ATIVIDADES_POR_PAGINA, before=None):
+        """
+        Retorna (atividades em ordem cronológica, cursor da página anterior ou None).
+        Lê só as 'limit' atividades mais recentes anteriores ao cursor 'before' (ID de uma atividade).
+        Levanta ValueError se o cursor não existe.
+        """
+        limit = max(1, min(int(limit or PEI_ATIVIDADES_POR_PAGINA), PEI_ATIVIDADES_LIMITE_MAXIMO))
+        activities_ref = self.ref(pei_id).collection('activities')
+        query = activities_ref.order_by('timestamp', direction=firestore.Query.DESCENDING)
+        if before:
+            cursor_doc = activities_ref.document(before).get()
+            if not cursor_doc.exists:
+                raise ValueError("Atividade de referência não encontrada.")
+            query = query.start_after(cursor_doc)
+
+        # Um documento a mais indica se ainda há atividades mais antigas
+        docs = list(query.limit(limit + 1).stream())
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+
+        activities = []
+        for activity_doc in reversed(docs):
+            activity = convert_doc_to_dict(activity_doc)
+            if isinstance(activity.get('doc_reference'), firestore.DocumentReference):
+                activity['doc_reference'] = activity['doc_reference'].path
+            if not activity.get('timestamp_fmt'):
+                # Atividades gravadas antes da formatação na escrita
+                activity['timestamp_fmt'] = format_activity_timestamp(activity.get('timestamp'))
+            activities.append(activity)
+        next_cursor = docs[-1].id if has_more else None
+        return activities, next_cursor
+
+    # --- Exibição ---
+
+    def goals_for_display(self, pei_ref, metas):
+        """Converte a árvore no formato usado pelos templates (goals -> targets -> aids)."""
+        goals = []
+        for goal in metas:
+            goal_path = f'{pei_ref.path}/metas/{goal["id"]}'
+            display_goal = {k: v for k, v in goal.items() if k != 'alvos'}
+            display_goal['meta_id'] = goal['id']
+            display_goal['rev'] = goal.get('rev', 0)
+            display_goal['doc_reference'] = pei_ref.path
+
+            first_finalization = _as_sao_paulo_datetime(goal.get('data_primeira_finalizacao'))
+            display_goal['data_primeira_finalizacao'] = first_finalization
+            display_goal['data_primeira_finalizacao_fmt'] = first_finalization.strftime('%d/%m/%Y %H:%M') if first_finalization else 'N/A'
+
+            display_goal['targets'] = []
+            for target in goal.get('alvos', []):
+                target_path = f'{goal_path}/alvos/{target["id"]}'
+                display_target = {k: v for k, v in target.items() if k != 'ajudas'}
+                display_target['alvo_id'] = target['id']
+                display_target['rev'] = target.get('rev', 0)
+                display_target['doc_reference'] = goal_path
+                display_target['Concluido'] = (target.get('status') == 'Finalizado')
+                display_target['aids'] = [
+                    dict(aid, ajuda_id=aid['id'], rev=aid.get('rev', 0), doc_reference=target_path) for aid in target.get('ajudas', [])
+                ]
+                display_goal['targets'].append(display_target)
+            goals.append(display_goal)
+        return goals
+
+
+# =================================================================
+# MIGRAÇÃO
+# =================================================================
+
+def migrate_pei(db_instance, pei_snapshot, dry_run=False):
+    """
+    Normaliza um PEI para o layout atual: árvore embutida (ou subcoleções, se grande),
+    status padronizados e atividades do modelo antigo movidas para a subcoleção 'activities'.
+    Retorna o layout final.
+    """
+    pei_data = pei_snapshot.to_dict() or {}
+    pei_ref = pei_snapshot.reference
+    layout = resolve_layout(pei_data)
+    if pei_data.get('schema_version') == PEI_SCHEMA_VERSION and layout in (PEI_LAYOUT_EMBUTIDO, PEI_LAYOUT_SUBCOLECOES) \
+            and not isinstance(pei_data.get('activities'), list):
+        return layout
+
+    clinica_id = pei_ref.parent.parent.id
+    repository = PeiRepository(db_instance, clinica_id)
+    metas = repository.load_tree(pei_ref, pei_data)
+    target_layout = PEI_LAYOUT_EMBUTIDO if fits_embedded(metas) else PEI_LAYOUT_SUBCOLECOES
+    if dry_run:
+        return target_layout
+
+    batch = db_instance.batch()
+    updates = {'status': normalize_status(pei_data.get('status', 'Ativo'))}
+
+    # Atividades embutidas (modelo antigo do prontuário) passam para a subcoleção
+    legacy_activities = pei_data.get('activities')
+    if isinstance(legacy_activities, list):
+        for activity in legacy_activities:
+            activity_ref = pei_ref.collection('activities').document(activity.get('id') or None)
+            batch.set(activity_ref, {
+                'content': activity.get('content', ''),
+                'timestamp': activity.get('timestamp'),
+                'timestamp_fmt': format_activity_timestamp(activity.get('timestamp')),
+                'user_name': activity.get('user_name', 'N/A'),
+                'pei_id': pei_ref.id,
+                'paciente_id': pei_data.get('paciente_id'),
+                'activity_id': activity_ref.id,
+                'doc_reference': pei_ref,
+            })
+        updates['activities'] = firestore.DELETE_FIELD
+
+    old_meta_refs = []
+    if target_layout == PEI_LAYOUT_EMBUTIDO:
+        if layout == PEI_LAYOUT_SUBCOLECOES:
+            old_meta_refs = list(pei_ref.collection('metas').list_documents())
+        # Força a gravação embutida mesmo quando a origem eram subcoleções
+        pei_data_for_write = {k: v for k, v in pei_data.items() if k != 'layout'}
+        if layout == PEI_LAYOUT_SUBCOLECOES:
+            pei_data_for_write['layout'] = PEI_LAYOUT_EMBUTIDO
+        repository.write_tree(batch, pei_ref, pei_data_for_write, metas, metas, updates)
+    else:
+        # Árvore grande: garante o formato completo nas subcoleções
+        repository.write_tree(batch, pei_ref, dict(pei_data, layout=PEI_LAYOUT_SUBCOLECOES), [], metas, updates)
+    batch.commit()
+    _bump_pei_version(clinica_id)
+
+    # Só apaga as subcoleções antigas depois que a árvore embutida foi gravada
+    if old_meta_refs:
+        cascade_delete(db_instance, old_meta_refs)
+    return target_layout
+
+
+def migrate_peis(db_instance, clinica_id, dry_run=False, progress_callback=None):
+    """Migra todos os PEIs de uma clínica. Retorna a contagem por layout final."""
+    peis_ref = db_instance.collection('clinicas').document(clinica_id).collection('peis')
+    pei_docs = list(peis_ref.stream())
+    counts = {PEI_LAYOUT_EMBUTIDO: 0, PEI_LAYOUT_SUBCOLECOES: 0, 'erros': 0}
+    for index, pei_doc in enumerate(pei_docs, start=1):
+        try:
+            counts[migrate_pei(db_instance, pei_doc, dry_run=dry_run)] += 1
+        except Exception as e:
+            print(f"Erro ao migrar PEI {pei_doc.id}: {e}")
+            counts['erros'] += 1
+        if progress_callback:
+            progress_callback(index, len(pei_docs))
+    return counts
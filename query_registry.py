@@ -0,0 +1,279 @@
+import argparse
+import itertools
+import json
+import os
+import string
+import sys
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+# =================================================================
+# REGISTRO DAS CONSULTAS DO FIRESTORE
+# =================================================================
+#
+# Cada módulo declara, ao lado do código que a executa, a forma das suas consultas:
+# filtros de igualdade (== e 'in'), array_contains, desigualdades e ordenação.
+# Filtros que só são aplicados em alguns casos entram em 'optional', e cada
+# combinação deles é tratada como uma variante da consulta. A partir do registro:
+#   - generate_indexes() monta o conteúdo de firestore.indexes.json;
+#     campos declarados com exempt_field() entram como exceções sem índices;
+#   - planner_warnings() aponta formas que dependem de suporte a várias
+#     desigualdades ou que completam a filtragem em Python;
+#   - check_queries() executa cada variante (limit 1) contra o Firestore
+#     configurado ou o emulador (FIRESTORE_EMULATOR_HOST).
+#
+# Uso: python query_registry.py [--gerar] [--verificar] [--executar CLINICA_ID]
+
+INDICES_ARQUIVO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'firestore.indexes.json')
+
+# Valor usado nos filtros ao executar as consultas declaradas; só a forma importa
+_VALOR_VERIFICACAO = '_verificacao_indices'
+
+# Índices de campo único criados por padrão pelo Firestore (escopo de coleção)
+_INDICES_PADRAO = (
+    {'order': 'ASCENDING', 'queryScope': 'COLLECTION'},
+    {'order': 'DESCENDING', 'queryScope': 'COLLECTION'},
+    {'arrayConfig': 'CONTAINS', 'queryScope': 'COLLECTION'},
+)
+
+_queries = {}
+_exemptions = set()
+
+class QueryShape:
+    """Forma declarada de uma consulta: campos filtrados e ordenação, sem os valores."""
+
+    def __init__(self, name, path, equality=(), range_fields=(), order_by=(), array_contains=None,
+                 optional=(), collection_group=False, python_filter=None):
+        self.name = name
+        self.path = path
+        self.collection_id = path.rstrip('/').split('/')[-1]
+        self.equality = tuple(equality)
+        self.range_fields = tuple(range_fields)
+        self.order_by = tuple((item, 'ASCENDING') if isinstance(item, str) else tuple(item) for item in order_by)
+        self.array_contains = array_contains
+        self.optional = tuple(optional)
+        self.collection_group = collection_group
+        self.python_filter = python_filter
+
+        conhecidos = set(self.equality) | set(self.range_fields) | ({array_contains} if array_contains else set())
+        desconhecidos = [campo for campo in self.optional if campo not in conhecidos]
+        if desconhecidos:
+            raise ValueError(f"Consulta '{name}': campos opcionais sem filtro declarado: {desconhecidos}")
+
+    @property
+    def scope(self):
+        return 'COLLECTION_GROUP' if self.collection_group else 'COLLECTION'
+
+    def variants(self):
+        """Todas as combinações dos filtros opcionais, como dicionários de filtros efetivos."""
+        for size in range(len(self.optional) + 1):
+            for omitted in itertools.combinations(self.optional, size):
+                yield {
+                    'equality': [campo for campo in self.equality if campo not in omitted],
+                    'array_contains': self.array_contains if self.array_contains not in omitted else None,
+                    'range_fields': [campo for campo in self.range_fields if campo not in omitted],
+                    'order_by': list(self.order_by),
+                    'omitted': omitted,
+                }
+
+def register_query(name, path, **kwargs):
+    """
+    Declara uma consulta. 'path' é o caminho da coleção com marcadores
+    (ex.: 'clinicas/{clinica_id}/agendamentos'); em consultas de grupo de coleções
+    basta o id da coleção. Veja QueryShape para os demais parâmetros.
+    """
+    shape = QueryShape(name, path, **kwargs)
+    _queries[name] = shape
+    return shape
+
+def exempt_field(path, campo):
+    """
+    Desliga os índices de campo único de 'campo' na coleção (ex.: mapas com chaves dinâmicas que
+    nunca são filtrados e multiplicariam as entradas de índice do documento).
+    """
+    _exemptions.add((path.rstrip('/').split('/')[-1], campo))
+
+def registered_queries():
+    return [_queries[name] for name in sorted(_queries)]
+
+def index_fields(variant):
+    """
+    Campos do índice que atende a variante: igualdades (em ordem alfabética),
+    array_contains, ordenações explícitas e, por fim, as desigualdades que não
+    fazem parte da ordenação (a ordem implícita aplicada pelo Firestore).
+    """
+    fields = [(campo, 'ASCENDING') for campo in sorted(set(variant['equality']))]
+    if variant['array_contains']:
+        fields.append((variant['array_contains'], 'CONTAINS'))
+    ordenados = set()
+    for campo, direction in variant['order_by']:
+        fields.append((campo, direction))
+        ordenados.add(campo)
+    for campo in sorted(set(variant['range_fields']) - ordenados):
+        fields.append((campo, 'ASCENDING'))
+    return fields
+
+def needs_composite(variant):
+    """Consultas só com igualdades usam os índices de campo único; ordenação ou desigualdade em 2+ campos exige índice composto."""
+    if not variant['order_by'] and not variant['range_fields']:
+        return False
+    return len(index_fields(variant)) > 1
+
+def _field_json(campo, mode):
+    if mode == 'CONTAINS':
+        return {'fieldPath': campo, 'arrayConfig': 'CONTAINS'}
+    return {'fieldPath': campo, 'order': mode}
+
+def generate_indexes(shapes=None):
+    """Conteúdo de firestore.indexes.json derivado das consultas registradas."""
+    indexes = {}
+    overrides = {}
+    for shape in shapes or registered_queries():
+        for variant in shape.variants():
+            fields = index_fields(variant)
+            if needs_composite(variant):
+                indexes[(shape.collection_id, shape.scope, tuple(fields))] = True
+            elif shape.collection_group:
+                # Consultas de grupo de coleções não usam os índices de campo único padrão
+                for campo, mode in fields:
+                    overrides.setdefault((shape.collection_id, campo), set()).add(mode)
+
+    return {
+        'indexes': [
+            {'collectionGroup': collection_id, 'queryScope': scope,
+             'fields': [_field_json(campo, mode) for campo, mode in fields]}
+            for collection_id, scope, fields in sorted(indexes)
+        ],
+        'fieldOverrides': [
+            {'collectionGroup': collection_id, 'fieldPath': campo,
+             'indexes': list(_INDICES_PADRAO) + [
+                 {'arrayConfig': 'CONTAINS', 'queryScope': 'COLLECTION_GROUP'} if mode == 'CONTAINS'
+                 else {'order': mode, 'queryScope': 'COLLECTION_GROUP'}
+                 for mode in sorted(modes)
+             ]}
+            for (collection_id, campo), modes in sorted(overrides.items())
+        ] + [
+            {'collectionGroup': collection_id, 'fieldPath': campo, 'indexes': []}
+            for collection_id, campo in sorted(_exemptions)
+        ],
+    }
+
+def write_indexes(path=INDICES_ARQUIVO):
+    manifest = generate_indexes()
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    return manifest
+
+def manifest_is_current(path=INDICES_ARQUIVO):
+    """Indica se o arquivo de índices em disco corresponde às consultas registradas."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f) == generate_indexes()
+    except (OSError, ValueError):
+        return False
+
+def planner_warnings(shapes=None):
+    """Lista (consulta, mensagem) com formas que merecem atenção, sem repetir mensagens."""
+    warnings = []
+    for shape in shapes or registered_queries():
+        messages = []
+        if shape.python_filter:
+            messages.append(f"filtra em Python: {shape.python_filter}")
+        for variant in shape.variants():
+            ranges = variant['range_fields']
+            if len(ranges) > 1:
+                messages.append(f"desigualdades em vários campos ({', '.join(ranges)}); exige o índice exato e lê mais entradas")
+            elif ranges and variant['order_by'] and variant['order_by'][0][0] != ranges[0]:
+                messages.append(f"desigualdade em '{ranges[0]}' com ordenação iniciada por '{variant['order_by'][0][0]}'")
+        for message in dict.fromkeys(messages):
+            warnings.append((shape.name, message))
+    return warnings
+
+def _describe(variant):
+    if not variant['omitted']:
+        return 'todos os filtros'
+    return 'sem ' + ', '.join(variant['omitted'])
+
+def build_query(db_instance, shape, variant, clinica_id):
+    """Monta a variante com valores fictícios; o Firestore valida o índice pela forma."""
+    if shape.collection_group:
+        query = db_instance.collection_group(shape.collection_id)
+    else:
+        marcadores = {}
+        for _, campo, _, _ in string.Formatter().parse(shape.path):
+            if campo:
+                marcadores[campo] = _VALOR_VERIFICACAO
+        marcadores['clinica_id'] = clinica_id
+        query = db_instance.collection(shape.path.format(**marcadores))
+    for campo in variant['equality']:
+        query = query.where(filter=FieldFilter(campo, '==', _VALOR_VERIFICACAO))
+    if variant['array_contains']:
+        query = query.where(filter=FieldFilter(variant['array_contains'], 'array_contains', _VALOR_VERIFICACAO))
+    for campo in variant['range_fields']:
+        query = query.where(filter=FieldFilter(campo, '>=', _VALOR_VERIFICACAO))
+    for campo, direction in variant['order_by']:
+        query = query.order_by(campo, direction=direction)
+    return query.limit(1)
+
+def check_queries(db_instance, clinica_id, shapes=None):
+    """
+    Executa todas as variantes registradas. Retorna a lista de falhas como
+    dicionários {consulta, variante, erro}; índices ausentes aparecem como FailedPrecondition.
+    """
+    failures = []
+    for shape in shapes or registered_queries():
+        for variant in shape.variants():
+            try:
+                build_query(db_instance, shape, variant, clinica_id).get()
+            except Exception as e:
+                failures.append({'consulta': shape.name, 'variante': _describe(variant), 'erro': str(e)})
+    return failures
+
+def load_declarations():
+    """
+    Importa a aplicação, que importa todos os módulos e blueprints que declaram consultas, e retorna o
+    módulo query_registry em que elas foram registradas. Rodando como 'python query_registry.py', este
+    arquivo é __main__ e os módulos da aplicação registram numa segunda cópia, importada por nome.
+    """
+    import app  # noqa: F401  (inicializa o Firebase como o servidor)
+    import query_registry
+    return query_registry
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Índices e verificação das consultas do Firestore.')
+    parser.add_argument('--gerar', action='store_true', help='reescreve firestore.indexes.json')
+    parser.add_argument('--verificar', action='store_true', help='falha se firestore.indexes.json estiver desatualizado')
+    parser.add_argument('--executar', metavar='CLINICA_ID', help='executa cada consulta declarada no Firestore/emulador')
+    args = parser.parse_args(argv)
+
+    registry = load_declarations()
+    shapes = registry.registered_queries()
+    print(f"{len(shapes)} consultas registradas.")
+    if not shapes:
+        # Nenhuma declaração carregada: gerar gravaria um manifesto vazio e verificar compararia com nada
+        print("ERRO: nenhuma consulta registrada; verifique a importação da aplicação.")
+        return 1
+    status = 0
+
+    if args.gerar:
+        manifest = registry.write_indexes()
+        print(f"{len(manifest['indexes'])} índices compostos e {len(manifest['fieldOverrides'])} exceções de campo gravados em {INDICES_ARQUIVO}.")
+    elif args.verificar and not registry.manifest_is_current():
+        print(f"ERRO: {INDICES_ARQUIVO} está desatualizado. Rode 'python query_registry.py --gerar'.")
+        status = 1
+
+    for name, message in registry.planner_warnings(shapes):
+        print(f"AVISO [{name}]: {message}")
+
+    if args.executar:
+        from utils import get_db
+        failures = registry.check_queries(get_db(), args.executar, shapes)
+        for failure in failures:
+            print(f"FALHA [{failure['consulta']}] ({failure['variante']}): {failure['erro']}")
+        print(f"{len(failures)} variantes falharam.")
+        if failures:
+            status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,552 @@
+import datetime
+import threading
+import time
+import uuid
+import pytz
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ, start_background_job
+from query_registry import register_query
+from audit import audit_operation
+from daily_agenda import agenda_operations
+from appointment_cube import cube_operations
+from financial_reports import invalidate_financial_report, revenue_months
+from availability import (
+    BookingConflictError, appointment_interval, find_series_conflicts, invalidate_availability, occupies_schedule,
+)
+
+# =================================================================
+# MOTOR DE RECORRÊNCIA DE AGENDAMENTOS
+# =================================================================
+#
+# Cada série fica em clinicas/{id}/series_agendamentos/{serie_id}, com a regra no formato
+# RRULE (ex.: 'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE;UNTIL=20271231') e os dados comuns
+# das ocorrências. As ocorrências são documentos normais em 'agendamentos', com 'serie_id'
+# e ID determinístico '{serie_id}_{AAAAMMDD}' (regravar uma ocorrência é idempotente).
+#
+# Materialização preguiçosa: só as ocorrências até 'materializado_ate' (horizonte móvel de
+# HORIZONTE_MATERIALIZACAO_SEMANAS) existem em 'agendamentos'. As seguintes são virtuais:
+# sintetizadas na leitura por virtual_occurrences() e gravadas quando o horizonte avança
+# (roll_series) ou quando alguém altera uma delas (load_occurrence). A rolagem também desativa
+# ('ativa': False) as séries já terminadas, e a leitura das virtuais filtra por data_fim: as
+# consultas de séries ficam limitadas às que ainda têm ocorrências no período.
+#
+# "Editar/cancelar esta e as seguintes" divide a série: a original termina na véspera e,
+# na edição, as ocorrências seguintes passam para uma nova série com os dados alterados.
+
+# Limite de operações por batch (o Firestore aceita até 500)
+SERIES_BATCH_SIZE = 400
+
+# Quantas semanas à frente de hoje ficam gravadas como documentos
+HORIZONTE_MATERIALIZACAO_SEMANAS = 8
+
+# Intervalo mínimo (segundos) entre duas rolagens automáticas do horizonte de uma clínica
+ROLAGEM_INTERVALO_SEGUNDOS = 6 * 3600
+
+# Frequências do formulário -> (FREQ, INTERVAL)
+FREQUENCIAS = {
+    'semanal': ('WEEKLY', 1),
+    'quinzenal': ('WEEKLY', 2),
+    'mensal': ('MONTHLY', 1),
+}
+
+# Índice = dia da semana no formato do formulário (0=Domingo ... 6=Sábado)
+_BYDAY = ['SU', 'MO', 'TU', 'WE', 'TH', 'FR', 'SA']
+
+# Campos da série copiados para cada ocorrência
+_CAMPOS_DA_OCORRENCIA = (
+    'paciente_id', 'paciente_nome', 'paciente_numero', 'profissional_id', 'profissional_nome',
+    'servico_procedimento_id', 'servico_procedimento_nome', 'servico_procedimento_preco',
+    'hora_agendamento', 'duracao_minutos', 'status',
+)
+
+_ultima_rolagem = {}
+_ultima_rolagem_lock = threading.Lock()
+
+
+def _series_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('series_agendamentos')
+
+def _agendamentos_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('agendamentos')
+
+def occurrence_id(serie_id, day):
+    return f"{serie_id}_{day.strftime('%Y%m%d')}"
+
+def horizon_end(today=None):
+    """Última data que deve estar materializada."""
+    today = today or datetime.datetime.now(SAO_PAULO_TZ).date()
+    return today + datetime.timedelta(weeks=HORIZONTE_MATERIALIZACAO_SEMANAS)
+
+def _materialized_until(serie_data):
+    # Séries anteriores à materialização preguiçosa foram gravadas por inteiro
+    return datetime.date.fromisoformat(serie_data.get('materializado_ate') or serie_data['data_fim'])
+
+
+# --- Regra (RRULE) ---
+
+def build_rrule(frequencia, dias_semana, data_inicio, data_fim):
+    """Monta a regra RRULE da série. dias_semana: inteiros 0=Domingo ... 6=Sábado."""
+    freq, interval = FREQUENCIAS.get(frequencia, FREQUENCIAS['semanal'])
+    parts = [f'FREQ={freq}', f'INTERVAL={interval}']
+    if freq == 'WEEKLY':
+        parts.append('BYDAY=' + ','.join(_BYDAY[d] for d in sorted(set(dias_semana))))
+    else:
+        parts.append(f'BYMONTHDAY={data_inicio.day}')
+    if data_fim:
+        parts.append(f"UNTIL={data_fim.strftime('%Y%m%d')}")
+    return ';'.join(parts)
+
+def parse_rrule(rrule):
+    """Converte a regra em {'freq', 'interval', 'byday', 'bymonthday', 'until'}."""
+    fields = dict(part.split('=', 1) for part in rrule.split(';') if '=' in part)
+    return {
+        'freq': fields.get('FREQ', 'WEEKLY'),
+        'interval': int(fields.get('INTERVAL', 1)),
+        'byday': [_BYDAY.index(d) for d in fields.get('BYDAY', '').split(',') if d in _BYDAY],
+        'bymonthday': int(fields['BYMONTHDAY']) if 'BYMONTHDAY' in fields else None,
+        'until': datetime.datetime.strptime(fields['UNTIL'], '%Y%m%d').date() if 'UNTIL' in fields else None,
+    }
+
+def replace_until(rrule, data_fim):
+    """Retorna a mesma regra terminando em data_fim."""
+    parts = [p for p in rrule.split(';') if not p.startswith('UNTIL=')]
+    parts.append(f"UNTIL={data_fim.strftime('%Y%m%d')}")
+    return ';'.join(parts)
+
+def expand_dates(rule, data_inicio, data_fim, a_partir_de=None):
+    """
+    Datas das ocorrências entre data_inicio e data_fim (inclusive); com a_partir_de, só as
+    posteriores a ele (a fase quinzenal/mensal continua contada a partir de data_inicio).
+    Semanal: para cada dia da semana da regra, a primeira data e saltos fixos de 7*INTERVAL dias
+    (sem percorrer o calendário dia a dia). Mensal: o dia do mês em cada mês.
+    """
+    data_fim = min(d for d in (data_fim, rule['until']) if d) if (data_fim or rule['until']) else None
+    lower = max(data_inicio, a_partir_de) if a_partir_de else data_inicio
+    if data_fim is None or data_fim < lower:
+        return []
+
+    dates = []
+    if rule['freq'] == 'WEEKLY':
+        step = 7 * rule['interval']
+        week_zero = data_inicio - datetime.timedelta(days=data_inicio.weekday())
+        for js_day in rule['byday']:
+            first = week_zero + datetime.timedelta(days=(js_day - 1) % 7)
+            if first < data_inicio:
+                first += datetime.timedelta(days=step)
+            if first < lower:
+                first += datetime.timedelta(days=step * -(-(lower - first).days // step))
+            count = (data_fim - first).days // step + 1 if first <= data_fim else 0
+            dates.extend(first + datetime.timedelta(days=step * k) for k in range(count))
+    else:
+        anchor_index = data_inicio.year * 12 + data_inicio.month - 1
+        lower_index = lower.year * 12 + lower.month - 1
+        month_index = lower_index + (anchor_index - lower_index) % rule['interval']
+        last_index = data_fim.year * 12 + data_fim.month - 1
+        for index in range(month_index, last_index + 1, rule['interval']):
+            try:
+                day = datetime.date(index // 12, index % 12 + 1, rule['bymonthday'] or data_inicio.day)
+            except ValueError:
+                continue  # Mês sem esse dia (ex.: 31 de abril)
+            if lower <= day <= data_fim:
+                dates.append(day)
+    return sorted(dates)
+
+
+# --- Ocorrências ---
+
+def _occurrence_timestamp(day, hora_agendamento):
+    naive = datetime.datetime.strptime(f"{day.isoformat()} {hora_agendamento}", "%Y-%m-%d %H:%M")
+    return SAO_PAULO_TZ.localize(naive).astimezone(pytz.utc)
+
+def build_occurrence(serie_id, serie_data, day, notify=True):
+    """
+    Documento de 'agendamentos' de uma ocorrência da série.
+    notify=False: ocorrência gravada pelo avanço do horizonte (o paciente já foi avisado da série).
+    """
+    occurrence = {campo: serie_data.get(campo) for campo in _CAMPOS_DA_OCORRENCIA}
+    occurrence.update({
+        'serie_id': serie_id,
+        'data_agendamento': day.isoformat(),
+        'data_agendamento_ts': _occurrence_timestamp(day, serie_data['hora_agendamento']),
+        'tipo_agendamento': 'recorrente',
+        'data_criacao': firestore.SERVER_TIMESTAMP,
+        'atualizado_em': firestore.SERVER_TIMESTAMP,
+        'notificacao_pendente': notify,
+    })
+    if notify:
+        occurrence['notificacao_proxima_tentativa'] = firestore.SERVER_TIMESTAMP
+        occurrence['tipo_alteracao'] = 'novo_agendamento'
+        occurrence['detalhes_alteracao'] = f"Novo agendamento recorrente com {serie_data.get('profissional_nome', 'N/A')} para " \
+                                           f"{serie_data.get('servico_procedimento_nome', 'N/A')} em {day.strftime('%d/%m/%Y')} " \
+                                           f"às {serie_data['hora_agendamento']}."
+    return occurrence
+
+def _virtual_occurrence(serie_id, serie_data, day):
+    occurrence = build_occurrence(serie_id, serie_data, day, notify=False)
+    occurrence.update({
+        'id': occurrence_id(serie_id, day),
+        'virtual': True,
+        'data_criacao': serie_data.get('criado_em'),
+        'atualizado_em': serie_data.get('atualizado_em'),
+    })
+    return occurrence
+
+register_query('series.ativas', 'clinicas/{clinica_id}/series_agendamentos',
+               equality=('ativa', 'profissional_id'), range_fields=('data_fim',), optional=('profissional_id',))
+
+def virtual_occurrences(db_instance, clinica_id, data_inicio, data_fim, profissional_id=None, transaction=None):
+    """
+    Ocorrências das séries ativas entre data_inicio e data_fim (inclusive) que ainda não
+    foram materializadas, sintetizadas a partir dos documentos das séries.
+    Só lê as séries que terminam a partir de data_inicio (data_fim em ISO ordena como data).
+    Cada item tem os campos de um agendamento, mais 'id' e 'virtual': True.
+    """
+    query = _series_ref(db_instance, clinica_id).where(filter=FieldFilter('ativa', '==', True))\
+        .where(filter=FieldFilter('data_fim', '>=', data_inicio.isoformat()))
+    if profissional_id:
+        query = query.where(filter=FieldFilter('profissional_id', '==', profissional_id))
+    occurrences = []
+    for doc in query.stream(transaction=transaction):
+        serie_data = doc.to_dict() or {}
+        try:
+            dates = expand_dates(
+                parse_rrule(serie_data['rrule']), datetime.date.fromisoformat(serie_data['data_inicio']),
+                min(data_fim, datetime.date.fromisoformat(serie_data['data_fim'])),
+                a_partir_de=max(data_inicio, _materialized_until(serie_data) + datetime.timedelta(days=1)),
+            )
+            occurrences.extend(_virtual_occurrence(doc.id, serie_data, day) for day in dates)
+        except (KeyError, ValueError, TypeError) as e:
+            print(f"Série {doc.id} ignorada na expansão virtual: {e}")
+    return occurrences
+
+def write_in_chunks(db_instance, operations):
+    """
+    Executa [(operação, referência, dados)] em batches de até SERIES_BATCH_SIZE gravações
+    (operação: 'set', 'merge' ou 'update').
+    Um item também pode ser uma lista de operações, que nunca é dividida entre batches
+    (ex.: a alteração de um agendamento, a sua agenda diária e o seu evento de auditoria).
+    """
+    batch, size = db_instance.batch(), 0
+    for item in operations:
+        group = item if isinstance(item, list) else [item]
+        if size and size + len(group) > SERIES_BATCH_SIZE:
+            batch.commit()
+            batch, size = db_instance.batch(), 0
+        for operation, doc_ref, data in group:
+            if operation == 'set':
+                batch.set(doc_ref, data)
+            elif operation == 'merge':
+                batch.set(doc_ref, data, merge=True)
+            else:
+                batch.update(doc_ref, data)
+        size += len(group)
+    if size:
+        batch.commit()
+
+def _raise_if_conflicts(db_instance, clinica_id, profissional_id, occurrences, ignore_ids=()):
+    ativos = [o for o in occurrences if occupies_schedule(o)]
+    conflitos = find_series_conflicts(db_instance, clinica_id, profissional_id,
+                                      [appointment_interval(o) for o in ativos], ignore_ids=ignore_ids)
+    if conflitos:
+        datas = ", ".join(sorted({c['inicio'].strftime('%d/%m/%Y %H:%M') for c in conflitos}))
+        raise BookingConflictError(f"O profissional já possui atendimentos em {datas}.", conflitos)
+
+
+# --- Materialização ---
+
+def _materialize(db_instance, clinica_id, serie_ref, serie_data, until, notify=False):
+    """Grava as ocorrências virtuais da série até 'until'. Retorna quantas foram gravadas."""
+    materializado_ate = _materialized_until(serie_data)
+    until = min(until, datetime.date.fromisoformat(serie_data['data_fim']))
+    if until <= materializado_ate:
+        return 0
+    dates = expand_dates(parse_rrule(serie_data['rrule']), datetime.date.fromisoformat(serie_data['data_inicio']),
+                         until, a_partir_de=materializado_ate + datetime.timedelta(days=1))
+    agendamentos_ref = _agendamentos_ref(db_instance, clinica_id)
+    operations, novas = [], []
+    for day in dates:
+        data = build_occurrence(serie_ref.id, serie_data, day, notify=notify)
+        novas.append((None, data))
+        operations.append([('set', agendamentos_ref.document(occurrence_id(serie_ref.id, day)), data)]
+                          + agenda_operations(db_instance, clinica_id, occurrence_id(serie_ref.id, day), depois=data))
+    # O marcador e os incrementos do cubo vão no último lote: se algo falhar antes, a próxima rodada
+    # regrava as mesmas IDs sem contar nada duas vezes
+    operations.append([('update', serie_ref, {'materializado_ate': until.isoformat()})]
+                      + cube_operations(db_instance, clinica_id, novas))
+    write_in_chunks(db_instance, operations)
+    invalidate_financial_report(clinica_id, *revenue_months(*(data for _, data in novas)))
+    return len(dates)
+
+def materialize_until(db_instance, clinica_id, serie_id, until):
+    """Materializa a série até 'until' (inclusive). Retorna quantas ocorrências foram gravadas."""
+    serie_ref = _series_ref(db_instance, clinica_id).document(serie_id)
+    serie_doc = serie_ref.get()
+    if not serie_doc.exists or not (serie_doc.to_dict() or {}).get('ativa', True):
+        return 0
+    return _materialize(db_instance, clinica_id, serie_ref, serie_doc.to_dict(), until)
+
+def load_occurrence(db_instance, clinica_id, agendamento_id):
+    """
+    Dados do agendamento; se o ID for de uma ocorrência virtual, a série é materializada
+    até ela antes da leitura. Retorna None se o agendamento não existir.
+    """
+    doc_ref = _agendamentos_ref(db_instance, clinica_id).document(agendamento_id)
+    data = doc_ref.get().to_dict()
+    if data:
+        return data
+    serie_id, separator, day_str = agendamento_id.rpartition('_')
+    if not separator:
+        return None
+    try:
+        day = datetime.datetime.strptime(day_str, '%Y%m%d').date()
+    except ValueError:
+        return None
+    if materialize_until(db_instance, clinica_id, serie_id, day):
+        return doc_ref.get().to_dict()
+    return None
+
+register_query('series.rolagem', 'clinicas/{clinica_id}/series_agendamentos', equality=('ativa',))
+
+def roll_series(db_instance, clinica_id, progress_callback=None):
+    """
+    Avança o horizonte de materialização de todas as séries ativas da clínica e desativa as que
+    já terminaram e estão inteiramente materializadas (não têm mais ocorrências virtuais), para
+    que virtual_occurrences e esta rolagem não as leiam de novo.
+    Retorna {'series': quantidade avançada, 'ocorrencias': quantidade gravada, 'encerradas': quantidade desativada}.
+    """
+    hoje = datetime.datetime.now(SAO_PAULO_TZ).date()
+    limite = horizon_end(hoje)
+    pendentes, encerradas = [], []
+    for doc in _series_ref(db_instance, clinica_id).where(filter=FieldFilter('ativa', '==', True)).stream():
+        serie_data = doc.to_dict() or {}
+        try:
+            data_fim = datetime.date.fromisoformat(serie_data['data_fim'])
+            if _materialized_until(serie_data) < min(limite, data_fim):
+                pendentes.append((doc.reference, serie_data))
+            # Com data_fim no passado, a rolagem abaixo materializa a série até o fim
+            if data_fim < hoje:
+                encerradas.append(doc.reference)
+        except (KeyError, ValueError, TypeError) as e:
+            print(f"Série {doc.id} ignorada na rolagem do horizonte: {e}")
+
+    total = 0
+    for index, (serie_ref, serie_data) in enumerate(pendentes):
+        total += _materialize(db_instance, clinica_id, serie_ref, serie_data, limite)
+        if serie_data.get('profissional_id'):
+            invalidate_availability(clinica_id, serie_data['profissional_id'])
+        if progress_callback:
+            progress_callback(index + 1, len(pendentes))
+    write_in_chunks(db_instance, [('update', serie_ref, {'ativa': False, 'atualizado_em': firestore.SERVER_TIMESTAMP})
+                                  for serie_ref in encerradas])
+    return {'series': len(pendentes), 'ocorrencias': total, 'encerradas': len(encerradas)}
+
+def schedule_series_roll(db_instance, clinica_id, force=False):
+    """
+    Agenda roll_series em segundo plano, no máximo uma vez a cada ROLAGEM_INTERVALO_SEGUNDOS
+    por clínica (a menos que force=True). Retorna o job_id ou None se não foi necessário.
+    """
+    now = time.monotonic()
+    with _ultima_rolagem_lock:
+        if not force and now - _ultima_rolagem.get(clinica_id, float('-inf')) < ROLAGEM_INTERVALO_SEGUNDOS:
+            return None
+        _ultima_rolagem[clinica_id] = now
+    return start_background_job('Materialização de séries de agendamentos', roll_series, db_instance, clinica_id,
+                                clinica_id=clinica_id)
+
+
+# --- Operações ---
+
+def create_series(db_instance, clinica_id, serie_data, frequencia, dias_semana, data_inicio, data_fim):
+    """
+    Cria uma série e grava as ocorrências até o horizonte de materialização (as demais ficam virtuais).
+    serie_data: campos comuns (paciente, profissional, serviço, hora_agendamento, duracao_minutos, status...).
+    Recusa a série inteira com BookingConflictError se alguma ocorrência, até data_fim, conflitar.
+    Retorna (serie_id, quantidade total de ocorrências).
+    """
+    rrule = build_rrule(frequencia, dias_semana, data_inicio, data_fim)
+    dates = expand_dates(parse_rrule(rrule), data_inicio, data_fim)
+    if not dates:
+        return None, 0
+
+    serie_id = uuid.uuid4().hex
+    occurrences = [(day, build_occurrence(serie_id, serie_data, day)) for day in dates]
+    _raise_if_conflicts(db_instance, clinica_id, serie_data['profissional_id'], [o for _, o in occurrences])
+
+    materializado_ate = max(min(data_fim, horizon_end()), data_inicio - datetime.timedelta(days=1))
+    serie_doc = dict(serie_data, **{
+        'rrule': rrule,
+        'frequencia': frequencia,
+        'dias_semana': sorted(set(dias_semana)),
+        'data_inicio': data_inicio.isoformat(),
+        'data_fim': data_fim.isoformat(),
+        'materializado_ate': materializado_ate.isoformat(),
+        'total_ocorrencias': len(dates),
+        'ativa': True,
+        'criado_em': firestore.SERVER_TIMESTAMP,
+        'atualizado_em': firestore.SERVER_TIMESTAMP,
+    })
+    agendamentos_ref = _agendamentos_ref(db_instance, clinica_id)
+    operations = [('set', _series_ref(db_instance, clinica_id).document(serie_id), serie_doc)]
+    operations += [[('set', agendamentos_ref.document(occurrence_id(serie_id, day)), data),
+                    audit_operation(db_instance, clinica_id, occurrence_id(serie_id, day), 'novo_agendamento',
+                                    data['detalhes_alteracao'], depois=data, origem='serie', serie_id=serie_id)]
+                   + agenda_operations(db_instance, clinica_id, occurrence_id(serie_id, day), depois=data)
+                   for day, data in occurrences if day <= materializado_ate]
+    operations.append(cube_operations(db_instance, clinica_id, [(None, data) for day, data in occurrences
+                                                                if day <= materializado_ate]))
+    write_in_chunks(db_instance, operations)
+    invalidate_availability(clinica_id, serie_data['profissional_id'])
+    invalidate_financial_report(clinica_id, *revenue_months(*(data for day, data in occurrences if day <= materializado_ate)))
+    return serie_id, len(dates)
+
+register_query('series.ocorrencias_a_partir', 'clinicas/{clinica_id}/agendamentos',
+               equality=('serie_id',), range_fields=('data_agendamento',))
+
+def load_occurrences_from(db_instance, clinica_id, serie_id, from_date):
+    """Ocorrências materializadas (não excluídas) da série a partir de from_date, numa única consulta."""
+    query = _agendamentos_ref(db_instance, clinica_id)\
+        .where(filter=FieldFilter('serie_id', '==', serie_id))\
+        .where(filter=FieldFilter('data_agendamento', '>=', from_date.isoformat()))
+    return [doc for doc in query.stream() if (doc.to_dict() or {}).get('status') != 'excluido']
+
+def _get_series(db_instance, clinica_id, serie_id):
+    serie_doc = _series_ref(db_instance, clinica_id).document(serie_id).get()
+    if not serie_doc.exists:
+        raise Exception("Série de agendamentos não encontrada.")
+    return serie_doc
+
+def edit_series_from(db_instance, clinica_id, serie_id, from_date, changes):
+    """
+    Aplica 'changes' (hora, profissional, serviço, preço, duração, status...) a esta e às
+    próximas ocorrências da série. Se from_date não é o início da série, ela é dividida:
+    a original termina na véspera e as ocorrências seguintes passam para uma nova série.
+    As ocorrências virtuais seguem o documento da série e não precisam ser regravadas.
+    Retorna a quantidade de ocorrências materializadas alteradas.
+    """
+    serie_doc = _get_series(db_instance, clinica_id, serie_id)
+    serie_data = serie_doc.to_dict() or {}
+    changes = {k: v for k, v in changes.items() if k in _CAMPOS_DA_OCORRENCIA}
+    occurrence_docs = load_occurrences_from(db_instance, clinica_id, serie_id, from_date)
+    materializado_ate = _materialized_until(serie_data)
+
+    series_ref = _series_ref(db_instance, clinica_id)
+    operations = []
+    target_serie_id = serie_id
+    data_inicio = datetime.date.fromisoformat(serie_data['data_inicio'])
+    nova_serie = dict(serie_data, **changes)
+    if from_date > data_inicio:
+        # Divide a série: a original termina na véspera
+        target_serie_id = uuid.uuid4().hex
+        vespera = from_date - datetime.timedelta(days=1)
+        operations.append(('update', serie_doc.reference, {
+            'data_fim': vespera.isoformat(),
+            'rrule': replace_until(serie_data['rrule'], vespera),
+            'materializado_ate': min(materializado_ate, vespera).isoformat(),
+            'atualizado_em': firestore.SERVER_TIMESTAMP,
+        }))
+        nova_serie.update({
+            'data_inicio': from_date.isoformat(),
+            'materializado_ate': max(materializado_ate, vespera).isoformat(),
+            'serie_origem_id': serie_id,
+            'criado_em': firestore.SERVER_TIMESTAMP,
+            'atualizado_em': firestore.SERVER_TIMESTAMP,
+        })
+        operations.append(('set', series_ref.document(target_serie_id), nova_serie))
+    else:
+        operations.append(('update', serie_doc.reference, dict(changes, atualizado_em=firestore.SERVER_TIMESTAMP)))
+
+    updated = []
+    for doc in occurrence_docs:
+        original = doc.to_dict() or {}
+        update = dict(changes, serie_id=target_serie_id, atualizado_em=firestore.SERVER_TIMESTAMP, notificacao_pendente=True,
+                      notificacao_proxima_tentativa=firestore.SERVER_TIMESTAMP)
+        if original.get('status') == 'cancelado' and changes.get('status') != 'cancelado':
+            update.pop('status', None)  # Ocorrências canceladas isoladamente continuam canceladas
+        day = datetime.date.fromisoformat(original['data_agendamento'])
+        if 'hora_agendamento' in changes:
+            update['data_agendamento_ts'] = _occurrence_timestamp(day, changes['hora_agendamento'])
+        if changes.get('status') == 'cancelado':
+            update['tipo_alteracao'] = 'cancelado'
+            update['detalhes_alteracao'] = f"Agendamento de {original.get('paciente_nome', 'N/A')} para {day.strftime('%d/%m/%Y')} às {original.get('hora_agendamento', 'N/A')} foi CANCELADO."
+        elif changes.get('hora_agendamento', original.get('hora_agendamento')) != original.get('hora_agendamento'):
+            update['tipo_alteracao'] = 'reagendado'
+            update['detalhes_alteracao'] = f"Agendamento de {original.get('paciente_nome', 'N/A')} reagendado de {day.strftime('%d/%m/%Y')} às {original.get('hora_agendamento', 'N/A')} para {day.strftime('%d/%m/%Y')} às {changes['hora_agendamento']}."
+        else:
+            update['tipo_alteracao'] = 'atualizado'
+            update['detalhes_alteracao'] = 'Agendamento recorrente atualizado (esta e as próximas ocorrências).'
+        updated.append((doc, original, update))
+
+    # Conflitos: as ocorrências materializadas e as virtuais com os novos dados, ignorando a própria série
+    merged = [dict(original, **update) for _, original, update in updated]
+    virtual_dates = expand_dates(parse_rrule(serie_data['rrule']), data_inicio, datetime.date.fromisoformat(serie_data['data_fim']),
+                                 a_partir_de=max(from_date, materializado_ate + datetime.timedelta(days=1)))
+    merged += [build_occurrence(target_serie_id, nova_serie, day, notify=False) for day in virtual_dates]
+    ignore_ids = [doc.id for doc, _, _ in updated] + [occurrence_id(serie_id, day) for day in virtual_dates]
+    profissionais = {m.get('profissional_id') for m in merged if m.get('profissional_id')}
+    for profissional_id in profissionais:
+        _raise_if_conflicts(db_instance, clinica_id, profissional_id,
+                            [m for m in merged if m.get('profissional_id') == profissional_id],
+                            ignore_ids=ignore_ids)
+
+    operations += [[('update', doc.reference, update),
+                    audit_operation(db_instance, clinica_id, doc.id, update['tipo_alteracao'], update['detalhes_alteracao'],
+                                    antes=original, depois=update, origem='serie', serie_id=target_serie_id)]
+                   + agenda_operations(db_instance, clinica_id, doc.id, original, dict(original, **update))
+                   for doc, original, update in updated]
+    operations.append(cube_operations(db_instance, clinica_id,
+                                      [(original, dict(original, **update)) for _, original, update in updated]))
+    write_in_chunks(db_instance, operations)
+    for profissional_id in profissionais | {serie_data.get('profissional_id')}:
+        if profissional_id:
+            invalidate_availability(clinica_id, profissional_id)
+    invalidate_financial_report(clinica_id, *revenue_months(*(agendamento for _, original, update in updated
+                                                              for agendamento in (original, dict(original, **update)))))
+    return len(updated)
+
+def cancel_series_from(db_instance, clinica_id, serie_id, from_date):
+    """
+    Cancela esta e as próximas ocorrências da série. A série passa a terminar na véspera
+    (ou é desativada, se o cancelamento começa no início), o que também descarta as
+    ocorrências virtuais. Retorna a quantidade de ocorrências materializadas canceladas.
+    """
+    serie_doc = _get_series(db_instance, clinica_id, serie_id)
+    serie_data = serie_doc.to_dict() or {}
+    occurrence_docs = load_occurrences_from(db_instance, clinica_id, serie_id, from_date)
+
+    vespera = from_date - datetime.timedelta(days=1)
+    if from_date > datetime.date.fromisoformat(serie_data['data_inicio']):
+        serie_update = {
+            'data_fim': vespera.isoformat(),
+            'rrule': replace_until(serie_data['rrule'], vespera),
+            'materializado_ate': min(_materialized_until(serie_data), vespera).isoformat(),
+        }
+    else:
+        serie_update = {'ativa': False}
+    serie_update['atualizado_em'] = firestore.SERVER_TIMESTAMP
+    operations = [('update', serie_doc.reference, serie_update)]
+    canceladas = []
+
+    for doc in occurrence_docs:
+        original = doc.to_dict() or {}
+        if original.get('status') == 'cancelado':
+            continue
+        update = {
+            'status': 'cancelado',
+            'atualizado_em': firestore.SERVER_TIMESTAMP,
+            'notificacao_pendente': True,
+            'notificacao_proxima_tentativa': firestore.SERVER_TIMESTAMP,
+            'tipo_alteracao': 'cancelado',
+            'detalhes_alteracao': f"Agendamento de {original.get('paciente_nome', 'N/A')} para {original.get('data_agendamento', 'N/A')} às {original.get('hora_agendamento', 'N/A')} foi CANCELADO.",
+        }
+        operations.append([('update', doc.reference, update),
+                           audit_operation(db_instance, clinica_id, doc.id, 'cancelado', update['detalhes_alteracao'],
+                                           antes=original, depois=update, origem='serie', serie_id=serie_id)]
+                          + agenda_operations(db_instance, clinica_id, doc.id, original, dict(original, **update)))
+        canceladas.append((original, dict(original, **update)))
+    write_in_chunks(db_instance, operations + [cube_operations(db_instance, clinica_id, canceladas)])
+    if serie_data.get('profissional_id'):
+        invalidate_availability(clinica_id, serie_data['profissional_id'])
+    invalidate_financial_report(clinica_id, *revenue_months(*(original for original, _ in canceladas)))
+    return len(canceladas)
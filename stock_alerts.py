@@ -0,0 +1,209 @@
+import datetime
+import threading
+import time
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ, start_background_job
+from query_registry import register_query
+from stock_ledger import ESTOQUE_BATCH_SIZE, normalize_name, refresh_stock_flags
+
+# =================================================================
+# ALERTAS DE ESTOQUE
+# =================================================================
+#
+# Cada produto guarda campos desnormalizados que tornam os alertas consultas indexadas:
+#   - abaixo_minimo: saldo <= estoque mínimo (mantido pelo livro a cada movimentação);
+#   - vence_em: validade do primeiro lote aberto (mantida pelo livro, ordenável por intervalo);
+#   - nome_busca: nome normalizado, para a busca por prefixo.
+# Uma tarefa diária grava em estoque_alertas/vencimentos os lotes abertos vencidos e a vencer em
+# ALERTA_VENCIMENTO_DIAS dias, com a quantidade de cada lote; a contagem exibida no menu fica em cache por clínica.
+
+# Janela (dias) da lista de produtos a vencer
+ALERTA_VENCIMENTO_DIAS = 30
+
+# Intervalo mínimo (segundos) entre dois cálculos automáticos dos vencimentos de uma clínica
+ALERTAS_INTERVALO_SEGUNDOS = 24 * 3600
+
+# Tempo (segundos) em que a contagem de alertas de uma clínica fica em cache
+ALERTAS_CONTAGEM_TTL = 120
+
+# Máximo de produtos guardados em cada lista do documento de vencimentos
+ALERTAS_MAX_ITENS = 500
+
+# Versão dos campos desnormalizados; produtos gravados antes dela são atualizados uma vez pela tarefa diária
+ALERTAS_CAMPOS_VERSAO = 2
+
+_contagens = {}
+_contagens_lock = threading.Lock()
+
+_ultimo_calculo = {}
+_ultimo_calculo_lock = threading.Lock()
+
+register_query('estoque.produtos_vencidos_ativos', 'clinicas/{clinica_id}/estoque_produtos',
+               equality=('ativo',), range_fields=('vence_em',))
+register_query('estoque.lotes_a_vencer', 'lotes', collection_group=True,
+               equality=('clinica_id', 'esgotado'), range_fields=('data_validade',), order_by=('data_validade',))
+register_query('estoque.alertas_estoque_baixo', 'clinicas/{clinica_id}/estoque_produtos',
+               equality=('ativo', 'abaixo_minimo'))
+
+
+def _produtos_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('estoque_produtos')
+
+def _vencimentos_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('estoque_alertas').document('vencimentos')
+
+def start_of_day(dia):
+    """Meia-noite (São Paulo) do dia, no formato gravado em data_validade/vence_em."""
+    return SAO_PAULO_TZ.localize(datetime.datetime.combine(dia, datetime.time.min))
+
+def catalog_fields(nome):
+    """Campos de busca gravados ao cadastrar ou editar um produto."""
+    return {'nome_busca': normalize_name(nome)}
+
+def _lotes_abertos(db_instance, clinica_id):
+    return db_instance.collection_group('lotes').where(filter=FieldFilter('clinica_id', '==', clinica_id))\
+        .where(filter=FieldFilter('esgotado', '==', False))
+
+def search_bounds(search_query):
+    """Intervalo [início, fim] de nome_busca que corresponde aos nomes iniciados por search_query."""
+    chave = normalize_name(search_query)
+    return chave, chave + '\uf8ff'
+
+def alert_counts(db_instance, clinica_id):
+    """
+    Quantidade de produtos ativos com estoque baixo e vencidos e de lotes abertos vencidos, por contagens
+    indexadas e com cache de ALERTAS_CONTAGEM_TTL por clínica: {'estoque_baixo', 'vencidos', 'lotes_vencidos', 'total'}.
+    """
+    now = time.monotonic()
+    with _contagens_lock:
+        entry = _contagens.get(clinica_id)
+        if entry and entry[0] > now:
+            return entry[1]
+
+    produtos_ref = _produtos_ref(db_instance, clinica_id)
+    hoje = start_of_day(datetime.datetime.now(SAO_PAULO_TZ).date())
+    estoque_baixo = produtos_ref.where(filter=FieldFilter('ativo', '==', True))\
+        .where(filter=FieldFilter('abaixo_minimo', '==', True)).count().get()[0][0].value
+    vencidos = produtos_ref.where(filter=FieldFilter('ativo', '==', True))\
+        .where(filter=FieldFilter('vence_em', '<', hoje)).count().get()[0][0].value
+    lotes_vencidos = _lotes_abertos(db_instance, clinica_id)\
+        .where(filter=FieldFilter('data_validade', '<', hoje)).count().get()[0][0].value
+    counts = {'estoque_baixo': estoque_baixo, 'vencidos': vencidos, 'lotes_vencidos': lotes_vencidos,
+              'total': estoque_baixo + vencidos}
+    with _contagens_lock:
+        _contagens[clinica_id] = (now + ALERTAS_CONTAGEM_TTL, counts)
+    return counts
+
+def invalidate_alert_counts(clinica_id):
+    """Descarta a contagem em cache após movimentações ou alterações de produtos."""
+    with _contagens_lock:
+        _contagens.pop(clinica_id, None)
+
+def backfill_alert_fields(db_instance, clinica_id, progress_callback=None):
+    """
+    Atualiza os produtos gravados antes da versão atual dos alertas: grava nome_busca onde falta e
+    recalcula abaixo_minimo e vence_em (o que também registra como lote o saldo sem lote).
+    Retorna a quantidade de produtos atualizados.
+    """
+    produtos = list(_produtos_ref(db_instance, clinica_id).select(['nome', 'nome_busca']).stream())
+    sem_busca = []
+    for doc in produtos:
+        produto = doc.to_dict() or {}
+        campos = catalog_fields(produto.get('nome'))
+        if produto.get('nome_busca') != campos['nome_busca']:
+            sem_busca.append((doc.reference, campos))
+    for start in range(0, len(sem_busca), ESTOQUE_BATCH_SIZE):
+        batch = db_instance.batch()
+        for ref, campos in sem_busca[start:start + ESTOQUE_BATCH_SIZE]:
+            batch.update(ref, campos)
+        batch.commit()
+
+    atualizados = {ref.id for ref, _ in sem_busca}
+    for index, doc in enumerate(produtos):
+        if refresh_stock_flags(db_instance, clinica_id, [doc.id]):
+            atualizados.add(doc.id)
+        if progress_callback:
+            progress_callback(index + 1, len(produtos))
+    return len(atualizados)
+
+def _alert_item(lote, produto, hoje):
+    vence_em = lote['data_validade']
+    return {
+        'id': lote['produto_id'],
+        'lote_id': lote['id'],
+        'nome': produto.get('nome', 'N/A'),
+        'marca': lote.get('marca'),
+        'quantidade_atual': lote.get('quantidade_atual', 0),
+        'estoque_minimo': produto.get('estoque_minimo', 0),
+        'unidade_medida': produto.get('unidade_medida'),
+        'vence_em': vence_em,
+        'dias_restantes': (vence_em.astimezone(SAO_PAULO_TZ).date() - hoje).days,
+    }
+
+def precompute_expiry_alerts(db_instance, clinica_id, dias=ALERTA_VENCIMENTO_DIAS, progress_callback=None):
+    """
+    Grava em estoque_alertas/vencimentos os lotes abertos de produtos ativos que estão vencidos ou vencem
+    nos próximos 'dias' dias (uma consulta por intervalo em data_validade nos lotes), com a quantidade de
+    cada lote. Na primeira execução de uma versão dos alertas, atualiza antes os campos dos produtos.
+    Retorna {'vencidos', 'a_vencer'} (quantidades de lotes).
+    """
+    resumo_ref = _vencimentos_ref(db_instance, clinica_id)
+    resumo = resumo_ref.get(field_paths=['campos_versao'])
+    if (resumo.to_dict() or {}).get('campos_versao', 0) < ALERTAS_CAMPOS_VERSAO:
+        backfill_alert_fields(db_instance, clinica_id, progress_callback)
+
+    hoje = datetime.datetime.now(SAO_PAULO_TZ).date()
+    limite = start_of_day(hoje + datetime.timedelta(days=dias + 1))
+    query = _lotes_abertos(db_instance, clinica_id).where(filter=FieldFilter('data_validade', '<', limite))\
+        .order_by('data_validade').select(['produto_id', 'marca', 'quantidade_atual', 'data_validade'])
+    lotes = [dict(doc.to_dict() or {}, id=doc.id) for doc in query.stream()]
+
+    produtos = {}
+    refs = [_produtos_ref(db_instance, clinica_id).document(produto_id) for produto_id in {lote['produto_id'] for lote in lotes}]
+    if refs:
+        for doc in db_instance.get_all(refs, field_paths=['nome', 'estoque_minimo', 'unidade_medida', 'ativo']):
+            if doc.exists:
+                produtos[doc.id] = doc.to_dict() or {}
+
+    vencidos, a_vencer = [], []
+    for lote in lotes:
+        produto = produtos.get(lote['produto_id'])
+        if not produto or not produto.get('ativo', False):
+            continue
+        item = _alert_item(lote, produto, hoje)
+        (vencidos if item['dias_restantes'] < 0 else a_vencer).append(item)
+
+    resumo_ref.set({
+        'referencia': hoje.isoformat(),
+        'dias': dias,
+        'vencidos': vencidos[:ALERTAS_MAX_ITENS],
+        'a_vencer': a_vencer[:ALERTAS_MAX_ITENS],
+        'total_vencidos': len(vencidos),
+        'total_a_vencer': len(a_vencer),
+        'quantidade_vencida': sum(item['quantidade_atual'] for item in vencidos),
+        'quantidade_a_vencer': sum(item['quantidade_atual'] for item in a_vencer),
+        'campos_versao': ALERTAS_CAMPOS_VERSAO,
+        'gerado_em': firestore.SERVER_TIMESTAMP,
+    })
+    invalidate_alert_counts(clinica_id)
+    return {'vencidos': len(vencidos), 'a_vencer': len(a_vencer)}
+
+def get_expiry_alerts(db_instance, clinica_id):
+    """Documento de vencimentos pré-calculado (ou None se ainda não foi gerado)."""
+    doc = _vencimentos_ref(db_instance, clinica_id).get()
+    return doc.to_dict() if doc.exists else None
+
+def schedule_stock_alerts(db_instance, clinica_id, force=False):
+    """
+    Agenda precompute_expiry_alerts em segundo plano, no máximo uma vez a cada ALERTAS_INTERVALO_SEGUNDOS
+    por clínica (a menos que force=True). Retorna o job_id ou None se não foi necessário.
+    """
+    now = time.monotonic()
+    with _ultimo_calculo_lock:
+        if not force and now - _ultimo_calculo.get(clinica_id, float('-inf')) < ALERTAS_INTERVALO_SEGUNDOS:
+            return None
+        _ultimo_calculo[clinica_id] = now
+    return start_background_job('Alertas de vencimento do estoque', precompute_expiry_alerts, db_instance, clinica_id,
+                                clinica_id=clinica_id)
@@ -0,0 +1,161 @@
+import datetime
+from collections import defaultdict
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ
+from query_registry import register_query
+from stock_ledger import ESTOQUE_BATCH_SIZE, consumo_mensal_ref, month_key, normalize_name
+
+# =================================================================
+# HISTÓRICO DE MOVIMENTAÇÕES DE ESTOQUE
+# =================================================================
+#
+# O histórico é lido em janelas de datas (data_movimentacao), da mais recente para a mais antiga,
+# em páginas com cursor (id do último lançamento exibido). O filtro por produto usa produto_id
+# (igualdade ou 'in'), resolvido a partir do nome no índice de produtos, em vez de um intervalo
+# em produto_nome combinado com a ordenação por data.
+# Os totais mensais de entrada e saída de cada produto (estoque_consumo_mensal, mantidos pelo livro
+# a cada movimentação) alimentam o gráfico de consumo sem ler os lançamentos.
+
+HISTORICO_POR_PAGINA = 50
+HISTORICO_LIMITE_MAXIMO = 200
+
+# Janela padrão e máxima (dias) de uma consulta ao histórico
+HISTORICO_JANELA_PADRAO_DIAS = 30
+HISTORICO_JANELA_MAXIMA_DIAS = 366
+
+# Meses exibidos no gráfico de consumo (padrão e máximo)
+CONSUMO_MESES_PADRAO = 12
+CONSUMO_MESES_MAXIMO = 36
+
+# Limite de valores do filtro 'in' do Firestore
+HISTORICO_PRODUTOS_MAX = 30
+
+register_query('estoque.historico', 'clinicas/{clinica_id}/estoque_movimentacoes',
+               equality=('tipo_movimentacao', 'produto_id'), range_fields=('data_movimentacao',),
+               order_by=(('data_movimentacao', 'DESCENDING'),), optional=('tipo_movimentacao', 'produto_id'))
+register_query('estoque.consumo_mensal', 'clinicas/{clinica_id}/estoque_consumo_mensal',
+               equality=('produto_id',), range_fields=('mes',), optional=('produto_id',))
+
+
+def _movimentacoes_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('estoque_movimentacoes')
+
+def _consumo_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id).collection('estoque_consumo_mensal')
+
+def matching_products(index, search_query):
+    """
+    Ids dos produtos cujo nome começa com search_query (sem acentos e maiúsculas), no máximo
+    HISTORICO_PRODUTOS_MAX. Retorna (ids, truncado).
+    """
+    prefixo = normalize_name(search_query)
+    ids = sorted(produto_id for produto_id, produto in index['por_id'].items()
+                 if normalize_name(produto['nome']).startswith(prefixo))
+    return ids[:HISTORICO_PRODUTOS_MAX], len(ids) > HISTORICO_PRODUTOS_MAX
+
+def history_page(db_instance, clinica_id, inicio, fim, tipo=None, produto_ids=None, limit=HISTORICO_POR_PAGINA, cursor=None):
+    """
+    Lançamentos entre as datas inicio e fim (inclusive), do mais recente para o mais antigo, filtrados
+    opcionalmente por tipo e produtos. 'cursor' é o id do último lançamento da página anterior.
+    Retorna (lançamentos como dicionários com 'id', cursor da próxima página ou None).
+    """
+    limit = max(1, min(int(limit or HISTORICO_POR_PAGINA), HISTORICO_LIMITE_MAXIMO))
+    movimentacoes_ref = _movimentacoes_ref(db_instance, clinica_id)
+    inicio_dt = SAO_PAULO_TZ.localize(datetime.datetime.combine(inicio, datetime.time.min))
+    fim_dt = SAO_PAULO_TZ.localize(datetime.datetime.combine(fim + datetime.timedelta(days=1), datetime.time.min))
+
+    query = movimentacoes_ref.where(filter=FieldFilter('data_movimentacao', '>=', inicio_dt))\
+        .where(filter=FieldFilter('data_movimentacao', '<', fim_dt))
+    if tipo:
+        query = query.where(filter=FieldFilter('tipo_movimentacao', '==', tipo))
+    if produto_ids:
+        if len(produto_ids) == 1:
+            query = query.where(filter=FieldFilter('produto_id', '==', produto_ids[0]))
+        else:
+            query = query.where(filter=FieldFilter('produto_id', 'in', list(produto_ids)))
+    query = query.order_by('data_movimentacao', direction=firestore.Query.DESCENDING)
+    if cursor:
+        cursor_doc = movimentacoes_ref.document(cursor).get()
+        if not cursor_doc.exists:
+            raise ValueError("Movimentação de referência não encontrada.")
+        query = query.start_after(cursor_doc)
+
+    # Um documento a mais indica se há uma próxima página
+    docs = list(query.limit(limit + 1).stream())
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    return [dict(doc.to_dict() or {}, id=doc.id) for doc in docs], (docs[-1].id if has_more else None)
+
+def month_range(ultimo, meses):
+    """Lista de 'meses' meses (AAAA-MM) terminando no mês da data 'ultimo', em ordem cronológica."""
+    ano, mes = ultimo.year, ultimo.month
+    chaves = []
+    for _ in range(meses):
+        chaves.append(f'{ano:04d}-{mes:02d}')
+        ano, mes = (ano, mes - 1) if mes > 1 else (ano - 1, 12)
+    return list(reversed(chaves))
+
+def monthly_totals(db_instance, clinica_id, meses, produto_id=None):
+    """
+    Entradas e saídas por mês, lidas dos totais mensais: [{mes, entrada, saida}] para cada mês de
+    'meses' (AAAA-MM, em ordem), de um produto ou somando todos.
+    """
+    if not meses:
+        return []
+    query = _consumo_ref(db_instance, clinica_id)
+    if produto_id:
+        query = query.where(filter=FieldFilter('produto_id', '==', produto_id))
+    query = query.where(filter=FieldFilter('mes', '>=', meses[0])).where(filter=FieldFilter('mes', '<=', meses[-1]))\
+        .select(['mes', 'entrada', 'saida'])
+    totais = {mes: {'mes': mes, 'entrada': 0, 'saida': 0} for mes in meses}
+    for doc in query.stream():
+        data = doc.to_dict() or {}
+        if data.get('mes') in totais:
+            totais[data['mes']]['entrada'] += data.get('entrada') or 0
+            totais[data['mes']]['saida'] += data.get('saida') or 0
+    return [totais[mes] for mes in meses]
+
+def rebuild_monthly_totals(db_instance, clinica_id, progress_callback=None):
+    """
+    Recalcula estoque_consumo_mensal a partir dos lançamentos e grava o campo 'mes' nos lançamentos
+    antigos que não o têm. Totais de meses sem lançamentos são removidos.
+    Retorna {'movimentacoes', 'totais'} (quantidades processadas).
+    """
+    totais = defaultdict(lambda: {'entrada': 0, 'saida': 0, 'produto_nome': None})
+    sem_mes = []
+    movimentacoes = list(_movimentacoes_ref(db_instance, clinica_id)
+                         .select(['produto_id', 'produto_nome', 'tipo_movimentacao', 'quantidade', 'data_movimentacao', 'mes'])
+                         .stream())
+    for doc in movimentacoes:
+        mov = doc.to_dict() or {}
+        if not mov.get('produto_id') or not isinstance(mov.get('data_movimentacao'), datetime.datetime):
+            continue
+        mes = month_key(mov['data_movimentacao'])
+        if mov.get('mes') != mes:
+            sem_mes.append((doc.reference, mes))
+        total = totais[(mes, mov['produto_id'])]
+        total['produto_nome'] = mov.get('produto_nome') or total['produto_nome']
+        total['saida' if mov.get('tipo_movimentacao') == 'saida' else 'entrada'] += mov.get('quantidade') or 0
+
+    existentes = [doc.reference for doc in _consumo_ref(db_instance, clinica_id).select([]).stream()]
+    validos = {consumo_mensal_ref(db_instance, clinica_id, mes, produto_id).id for mes, produto_id in totais}
+    escritas = [('update', ref, {'mes': mes}) for ref, mes in sem_mes]
+    escritas += [('set', consumo_mensal_ref(db_instance, clinica_id, mes, produto_id), {
+        'produto_id': produto_id, 'produto_nome': total['produto_nome'], 'mes': mes,
+        'entrada': total['entrada'], 'saida': total['saida'], 'atualizado_em': firestore.SERVER_TIMESTAMP,
+    }) for (mes, produto_id), total in totais.items()]
+    escritas += [('delete', ref, None) for ref in existentes if ref.id not in validos]
+
+    for start in range(0, len(escritas), ESTOQUE_BATCH_SIZE):
+        batch = db_instance.batch()
+        for operacao, ref, data in escritas[start:start + ESTOQUE_BATCH_SIZE]:
+            if operacao == 'delete':
+                batch.delete(ref)
+            else:
+                getattr(batch, operacao)(ref, data)
+        batch.commit()
+        if progress_callback:
+            progress_callback(min(start + ESTOQUE_BATCH_SIZE, len(escritas)), len(escritas))
+    return {'movimentacoes': len(movimentacoes), 'totais': len(totais)}
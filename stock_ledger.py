@@ -0,0 +1,786 @@
+import csv
+import datetime
+import heapq
+import io
+import itertools
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import SAO_PAULO_TZ, parse_date_input, start_background_job
+from query_registry import register_query
+from payables import create_payable
+from financial_reports import invalidate_financial_report
+
+# =================================================================
+# LIVRO DE MOVIMENTAÇÕES DE ESTOQUE
+# =================================================================
+#
+# Cada movimentação grava, de uma só vez, o saldo do produto (estoque_produtos/{id}.quantidade_atual),
+# o lançamento em estoque_movimentacoes e, se pedido, a conta em contas_a_pagar:
+#   - entrada: batch com firestore.Increment(+quantidade); não precisa ler o saldo, então
+#     entradas simultâneas nunca se sobrescrevem;
+#   - saída: transação que lê o saldo, recusa a saída se ele ficaria negativo e aplica
+#     firestore.Increment(-quantidade).
+# O saldo é dividido em lotes (estoque_produtos/{id}/lotes): cada entrada cria um lote com sua validade
+# (data_vencimento da movimentação) e marca, e cada saída consome os lotes abertos na ordem FEFO
+# (primeiro a vencer, primeiro a sair) por meio de um LotIndex carregado uma vez por transação.
+# Os lançamentos registram os lotes afetados em 'lotes' e 'lotes_ids' (histórico por lote) e o mês
+# em 'mes'; cada movimentação também soma sua quantidade ao total mensal do produto em
+# estoque_consumo_mensal/{AAAA-MM}_{produto_id}, usado no gráfico de consumo sem ler os lançamentos.
+# Movimentações em lote (API e importação de CSV/XLSX) são validadas contra um índice de produtos
+# em cache e gravadas em batches; produtos com saídas no lote usam uma transação por produto.
+# Toda movimentação mantém os campos desnormalizados 'abaixo_minimo' e 'vence_em' (validade do primeiro
+# lote aberto) do produto: as saídas os calculam na própria transação; depois das entradas,
+# refresh_stock_flags() os reconfere nos produtos que estavam abaixo do mínimo ou ganharam um lote mais próximo.
+# O livro (estoque_movimentacoes) é a fonte da verdade: reconcile_stock() recalcula os saldos a
+# partir dele e marca em 'divergencia_estoque' os produtos cujo saldo gravado diverge.
+
+TIPOS_MOVIMENTACAO = ('entrada', 'saida')
+
+# Limite de operações por batch na reconciliação (o Firestore aceita até 500)
+ESTOQUE_BATCH_SIZE = 400
+
+# Intervalo mínimo (segundos) entre duas reconciliações automáticas de uma clínica
+RECONCILIACAO_INTERVALO_SEGUNDOS = 24 * 3600
+
+# Linhas de movimentação gravadas por batch/transação no lote (cada linha grava até 4 documentos:
+# lançamento, lote, saldo do produto e total mensal)
+LOTE_LINHAS_POR_BATCH = ESTOQUE_BATCH_SIZE // 4
+
+# Id do lote que recebe o saldo de produtos movimentados antes do controle por lotes
+LOTE_SALDO_ANTERIOR_ID = 'saldo_anterior'
+
+# Chaves de ordenação FEFO: lotes sem validade saem por último; o saldo anterior sai antes dos lotes de mesma validade
+_SEM_VALIDADE = datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+_ORDEM_INICIAL = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+# Limite de linhas de uma movimentação em lote (requisição ou arquivo)
+LOTE_MAX_LINHAS = 5000
+
+# Tempo (segundos) em que o índice de produtos de uma clínica fica em cache
+PRODUTOS_INDICE_TTL = 300
+
+# Cabeçalhos aceitos na importação (normalizados) -> campo da linha
+_COLUNAS_IMPORTACAO = {
+    'produto_id': 'produto_id', 'id': 'produto_id',
+    'produto': 'produto', 'produto_nome': 'produto', 'nome': 'produto',
+    'tipo': 'tipo', 'tipo_movimentacao': 'tipo',
+    'quantidade': 'quantidade', 'qtd': 'quantidade',
+    'marca': 'marca',
+    'preco_total': 'preco_total', 'preco': 'preco_total', 'valor': 'preco_total',
+    'data_vencimento': 'data_vencimento', 'vencimento': 'data_vencimento', 'validade': 'data_vencimento',
+}
+
+_indice_produtos = {}
+_indice_produtos_lock = threading.Lock()
+
+_ultima_reconciliacao = {}
+_ultima_reconciliacao_lock = threading.Lock()
+
+
+class StockMovementError(Exception):
+    """Movimentação recusada: produto inexistente, tipo ou quantidade inválidos."""
+
+
+class InsufficientStockError(StockMovementError):
+    """Saída recusada porque deixaria o saldo do produto negativo."""
+
+    def __init__(self, message, disponivel):
+        super().__init__(message)
+        self.disponivel = disponivel
+
+
+def _clinica_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id)
+
+def produto_ref(db_instance, clinica_id, produto_id):
+    return _clinica_ref(db_instance, clinica_id).collection('estoque_produtos').document(produto_id)
+
+def _movimentacoes_ref(db_instance, clinica_id):
+    return _clinica_ref(db_instance, clinica_id).collection('estoque_movimentacoes')
+
+def lotes_ref(db_instance, clinica_id, produto_id):
+    return produto_ref(db_instance, clinica_id, produto_id).collection('lotes')
+
+def month_key(when):
+    """Mês (AAAA-MM, horário de Brasília) de um instante: campo 'mes' dos lançamentos e dos totais mensais."""
+    return when.astimezone(SAO_PAULO_TZ).strftime('%Y-%m')
+
+def consumo_mensal_ref(db_instance, clinica_id, mes, produto_id):
+    return _clinica_ref(db_instance, clinica_id).collection('estoque_consumo_mensal').document(f'{mes}_{produto_id}')
+
+def add_monthly_totals(writer, db_instance, clinica_id, produto_id, produto_nome, agora, entrada=0, saida=0):
+    """Soma as quantidades ao total mensal do produto, no mesmo batch/transação da movimentação."""
+    mes = month_key(agora)
+    writer.set(consumo_mensal_ref(db_instance, clinica_id, mes, produto_id), {
+        'produto_id': produto_id,
+        'produto_nome': produto_nome,
+        'mes': mes,
+        'entrada': firestore.Increment(entrada),
+        'saida': firestore.Increment(saida),
+        'atualizado_em': firestore.SERVER_TIMESTAMP,
+    }, merge=True)
+    if entrada:
+        invalidate_financial_report(clinica_id, mes)
+
+def movement_data(produto_id, produto_nome, tipo, quantidade, quantidade_apos=None, marca=None, preco_total=None,
+                  data_vencimento=None, criar_conta_pagar=False, usuario=None, agora=None, lotes=None):
+    """
+    Documento de estoque_movimentacoes. quantidade_apos só é conhecida nas saídas (lidas na transação);
+    lotes é a lista [{lote_id, quantidade, data_validade}] criada (entrada) ou consumida (saída).
+    """
+    agora = agora or datetime.datetime.now(SAO_PAULO_TZ)
+    data = {
+        'produto_id': produto_id,
+        'produto_nome': produto_nome,
+        'tipo_movimentacao': tipo,
+        'quantidade': quantidade,
+        'marca': marca or None,
+        'preco_total': preco_total or None,
+        'data_vencimento': data_vencimento or None,
+        'criar_conta_pagar': criar_conta_pagar,
+        'data_movimentacao': agora,
+        'mes': month_key(agora),
+        'usuario_responsavel': usuario or 'N/A',
+    }
+    if quantidade_apos is not None:
+        data['quantidade_apos_movimento'] = quantidade_apos
+    if lotes is not None:
+        data['lotes'] = lotes
+        data['lotes_ids'] = [lote['lote_id'] for lote in lotes]
+    return data
+
+def lot_data(clinica_id, produto_id, quantidade, data_validade=None, marca=None, movimentacao_id=None,
+             agora=None, origem='entrada'):
+    """Documento de estoque_produtos/{id}/lotes. Lotes sem validade não têm o campo data_validade."""
+    data = {
+        'clinica_id': clinica_id,
+        'produto_id': produto_id,
+        'quantidade_inicial': quantidade,
+        'quantidade_atual': quantidade,
+        'esgotado': quantidade <= 0,
+        'marca': marca or None,
+        'movimentacao_id': movimentacao_id,
+        'origem': origem,
+        'criado_em': agora or datetime.datetime.now(SAO_PAULO_TZ),
+    }
+    if data_validade:
+        data['data_validade'] = data_validade
+    return data
+
+def payable_data(produto_id, produto_nome, quantidade, preco_total, data_vencimento, usuario=None, agora=None):
+    """Conta a pagar gerada por uma entrada de estoque."""
+    return {
+        'descricao': f'Compra de estoque: {produto_nome} (Qtd: {quantidade})',
+        'produto_id': produto_id,
+        'produto_nome': produto_nome,
+        'valor': preco_total,
+        'data_vencimento': data_vencimento or None,
+        'status': 'pendente',
+        'data_lancamento': agora or datetime.datetime.now(SAO_PAULO_TZ),
+        'usuario_responsavel': usuario or 'N/A',
+    }
+
+def normalize_name(text):
+    """Minúsculas, sem acentos e com espaços simples (comparação de nomes, cabeçalhos e busca por prefixo)."""
+    text = unicodedata.normalize('NFKD', str(text or ''))
+    return ' '.join(''.join(c for c in text if not unicodedata.combining(c)).split()).casefold()
+
+def below_minimum(quantidade, estoque_minimo):
+    """Valor do campo desnormalizado 'abaixo_minimo' (saldo menor ou igual ao estoque mínimo)."""
+    return (quantidade or 0) <= (estoque_minimo or 0)
+
+register_query('estoque.lotes_abertos', 'clinicas/{clinica_id}/estoque_produtos/{produto_id}/lotes',
+               equality=('esgotado',))
+
+
+class LotIndex:
+    """
+    Lotes abertos de um produto numa heap ordenada por (validade, criação), carregada uma vez por
+    transação. consume() retira a quantidade na ordem FEFO; write() grava só os lotes alterados.
+    O saldo do produto não coberto por lotes (movimentado antes do controle por lotes) entra como o
+    lote LOTE_SALDO_ANTERIOR_ID, com a data_validade do cadastro do produto.
+    """
+
+    def __init__(self, clinica_id, produto_id, lotes_collection):
+        self.clinica_id = clinica_id
+        self.produto_id = produto_id
+        self._collection = lotes_collection
+        self._lotes = {}
+        self._heap = []
+        self._alterados = set()
+
+    @classmethod
+    def load(cls, transaction, db_instance, clinica_id, produto_id, produto, agora=None):
+        """produto: dados lidos na mesma transação (quantidade_atual e data_validade)."""
+        index = cls(clinica_id, produto_id, lotes_ref(db_instance, clinica_id, produto_id))
+        rastreado = 0
+        query = index._collection.where(filter=FieldFilter('esgotado', '==', False))
+        for snapshot in transaction.get(query):
+            lote = snapshot.to_dict() or {}
+            rastreado += lote.get('quantidade_atual', 0)
+            index._push(snapshot.id, lote)
+        sem_lote = produto.get('quantidade_atual', 0) - rastreado
+        if sem_lote > 0:
+            # Gravado na primeira escrita, para que o saldo anterior também apareça nas consultas por lote
+            lote = lot_data(clinica_id, produto_id, sem_lote, produto.get('data_validade'), agora=agora, origem='saldo_anterior')
+            lote['criado_em'] = _ORDEM_INICIAL
+            index.add(LOTE_SALDO_ANTERIOR_ID, lote)
+        return index
+
+    def _push(self, lote_id, lote):
+        self._lotes[lote_id] = lote
+        heapq.heappush(self._heap, (lote.get('data_validade') or _SEM_VALIDADE, lote.get('criado_em') or _ORDEM_INICIAL, lote_id))
+
+    def add(self, lote_id, lote):
+        """Inclui um lote criado na mesma transação (entrada de um lote de movimentações)."""
+        self._push(lote_id, lote)
+        self._alterados.add(lote_id)
+
+    @property
+    def disponivel(self):
+        return sum(self._lotes[lote_id]['quantidade_atual'] for _, _, lote_id in self._heap)
+
+    def earliest_expiry(self):
+        """Validade do primeiro lote aberto (valor de 'vence_em'), ou None."""
+        if not self._heap or self._heap[0][0] is _SEM_VALIDADE:
+            return None
+        return self._heap[0][0]
+
+    def consume(self, quantidade):
+        """Retira a quantidade dos lotes, primeiro a vencer primeiro. Retorna [{lote_id, quantidade, data_validade}]."""
+        consumidos = []
+        while quantidade > 0 and self._heap:
+            lote_id = self._heap[0][2]
+            lote = self._lotes[lote_id]
+            usado = min(quantidade, lote['quantidade_atual'])
+            lote['quantidade_atual'] -= usado
+            quantidade -= usado
+            self._alterados.add(lote_id)
+            consumidos.append({'lote_id': lote_id, 'quantidade': usado, 'data_validade': lote.get('data_validade')})
+            if lote['quantidade_atual'] <= 0:
+                lote['esgotado'] = True
+                heapq.heappop(self._heap)
+        return consumidos
+
+    @property
+    def pendente(self):
+        return bool(self._alterados)
+
+    def write(self, writer):
+        """Grava os lotes alterados com o writer (transação ou batch)."""
+        for lote_id in self._alterados:
+            lote = dict(self._lotes[lote_id])
+            if lote_id == LOTE_SALDO_ANTERIOR_ID:
+                lote['criado_em'] = firestore.SERVER_TIMESTAMP
+            writer.set(self._collection.document(lote_id), lote)
+        self._alterados.clear()
+
+
+def _validate(tipo, quantidade):
+    if tipo not in TIPOS_MOVIMENTACAO:
+        raise StockMovementError('Tipo de movimentação inválido.')
+    if not isinstance(quantidade, int) or quantidade <= 0:
+        raise StockMovementError('A quantidade deve ser um número positivo.')
+
+@firestore.transactional
+def _exit_in_transaction(transaction, db_instance, clinica_id, produto_id, mov_ref, quantidade, marca, preco_total,
+                         data_vencimento, usuario, agora):
+    prod_ref = produto_ref(db_instance, clinica_id, produto_id)
+    snapshot = prod_ref.get(transaction=transaction,
+                            field_paths=['nome', 'quantidade_atual', 'estoque_minimo', 'data_validade'])
+    if not snapshot.exists:
+        raise StockMovementError('Produto não encontrado para movimentação.')
+    produto = snapshot.to_dict() or {}
+    disponivel = produto.get('quantidade_atual', 0)
+    if disponivel < quantidade:
+        raise InsufficientStockError('Quantidade em estoque insuficiente para esta saída.', disponivel)
+    produto_nome = produto.get('nome', 'N/A')
+    lotes = LotIndex.load(transaction, db_instance, clinica_id, produto_id, produto, agora)
+    consumidos = lotes.consume(quantidade)
+    lotes.write(transaction)
+    transaction.update(prod_ref, {'quantidade_atual': firestore.Increment(-quantidade),
+                                  'abaixo_minimo': below_minimum(disponivel - quantidade, produto.get('estoque_minimo')),
+                                  'vence_em': lotes.earliest_expiry(),
+                                  'atualizado_em': firestore.SERVER_TIMESTAMP})
+    transaction.set(mov_ref, movement_data(produto_id, produto_nome, 'saida', quantidade, disponivel - quantidade,
+                                           marca, preco_total, data_vencimento, False, usuario, agora, consumidos))
+    add_monthly_totals(transaction, db_instance, clinica_id, produto_id, produto_nome, agora, saida=quantidade)
+    return produto_nome, disponivel - quantidade
+
+def record_movement(db_instance, clinica_id, produto_id, tipo, quantidade, marca=None, preco_total=None,
+                    data_vencimento=None, criar_conta_pagar=False, usuario=None):
+    """
+    Registra uma movimentação: saldo, lotes, lançamento e conta a pagar (só em entradas) gravados juntos.
+    Numa entrada, data_vencimento é a validade do lote criado.
+    Retorna {movimentacao_id, conta_id, produto_nome, quantidade_apos}; levanta StockMovementError
+    (ou InsufficientStockError) sem gravar nada quando a movimentação é recusada.
+    """
+    _validate(tipo, quantidade)
+    prod_ref = produto_ref(db_instance, clinica_id, produto_id)
+    mov_ref = _movimentacoes_ref(db_instance, clinica_id).document()
+    agora = datetime.datetime.now(SAO_PAULO_TZ)
+
+    if tipo == 'saida':
+        produto_nome, quantidade_apos = _exit_in_transaction(db_instance.transaction(), db_instance, clinica_id, produto_id, mov_ref,
+                                                             quantidade, marca, preco_total, data_vencimento, usuario, agora)
+        return {'movimentacao_id': mov_ref.id, 'conta_id': None, 'produto_nome': produto_nome, 'quantidade_apos': quantidade_apos}
+
+    snapshot = prod_ref.get(field_paths=['nome', 'abaixo_minimo', 'vence_em'])
+    if not snapshot.exists:
+        raise StockMovementError('Produto não encontrado para movimentação.')
+    produto = snapshot.to_dict() or {}
+    produto_nome = produto.get('nome', 'N/A')
+
+    lote_ref = lotes_ref(db_instance, clinica_id, produto_id).document()
+    batch = db_instance.batch()
+    batch.update(prod_ref, {'quantidade_atual': firestore.Increment(quantidade), 'atualizado_em': firestore.SERVER_TIMESTAMP})
+    batch.set(lote_ref, lot_data(clinica_id, produto_id, quantidade, data_vencimento, marca, mov_ref.id, agora))
+    batch.set(mov_ref, movement_data(produto_id, produto_nome, tipo, quantidade, None, marca, preco_total,
+                                     data_vencimento, criar_conta_pagar, usuario, agora,
+                                     [{'lote_id': lote_ref.id, 'quantidade': quantidade, 'data_validade': data_vencimento}]))
+    add_monthly_totals(batch, db_instance, clinica_id, produto_id, produto_nome, agora, entrada=quantidade)
+    conta_id = None
+    if criar_conta_pagar:
+        conta_id = create_payable(db_instance, clinica_id, payable_data(produto_id, produto_nome, quantidade, preco_total,
+                                                                        data_vencimento, usuario, agora), writer=batch).id
+    batch.commit()
+    # Uma entrada só pode tirar o produto da lista de estoque baixo ou antecipar o próximo vencimento
+    if produto.get('abaixo_minimo', True) or _expires_sooner(data_vencimento, produto.get('vence_em')):
+        refresh_stock_flags(db_instance, clinica_id, [produto_id])
+    return {'movimentacao_id': mov_ref.id, 'conta_id': conta_id, 'produto_nome': produto_nome, 'quantidade_apos': None}
+
+
+def _expires_sooner(data_validade, vence_em):
+    return bool(data_validade) and (not vence_em or data_validade < vence_em)
+
+@firestore.transactional
+def _refresh_flags(transaction, db_instance, clinica_id, produto_id):
+    prod_ref = produto_ref(db_instance, clinica_id, produto_id)
+    snapshot = prod_ref.get(transaction=transaction, field_paths=['quantidade_atual', 'estoque_minimo', 'data_validade',
+                                                                  'abaixo_minimo', 'vence_em'])
+    if not snapshot.exists:
+        return False
+    produto = snapshot.to_dict() or {}
+    lotes = LotIndex.load(transaction, db_instance, clinica_id, produto_id, produto)
+    campos = {
+        'abaixo_minimo': below_minimum(produto.get('quantidade_atual'), produto.get('estoque_minimo')),
+        'vence_em': lotes.earliest_expiry(),
+    }
+    alterados = {campo: valor for campo, valor in campos.items() if campo not in produto or produto[campo] != valor}
+    if not alterados and not lotes.pendente:
+        return False
+    lotes.write(transaction)
+    if alterados:
+        transaction.update(prod_ref, alterados)
+    return True
+
+def refresh_stock_flags(db_instance, clinica_id, produto_ids):
+    """
+    Recalcula 'abaixo_minimo' e 'vence_em' dos produtos a partir do saldo, do estoque mínimo e dos lotes
+    abertos (uma transação por produto, que só escreve quando algum valor muda). Usada após entradas e
+    após editar o produto. Retorna os ids cujos campos mudaram.
+    """
+    alterados = []
+    for produto_id in dict.fromkeys(produto_ids):
+        if _refresh_flags(db_instance.transaction(), db_instance, clinica_id, produto_id):
+            alterados.append(produto_id)
+    return alterados
+
+
+def _lot_sort_key(lote):
+    return (lote.get('data_validade') or _SEM_VALIDADE, lote.get('criado_em') or _ORDEM_INICIAL)
+
+def list_lots(db_instance, clinica_id, produto_id, incluir_esgotados=False):
+    """Lotes do produto na ordem de consumo (FEFO), como dicionários com 'id'."""
+    query = lotes_ref(db_instance, clinica_id, produto_id)
+    if not incluir_esgotados:
+        query = query.where(filter=FieldFilter('esgotado', '==', False))
+    lotes = [dict(doc.to_dict() or {}, id=doc.id) for doc in query.stream()]
+    return sorted(lotes, key=_lot_sort_key)
+
+register_query('estoque.historico_do_lote', 'clinicas/{clinica_id}/estoque_movimentacoes',
+               equality=('produto_id',), array_contains='lotes_ids', order_by=(('data_movimentacao', 'DESCENDING'),))
+
+def lot_history(db_instance, clinica_id, produto_id, lote_id, limit=200):
+    """Movimentações que criaram ou consumiram o lote, da mais recente para a mais antiga."""
+    query = _movimentacoes_ref(db_instance, clinica_id)\
+        .where(filter=FieldFilter('produto_id', '==', produto_id))\
+        .where(filter=FieldFilter('lotes_ids', 'array_contains', lote_id))\
+        .order_by('data_movimentacao', direction=firestore.Query.DESCENDING).limit(limit)
+    return [dict(doc.to_dict() or {}, id=doc.id) for doc in query.stream()]
+
+
+# --- Movimentações em lote ---
+
+def product_index(db_instance, clinica_id):
+    """
+    Índice dos produtos da clínica, cacheado por PRODUTOS_INDICE_TTL:
+    {'por_id': {id: {nome, ativo}}, 'por_nome': {nome normalizado: id ou None se ambíguo}}.
+    Não guarda saldos, que mudam a cada movimentação.
+    """
+    now = time.monotonic()
+    with _indice_produtos_lock:
+        entry = _indice_produtos.get(clinica_id)
+        if entry and entry[0] > now:
+            return entry[1]
+
+    por_id, por_nome = {}, {}
+    for doc in _clinica_ref(db_instance, clinica_id).collection('estoque_produtos').select(['nome', 'ativo']).stream():
+        data = doc.to_dict() or {}
+        por_id[doc.id] = {'nome': data.get('nome', 'N/A'), 'ativo': data.get('ativo', False)}
+        chave = normalize_name(data.get('nome'))
+        por_nome[chave] = None if chave in por_nome else doc.id
+    index = {'por_id': por_id, 'por_nome': por_nome}
+    with _indice_produtos_lock:
+        _indice_produtos[clinica_id] = (now + PRODUTOS_INDICE_TTL, index)
+    return index
+
+def invalidate_product_index(clinica_id):
+    """Descarta o índice de produtos da clínica após cadastrar, editar ou excluir produtos."""
+    with _indice_produtos_lock:
+        _indice_produtos.pop(clinica_id, None)
+
+def _parse_row(index, row):
+    produto_id = str(row.get('produto_id') or '').strip()
+    if produto_id:
+        if produto_id not in index['por_id']:
+            raise StockMovementError(f"Produto '{produto_id}' não encontrado.")
+    else:
+        nome = normalize_name(row.get('produto'))
+        if not nome:
+            raise StockMovementError('Informe o produto (produto_id ou nome).')
+        if nome not in index['por_nome']:
+            raise StockMovementError(f"Produto '{row.get('produto')}' não encontrado.")
+        produto_id = index['por_nome'][nome]
+        if produto_id is None:
+            raise StockMovementError(f"Há mais de um produto chamado '{row.get('produto')}'; use o produto_id.")
+    produto = index['por_id'][produto_id]
+    if not produto['ativo']:
+        raise StockMovementError(f"O produto '{produto['nome']}' está inativo.")
+
+    tipo = normalize_name(row.get('tipo'))
+    if tipo not in TIPOS_MOVIMENTACAO:
+        raise StockMovementError("Tipo de movimentação inválido (use 'entrada' ou 'saida').")
+    try:
+        quantidade = float(str(row.get('quantidade')).strip().replace(',', '.'))
+    except (TypeError, ValueError):
+        raise StockMovementError('Quantidade inválida.')
+    if quantidade <= 0 or not quantidade.is_integer():
+        raise StockMovementError('A quantidade deve ser um número inteiro positivo.')
+
+    preco_total = row.get('preco_total')
+    if preco_total in (None, ''):
+        preco_total = 0.0
+    else:
+        try:
+            preco_total = float(str(preco_total).strip().replace(',', '.'))
+        except ValueError:
+            raise StockMovementError('Preço total inválido.')
+
+    data_vencimento = row.get('data_vencimento')
+    if isinstance(data_vencimento, datetime.datetime):
+        data_vencimento = data_vencimento if data_vencimento.tzinfo else SAO_PAULO_TZ.localize(data_vencimento)
+    elif data_vencimento not in (None, ''):
+        data_vencimento = parse_date_input(str(data_vencimento).strip())
+        if not data_vencimento:
+            raise StockMovementError('Data de vencimento inválida (use AAAA-MM-DD ou DD/MM/AAAA).')
+    else:
+        data_vencimento = None
+
+    return {
+        'produto_id': produto_id,
+        'produto_nome': produto['nome'],
+        'tipo': tipo,
+        'quantidade': int(quantidade),
+        'marca': str(row.get('marca') or '').strip() or None,
+        'preco_total': preco_total,
+        'data_vencimento': data_vencimento,
+    }
+
+def validate_movements(index, rows):
+    """
+    Valida as linhas [(número, {produto_id|produto, tipo, quantidade, marca, preco_total, data_vencimento})]
+    contra o índice de produtos. Retorna (movimentos válidos, com 'linha'; erros [{linha, erro}]).
+    """
+    movimentos, erros = [], []
+    for linha, row in rows:
+        try:
+            movimentos.append(dict(_parse_row(index, row), linha=linha))
+        except StockMovementError as e:
+            erros.append({'linha': linha, 'erro': str(e)})
+    return movimentos, erros
+
+def iter_file_rows(file_storage):
+    """
+    Lê aos poucos um CSV (separado por ',' ou ';') ou uma planilha XLSX enviada.
+    Produz (número da linha no arquivo, {campo: valor}) a partir da linha seguinte ao cabeçalho.
+    """
+    filename = (file_storage.filename or '').lower()
+    if filename.endswith('.xlsx'):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise StockMovementError('A importação de planilhas .xlsx requer o pacote openpyxl.')
+        rows = load_workbook(file_storage.stream, read_only=True, data_only=True).active.iter_rows(values_only=True)
+    elif filename.endswith('.csv'):
+        text = io.TextIOWrapper(file_storage.stream, encoding='utf-8-sig', newline='')
+        first = text.readline()
+        rows = csv.reader(itertools.chain([first], text), delimiter=';' if first.count(';') > first.count(',') else ',')
+    else:
+        raise StockMovementError('Envie um arquivo .csv ou .xlsx.')
+
+    header = None
+    for numero, values in enumerate(rows, start=1):
+        if header is None:
+            header = [_COLUNAS_IMPORTACAO.get(normalize_name(value).replace(' ', '_')) for value in values]
+            if 'tipo' not in header or 'quantidade' not in header or not {'produto_id', 'produto'} & set(header):
+                raise StockMovementError('Cabeçalho inválido: o arquivo precisa das colunas produto (ou produto_id), tipo e quantidade.')
+            continue
+        if all(value in (None, '') for value in values):
+            continue
+        yield numero, {campo: value for campo, value in zip(header, values) if campo}
+
+def consolidated_payable_data(importacao_id, entradas, data_vencimento, usuario=None, agora=None):
+    """Uma única conta a pagar para todas as entradas de um lote (ex.: a nota de um fornecedor)."""
+    return {
+        'descricao': f'Compra de estoque: {len(entradas)} item(ns) (lote {importacao_id[:8]})',
+        'valor': round(sum(mov['preco_total'] or 0 for mov in entradas), 2),
+        'data_vencimento': data_vencimento or None,
+        'status': 'pendente',
+        'data_lancamento': agora or datetime.datetime.now(SAO_PAULO_TZ),
+        'usuario_responsavel': usuario or 'N/A',
+        'importacao_id': importacao_id,
+        'itens': [{'produto_id': mov['produto_id'], 'produto_nome': mov['produto_nome'],
+                   'quantidade': mov['quantidade'], 'preco_total': mov['preco_total'] or None} for mov in entradas],
+    }
+
+def _bulk_movement_data(mov, quantidade_apos, importacao_id, criar_conta_pagar, usuario, agora, lotes):
+    data = movement_data(mov['produto_id'], mov['produto_nome'], mov['tipo'], mov['quantidade'], quantidade_apos,
+                         mov['marca'], mov['preco_total'], mov['data_vencimento'],
+                         criar_conta_pagar and mov['tipo'] == 'entrada', usuario, agora, lotes)
+    data['importacao_id'] = importacao_id
+    return data
+
+register_query('estoque.produtos_abaixo_minimo', 'clinicas/{clinica_id}/estoque_produtos',
+               equality=('abaixo_minimo',))
+
+@firestore.transactional
+def _apply_product_rows(transaction, db_instance, clinica_id, produto_id, movimentos, importacao_id, criar_conta_pagar, usuario, agora):
+    """
+    Aplica, na ordem, as linhas de um produto que tem saídas no lote, com os lotes do produto carregados
+    uma única vez: entradas criam lotes e saídas os consomem (FEFO). Linhas que deixariam o saldo
+    negativo são recusadas individualmente. Retorna (linhas gravadas, erros).
+    """
+    prod_ref = produto_ref(db_instance, clinica_id, produto_id)
+    snapshot = prod_ref.get(transaction=transaction, field_paths=['quantidade_atual', 'estoque_minimo', 'data_validade'])
+    if not snapshot.exists:
+        return [], [{'linha': mov['linha'], 'erro': 'Produto não encontrado.'} for mov in movimentos]
+    produto = snapshot.to_dict() or {}
+    lotes = LotIndex.load(transaction, db_instance, clinica_id, produto_id, produto, agora)
+    inicial = saldo = produto.get('quantidade_atual', 0)
+    gravados, erros = [], []
+    totais = {'entrada': 0, 'saida': 0}
+    for mov in movimentos:
+        if mov['tipo'] == 'saida' and saldo < mov['quantidade']:
+            erros.append({'linha': mov['linha'], 'erro': f'Quantidade em estoque insuficiente (disponível: {saldo}).'})
+            continue
+        mov_ref = _movimentacoes_ref(db_instance, clinica_id).document()
+        if mov['tipo'] == 'entrada':
+            lote_id = lotes_ref(db_instance, clinica_id, produto_id).document().id
+            lotes.add(lote_id, lot_data(clinica_id, produto_id, mov['quantidade'], mov['data_vencimento'], mov['marca'],
+                                        mov_ref.id, agora))
+            afetados = [{'lote_id': lote_id, 'quantidade': mov['quantidade'], 'data_validade': mov['data_vencimento']}]
+            saldo += mov['quantidade']
+        else:
+            afetados = lotes.consume(mov['quantidade'])
+            saldo -= mov['quantidade']
+        transaction.set(mov_ref, _bulk_movement_data(mov, saldo, importacao_id, criar_conta_pagar, usuario, agora, afetados))
+        totais[mov['tipo']] += mov['quantidade']
+        gravados.append(mov)
+    lotes.write(transaction)
+    if gravados:
+        add_monthly_totals(transaction, db_instance, clinica_id, produto_id, gravados[0]['produto_nome'], agora, **totais)
+    if saldo != inicial:
+        transaction.update(prod_ref, {'quantidade_atual': firestore.Increment(saldo - inicial),
+                                      'abaixo_minimo': below_minimum(saldo, produto.get('estoque_minimo')),
+                                      'vence_em': lotes.earliest_expiry(),
+                                      'atualizado_em': firestore.SERVER_TIMESTAMP})
+    return gravados, erros
+
+def apply_movements(db_instance, clinica_id, movimentos, criar_conta_pagar=False, conta_data_vencimento=None,
+                    usuario=None, progress_callback=None):
+    """
+    Grava movimentos já validados (validate_movements). Produtos só com entradas vão em batches de
+    LOTE_LINHAS_POR_BATCH linhas (um lote novo por linha), com um Increment por produto em cada batch; produtos com saídas
+    usam uma transação por produto, na ordem das linhas. Com criar_conta_pagar, as entradas gravadas
+    geram uma única conta a pagar consolidada.
+    Retorna {'importacao_id', 'aplicadas', 'erros': [{linha, erro}], 'conta_id'}.
+    """
+    importacao_id = _movimentacoes_ref(db_instance, clinica_id).document().id
+    agora = datetime.datetime.now(SAO_PAULO_TZ)
+    com_saida = {mov['produto_id'] for mov in movimentos if mov['tipo'] == 'saida'}
+    so_entradas = [mov for mov in movimentos if mov['produto_id'] not in com_saida]
+    por_produto = defaultdict(list)
+    for mov in movimentos:
+        if mov['produto_id'] in com_saida:
+            por_produto[mov['produto_id']].append(mov)
+
+    aplicados, erros, processados = [], [], 0
+
+    def _progress(quantidade):
+        nonlocal processados
+        processados += quantidade
+        if progress_callback:
+            progress_callback(processados, len(movimentos))
+
+    for start in range(0, len(so_entradas), LOTE_LINHAS_POR_BATCH):
+        parte = so_entradas[start:start + LOTE_LINHAS_POR_BATCH]
+        batch = db_instance.batch()
+        totais = defaultdict(int)
+        for mov in parte:
+            totais[mov['produto_id']] += mov['quantidade']
+            mov_ref = _movimentacoes_ref(db_instance, clinica_id).document()
+            lote_ref = lotes_ref(db_instance, clinica_id, mov['produto_id']).document()
+            batch.set(lote_ref, lot_data(clinica_id, mov['produto_id'], mov['quantidade'], mov['data_vencimento'],
+                                         mov['marca'], mov_ref.id, agora))
+            batch.set(mov_ref, _bulk_movement_data(mov, None, importacao_id, criar_conta_pagar, usuario, agora,
+                                                   [{'lote_id': lote_ref.id, 'quantidade': mov['quantidade'],
+                                                     'data_validade': mov['data_vencimento']}]))
+        nomes = {mov['produto_id']: mov['produto_nome'] for mov in parte}
+        for produto_id, quantidade in totais.items():
+            batch.update(produto_ref(db_instance, clinica_id, produto_id),
+                         {'quantidade_atual': firestore.Increment(quantidade), 'atualizado_em': firestore.SERVER_TIMESTAMP})
+            add_monthly_totals(batch, db_instance, clinica_id, produto_id, nomes[produto_id], agora, entrada=quantidade)
+        try:
+            batch.commit()
+            aplicados.extend(parte)
+        except Exception as e:
+            print(f"Erro ao gravar batch do lote {importacao_id}: {e}")
+            erros.extend({'linha': mov['linha'], 'erro': f'Falha ao gravar: {e}'} for mov in parte)
+        _progress(len(parte))
+
+    for produto_id, linhas in por_produto.items():
+        for start in range(0, len(linhas), LOTE_LINHAS_POR_BATCH):
+            parte = linhas[start:start + LOTE_LINHAS_POR_BATCH]
+            try:
+                gravados, recusados = _apply_product_rows(db_instance.transaction(), db_instance, clinica_id, produto_id,
+                                                          parte, importacao_id, criar_conta_pagar, usuario, agora)
+                aplicados.extend(gravados)
+                erros.extend(recusados)
+            except Exception as e:
+                print(f"Erro ao gravar as saídas do produto {produto_id} no lote {importacao_id}: {e}")
+                erros.extend({'linha': mov['linha'], 'erro': f'Falha ao gravar: {e}'} for mov in parte)
+            _progress(len(parte))
+
+    # Entradas em batch não leem o produto: reconfere os que estavam abaixo do mínimo e os que
+    # receberam lotes com validade (que podem antecipar o vence_em)
+    entradas_ids = {mov['produto_id'] for mov in aplicados if mov['produto_id'] not in com_saida}
+    if entradas_ids:
+        try:
+            abaixo = {doc.id for doc in _clinica_ref(db_instance, clinica_id).collection('estoque_produtos')
+                      .where(filter=FieldFilter('abaixo_minimo', '==', True)).select([]).stream()}
+            com_validade = {mov['produto_id'] for mov in aplicados if mov['produto_id'] in entradas_ids and mov['data_vencimento']}
+            refresh_stock_flags(db_instance, clinica_id, sorted((abaixo & entradas_ids) | com_validade))
+        except Exception as e:
+            print(f"Erro ao atualizar os alertas de estoque do lote {importacao_id}: {e}")
+
+    conta_id = None
+    entradas = sorted((mov for mov in aplicados if mov['tipo'] == 'entrada'), key=lambda mov: mov['linha'])
+    if criar_conta_pagar and entradas:
+        conta_id = create_payable(db_instance, clinica_id,
+                                  consolidated_payable_data(importacao_id, entradas, conta_data_vencimento, usuario, agora)).id
+
+    return {'importacao_id': importacao_id, 'aplicadas': len(aplicados),
+            'erros': sorted(erros, key=lambda erro: erro['linha']), 'conta_id': conta_id}
+
+
+# --- Reconciliação ---
+
+def _ledger_balance(movements):
+    saldo = 0
+    for mov in movements:
+        quantidade = mov.get('quantidade') or 0
+        saldo += quantidade if mov.get('tipo_movimentacao') == 'entrada' else -quantidade
+    return saldo
+
+register_query('estoque.movimentacoes_do_produto', 'clinicas/{clinica_id}/estoque_movimentacoes',
+               equality=('produto_id',))
+
+@firestore.transactional
+def _confirm_drift(transaction, db_instance, clinica_id, produto_id):
+    """
+    Reconfere um produto divergente numa transação (saldo e lançamentos lidos juntos), para não
+    acusar uma movimentação gravada entre a varredura do livro e a leitura dos produtos.
+    Retorna (esperado, registrado) ou None se o saldo confere.
+    """
+    prod_ref = produto_ref(db_instance, clinica_id, produto_id)
+    snapshot = prod_ref.get(transaction=transaction, field_paths=['quantidade_atual', 'divergencia_estoque'])
+    if not snapshot.exists:
+        return None
+    query = _movimentacoes_ref(db_instance, clinica_id).where(filter=FieldFilter('produto_id', '==', produto_id))\
+        .select(['tipo_movimentacao', 'quantidade'])
+    esperado = _ledger_balance(doc.to_dict() or {} for doc in transaction.get(query))
+    registrado = (snapshot.to_dict() or {}).get('quantidade_atual', 0)
+    if esperado == registrado:
+        return None
+    transaction.update(prod_ref, {'divergencia_estoque': {
+        'esperado': esperado, 'registrado': registrado, 'verificado_em': firestore.SERVER_TIMESTAMP,
+    }})
+    return esperado, registrado
+
+def reconcile_stock(db_instance, clinica_id, progress_callback=None):
+    """
+    Recalcula o saldo de cada produto a partir do livro de movimentações e marca as divergências
+    em 'divergencia_estoque' (removida dos produtos que voltaram a conferir). Não corrige os
+    saldos: a correção é uma decisão do administrador.
+    Retorna {'produtos': quantidade verificada, 'divergentes': [{produto_id, nome, esperado, registrado}]}.
+    """
+    saldos = defaultdict(int)
+    for doc in _movimentacoes_ref(db_instance, clinica_id).select(['produto_id', 'tipo_movimentacao', 'quantidade']).stream():
+        mov = doc.to_dict() or {}
+        if mov.get('produto_id'):
+            saldos[mov['produto_id']] += _ledger_balance([mov])
+
+    produtos = list(_clinica_ref(db_instance, clinica_id).collection('estoque_produtos')
+                    .select(['nome', 'quantidade_atual', 'divergencia_estoque']).stream())
+    divergentes, resolvidos = [], []
+    for index, doc in enumerate(produtos):
+        produto = doc.to_dict() or {}
+        confirmado = None
+        if saldos.get(doc.id, 0) != produto.get('quantidade_atual', 0):
+            confirmado = _confirm_drift(db_instance.transaction(), db_instance, clinica_id, doc.id)
+        if confirmado:
+            divergentes.append({'produto_id': doc.id, 'nome': produto.get('nome', 'N/A'),
+                                'esperado': confirmado[0], 'registrado': confirmado[1]})
+        elif 'divergencia_estoque' in produto:
+            resolvidos.append(doc.reference)
+        if progress_callback:
+            progress_callback(index + 1, len(produtos))
+
+    for start in range(0, len(resolvidos), ESTOQUE_BATCH_SIZE):
+        batch = db_instance.batch()
+        for ref in resolvidos[start:start + ESTOQUE_BATCH_SIZE]:
+            batch.update(ref, {'divergencia_estoque': firestore.DELETE_FIELD})
+        batch.commit()
+
+    if divergentes:
+        print(f"Reconciliação de estoque da clínica {clinica_id}: {len(divergentes)} produto(s) divergente(s).")
+    return {'produtos': len(produtos), 'divergentes': divergentes}
+
+def schedule_stock_reconciliation(db_instance, clinica_id, force=False):
+    """
+    Agenda reconcile_stock em segundo plano, no máximo uma vez a cada RECONCILIACAO_INTERVALO_SEGUNDOS
+    por clínica (a menos que force=True). Retorna o job_id ou None se não foi necessário.
+    """
+    now = time.monotonic()
+    with _ultima_reconciliacao_lock:
+        if not force and now - _ultima_reconciliacao.get(clinica_id, float('-inf')) < RECONCILIACAO_INTERVALO_SEGUNDOS:
+            return None
+        _ultima_reconciliacao[clinica_id] = now
+    return start_background_job('Reconciliação do estoque', reconcile_stock, db_instance, clinica_id,
+                                clinica_id=clinica_id)
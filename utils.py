@@ -6,6 +6,11 @@ from google.cloud import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
 import uuid
 import json # NOVO: Para serializar/desserializar permissões
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions as google_exceptions
+from query_registry import register_query
 
 # Esta variável será inicializada por app.py
 _db_instance = None 
@@ -19,6 +24,16 @@ except Exception as e:
     print(f"ERRO: Não foi possível inicializar o fuso horário: {e}. Usando UTC como fallback.")
     SAO_PAULO_TZ = pytz.utc
 
+class VersionConflictError(Exception):
+    """
+    Gravação recusada porque o documento mudou desde a versão ('rev') vista pelo cliente.
+    conflicts: lista de diffs mescláveis com os campos atuais e os campos propostos.
+    """
+
+    def __init__(self, message, conflicts):
+        super().__init__(message)
+        self.conflicts = conflicts
+
 def set_db(db_client):
     """Define a instância do Firestore Client para ser acessível globalmente."""
     global _db_instance
@@ -161,6 +176,7 @@ def get_counts_for_navbar(db_instance, clinica_id):
         'profissionais': 0,
         'contas_a_pagar': 0,
         'estoque': 0,
+        'estoque_alertas': 0,
         'patrimonio': 0,
         'horarios': 0,
         'utilizadores': 0,
@@ -223,10 +239,17 @@ def get_counts_for_navbar(db_instance, clinica_id):
         print(f"Erro ao contar contas a pagar: {e}")
 
     try:
-        counts['estoque'] = db_instance.collection('clinicas').document(clinica_id).collection('estoque').count().get()[0][0].value
+        counts['estoque'] = db_instance.collection('clinicas').document(clinica_id).collection('estoque_produtos').count().get()[0][0].value
     except Exception as e:
         print(f"Erro ao contar estoque: {e}")
 
+    try:
+        # Alertas de estoque (baixo + vencidos), contados por consultas indexadas e em cache por clínica
+        from stock_alerts import alert_counts
+        counts['estoque_alertas'] = alert_counts(db_instance, clinica_id)['total']
+    except Exception as e:
+        print(f"Erro ao contar alertas de estoque: {e}")
+
     try:
         counts['patrimonio'] = db_instance.collection('clinicas').document(clinica_id).collection('patrimonio').count().get()[0][0].value
     except Exception as e:
@@ -352,6 +375,9 @@ def update_goal_target_status(clinica_id, patient_id, goal_id, target_id, comple
         print(f"Erro ao atualizar status do alvo {target_id}: {e}")
         return False
 
+register_query('agendamentos.semana_do_paciente', 'clinicas/{clinica_id}/agendamentos',
+               equality=('paciente_id',), range_fields=('data_hora_inicio',), order_by=('data_hora_inicio',))
+
 def get_weekly_appointments_for_patient(clinica_id, patient_id, start_date_str, end_date_str):
     """
     Retorna os agendamentos de um paciente para uma semana específica.
@@ -379,17 +405,15 @@ def get_weekly_appointments_for_patient(clinica_id, patient_id, start_date_str,
                     appointment['data_hora_inicio_str'] = format_firestore_timestamp(appointment['data_hora_inicio'])
                 if isinstance(appointment.get('data_hora_fim'), datetime.datetime):
                     appointment['data_hora_fim_str'] = format_firestore_timestamp(appointment['data_hora_fim'])
-                
-                if appointment.get('profissional_id'):
-                    prof_doc = db.collection('clinicas').document(clinica_id).collection('profissionais').document(appointment['profissional_id']).get()
-                    if prof_doc.exists:
-                        appointment['profissional_nome'] = prof_doc.to_dict().get('nome', 'Desconhecido')
-                    else:
-                        appointment['profissional_nome'] = 'Desconhecido'
-                else:
-                    appointment['profissional_nome'] = 'Não Atribuído'
-
                 weekly_appointments.append(appointment)
+
+        # Nomes dos profissionais resolvidos de uma vez para todos os agendamentos
+        professional_names = resolve_professional_names(db, clinica_id, [a.get('profissional_id') for a in weekly_appointments])
+        for appointment in weekly_appointments:
+            if appointment.get('profissional_id'):
+                appointment['profissional_nome'] = professional_names.get(appointment['profissional_id'], 'Desconhecido')
+            else:
+                appointment['profissional_nome'] = 'Não Atribuído'
     except Exception as e:
         print(f"Erro ao buscar agendamentos semanais para o paciente {patient_id}: {e}")
     return weekly_appointments
@@ -430,6 +454,9 @@ def delete_weekly_plan_entry(clinica_id, patient_id, entry_id):
         print(f"Erro ao excluir entrada do planejamento semanal {entry_id}: {e}")
         return False
 
+register_query('planejamento_semanal.do_profissional', 'clinicas/{clinica_id}/pacientes/{paciente_id}/planejamento_semanal',
+               equality=('professional_id',), range_fields=('plan_date',), order_by=('plan_date',))
+
 def get_weekly_plan_entries(clinica_id, patient_id, professional_id, start_date_str, end_date_str):
     """
     Retorna as entradas do planejamento semanal para um paciente e profissional em uma semana.
@@ -489,6 +516,9 @@ def get_all_protocols_with_items(clinica_id):
         print(f"Erro ao buscar protocolos com itens e níveis para a clínica {clinica_id}: {e}")
     return protocols_list
 
+register_query('protocolos.tarefas_testes', 'clinicas/{clinica_id}/protocols/{protocol_id}/tarefas_testes',
+               order_by=('nivel', 'ordem'))
+
 def get_protocol_by_id(clinica_id, protocol_id):
     """
     Retorna um protocolo específico por ID, incluindo seus níveis, habilidades, pontuação e tarefas/testes.
@@ -658,6 +688,7 @@ def add_protocol_to_evaluation(clinica_id, patient_id, evaluation_id, protocol_i
                 'additional_info': '',
                 'data_resposta': None,
                 'status': 'pendente',
+                'rev': 0,
                 'created_at': firestore.SERVER_TIMESTAMP
             }
             evaluation_tasks_ref.add(task_data_for_eval)
@@ -685,6 +716,11 @@ def add_protocol_to_evaluation(clinica_id, patient_id, evaluation_id, protocol_i
         print(f"Erro ao vincular protocolo {protocol_id} à avaliação {evaluation_id} do paciente {patient_id}: {e}")
         return False
 
+register_query('avaliacoes.tarefas_avaliadas', 'clinicas/{clinica_id}/pacientes/{paciente_id}/avaliacoes/{avaliacao_id}/tarefas_avaliadas',
+               order_by=('linked_protocol_instance_id', 'nivel', 'item_numero'))
+register_query('avaliacoes.pontuacoes_avaliadas', 'clinicas/{clinica_id}/pacientes/{paciente_id}/avaliacoes/{avaliacao_id}/pontuacoes_avaliadas',
+               order_by=('linked_protocol_instance_id', 'created_at'))
+
 def get_evaluation_details(clinica_id, patient_id, evaluation_id):
     """
     Retorna os detalhes de uma avaliação específica, incluindo protocolos vinculados, tarefas e pontuações aplicadas.
@@ -723,23 +759,56 @@ def get_evaluation_details(clinica_id, patient_id, evaluation_id):
         print(f"Erro ao buscar detalhes da avaliação {evaluation_id} do paciente {patient_id}: {e}")
     return evaluation_data
 
-def save_evaluation_task_response(clinica_id, patient_id, evaluation_id, task_id, response_value, additional_info):
+@firestore.transactional
+def _save_task_response_in_transaction(transaction, task_ref, fields):
+    snapshot = task_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        raise google_exceptions.NotFound(f"Tarefa {task_ref.id} não encontrada.")
+    new_rev = int((snapshot.to_dict() or {}).get('rev') or 0) + 1
+    transaction.update(task_ref, dict(fields, rev=new_rev))
+    return new_rev
+
+def save_evaluation_task_response(clinica_id, patient_id, evaluation_id, task_id, response_value, additional_info, expected_rev=None):
     """
-    Salva a resposta de uma tarefa específica dentro de uma avaliação.
+    Salva a resposta de uma tarefa específica dentro de uma avaliação e retorna a nova revisão.
+    Cada gravação incrementa o contador 'rev' da tarefa. Se expected_rev (inteiro) for informado, a gravação
+    só acontece se a tarefa ainda estiver nessa revisão (pré-condição no update_time, sem transação);
+    caso contrário levanta VersionConflictError com os valores atuais e os propostos. Sem expected_rev,
+    a revisão é lida e incrementada numa transação.
+    Levanta google_exceptions.NotFound se a tarefa não existe.
     """
     db = get_db()
     task_ref = db.collection('clinicas').document(clinica_id).collection('pacientes').document(patient_id).collection('avaliacoes').document(evaluation_id).collection('tarefas_avaliadas').document(task_id)
-    try:
-        task_ref.update({
-            'response_value': response_value,
-            'additional_info': additional_info,
-            'data_resposta': firestore.SERVER_TIMESTAMP,
-            'status': 'respondida'
-        })
-        return True
-    except Exception as e:
-        print(f"Erro ao salvar resposta da tarefa {task_id} na avaliação {evaluation_id}: {e}")
-        return False
+    proposed = {'response_value': response_value, 'additional_info': additional_info}
+    fields = dict(proposed, data_resposta=firestore.SERVER_TIMESTAMP, status='respondida')
+    if expected_rev is None:
+        return _save_task_response_in_transaction(db.transaction(), task_ref, fields)
+
+    snapshot = task_ref.get()
+    if not snapshot.exists:
+        raise google_exceptions.NotFound(f"Tarefa {task_id} não encontrada na avaliação {evaluation_id}.")
+    current = snapshot.to_dict() or {}
+    current_rev = int(current.get('rev') or 0)
+    if current_rev == expected_rev:
+        try:
+            task_ref.update(dict(fields, rev=current_rev + 1),
+                            option=db.write_option(last_update_time=snapshot.update_time))
+            return current_rev + 1
+        except google_exceptions.FailedPrecondition:
+            # Outra gravação entrou entre a leitura e a escrita: relê para montar o diff
+            current = task_ref.get().to_dict() or {}
+            current_rev = int(current.get('rev') or 0)
+    raise VersionConflictError(
+        "A resposta desta tarefa foi alterada por outro usuário.",
+        [{
+            'id': task_id,
+            'tipo': 'tarefa',
+            'rev_esperada': expected_rev,
+            'rev_atual': current_rev,
+            'atual': {k: current.get(k) for k in proposed},
+            'proposto': {k: v for k, v in proposed.items() if current.get(k) != v},
+        }]
+    )
 
 def save_evaluation_scoring_response(clinica_id, patient_id, evaluation_id, scoring_applied_id, applied_value):
     """
@@ -770,33 +839,23 @@ def update_evaluation_status(clinica_id, patient_id, evaluation_id, status):
         print(f"Erro ao atualizar status da avaliação {evaluation_id}: {e}")
         return False
 
+def _evaluation_ref(db, clinica_id, patient_id, evaluation_id):
+    return db.collection('clinicas').document(clinica_id).collection('pacientes').document(patient_id).collection('avaliacoes').document(evaluation_id)
+
+def evaluation_delete_counts(clinica_id, patient_id, evaluation_id):
+    """Documentos que delete_evaluation apagaria, por coleção (cascade_delete com dry_run)."""
+    db = get_db()
+    return cascade_delete(db, [_evaluation_ref(db, clinica_id, patient_id, evaluation_id)], dry_run=True)
+
 def delete_evaluation(clinica_id, patient_id, evaluation_id):
     """
-    Exclui uma avaliação e suas subcoleções (protocolos vinculados e tarefas avaliadas).
+    Exclui uma avaliação: o documento sai da listagem imediatamente e as subcoleções (protocolos
+    vinculados e tarefas avaliadas) são apagadas em segundo plano. Retorna o job_id.
     """
     db = get_db()
-    evaluation_ref = db.collection('clinicas').document(clinica_id).collection('pacientes').document(patient_id).collection('avaliacoes').document(evaluation_id)
-    
-    try:
-        linked_protocols_ref = evaluation_ref.collection('protocolos_vinculados')
-        for linked_proto_doc in linked_protocols_ref.stream():
-            linked_proto_doc.reference.collection('tarefas_snapshot').map(lambda doc: doc.reference.delete())
-            linked_proto_doc.reference.collection('pontuacao_snapshot').map(lambda doc: doc.reference.delete())
-            linked_proto_doc.reference.delete()
-
-        tasks_ref = evaluation_ref.collection('tarefas_avaliadas')
-        for doc in tasks_ref.stream():
-            doc.reference.delete()
-
-        scoring_ref = evaluation_ref.collection('pontuacoes_avaliadas')
-        for doc in scoring_ref.stream():
-            doc.reference.delete()
-
-        evaluation_ref.delete()
-        return True
-    except Exception as e:
-        print(f"Erro ao excluir avaliação {evaluation_id} do paciente {patient_id}: {e}")
-        return False
+    evaluation_ref = _evaluation_ref(db, clinica_id, patient_id, evaluation_id)
+    evaluation_ref.delete()
+    return start_cascade_delete_job(db, [evaluation_ref], f'Exclusão da avaliação {evaluation_id}', clinica_id=clinica_id)
 
 def delete_linked_protocol_and_tasks(clinica_id, patient_id, evaluation_id, linked_protocol_instance_id_to_remove):
     """
@@ -809,27 +868,237 @@ def delete_linked_protocol_and_tasks(clinica_id, patient_id, evaluation_id, link
     
     try:
         linked_protocol_doc_ref = evaluation_ref.collection('protocolos_vinculados').document(linked_protocol_instance_id_to_remove)
-        
-        for doc in linked_protocol_doc_ref.collection('tarefas_snapshot').stream():
-            doc.reference.delete()
-        for doc in linked_protocol_doc_ref.collection('pontuacao_snapshot').stream():
-            doc.reference.delete()
-        
-        linked_protocol_doc_ref.delete()
+        refs_to_delete = [linked_protocol_doc_ref]
 
         tasks_to_delete_query = evaluation_ref.collection('tarefas_avaliadas').where(
             filter=FieldFilter('linked_protocol_instance_id', '==', linked_protocol_instance_id_to_remove)
         )
-        for task_doc in tasks_to_delete_query.stream():
-            task_doc.reference.delete()
+        refs_to_delete.extend(task_doc.reference for task_doc in tasks_to_delete_query.stream())
         
         scoring_to_delete_query = evaluation_ref.collection('pontuacoes_avaliadas').where(
             filter=FieldFilter('linked_protocol_instance_id', '==', linked_protocol_instance_id_to_remove)
         )
-        for score_doc in scoring_to_delete_query.stream():
-            score_doc.reference.delete()
+        refs_to_delete.extend(score_doc.reference for score_doc in scoring_to_delete_query.stream())
 
+        cascade_delete(db, refs_to_delete)
         return True
     except Exception as e:
         print(f"Erro ao desvincular protocolo {linked_protocol_instance_id_to_remove} da avaliação {evaluation_id} do paciente {patient_id}: {e}")
         return False
+
+
+# =================================================================
+# EXCLUSÃO EM CASCATA (BulkWriter + varredura concorrente)
+# =================================================================
+
+CASCADE_DELETE_MAX_WORKERS = 8
+
+# Registro em memória dos jobs em segundo plano (job_id -> estado)
+_background_jobs = {}
+_background_jobs_lock = threading.Lock()
+# Momento (time.monotonic) em que cada job terminou, para descartar os antigos
+_background_jobs_finished = {}
+
+# Jobs concluídos ficam consultáveis por este tempo (segundos); o registro guarda no máximo
+# BACKGROUND_JOBS_MAX jobs (os concluídos mais antigos saem primeiro)
+BACKGROUND_JOBS_TTL = 3600
+BACKGROUND_JOBS_MAX = 500
+
+def _list_child_documents(doc_ref):
+    """Retorna as referências de todos os documentos das subcoleções de um documento."""
+    children = []
+    for sub_coll_ref in doc_ref.collections():
+        # list_documents() também devolve documentos "fantasmas" (sem dados, mas com subcoleções)
+        children.extend(sub_coll_ref.list_documents())
+    return children
+
+def collect_document_tree(root_refs, max_workers=CASCADE_DELETE_MAX_WORKERS):
+    """
+    Percorre, nível a nível e em paralelo, as subárvores dos documentos informados.
+    Retorna uma lista de níveis (o primeiro contém as próprias raízes).
+    """
+    levels = []
+    frontier = list(root_refs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while frontier:
+            levels.append(frontier)
+            next_frontier = []
+            for children in executor.map(_list_child_documents, frontier):
+                next_frontier.extend(children)
+            frontier = next_frontier
+    return levels
+
+def cascade_delete(db_instance, root_refs, dry_run=False, progress_callback=None):
+    """
+    Exclui os documentos informados e todas as suas subcoleções usando BulkWriter.
+    Com dry_run=True nada é apagado; apenas as contagens por coleção são retornadas.
+    Retorna um dicionário {'total': int, 'por_colecao': {nome_colecao: int}}.
+    """
+    levels = collect_document_tree(root_refs)
+
+    counts = {}
+    for level in levels:
+        for ref in level:
+            counts[ref.parent.id] = counts.get(ref.parent.id, 0) + 1
+    total = sum(counts.values())
+
+    if dry_run or total == 0:
+        return {'total': total, 'por_colecao': counts}
+
+    deleted = {'count': 0}
+    deleted_lock = threading.Lock()
+    bulk_writer = db_instance.bulk_writer()
+
+    def _on_write_result(reference, result, writer):
+        # O BulkWriter chama este callback a partir das suas próprias threads
+        with deleted_lock:
+            deleted['count'] += 1
+            processed = deleted['count']
+        if progress_callback:
+            progress_callback(processed, total)
+
+    bulk_writer.on_write_result(_on_write_result)
+    try:
+        # Apaga das folhas para as raízes: se algo falhar no meio, nenhuma subárvore fica órfã
+        for level in reversed(levels):
+            for ref in level:
+                bulk_writer.delete(ref)
+            bulk_writer.flush()
+    finally:
+        bulk_writer.close()
+
+    return {'total': total, 'por_colecao': counts}
+
+def _prune_background_jobs():
+    """
+    Remove do registro os jobs concluídos há mais de BACKGROUND_JOBS_TTL e, se ainda houver mais de
+    BACKGROUND_JOBS_MAX, os concluídos mais antigos. Jobs em andamento nunca saem.
+    Deve ser chamada com _background_jobs_lock adquirido.
+    """
+    limite = time.monotonic() - BACKGROUND_JOBS_TTL
+    for job_id, finished_at in list(_background_jobs_finished.items()):
+        if finished_at < limite:
+            _background_jobs.pop(job_id, None)
+            del _background_jobs_finished[job_id]
+    excesso = len(_background_jobs) - BACKGROUND_JOBS_MAX + 1
+    if excesso > 0:
+        for job_id, _ in sorted(_background_jobs_finished.items(), key=lambda item: item[1])[:excesso]:
+            _background_jobs.pop(job_id, None)
+            del _background_jobs_finished[job_id]
+
+def start_background_job(description, target, *args, clinica_id=None, **kwargs):
+    """
+    Executa target(*args, progress_callback=..., **kwargs) numa thread em segundo plano.
+    Retorna o job_id, cujo estado pode ser consultado com get_background_job() até BACKGROUND_JOBS_TTL
+    segundos depois da conclusão.
+    """
+    job_id = str(uuid.uuid4())
+    job = {
+        'id': job_id,
+        'clinica_id': clinica_id,
+        'descricao': description,
+        'status': 'pendente',
+        'processados': 0,
+        'total': None,
+        'resultado': None,
+        'erro': None,
+        'iniciado_em': datetime.datetime.now(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M:%S'),
+        'concluido_em': None,
+    }
+    with _background_jobs_lock:
+        _prune_background_jobs()
+        _background_jobs[job_id] = job
+
+    def _progress(processed, total):
+        with _background_jobs_lock:
+            job['processados'] = processed
+            job['total'] = total
+
+    def _run():
+        with _background_jobs_lock:
+            job['status'] = 'em_andamento'
+        try:
+            result = target(*args, progress_callback=_progress, **kwargs)
+            with _background_jobs_lock:
+                job['resultado'] = result
+                job['status'] = 'concluido'
+        except Exception as e:
+            print(f"Erro no job em segundo plano {job_id} ({description}): {e}")
+            with _background_jobs_lock:
+                job['erro'] = str(e)
+                job['status'] = 'erro'
+        finally:
+            with _background_jobs_lock:
+                job['concluido_em'] = datetime.datetime.now(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M:%S')
+                _background_jobs_finished[job_id] = time.monotonic()
+
+    threading.Thread(target=_run, daemon=True).start()
+    return job_id
+
+def get_background_job(job_id):
+    """Retorna uma cópia do estado de um job em segundo plano (ou None)."""
+    with _background_jobs_lock:
+        job = _background_jobs.get(job_id)
+        return dict(job) if job else None
+
+def start_cascade_delete_job(db_instance, root_refs, description, clinica_id=None):
+    """Agenda uma exclusão em cascata em segundo plano e retorna o job_id."""
+    return start_background_job(description, cascade_delete, db_instance, list(root_refs), clinica_id=clinica_id)
+
+
+# =================================================================
+# RESOLUÇÃO DE NOMES DE PROFISSIONAIS
+# =================================================================
+
+# Tempo (segundos) que um nome fica no cache da clínica antes de ser relido
+PROFESSIONAL_NAMES_CACHE_TTL = 300
+
+# {clinica_id: {profissional_id: (nome ou None se não existe, expira_em)}}
+_professional_names_cache = {}
+_professional_names_lock = threading.Lock()
+
+def resolve_professional_names(db_instance, clinica_id, professional_ids):
+    """
+    Resolve os nomes de vários profissionais de uma vez.
+    Usa o cache da clínica e busca os que faltam com um único get_all().
+    Retorna {profissional_id: nome}; IDs inexistentes ficam fora do dicionário.
+    """
+    ids = {pid for pid in professional_ids if pid}
+    if not ids:
+        return {}
+
+    now = time.monotonic()
+    names = {}
+    missing = []
+    with _professional_names_lock:
+        clinic_cache = _professional_names_cache.setdefault(clinica_id, {})
+        for pid in ids:
+            entry = clinic_cache.get(pid)
+            if entry and entry[1] > now:
+                if entry[0] is not None:
+                    names[pid] = entry[0]
+            else:
+                missing.append(pid)
+
+    if missing:
+        profissionais_ref = db_instance.collection('clinicas').document(clinica_id).collection('profissionais')
+        fetched = {}
+        for prof_doc in db_instance.get_all([profissionais_ref.document(pid) for pid in missing], field_paths=['nome']):
+            fetched[prof_doc.id] = (prof_doc.to_dict() or {}).get('nome', 'N/A') if prof_doc.exists else None
+        expires_at = now + PROFESSIONAL_NAMES_CACHE_TTL
+        with _professional_names_lock:
+            clinic_cache = _professional_names_cache.setdefault(clinica_id, {})
+            for pid in missing:
+                nome = fetched.get(pid)
+                clinic_cache[pid] = (nome, expires_at)
+                if nome is not None:
+                    names[pid] = nome
+    return names
+
+def invalidate_professional_names(clinica_id, professional_id=None):
+    """Remove do cache um profissional (ou todos os da clínica) após alterações."""
+    with _professional_names_lock:
+        if professional_id is None:
+            _professional_names_cache.pop(clinica_id, None)
+        else:
+            _professional_names_cache.get(clinica_id, {}).pop(professional_id, None)
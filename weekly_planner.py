@@ -0,0 +1,342 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import convert_doc_to_dict, resolve_professional_names
+from pei_repository import PeiRepository, pei_version
+from query_registry import register_query
+
+# =================================================================
+# PLANEJAMENTO SEMANAL: ASSOCIAÇÃO DE METAS A AGENDAMENTOS
+# =================================================================
+#
+# Cada associação fica em clinicas/{id}/agendamentos/{agendamento_id}/metas_associadas/{meta_id}.
+# O ID determinístico torna as gravações em lote idempotentes (associar é um set e desassociar é
+# um delete no mesmo caminho); as rotas de uma meta só consultam a subcoleção do agendamento pelo
+# meta_id para também enxergar as associações antigas. O título do PEI é gravado na associação para a página não precisar
+# ler o PEI de cada meta. O estado de uma semana inteira é lido com uma única consulta de grupo
+# de coleções em 'metas_associadas' por 'ref_agendamentos' (índice de campo único com escopo
+# de grupo de coleções). Associações antigas (ID automático) são regravadas no formato novo
+# na primeira gravação em lote da semana.
+
+# Gravações por lote (o Firestore aceita até 500)
+ASSOCIACOES_BATCH_SIZE = 400
+
+# Limite de valores de um filtro 'in' do Firestore
+_LIMITE_FILTRO_IN = 30
+
+_CAMPOS_COMPARADOS = ('meta_id', 'meta_nome', 'pei_id', 'pei_title')
+
+# Leituras independentes da montagem do planejamento executadas em paralelo
+PLANEJAMENTO_MAX_WORKERS = 4
+
+# Tempo (segundos) que o contexto do planejamento (paciente, metas ativas, profissionais) fica em
+# cache. Gravações de PEI feitas por este processo descartam o cache antes disso (pei_version).
+PLANEJAMENTO_CACHE_TTL = 300
+
+# {(clinica_id, paciente_id, user_uid): (versão dos PEIs, expira_em, contexto)}
+_planner_cache = {}
+_planner_cache_lock = threading.Lock()
+
+
+class PlannerAccessError(Exception):
+    """O planejamento não pode ser montado para este usuário/paciente (mensagem para o usuário)."""
+
+
+def _clinica_ref(db_instance, clinica_id):
+    return db_instance.collection('clinicas').document(clinica_id)
+
+def association_ref(db_instance, clinica_id, agendamento_id, meta_id):
+    return _clinica_ref(db_instance, clinica_id).collection('agendamentos').document(agendamento_id)\
+        .collection('metas_associadas').document(meta_id)
+
+def association_data(db_instance, clinica_id, agendamento_id, meta_id, meta_nome, pei_id, pei_title):
+    """Documento de uma associação (com as referências usadas pelo restante do sistema)."""
+    clinica_ref = _clinica_ref(db_instance, clinica_id)
+    pei_ref = clinica_ref.collection('peis').document(pei_id)
+    return {
+        'clinica_id': clinica_id,
+        'agendamento_id': agendamento_id,
+        'meta_id': meta_id,
+        'meta_nome': meta_nome,
+        'pei_id': pei_id,
+        'pei_title': pei_title,
+        'ref_meta': pei_ref.collection('metas').document(meta_id),
+        'ref_pei': pei_ref,
+        'ref_agendamentos': clinica_ref.collection('agendamentos').document(agendamento_id),
+        'timestamp': firestore.SERVER_TIMESTAMP,
+    }
+
+def pei_titles(db_instance, clinica_id, pei_ids):
+    """Títulos dos PEIs informados, numa única leitura em lote. PEIs inexistentes ficam de fora."""
+    pei_ids = {pei_id for pei_id in pei_ids if pei_id}
+    if not pei_ids:
+        return {}
+    peis_ref = _clinica_ref(db_instance, clinica_id).collection('peis')
+    return {
+        doc.id: (doc.to_dict() or {}).get('titulo', 'PEI sem Título')
+        for doc in db_instance.get_all([peis_ref.document(pei_id) for pei_id in pei_ids], field_paths=['titulo'])
+        if doc.exists
+    }
+
+register_query('planejamento.associacoes_dos_agendamentos', 'metas_associadas', collection_group=True,
+               equality=('ref_agendamentos',))
+
+def load_associations(db_instance, clinica_id, agendamento_ids):
+    """
+    Associações atuais dos agendamentos informados: {agendamento_id: [snapshot, ...]}.
+    Uma consulta de grupo de coleções por bloco de 30 agendamentos (uma só para uma semana comum).
+    """
+    agendamentos_ref = _clinica_ref(db_instance, clinica_id).collection('agendamentos')
+    agendamento_ids = list(dict.fromkeys(agendamento_ids))
+    associations = {agendamento_id: [] for agendamento_id in agendamento_ids}
+    for start in range(0, len(agendamento_ids), _LIMITE_FILTRO_IN):
+        refs = [agendamentos_ref.document(agendamento_id) for agendamento_id in agendamento_ids[start:start + _LIMITE_FILTRO_IN]]
+        query = db_instance.collection_group('metas_associadas')\
+            .where(filter=FieldFilter('ref_agendamentos', 'in', refs))
+        for doc in query.stream():
+            associations[doc.reference.parent.parent.id].append(doc)
+    return associations
+
+register_query('planejamento.associacoes_da_meta', 'clinicas/{clinica_id}/agendamentos/{agendamento_id}/metas_associadas',
+               equality=('meta_id',))
+
+def _goal_associations(db_instance, clinica_id, agendamento_id, meta_id):
+    """Associações da meta ao agendamento, no formato novo (ID da meta) ou antigo (ID automático)."""
+    return list(_clinica_ref(db_instance, clinica_id).collection('agendamentos').document(agendamento_id)
+                .collection('metas_associadas').where(filter=FieldFilter('meta_id', '==', meta_id)).stream())
+
+def associate_goal(db_instance, clinica_id, agendamento_id, meta_id, meta_nome, pei_id, pei_title):
+    """
+    Associa uma meta a um agendamento. Retorna False se ela já estava associada (inclusive por uma
+    associação antiga com ID automático, que não é duplicada).
+    """
+    if _goal_associations(db_instance, clinica_id, agendamento_id, meta_id):
+        return False
+    try:
+        association_ref(db_instance, clinica_id, agendamento_id, meta_id).create(
+            association_data(db_instance, clinica_id, agendamento_id, meta_id, meta_nome, pei_id, pei_title))
+    except google_exceptions.AlreadyExists:
+        return False
+    return True
+
+def dissociate_goal(db_instance, clinica_id, agendamento_id, meta_id):
+    """Remove a meta do agendamento (associações no formato novo e antigas). Retorna quantas foram apagadas."""
+    docs = _goal_associations(db_instance, clinica_id, agendamento_id, meta_id)
+    _commit(db_instance, [('delete', doc.reference, None) for doc in docs])
+    return len(docs)
+
+def _commit(db_instance, operations):
+    for start in range(0, len(operations), ASSOCIACOES_BATCH_SIZE):
+        batch = db_instance.batch()
+        for op, ref, data in operations[start:start + ASSOCIACOES_BATCH_SIZE]:
+            if op == 'set':
+                batch.set(ref, data)
+            else:
+                batch.delete(ref)
+        batch.commit()
+
+def save_week_associations(db_instance, clinica_id, desired):
+    """
+    Aplica o conjunto de associações desejado para cada agendamento informado.
+    desired: {agendamento_id: [{'meta_id', 'meta_nome', 'pei_id'}, ...]}; agendamentos fora do
+    dicionário não são alterados, e uma lista vazia remove todas as metas do agendamento.
+    O estado atual é lido de uma vez, comparado com o desejado, e só as diferenças são gravadas.
+    Retorna {'adicionadas': n, 'removidas': n, 'inalteradas': n}.
+    """
+    current = load_associations(db_instance, clinica_id, desired.keys())
+    titles = pei_titles(db_instance, clinica_id, {meta['pei_id'] for metas in desired.values() for meta in metas})
+
+    operations = []
+    summary = {'adicionadas': 0, 'removidas': 0, 'inalteradas': 0}
+    for agendamento_id, metas in desired.items():
+        wanted = {
+            meta['meta_id']: association_data(db_instance, clinica_id, agendamento_id, meta['meta_id'], meta['meta_nome'],
+                                              meta['pei_id'], titles.get(meta['pei_id'], 'PEI não encontrado'))
+            for meta in metas
+        }
+        for doc in current.get(agendamento_id, []):
+            existing = doc.to_dict() or {}
+            data = wanted.get(doc.id)
+            if data and all(existing.get(campo) == data[campo] for campo in _CAMPOS_COMPARADOS):
+                del wanted[doc.id]
+                summary['inalteradas'] += 1
+            elif not data:
+                # Removida, ou no formato antigo (ID automático), que é regravada com o ID da meta
+                operations.append(('delete', doc.reference, None))
+                if existing.get('meta_id') not in wanted:
+                    summary['removidas'] += 1
+        for meta_id, data in wanted.items():
+            operations.append(('set', association_ref(db_instance, clinica_id, agendamento_id, meta_id), data))
+            summary['adicionadas'] += 1
+
+    _commit(db_instance, operations)
+    return summary
+
+
+# =================================================================
+# MONTAGEM DO PLANEJAMENTO SEMANAL
+# =================================================================
+#
+# A página é montada em duas partes:
+#   - contexto (não depende da semana): logo da clínica, profissional do usuário, paciente,
+#     árvore de metas ativas e lista de profissionais. As leituras independentes rodam em
+#     paralelo e o resultado fica em cache por paciente/usuário;
+#   - semana: consulta dos agendamentos e, em seguida, das metas associadas (grupo de coleções).
+# Navegar entre semanas reaproveita o contexto e só faz as leituras da semana.
+
+def _convert_doc_references_to_paths(data):
+    if isinstance(data, dict):
+        return {k: _convert_doc_references_to_paths(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_convert_doc_references_to_paths(elem) for elem in data]
+    if isinstance(data, firestore.DocumentReference):
+        return data.path
+    return data
+
+def _read_clinic_logo(db_instance, clinica_id):
+    clinica_doc = db_instance.collection('clinicas').document(clinica_id).get(field_paths=['url_logo'])
+    return (clinica_doc.to_dict() or {}).get('url_logo', '') if clinica_doc.exists else ''
+
+def _read_user_professional_id(db_instance, user_uid):
+    user_doc = db_instance.collection('User').document(user_uid).get(field_paths=['profissional_id'])
+    return (user_doc.to_dict() or {}).get('profissional_id') if user_doc.exists else None
+
+def _read_professionals(db_instance, clinica_id):
+    professionals = []
+    for prof_doc in db_instance.collection('clinicas').document(clinica_id).collection('profissionais').stream():
+        prof_data = convert_doc_to_dict(prof_doc)
+        if prof_data:
+            prof_data['id'] = prof_doc.id
+            professionals.append(prof_data)
+    return professionals
+
+def _active_goals(db_instance, clinica_id, paciente_id, profissional_id):
+    """Metas ativas dos PEIs ativos do paciente (sem as ajudas), no formato usado pelo template."""
+    repository = PeiRepository(db_instance, clinica_id)
+    pei_docs = list(repository.query_for_patient(paciente_id, professional_id=profissional_id, status='Ativo').stream())
+    trees = repository.get_trees(pei_docs, include_aids=False)
+    metas_ativas = []
+    for pei_doc in pei_docs:
+        pei_title = (pei_doc.to_dict() or {}).get('titulo', 'PEI sem Título')
+        for meta in trees.get(pei_doc.id, []):
+            if meta.get('status') == 'Ativo':
+                meta_data = {k: v for k, v in meta.items() if k != 'alvos'}
+                meta_data['pei_id'] = pei_doc.id
+                meta_data['pei_title'] = pei_title
+                meta_data['alvos'] = [
+                    {k: v for k, v in alvo.items() if k != 'ajudas'} for alvo in meta.get('alvos', [])
+                ]
+                metas_ativas.append(_convert_doc_references_to_paths(meta_data))
+    return metas_ativas
+
+def load_planner_context(db_instance, clinica_id, paciente_id, user_uid, is_admin):
+    """
+    Parte do planejamento que não depende da semana (ver acima), com cache.
+    Retorna None se o paciente não existe; levanta PlannerAccessError se o usuário não é admin
+    e não tem perfil de profissional.
+    """
+    key = (clinica_id, paciente_id, user_uid)
+    version = pei_version(clinica_id)
+    now = time.monotonic()
+    with _planner_cache_lock:
+        cached = _planner_cache.get(key)
+        if cached and cached[0] == version and cached[1] > now:
+            return cached[2]
+
+    patient_ref = db_instance.collection('clinicas').document(clinica_id).collection('pacientes').document(paciente_id)
+    with ThreadPoolExecutor(max_workers=PLANEJAMENTO_MAX_WORKERS) as executor:
+        logo_future = executor.submit(_read_clinic_logo, db_instance, clinica_id)
+        patient_future = executor.submit(patient_ref.get)
+        professionals_future = executor.submit(_read_professionals, db_instance, clinica_id) if is_admin else None
+        profissional_id = None
+        if not is_admin:
+            profissional_id = _read_user_professional_id(db_instance, user_uid)
+            if not profissional_id:
+                raise PlannerAccessError("Sua conta de usuário não está associada a um perfil de profissional. Contate o administrador.")
+        # A árvore de metas depende do profissional (filtro dos PEIs); as outras leituras já estão em andamento
+        goals_future = executor.submit(_active_goals, db_instance, clinica_id, paciente_id, profissional_id)
+
+        patient_doc = patient_future.result()
+        if not patient_doc.exists:
+            return None
+        try:
+            url_logo = logo_future.result()
+        except Exception as e:
+            print(f"Erro ao carregar URL da logo da clínica: {e}")
+            url_logo = ''
+        context = {
+            'url_logo': url_logo,
+            'patient': convert_doc_to_dict(patient_doc),
+            'profissional_id_logado': profissional_id,
+            'metas_ativas': goals_future.result(),
+            'professionals': professionals_future.result() if professionals_future else [],
+        }
+
+    context['profissional_nome_logado'] = resolve_professional_names(
+        db_instance, clinica_id, [profissional_id]).get(profissional_id, 'N/A') if profissional_id else 'N/A'
+    with _planner_cache_lock:
+        for stale in [k for k, v in _planner_cache.items() if v[1] <= now or (k[0] == clinica_id and v[0] != version)]:
+            _planner_cache.pop(stale, None)
+        _planner_cache[key] = (version, now + PLANEJAMENTO_CACHE_TTL, context)
+    return context
+
+register_query('planejamento.agendamentos_da_semana', 'clinicas/{clinica_id}/agendamentos',
+               equality=('paciente_id', 'profissional_id'), range_fields=('data_agendamento_ts',),
+               order_by=('data_agendamento_ts', 'hora_agendamento'), optional=('profissional_id',))
+
+def load_week(db_instance, clinica_id, paciente_id, start_date, end_date, profissional_id=None, pei_titles_known=None):
+    """
+    Agendamentos do paciente no intervalo, com as metas associadas e o nome do profissional.
+    pei_titles_known: {pei_id: título} já conhecidos (para associações antigas sem o título gravado).
+    """
+    query = db_instance.collection('clinicas').document(clinica_id).collection('agendamentos')\
+        .where(filter=FieldFilter('paciente_id', '==', paciente_id))\
+        .where(filter=FieldFilter('data_agendamento_ts', '>=', start_date))\
+        .where(filter=FieldFilter('data_agendamento_ts', '<=', end_date))
+    if profissional_id:
+        query = query.where(filter=FieldFilter('profissional_id', '==', profissional_id))
+
+    agendamentos = []
+    for ag_doc in query.order_by('data_agendamento_ts').order_by('hora_agendamento').stream():
+        ag_data = convert_doc_to_dict(ag_doc)
+        if ag_data:
+            ag_data['id'] = ag_doc.id
+            if ag_data.get('data_agendamento_ts'):
+                ag_data['data_formatada'] = ag_data['data_agendamento_ts'].strftime('%d/%m/%Y')
+            agendamentos.append(ag_data)
+    if not agendamentos:
+        return []
+
+    # Metas associadas (uma consulta de grupo de coleções) e nomes dos profissionais (cache) em paralelo
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        associations_future = executor.submit(load_associations, db_instance, clinica_id, [ag['id'] for ag in agendamentos])
+        names_future = executor.submit(resolve_professional_names, db_instance, clinica_id,
+                                       [ag.get('profissional_id') for ag in agendamentos])
+        associations = {
+            agendamento_id: [data for data in map(convert_doc_to_dict, docs) if data]
+            for agendamento_id, docs in associations_future.result().items()
+        }
+        professional_names = names_future.result()
+
+    # Associações antigas não têm o título do PEI: usa os já conhecidos e lê os demais em lote
+    titles = dict(pei_titles_known or {})
+    missing = {meta.get('pei_id') for metas in associations.values() for meta in metas if not meta.get('pei_title')} - set(titles)
+    titles.update(pei_titles(db_instance, clinica_id, missing))
+
+    for index, ag_data in enumerate(agendamentos):
+        ag_data['metas_associadas'] = []
+        for meta_assoc_data in associations.get(ag_data['id'], []):
+            if not meta_assoc_data.get('pei_title'):
+                meta_assoc_data['pei_title'] = titles.get(meta_assoc_data.get('pei_id'), 'PEI não encontrado')
+            ag_data['metas_associadas'].append(meta_assoc_data)
+        if ag_data.get('profissional_id'):
+            ag_data['profissional_nome'] = professional_names.get(ag_data['profissional_id'], 'Desconhecido')
+        else:
+            ag_data['profissional_nome'] = 'Não Atribuído'
+        # Converte referências de documentos para caminhos para envio ao template
+        agendamentos[index] = _convert_doc_references_to_paths(ag_data)
+    return agendamentos